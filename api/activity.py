@@ -0,0 +1,136 @@
+"""
+Per-member activity counters.
+
+``Member.message_count`` and ``Member.last_message_at`` are denormalized so
+that profiles and the top-posters list read one row per member instead of
+counting ``messages``. Every insert path calls ``record_posts`` inside its
+own transaction, so a counter commits or rolls back with the messages it
+counts; the update is relative (``F() + n``), so concurrent posts by the
+same member never lose an increment. Deleting a message goes through
+``record_delete`` the same way. Archiving moves messages without touching
+the counters: they count the whole history.
+
+Nothing else keeps them in step (raw SQL, fixtures, a crash between
+releases that changed the rules), so ``manage.py reconcile_member_counters``
+recomputes them from ``messages`` and ``message_archive_authors`` in bulk
+and only rewrites the rows that drifted.
+"""
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce, Greatest
+
+from .models import Member, Message, MessageArchiveAuthor
+
+TOP_POSTERS_LIMIT = 10
+TOP_POSTERS_MAX_LIMIT = 100
+
+# Recount members with ids in [low, high]. Both aggregates are read from
+# indexes keyed by author, and rows that already match are left alone.
+RECONCILE_SQL = """
+UPDATE members SET message_count = totals.count, last_message_at = totals.last
+FROM (
+    SELECT m.id AS member_id,
+           COALESCE(hot.count, 0) + COALESCE(cold.count, 0) AS count,
+           MAX(COALESCE(hot.last, cold.last), COALESCE(cold.last, hot.last)) AS last
+    FROM members m
+    LEFT JOIN (
+        SELECT author_id, COUNT(*) AS count, MAX(created_at) AS last
+        FROM messages WHERE author_id BETWEEN %s AND %s GROUP BY author_id
+    ) hot ON hot.author_id = m.id
+    LEFT JOIN (
+        SELECT author_id, SUM(count) AS count, MAX(last_created_at) AS last
+        FROM message_archive_authors WHERE author_id BETWEEN %s AND %s GROUP BY author_id
+    ) cold ON cold.author_id = m.id
+    WHERE m.id BETWEEN %s AND %s
+) AS totals
+WHERE members.id = totals.member_id
+  AND (members.message_count != totals.count OR members.last_message_at IS NOT totals.last)
+"""
+
+
+def record_posts(messages):
+    """
+    Count newly inserted ``messages`` towards their authors. Call it in the
+    transaction that inserted them; it issues one UPDATE per author.
+    """
+    posted = defaultdict(lambda: [0, None])
+    for message in messages:
+        totals = posted[message.author_id]
+        totals[0] += 1
+        if totals[1] is None or message.created_at > totals[1]:
+            totals[1] = message.created_at
+    for author_id, (count, last) in posted.items():
+        # No save(): the counters must not bump updated_at, which drives the
+        # message list validators, nor evict the member from caches.
+        Member.objects.filter(pk=author_id).update(
+            message_count=F('message_count') + count,
+            last_message_at=Greatest(Coalesce('last_message_at', Value(last)), Value(last)),
+        )
+
+
+def record_delete(message):
+    """
+    Uncount a deleted message, in the transaction that deleted it. When it
+    was the author's newest, ``last_message_at`` falls back to the next one.
+    """
+    # The archive is older than every hot message, so it only matters
+    # once the author has none left in the hot table.
+    hot = Message.objects.filter(author_id=OuterRef('pk')).order_by('-created_at').values('created_at')[:1]
+    archived = MessageArchiveAuthor.objects.filter(author_id=OuterRef('pk')).order_by(
+        '-last_created_at'
+    ).values('last_created_at')[:1]
+    Member.objects.filter(pk=message.author_id).update(
+        # Never below zero, even if the counter has drifted.
+        message_count=Greatest(F('message_count') - 1, Value(0)),
+        last_message_at=Coalesce(Subquery(hot), Subquery(archived)),
+    )
+
+
+def load_counters(member):
+    """Refresh the counters of a (possibly cached) member with one PK lookup."""
+    member.message_count, member.last_message_at = (
+        Member.objects.filter(pk=member.pk).values_list('message_count', 'last_message_at').get()
+    )
+    return member
+
+
+async def aload_counters(member):
+    """``load_counters`` through the async ORM."""
+    member.message_count, member.last_message_at = (
+        await Member.objects.filter(pk=member.pk).values_list(
+            'message_count', 'last_message_at'
+        ).aget()
+    )
+    return member
+
+
+def top_posters(limit=TOP_POSTERS_LIMIT):
+    """The members with the most messages, read in order from their index."""
+    return (
+        Member.objects.filter(message_count__gt=0)
+        .order_by('-message_count', 'id')
+        .only('id', 'username', 'message_count', 'last_message_at')[:limit]
+    )
+
+
+def reconcile(batch_size=1000):
+    """
+    Recompute every member's counters, ``batch_size`` members per short
+    transaction; return how many members were corrected.
+    """
+    fixed = 0
+    last_id = 0
+    while True:
+        ids = list(
+            Member.objects.filter(pk__gt=last_id).order_by('pk')
+            .values_list('pk', flat=True)[:batch_size]
+        )
+        if not ids:
+            return fixed
+        low, high = ids[0], ids[-1]
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(RECONCILE_SQL, [low, high] * 3)
+            fixed += cursor.rowcount
+        last_id = high
@@ -0,0 +1,342 @@
+"""
+Hot/cold message retention.
+
+``manage.py archive_messages``, run daily by ``manage.py run_maintenance``
+(``MAINTENANCE_SCHEDULE``), moves messages older than
+``MESSAGE_RETENTION['HOT_DAYS']`` out of ``messages`` into
+``MessageArchiveChunk`` rows, room by room. Each chunk is a zlib-compressed
+JSON array of up to ``CHUNK_SIZE`` messages from one room and calendar
+month, with its keyset bounds, row count and a SHA-256 of the uncompressed
+payload. A batch of ``BATCH_SIZE`` messages is one ``DELETE ... RETURNING``
+plus its chunk inserts in a short transaction, so writers wait for one
+batch at most, and two archivers cannot move the same rows. The newest
+``MIN_HOT`` messages of each room are never archived, which keeps its
+first pages, its latest-messages cache entry and its ETag head in
+``messages``.
+
+Each room's messages are archived oldest first, so its archive is always a
+prefix of its history in (created_at, id) order. The paginators rely on
+this to read through: a page that runs out of hot rows continues with the
+newest archived ones (``older_than``), and a cursor inside the archive
+reads forward into it before the hot table (``newer_than``). ``History``
+does the same for page numbers.
+
+Authors are not archived: they are joined from ``members`` on read, and
+messages of deleted members are skipped. Each chunk lists its authors with
+their message counts in ``MessageArchiveAuthor``, so a member's history
+only opens the chunks that hold their messages, and ``api.activity`` can
+recount members without decompressing anything.
+
+Messages keep the HTML they were rendered to (see api.rendering). Chunks
+archived before messages were rendered have only the text; they are
+rendered on read until ``manage.py render_messages`` rewrites them.
+
+Archived messages leave the search index with ``messages``; searches cover
+the hot window only and say so (see api.search).
+"""
+import bisect
+import hashlib
+import itertools
+import json
+import zlib
+from collections import namedtuple
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q, Sum
+from django.utils import timezone
+
+from . import changes, rooms
+from .models import Member, MessageArchiveAuthor, MessageArchiveChunk
+from .readpath import MESSAGE_FIELDS
+
+ArchivedRow = namedtuple('Row', MESSAGE_FIELDS)
+
+COMPRESSION_LEVEL = 6
+
+
+def encode_payload(rows):
+    """
+    Return ``(payload, checksum)`` for ``[id, author_id, created_at, text,
+    rendered_html, renderer_version]`` rows.
+    """
+    raw = json.dumps(rows, ensure_ascii=False, separators=(',', ':')).encode()
+    return zlib.compress(raw, COMPRESSION_LEVEL), hashlib.sha256(raw).hexdigest()
+
+
+def decode_payload(payload):
+    """Return ``(rows, checksum)`` for a chunk payload."""
+    raw = zlib.decompress(payload)
+    return json.loads(raw), hashlib.sha256(raw).hexdigest()
+
+
+def parse_created_at(value):
+    return datetime.fromisoformat(value).replace(tzinfo=dt_timezone.utc)
+
+
+def month(created_at):
+    return created_at.date().replace(day=1)
+
+
+def chunked(rows, size):
+    """Split sorted payload rows into runs of at most ``size`` from one month."""
+    for _, group in itertools.groupby(rows, key=lambda row: row[2][:7]):
+        group = list(group)
+        for start in range(0, len(group), size):
+            yield group[start:start + size]
+
+
+def hot_bounds(room_id, hot_days=None):
+    """
+    Return ``(cutoff, keep)`` for a room: its messages older than both the
+    cutoff time and the ``(created_at, id)`` key ``keep`` may be archived.
+    ``keep`` is None when the room has no more than ``MIN_HOT`` messages.
+    """
+    from .pagination import MessagesCursorPagination, MessagesPagination
+
+    retention = settings.MESSAGE_RETENTION
+    if hot_days is None:
+        hot_days = retention['HOT_DAYS']
+    cutoff = timezone.now() - timedelta(days=hot_days)
+    # Enough hot messages for every first page and the latest-messages cache.
+    min_hot = max(
+        retention['MIN_HOT'],
+        settings.LATEST_MESSAGES_CACHE['SIZE'],
+        MessagesPagination.max_page_size + 1,
+        MessagesCursorPagination.max_page_size + 1,
+    )
+    keep = (
+        rooms.messages(room_id).order_by('-created_at', '-id')
+        .values_list('created_at', 'id')[min_hot - 1:min_hot].first()
+    )
+    return cutoff, keep
+
+
+def archive_batch(room_id, cutoff, keep, size):
+    """Move up to ``size`` of a room's oldest archivable messages; return how many."""
+    if keep is None:
+        return 0
+    using = rooms.database(room_id)
+    connection = connections[using]
+    adapt = connection.ops.adapt_datetimefield_value
+    # Moving messages is not a change to them: keep it out of the change feed.
+    with transaction.atomic(using=using), changes.paused('archive', using), connection.cursor() as cursor:
+        # Deleting first takes the write lock before anything is read.
+        cursor.execute(
+            """
+            DELETE FROM messages WHERE id IN (
+                SELECT id FROM messages
+                WHERE room_id = %s
+                  AND created_at < %s AND created_at <= %s AND (created_at < %s OR id < %s)
+                ORDER BY created_at, id
+                LIMIT %s
+            )
+            RETURNING id, author_id, created_at, text, rendered_html, renderer_version
+            """,
+            [room_id, adapt(cutoff), adapt(keep[0]), adapt(keep[0]), keep[1], size]
+        )
+        rows = [
+            [pk, author_id, created_at.isoformat(timespec='microseconds'), *rest]
+            for pk, author_id, created_at, *rest in cursor.fetchall()
+        ]
+        rows.sort(key=row_key)
+        for group in chunked(rows, settings.MESSAGE_RETENTION['CHUNK_SIZE']):
+            payload, checksum = encode_payload(group)
+            first, last = group[0], group[-1]
+            chunk = MessageArchiveChunk.objects.using(using).create(
+                room_id=room_id,
+                bucket=month(parse_created_at(first[2])),
+                first_created_at=parse_created_at(first[2]),
+                first_id=first[0],
+                last_created_at=parse_created_at(last[2]),
+                last_id=last[0],
+                count=len(group),
+                checksum=checksum,
+                payload=payload,
+            )
+            MessageArchiveAuthor.objects.using(using).bulk_create(
+                MessageArchiveAuthor(
+                    chunk=chunk,
+                    author_id=author_id,
+                    count=count,
+                    last_created_at=parse_created_at(created_at),
+                )
+                for author_id, (count, created_at) in chunk_authors(group).items()
+            )
+    return len(rows)
+
+
+def chunk_authors(rows):
+    """``{author_id: [count, newest created_at]}`` for sorted payload rows."""
+    authors = {}
+    for _, author_id, created_at, *_ in rows:
+        totals = authors.setdefault(author_id, [0, created_at])
+        totals[0] += 1
+        totals[1] = created_at
+    return authors
+
+
+def archived_count(room_id):
+    return archive_chunks(room_id).aggregate(total=Sum('count'))['total'] or 0
+
+
+def chunk_rows(chunk, descending=False, after=None, before=None, author_id=None):
+    """
+    The payload rows of a chunk strictly between the stored keys ``after``
+    and ``before``, optionally only those by ``author_id``.
+    """
+    rows, _ = decode_payload(chunk.payload)
+    start = 0 if after is None else bisect.bisect_right(rows, after, key=row_key)
+    stop = len(rows) if before is None else bisect.bisect_left(rows, before, key=row_key)
+    rows = rows[start:stop]
+    if author_id is not None:
+        rows = [row for row in rows if row[1] == author_id]
+    if descending:
+        rows.reverse()
+    return rows
+
+
+def row_key(row):
+    return row[2], row[0]
+
+
+def with_authors(rows):
+    """Build ``ArchivedRow``s for payload rows."""
+    authors = {
+        author[0]: author for author in Member.objects.filter(
+            id__in={row[1] for row in rows}
+        ).values_list('id', 'username', 'email', 'created_at')
+    }
+    return [
+        ArchivedRow(pk, text, *rendered, parse_created_at(created_at), author_id, *authors[author_id][1:])
+        for pk, author_id, created_at, text, *rendered in map(rendered_row, rows)
+        if author_id in authors
+    ]
+
+
+def rendered_row(row):
+    """A payload row, as never rendered if it was archived without its HTML."""
+    return row if len(row) > 4 else [*row, '', 0]
+
+
+def stored(created_at):
+    """``created_at`` as it is stored in payloads: naive UTC, to the microsecond."""
+    return created_at.astimezone(dt_timezone.utc).replace(tzinfo=None).isoformat(timespec='microseconds')
+
+
+def archive_chunks(room_id, author_id=None):
+    """A room's chunks, or only those holding messages by ``author_id``."""
+    chunks = MessageArchiveChunk.objects.using(rooms.database(room_id)).filter(room_id=room_id)
+    if author_id is not None:
+        chunks = chunks.filter(authors__author_id=author_id)
+    return chunks
+
+
+def older_than(room_id, key, limit, author_id=None):
+    """
+    Up to ``limit`` archived messages of a room (by ``author_id``, if
+    given) before ``key`` or the newest, newest first.
+    """
+    chunks = archive_chunks(room_id, author_id).order_by('-first_created_at', '-first_id')
+    if key is None:
+        return take(chunks, limit, True, author_id=author_id)
+    created_at, pk = key
+    chunks = chunks.filter(
+        Q(first_created_at__lte=created_at)
+        & (Q(first_created_at__lt=created_at) | Q(first_id__lt=pk))
+    )
+    return take(chunks, limit, True, before=(stored(created_at), pk), author_id=author_id)
+
+
+def newer_than(room_id, key, limit, author_id=None):
+    """
+    Up to ``limit`` archived messages of a room (by ``author_id``, if
+    given) after ``key``, oldest first.
+    """
+    created_at, pk = key
+    newest = archive_chunks(room_id, author_id).order_by('-first_created_at', '-first_id').values_list(
+        'last_created_at', 'last_id'
+    ).first()
+    if newest is None or newest <= key:
+        return []
+    # Start from the chunk holding the key: the one with the last first key before it.
+    start = archive_chunks(room_id).order_by('-first_created_at', '-first_id').filter(
+        Q(first_created_at__lte=created_at)
+        & (Q(first_created_at__lt=created_at) | Q(first_id__lte=pk))
+    ).values_list('first_created_at', 'first_id').first()
+    chunks = archive_chunks(room_id, author_id).order_by('first_created_at', 'first_id')
+    if start is not None:
+        chunks = chunks.filter(
+            Q(first_created_at__gte=start[0])
+            & (Q(first_created_at__gt=start[0]) | Q(first_id__gte=start[1]))
+        )
+    return take(chunks, limit, False, after=(stored(created_at), pk), author_id=author_id)
+
+
+def take(chunks, limit, descending, after=None, before=None, author_id=None):
+    """The first ``limit`` rows of ``chunks`` between the keys, with authors."""
+    result, pending = [], []
+    chunks = chunks.iterator(chunk_size=2)
+    while len(result) < limit:
+        need = limit - len(result)
+        if len(pending) >= need:
+            # Messages of deleted members drop out here, so loop until full.
+            result.extend(with_authors(pending[:need]))
+            pending = pending[need:]
+            continue
+        chunk = next(chunks, None)
+        if chunk is None:
+            result.extend(with_authors(pending))
+            break
+        pending.extend(chunk_rows(chunk, descending, after, before, author_id))
+    return result
+
+
+def page(room_id, offset, limit):
+    """``limit`` archived messages from ``offset`` in a room's newest-first history."""
+    rows = []
+    chunks = archive_chunks(room_id).order_by('-first_created_at', '-first_id')
+    position = 0
+    for pk, count in chunks.values_list('id', 'count').iterator():
+        if position + count > offset:
+            skip = max(offset - position, 0)
+            chunk = archive_chunks(room_id).get(pk=pk)
+            rows.extend(chunk_rows(chunk, descending=True)[skip:skip + limit - len(rows)])
+            if len(rows) >= limit:
+                break
+        position += count
+    return with_authors(rows)
+
+
+class History:
+    """
+    A room's message history as a sequence for ``django.core.paginator``:
+    the newest-first ``queryset`` of its hot message rows followed by its
+    archive.
+    """
+
+    def __init__(self, queryset, room_id):
+        self.queryset = queryset
+        self.room_id = room_id
+        self.hot = None
+
+    def count(self):
+        self.hot = self.queryset.count()
+        return self.hot + archived_count(self.room_id)
+
+    async def acount(self):
+        return await sync_to_async(self.count)()
+
+    def __getitem__(self, index):
+        start, stop = index.start or 0, index.stop
+        if self.hot is None:
+            self.hot = self.queryset.count()
+        rows = list(self.queryset[start:stop]) if start < self.hot else []
+        if stop > self.hot:
+            rows.extend(page(self.room_id, max(start - self.hot, 0), stop - max(start, self.hot)))
+        return rows
+
+    async def aslice(self, start, stop):
+        return await sync_to_async(self.__getitem__)(slice(start, stop))
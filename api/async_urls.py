@@ -0,0 +1,20 @@
+from django.urls import path
+from .async_views import (
+    RegisterView,
+    LoginView,
+    CurrentUserView,
+    ProfileView,
+    MessagesView,
+    MessageChangesView
+)
+
+urlpatterns = [
+    path("auth/register/", RegisterView.as_view(), name="auth-register"),
+    path("auth/login/", LoginView.as_view(), name="auth-login"),
+    path("auth/me/", CurrentUserView.as_view(), name="auth-me"),
+    path("profile/", ProfileView.as_view(), name="profile"),
+    path("messages/", MessagesView.as_view(), name="messages"),
+    path("messages/changes/", MessageChangesView.as_view(), name="messages-changes"),
+    path("rooms/<int:room_id>/messages/", MessagesView.as_view(), name="room-messages"),
+    path("rooms/<int:room_id>/changes/", MessageChangesView.as_view(), name="room-changes"),
+]
@@ -0,0 +1,395 @@
+"""
+Async handlers for the hot API endpoints.
+
+The ASGI deployment (``config/asgi.py``) routes through ``config.urls_async``,
+which serves these views at the same URLs as their DRF counterparts in
+``api.views``, with the same status codes and payloads. Database access goes
+through Django's async ORM, password hashing through the bounded pool in
+``api.hashing``, and long-polls park a future on the notification hub rather
+than a thread.
+
+DRF 3.16 has no async ``APIView``, so ``AsyncAPIView`` is a plain Django view
+that reuses DRF's ``Request`` for parsing and content negotiation, the same
+renderers, and DRF's ``{"detail": ...}`` body for ``APIException``.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework import status
+from rest_framework.exceptions import APIException, MethodNotAllowed, NotAcceptable
+from rest_framework.negotiation import DefaultContentNegotiation
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from . import activity, changes, rendering, rooms
+from .attachments import AttachmentsUnavailable
+from .authentication import aauthenticate
+from .batching import WriteQueueFull
+from .conditional import (
+    amessages_head,
+    member_validators,
+    messages_validators,
+    not_modified,
+    profile_validators,
+    set_validators
+)
+from .events import message_created
+from .hashing import HashingBusy, acheck_password, amake_password
+from .latest import latest_messages
+from .models import Member, Room
+from .notify import change_hub, hub
+from .readpath import message_rows
+from .renderers import FastJSONRenderer, MessagePackRenderer
+from .serializers import (
+    AttachmentSerializer,
+    LoginSerializer,
+    MemberSerializer,
+    MessageChangesSerializer,
+    MessageCreateSerializer,
+    ProfileSerializer,
+    ProfileUpdateSerializer,
+    RegisterSerializer
+)
+from .views import MessageListMixin
+
+
+class AsyncAPIView(View):
+    """Base class for the async views: negotiation, parsing and rendering."""
+    renderer_classes = [FastJSONRenderer]
+    parser_classes = api_settings.DEFAULT_PARSER_CLASSES
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Session authentication without CSRF checks, like APIView.
+        return csrf_exempt(super().as_view(**initkwargs))
+
+    async def dispatch(self, request, *args, **kwargs):
+        request = Request(request, parsers=[parser() for parser in self.parser_classes])
+        renderers = [renderer() for renderer in self.renderer_classes]
+        try:
+            request.accepted_renderer, request.accepted_media_type = (
+                DefaultContentNegotiation().select_renderer(request, renderers)
+            )
+        except NotAcceptable as exc:
+            request.accepted_renderer = renderers[0]
+            request.accepted_media_type = renderers[0].media_type
+            return self.render(request, {'detail': exc.detail}, exc.status_code)
+
+        try:
+            response = await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            response = self.render(request, {'detail': exc.detail}, exc.status_code)
+        response['Allow'] = ', '.join(self._allowed_methods())
+        if len(renderers) > 1:
+            patch_vary_headers(response, ['Accept'])
+        return response
+
+    def http_method_not_allowed(self, request, *args, **kwargs):
+        raise MethodNotAllowed(request.method)
+
+    def render(self, request, data, status=status.HTTP_200_OK, headers=None):
+        renderer = request.accepted_renderer
+        content = renderer.render(data, request.accepted_media_type, {'request': request})
+        response = HttpResponse(content, status=status, content_type=renderer.media_type)
+        for name, value in (headers or {}).items():
+            response[name] = value
+        return response
+
+    def error(self, request, message, status, details=None, headers=None):
+        """Render the API's ``{"error": ..., "details": ...}`` error body."""
+        return self.render(
+            request,
+            {"error": message, "details": details or {}},
+            status=status,
+            headers=headers,
+        )
+
+    def authentication_required(self, request):
+        return self.error(request, "Authentication required", status.HTTP_401_UNAUTHORIZED)
+
+    def room_error(self, request, access):
+        """404 or 403 for a room the member may not use, else None."""
+        if access == rooms.NOT_FOUND:
+            return self.error(request, "Room not found", status.HTTP_404_NOT_FOUND)
+        if access == rooms.NOT_MEMBER:
+            return self.error(request, "Join the room first", status.HTTP_403_FORBIDDEN)
+        return None
+
+    def server_busy(self, request):
+        return self.error(
+            request,
+            "Server is busy, retry shortly",
+            status.HTTP_503_SERVICE_UNAVAILABLE,
+            headers={"Retry-After": "1"}
+        )
+
+
+class RegisterView(AsyncAPIView):
+    """Async ``api.views.RegisterView``."""
+
+    async def post(self, request):
+        serializer = RegisterSerializer(data=request.data)
+
+        # Field validation checks username and email uniqueness in the DB.
+        if not await sync_to_async(serializer.is_valid)():
+            return self.error(
+                request, "Validation failed", status.HTTP_400_BAD_REQUEST, serializer.errors
+            )
+
+        data = serializer.validated_data
+        member = Member(username=data['username'], email=data['email'])
+        try:
+            member.password_hash = await amake_password(data['password'])
+        except (HashingBusy, TimeoutError):
+            return self.server_busy(request)
+        await member.asave()
+
+        return self.render(
+            request,
+            {
+                "message": "User registered successfully",
+                "user": MemberSerializer(member).data
+            },
+            status=status.HTTP_201_CREATED
+        )
+
+
+class CredentialsSerializer(LoginSerializer):
+    """``LoginSerializer`` field validation only; LoginView checks the password."""
+
+    def validate(self, attrs):
+        return attrs
+
+
+class LoginView(AsyncAPIView):
+    """Async ``api.views.LoginView``."""
+
+    async def post(self, request):
+        serializer = CredentialsSerializer(data=request.data)
+
+        member = None
+        if serializer.is_valid():
+            email = serializer.validated_data['email']
+            password = serializer.validated_data['password']
+            candidate = await Member.objects.filter(email=email).afirst()
+            try:
+                if await acheck_password(candidate, password):
+                    member = candidate
+            except (HashingBusy, TimeoutError):
+                return self.server_busy(request)
+
+        if member is None:
+            return self.error(
+                request,
+                "Invalid credentials",
+                status.HTTP_400_BAD_REQUEST,
+                {"non_field_errors": serializer.errors.get(
+                    'non_field_errors', ['Invalid email or password']
+                )}
+            )
+
+        # Store member ID in session
+        await request.session.aset('member_id', member.id)
+        await request.session.asave()
+
+        return self.render(
+            request,
+            {
+                "message": "Login successful",
+                "user": MemberSerializer(member).data
+            }
+        )
+
+
+class CurrentUserView(AsyncAPIView):
+    """Async ``api.views.CurrentUserView``."""
+
+    async def get(self, request):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        etag, last_modified = member_validators(member)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        response = self.render(request, MemberSerializer(member).data)
+        return set_validators(response, etag, last_modified)
+
+
+class ProfileView(CurrentUserView):
+    """Async ``api.views.ProfileView``."""
+
+    async def get(self, request):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        await activity.aload_counters(member)
+        etag, last_modified = profile_validators(member)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        response = self.render(request, ProfileSerializer(member).data)
+        return set_validators(response, etag, last_modified)
+
+    async def put(self, request):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        serializer = ProfileUpdateSerializer(member, data=request.data, partial=True)
+
+        # Validation checks uniqueness in the DB; saving fires the member
+        # signals (cache invalidation), so both run in a worker thread.
+        if not await sync_to_async(serializer.is_valid)():
+            return self.error(
+                request, "Validation failed", status.HTTP_400_BAD_REQUEST, serializer.errors
+            )
+        await sync_to_async(serializer.save)()
+        await activity.aload_counters(member)
+
+        return self.render(request, ProfileSerializer(member).data)
+
+
+class MessagesView(MessageListMixin, AsyncAPIView):
+    """Async ``api.views.MessagesView``."""
+    renderer_classes = [FastJSONRenderer, MessagePackRenderer]
+
+    async def wait_for_messages(self, request, room_id, compact, fields):
+        after_id, wait, limit, errors = self.get_wait_params(request)
+        if errors:
+            return self.error(request, "Validation failed", status.HTTP_400_BAD_REQUEST, errors)
+
+        hub.listen(room_id)
+        messages = [row async for row in self.get_messages_after(room_id, after_id, limit)]
+        if not messages and wait and await hub.await_newer(room_id, after_id, wait):
+            messages = [row async for row in self.get_messages_after(room_id, after_id, limit)]
+        messages.reverse()
+        messages = await rendering.arefresh(messages)
+
+        return self.render(request, self.results_data(messages, compact, fields))
+
+    async def get(self, request, room_id=Room.GENERAL_ID):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        response = self.room_error(request, await rooms.aaccess(member, room_id))
+        if response is not None:
+            return response
+
+        compact, fields, errors = self.get_representation(request)
+        if errors:
+            return self.error(request, "Validation failed", status.HTTP_400_BAD_REQUEST, errors)
+
+        if 'after_id' in request.query_params:
+            return await self.wait_for_messages(request, room_id, compact, fields)
+
+        head = await amessages_head(room_id)
+        etag, last_modified = messages_validators(request, head)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+
+        response = await latest_messages.aresponse(request, room_id, head)
+        if response is not None:
+            return set_validators(response, etag, last_modified)
+
+        paginator = self.get_paginator(request, room_id)
+        messages = await paginator.apaginate_queryset(message_rows(rooms.messages(room_id)), request)
+        messages = await rendering.arefresh(messages)
+
+        results, authors = self.represent(messages, compact, fields)
+        data = paginator.get_paginated_response(results).data
+        if authors is not None:
+            data['authors'] = authors
+        return set_validators(self.render(request, data), etag, last_modified)
+
+    async def post(self, request, room_id=Room.GENERAL_ID):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        response = self.room_error(request, await rooms.aaccess(member, room_id))
+        if response is not None:
+            return response
+
+        serializer = MessageCreateSerializer(data=request.data)
+        if not serializer.is_valid():
+            return self.error(
+                request, "Validation failed", status.HTTP_400_BAD_REQUEST, serializer.errors
+            )
+
+        try:
+            data = await sync_to_async(self.create_message)(serializer, member, room_id)
+        except (WriteQueueFull, TimeoutError):
+            return self.server_busy(request)
+        except AttachmentsUnavailable:
+            return self.error(
+                request, "Validation failed", status.HTTP_400_BAD_REQUEST,
+                {"attachments": ["Attachments must be your own uploads, not posted yet."]}
+            )
+        return self.render(request, data, status=status.HTTP_201_CREATED)
+
+    @staticmethod
+    def create_message(serializer, member, room_id):
+        # Saving may wait on the group-commit writer, and publishing runs
+        # on-commit hooks, so this runs in a worker thread.
+        message = serializer.save(author=member, room_id=room_id)
+        data = message_created(message)
+        if serializer.validated_data.get('attachments'):
+            data['attachments'] = AttachmentSerializer(message.attachments.all(), many=True).data
+        return data
+
+
+class MessageChangesView(AsyncAPIView):
+    """The change feed; waiting parks a future instead of a thread."""
+
+    async def get(self, request, room_id=Room.GENERAL_ID):
+        member = await aauthenticate(request)
+        if member is None:
+            return self.authentication_required(request)
+
+        response = self.room_error(request, await rooms.aaccess(member, room_id))
+        if response is not None:
+            return response
+
+        serializer = MessageChangesSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return self.error(request, "Validation failed", status.HTTP_400_BAD_REQUEST, serializer.errors)
+
+        params = serializer.validated_data
+        since = params.get('since')
+        bounds = await sync_to_async(changes.bounds)(room_id)
+        latest = bounds[1] or 0
+        if since is None:
+            return self.render(request, changes.feed_page(latest, [], 0))
+        if changes.is_expired(since, bounds):
+            return self.error(
+                request,
+                "Change cursor expired, reload the messages",
+                status.HTTP_410_GONE,
+                {"seq": latest}
+            )
+        await sync_to_async(changes.cursor_tracker.acknowledge)(
+            member.id, room_id, params['client'], since
+        )
+
+        change_hub.listen(room_id)
+        seen = change_hub.latest_id(room_id)
+        limit = params['limit']
+        found = await sync_to_async(changes.changes_after)(room_id, since, limit + 1)
+        wait = min(params['wait'], settings.MESSAGES_LONGPOLL_MAX_WAIT)
+        if not found and wait and await change_hub.await_newer(room_id, seen, wait):
+            found = await sync_to_async(changes.changes_after)(room_id, since, limit + 1)
+
+        return self.render(
+            request, await sync_to_async(changes.feed_page)(since, found, limit, latest)
+        )
+
@@ -0,0 +1,472 @@
+"""
+Message attachments: resumable uploads, content-addressed storage,
+access-checked downloads and thumbnails.
+
+An upload starts with ``POST /api/uploads/`` declaring the file's name and
+size, and its bytes follow in any number of ``PATCH /api/uploads/<id>/``
+requests, each carrying the ``Upload-Offset`` it starts at. The body is
+read from the request stream ``BLOCK_SIZE`` bytes at a time and appended
+to a part file, so a request never holds more than a block in memory and
+nginx does not buffer it either (``proxy_request_buffering off``). An
+interrupted request keeps what arrived: ``GET /api/uploads/<id>/`` returns
+the offset to resume from. A flock on the part file lets one request at a
+time write to an upload, in any process.
+
+The SHA-256 of the file is computed while it streams in. hashlib cannot
+save a hash's state, so each process keeps the running hash of the
+uploads it is receiving (``RunningHashes``); when a resumed upload reaches
+a process that does not have it, the part file is hashed again up to the
+offset, once. When the last byte arrives the part file becomes the blob
+for its hash, or is dropped if that blob already exists, and an
+``Attachment`` row points to it.
+
+Attachments are posted with a message (``attachments`` in the message
+body) and readable by its room's members; an attachment not posted yet is
+only readable by its uploader. Downloads are checked here and answered with
+an ``X-Accel-Redirect`` to nginx's internal location for ``ROOT``, so nginx
+sends the bytes and no Python worker is held for them.
+
+Images get a thumbnail on a bounded pool of threads once their upload
+completes, like password hashing (see api.hashing), so the upload request
+does not wait for it. Thumbnails are stored per hash too, and need Pillow,
+which is optional: without it no thumbnails are made.
+"""
+import contextlib
+import fcntl
+import hashlib
+import mimetypes
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from functools import partial
+from pathlib import Path
+
+from django.conf import settings
+from django.db import transaction
+from django.http import FileResponse, HttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
+
+from . import rooms, stats
+from .models import Attachment, Upload
+
+try:
+    from PIL import Image
+except ImportError:  # Pillow is optional; there are no thumbnails without it.
+    Image = None
+
+BLOBS = 'blobs'
+THUMBNAILS = 'thumbnails'
+UPLOADS = 'uploads'
+
+# Formats thumbnails are made of, and content types browsers may render
+# inline from our origin; anything else is sent as a download.
+THUMBNAIL_FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+INLINE_TYPES = {'image/jpeg', 'image/png', 'image/gif', 'image/webp'}
+
+# A blob or thumbnail younger than this is never cleaned up, even if no
+# attachment refers to it: its attachment may be about to be created.
+CLEANUP_GRACE = timedelta(hours=1)
+
+
+class UploadConflict(Exception):
+    """The chunk does not start at the upload's offset, or another request is writing."""
+
+    def __init__(self, received):
+        super().__init__(received)
+        self.received = received
+
+
+class AttachmentsUnavailable(Exception):
+    """Some attachments to post are not the author's, or are attached already."""
+
+
+def root():
+    return Path(settings.ATTACHMENTS['ROOT'])
+
+
+def blob_path(sha256):
+    return root() / BLOBS / sha256[:2] / sha256[2:4] / sha256
+
+
+def thumbnail_path(sha256):
+    return root() / THUMBNAILS / sha256[:2] / f'{sha256}.jpg'
+
+
+def part_path(upload_id):
+    return root() / UPLOADS / f'{upload_id}.part'
+
+
+def guess_content_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+class RunningHashes:
+    """
+    The running SHA-256 of the uploads this process is receiving, keyed by
+    upload id with the offset they have hashed up to. Bounded, oldest out.
+    """
+
+    def __init__(self, size=256):
+        self.size = size
+        self._hashes = OrderedDict()
+        self._lock = threading.Lock()
+        self.rehashed = 0
+
+    def take(self, upload_id, offset, part):
+        """
+        Remove and return the hash of the first ``offset`` bytes of an upload,
+        reading them back from its open ``part`` file if this process does
+        not have it.
+        """
+        with self._lock:
+            entry = self._hashes.pop(upload_id, None)
+        if entry is not None and entry[0] == offset:
+            return entry[1]
+        hasher = hashlib.sha256()
+        part.seek(0)
+        remaining = offset
+        while remaining:
+            block = part.read(min(settings.ATTACHMENTS['BLOCK_SIZE'], remaining))
+            if not block:
+                raise UploadConflict(offset - remaining)
+            hasher.update(block)
+            remaining -= len(block)
+        with self._lock:
+            self.rehashed += 1
+        return hasher
+
+    def put(self, upload_id, offset, hasher):
+        with self._lock:
+            self._hashes[upload_id] = (offset, hasher)
+            while len(self._hashes) > self.size:
+                self._hashes.popitem(last=False)
+
+    def discard(self, upload_id):
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+
+
+running_hashes = RunningHashes()
+
+
+def start_upload(member, filename, size, content_type=''):
+    """Create an upload and its empty part file."""
+    upload = Upload.objects.create(
+        member=member,
+        filename=filename,
+        size=size,
+        content_type=content_type or guess_content_type(filename),
+    )
+    path = part_path(upload.pk)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.touch()
+    return upload
+
+
+def receive(upload, offset, stream, length):
+    """
+    Append ``length`` bytes read from ``stream`` to an upload at ``offset``.
+    Return the upload with its new ``received`` offset, and the attachment
+    it became if that was the last chunk.
+
+    Raises ``UploadConflict`` with the current offset when ``offset`` is not
+    where the upload stands or another request is writing to it, and
+    ``Upload.DoesNotExist`` when another request completed or cancelled it.
+    """
+    try:
+        part = open(part_path(upload.pk), 'r+b')
+    except FileNotFoundError:
+        raise Upload.DoesNotExist() from None
+    with part:
+        try:
+            fcntl.flock(part, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadConflict(upload.received) from None
+        # Re-read under the lock: the other request may have moved it.
+        upload.refresh_from_db(fields=['received'])
+        if offset != upload.received:
+            raise UploadConflict(upload.received)
+        hasher = running_hashes.take(upload.pk, offset, part)
+        # Drop whatever a failed request wrote past the last recorded offset.
+        part.seek(offset)
+        part.truncate()
+        remaining = length
+        try:
+            while remaining:
+                block = stream.read(min(settings.ATTACHMENTS['BLOCK_SIZE'], remaining))
+                if not block:
+                    break
+                part.write(block)
+                hasher.update(block)
+                remaining -= len(block)
+        finally:
+            # Keep what arrived, even when the client went away mid-chunk,
+            # and only record it once it is on disk.
+            part.flush()
+            os.fsync(part.fileno())
+            upload.received = offset + length - remaining
+            Upload.objects.filter(pk=upload.pk).update(
+                received=upload.received, updated_at=timezone.now()
+            )
+            running_hashes.put(upload.pk, upload.received, hasher)
+        if upload.received < upload.size:
+            return upload, None
+        return upload, complete(upload, hasher.hexdigest())
+
+
+def complete(upload, sha256):
+    """Store a fully received upload under its hash and return its attachment."""
+    part = part_path(upload.pk)
+    blob = blob_path(sha256)
+    blob.parent.mkdir(parents=True, exist_ok=True)
+    if blob.exists():
+        part.unlink()
+    else:
+        os.replace(part, blob)
+    # Fresh for CLEANUP_GRACE: a concurrent cleanup must not take it now.
+    os.utime(blob)
+    running_hashes.discard(upload.pk)
+    with transaction.atomic():
+        attachment = Attachment.objects.create(
+            uploader_id=upload.member_id,
+            sha256=sha256,
+            size=upload.size,
+            filename=upload.filename,
+            content_type=upload.content_type,
+        )
+        upload.delete()
+        transaction.on_commit(partial(thumbnails.schedule, sha256))
+    return attachment
+
+
+def cancel(upload):
+    """Delete an upload and what it has received."""
+    running_hashes.discard(upload.pk)
+    part_path(upload.pk).unlink(missing_ok=True)
+    upload.delete()
+
+
+def check_available(author, ids):
+    """
+    Raise ``AttachmentsUnavailable`` unless every attachment in ``ids`` was
+    uploaded by ``author`` and is not attached to a message yet.
+    """
+    available = Attachment.objects.filter(
+        pk__in=ids, uploader=author, message__isnull=True
+    ).count()
+    if available != len(ids):
+        raise AttachmentsUnavailable()
+
+
+def attach(message, ids):
+    """
+    Attach the author's unattached attachments in ``ids`` to ``message``.
+    Raises ``AttachmentsUnavailable`` if any of them was attached, cancelled
+    or cleaned since ``check_available``; call it in the transaction that
+    inserts the message, so the post rolls back with it.
+    """
+    attached = Attachment.objects.filter(
+        pk__in=ids, uploader_id=message.author_id, message__isnull=True
+    ).update(message=message, room_id=message.room_id)
+    if attached != len(ids):
+        raise AttachmentsUnavailable()
+
+
+def can_read(member, attachment):
+    """Whether ``member`` may download ``attachment``."""
+    if attachment.uploader_id == member.id:
+        return True
+    if attachment.room_id is None:
+        return False
+    return rooms.access(member, attachment.room_id) == rooms.FOUND
+
+
+def has_thumbnail(attachment):
+    return thumbnail_path(attachment.sha256).exists()
+
+
+def file_response(path, content_type, filename):
+    """
+    Send a file under ``ROOT``: as an ``X-Accel-Redirect`` for nginx to
+    serve, or by Django itself when ``ACCEL_REDIRECT`` is empty.
+    """
+    prefix = settings.ATTACHMENTS['ACCEL_REDIRECT']
+    if prefix:
+        response = HttpResponse(content_type=content_type)
+        response['X-Accel-Redirect'] = prefix + path.relative_to(root()).as_posix()
+    else:
+        response = FileResponse(path.open('rb'), content_type=content_type)
+    inline = content_type in INLINE_TYPES
+    response['Content-Disposition'] = content_disposition_header(not inline, filename)
+    response['X-Content-Type-Options'] = 'nosniff'
+    # An attachment's bytes never change; access to it might.
+    response['Cache-Control'] = 'private, max-age=86400'
+    return response
+
+
+def download_response(attachment):
+    return file_response(
+        blob_path(attachment.sha256), attachment.content_type, attachment.filename
+    )
+
+
+def thumbnail_response(attachment):
+    name = os.path.splitext(attachment.filename)[0] + '.jpg'
+    return file_response(thumbnail_path(attachment.sha256), 'image/jpeg', name)
+
+
+class ThumbnailPool:
+    """
+    Makes thumbnails on ``workers`` threads, with at most ``max_queue``
+    waiting; beyond that new ones are dropped (and counted) rather than
+    queued without bound.
+    """
+
+    def __init__(self, workers, max_queue=64, size=320):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.size = size
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='thumbnails'
+        )
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.latency = stats.Histogram(
+            [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+        )
+
+    def schedule(self, sha256):
+        """
+        Queue a thumbnail of the blob ``sha256``. Return False when none will
+        be made by this call: Pillow is missing, it exists, or the queue is full.
+        """
+        if Image is None or thumbnail_path(sha256).exists():
+            return False
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            return False
+        with self._lock:
+            self.in_flight += 1
+        try:
+            self._executor.submit(self._run, sha256, time.perf_counter())
+        except BaseException:
+            self._done(None)
+            raise
+        return True
+
+    def _run(self, sha256, started):
+        error = None
+        try:
+            self.make(sha256)
+        except Exception as exc:  # not an image, or a corrupt one
+            error = exc
+        finally:
+            self.latency.observe(time.perf_counter() - started)
+            self._done(error)
+
+    def _done(self, error):
+        with self._lock:
+            self.in_flight -= 1
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        self._slots.release()
+
+    def make(self, sha256):
+        """Write the thumbnail of blob ``sha256``, if it is an image."""
+        target = thumbnail_path(sha256)
+        target.parent.mkdir(parents=True, exist_ok=True)
+        temporary = target.with_name(f'{target.name}.{threading.get_ident()}.tmp')
+        with Image.open(blob_path(sha256), formats=THUMBNAIL_FORMATS) as image:
+            # Lets JPEG decode at a fraction of the full size.
+            image.draft('RGB', (self.size, self.size))
+            image.thumbnail((self.size, self.size))
+            image.convert('RGB').save(temporary, 'JPEG', quality=80)
+        os.replace(temporary, target)
+
+    def stats(self):
+        return {
+            'available': Image is not None,
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+            'rejected': self.rejected,
+            'latency_seconds': self.latency.snapshot(),
+        }
+
+
+thumbnails = ThumbnailPool(
+    workers=settings.ATTACHMENTS['THUMBNAIL_WORKERS'],
+    max_queue=settings.ATTACHMENTS['THUMBNAIL_MAX_QUEUE'],
+    size=settings.ATTACHMENTS['THUMBNAIL_SIZE'],
+)
+stats.register('thumbnails', thumbnails.stats)
+
+
+def upload_stats():
+    return {'rehashed': running_hashes.rehashed}
+
+
+stats.register('uploads', upload_stats)
+
+
+def clean(ttl_hours=None):
+    """
+    Delete uploads idle for ``ttl_hours`` with their part files, and blobs
+    and thumbnails no attachment uses. Return ``(uploads, files)`` deleted.
+    """
+    if ttl_hours is None:
+        ttl_hours = settings.ATTACHMENTS['UPLOAD_TTL_HOURS']
+    ttl = timedelta(hours=ttl_hours)
+    uploads = 0
+    for upload in Upload.objects.filter(updated_at__lt=timezone.now() - ttl).iterator():
+        cancel(upload)
+        uploads += 1
+    # Part files left behind by uploads that are gone from the database.
+    files = remove_older(root() / UPLOADS, time.time() - ttl.total_seconds(), lambda names: set())
+    horizon = time.time() - CLEANUP_GRACE.total_seconds()
+    for directory in (BLOBS, THUMBNAILS):
+        files += remove_older(root() / directory, horizon, used_hashes)
+    return uploads, files
+
+
+def used_hashes(names):
+    return set(Attachment.objects.filter(sha256__in=names).values_list('sha256', flat=True))
+
+
+def remove_older(directory, horizon, keep, batch_size=500):
+    """
+    Delete the files under ``directory`` last modified before ``horizon``
+    whose name, up to the first dot, is not in ``keep(names)``.
+    """
+    candidates = {}
+    for path in directory.rglob('*'):
+        if path.is_file() and path.stat().st_mtime < horizon:
+            candidates.setdefault(path.name.split('.')[0], []).append(path)
+    names = list(candidates)
+    removed = 0
+    for start in range(0, len(names), batch_size):
+        batch = names[start:start + batch_size]
+        kept = keep(batch)
+        for name in batch:
+            if name in kept:
+                continue
+            for path in candidates[name]:
+                # Checked again: complete() touches a blob it is about to use.
+                with contextlib.suppress(FileNotFoundError):
+                    if path.stat().st_mtime < horizon:
+                        path.unlink()
+                        removed += 1
+    return removed
@@ -0,0 +1,173 @@
+"""
+Session-based authentication for members.
+
+``LoginView`` stores ``member_id`` in the session. This class resolves it to
+a ``Member`` once per request through a bounded per-process LRU cache with a
+TTL, so the hot polling endpoints skip the members lookup on most requests.
+Cached entries are dropped when a member is saved or deleted, locally and
+in every other process through the chat broker.
+"""
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from drf_spectacular.extensions import OpenApiAuthenticationExtension
+from rest_framework.authentication import BaseAuthentication
+
+from . import stats
+from .broker import get_broker
+from .models import Member
+
+MEMBERS_CHANNEL = 'members'
+
+
+class MemberCache:
+    """Bounded LRU cache of members by id, with a time-to-live per entry."""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._unsubscribe = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def listen(self):
+        """Subscribe to invalidations from other processes, once per process."""
+        if self._unsubscribe is None:
+            with self._lock:
+                if self._unsubscribe is None:
+                    self._unsubscribe = get_broker().subscribe(
+                        MEMBERS_CHANNEL, self._on_invalidate
+                    )
+
+    def _on_invalidate(self, payload):
+        self.invalidate(int(payload))
+
+    def get(self, member_id):
+        """
+        Return a private copy of the member, loading it on a miss, or None
+        if the member does not exist.
+        """
+        member = self.lookup(member_id)
+        if member is None:
+            member = Member.objects.filter(id=member_id).first()
+            if member is not None:
+                self.set(member)
+        return member
+
+    async def aget(self, member_id):
+        """``get`` through the async ORM."""
+        member = self.lookup(member_id)
+        if member is None:
+            member = await Member.objects.filter(id=member_id).afirst()
+            if member is not None:
+                self.set(member)
+        return member
+
+    def lookup(self, member_id):
+        """Return a private copy of a live cached member, or None."""
+        self.listen()
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(member_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(member_id)
+                self.hits += 1
+                return copy.copy(entry[1])
+            self.misses += 1
+        return None
+
+    def set(self, member):
+        with self._lock:
+            self._entries[member.id] = (time.monotonic() + self.ttl, copy.copy(member))
+            self._entries.move_to_end(member.id)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, member_id):
+        with self._lock:
+            if self._entries.pop(member_id, None) is not None:
+                self.invalidations += 1
+
+    def broadcast_invalidate(self, member_id):
+        """Drop the member here and in every process reached by the broker."""
+        self.invalidate(member_id)
+        get_broker().publish(MEMBERS_CHANNEL, str(member_id).encode())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+
+member_cache = MemberCache(
+    max_size=settings.MEMBER_CACHE['MAX_SIZE'],
+    ttl=settings.MEMBER_CACHE['TTL'],
+)
+stats.register('member_cache', member_cache.stats)
+
+
+class SessionMemberAuthentication(BaseAuthentication):
+    """
+    Authenticate the member stored in the session by ``LoginView``.
+
+    Sessions pointing at a member that no longer exists are flushed.
+    """
+
+    def authenticate(self, request):
+        session = request._request.session
+        member_id = session.get('member_id')
+        if not member_id:
+            return None
+
+        member = member_cache.get(member_id)
+        if member is None:
+            session.flush()
+            return None
+        return (member, None)
+
+
+async def aauthenticate(request):
+    """
+    Async counterpart of ``SessionMemberAuthentication`` for the async
+    views: return the session's member, or None.
+    """
+    session = request.session
+    member_id = await session.aget('member_id')
+    if not member_id:
+        return None
+
+    member = await member_cache.aget(member_id)
+    if member is None:
+        await session.aflush()
+    return member
+
+
+class SessionMemberAuthenticationScheme(OpenApiAuthenticationExtension):
+    target_class = 'api.authentication.SessionMemberAuthentication'
+    name = 'cookieAuth'
+
+    def get_security_definition(self, auto_schema):
+        return {
+            'type': 'apiKey',
+            'in': 'cookie',
+            'name': settings.SESSION_COOKIE_NAME,
+        }
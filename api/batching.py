@@ -0,0 +1,170 @@
+"""
+Group commit for new messages.
+
+SQLite has a single writer, so a burst of posts serializes on one fsync per
+INSERT transaction. When ``MESSAGES_WRITE_BATCHING['ENABLED']`` is set,
+``MessageCreateSerializer`` hands new messages to a per-process writer
+thread instead. The writer collects what arrives within a few milliseconds
+and inserts it with one ``bulk_create`` in one transaction, together with
+the authors' activity counters (see ``api.activity``). Each caller
+blocks until its own row is committed and gets its saved ``Message`` back
+with the real id and ``created_at``.
+
+The queue is bounded: when it is full, ``WriteQueueFull`` is raised at once
+so the view can shed load instead of piling up blocked requests.
+
+A caller that times out cancels its message if the writer has not taken it
+yet, and only then gets ``TimeoutError`` (a 503): a message the client is
+told to retry has never been written. Once its batch is being committed,
+the caller waits for the outcome instead. When a batch fails on one bad
+row (``IntegrityError``, ``DataError``), its messages are inserted again one
+by one, so only that row's caller gets the error.
+"""
+import queue
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.db import DataError, IntegrityError, close_old_connections, transaction
+
+from . import activity, stats
+from .models import Message
+
+
+class WriteQueueFull(Exception):
+    """The write queue is at capacity; the caller should retry later."""
+
+
+class _Pending:
+    __slots__ = ('message', 'future')
+
+    def __init__(self, message):
+        self.message = message
+        self.future = Future()
+
+
+class MessageWriteBatcher:
+    def __init__(self, window_ms=5, max_batch_size=100, max_queue_size=1000,
+                 commit_timeout=10.0):
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.commit_timeout = commit_timeout
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.batch_sizes = stats.Histogram([1, 2, 5, 10, 20, 50, 100, 200])
+        self.commit_latency = stats.Histogram(
+            [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0]
+        )
+        self.rejected = 0
+        self.failed = 0
+
+    def _ensure_writer(self):
+        # Started lazily so that it runs in the worker process, not in a
+        # preloading master that forks afterwards.
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(
+                        target=self._write_forever, name='message-writer', daemon=True
+                    )
+                    self._thread.start()
+
+    def save(self, **fields):
+        """
+        Queue a new message and block until it is committed.
+
+        Raises ``WriteQueueFull`` when the queue is at capacity and
+        ``TimeoutError`` if the writer does not get to the message in time,
+        in which case it is never written.
+        """
+        self._ensure_writer()
+        pending = _Pending(Message(**fields))
+        try:
+            self._queue.put_nowait(pending)
+        except queue.Full:
+            self.rejected += 1
+            raise WriteQueueFull()
+        try:
+            return pending.future.result(timeout=self.commit_timeout)
+        except FutureTimeoutError:
+            if pending.future.cancel():
+                raise TimeoutError("Message commit timed out")
+        # Already being committed: its outcome is the caller's to report.
+        return pending.future.result()
+
+    def _write_forever(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._commit(batch)
+
+    def _commit(self, batch):
+        # Callers that timed out have cancelled theirs; the rest can no longer.
+        batch = [pending for pending in batch if pending.future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        # The writer thread never sees request_started/finished, so apply
+        # CONN_MAX_AGE and health checks to its connection here.
+        close_old_connections()
+        started = time.perf_counter()
+        try:
+            self._insert(batch)
+        except (IntegrityError, DataError) as exc:
+            if len(batch) == 1:
+                self._fail(batch, exc)
+                return
+            # Find the bad rows: the others still commit.
+            for pending in batch:
+                try:
+                    self._insert([pending])
+                except Exception as exc:
+                    self._fail([pending], exc)
+                else:
+                    pending.future.set_result(pending.message)
+            return
+        except Exception as exc:
+            self._fail(batch, exc)
+            return
+        self.commit_latency.observe(time.perf_counter() - started)
+        self.batch_sizes.observe(len(batch))
+        for pending in batch:
+            pending.future.set_result(pending.message)
+
+    def _insert(self, batch):
+        with transaction.atomic():
+            messages = Message.objects.bulk_create([pending.message for pending in batch])
+            activity.record_posts(messages)
+
+    def _fail(self, batch, exc):
+        self.failed += len(batch)
+        for pending in batch:
+            pending.future.set_exception(exc)
+
+    def stats(self):
+        return {
+            'queued': self._queue.qsize(),
+            'max_queue_size': self._queue.maxsize,
+            'rejected': self.rejected,
+            'failed': self.failed,
+            'batch_size': self.batch_sizes.snapshot(),
+            'commit_latency_seconds': self.commit_latency.snapshot(),
+        }
+
+
+message_batcher = MessageWriteBatcher(
+    window_ms=settings.MESSAGES_WRITE_BATCHING['WINDOW_MS'],
+    max_batch_size=settings.MESSAGES_WRITE_BATCHING['MAX_BATCH_SIZE'],
+    max_queue_size=settings.MESSAGES_WRITE_BATCHING['MAX_QUEUE_SIZE'],
+    commit_timeout=settings.MESSAGES_WRITE_BATCHING['COMMIT_TIMEOUT'],
+)
+stats.register('message_batcher', message_batcher.stats)
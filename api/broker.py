@@ -0,0 +1,183 @@
+"""
+Pub/sub brokers that fan chat events out to every server process.
+
+The backend is chosen with ``settings.CHAT_BROKER['BACKEND']``:
+
+- ``api.broker.InMemoryBroker`` delivers within the current process only.
+  It suits development, tests and single-process deployments.
+- ``api.broker.RelayBroker`` connects to the relay started by
+  ``manage.py runbroker``, a local stand-in for a multi-process pub/sub
+  service such as Redis. Every process publishes to the relay and receives
+  every event back, so gunicorn workers and ASGI processes all see each
+  other's messages.
+
+Payloads are opaque bytes: an event is encoded once by the publisher and
+shared as-is by every subscriber.
+"""
+import logging
+import socket
+import struct
+import threading
+import time
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    """Return the process-wide broker configured in settings."""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                options = dict(settings.CHAT_BROKER)
+                backend = import_string(options.pop('BACKEND'))
+                _broker = backend(**{key.lower(): value for key, value in options.items()})
+    return _broker
+
+
+class BaseBroker:
+    """
+    Broker interface.
+
+    Subscribers are plain callables taking the payload bytes. They may be
+    invoked from a broker thread and must not block.
+    """
+
+    def __init__(self, **options):
+        self._subscribers = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel, payload):
+        raise NotImplementedError
+
+    def subscribe(self, channel, callback):
+        """Register ``callback`` for ``channel`` and return an unsubscribe function."""
+        with self._lock:
+            callbacks = self._subscribers.get(channel, ())
+            self._subscribers[channel] = callbacks + (callback,)
+
+        def unsubscribe():
+            with self._lock:
+                callbacks = self._subscribers.get(channel, ())
+                self._subscribers[channel] = tuple(c for c in callbacks if c is not callback)
+
+        return unsubscribe
+
+    def deliver(self, channel, payload):
+        """Hand a payload to this process's subscribers of ``channel``."""
+        for callback in self._subscribers.get(channel, ()):
+            try:
+                callback(payload)
+            except Exception:
+                logger.exception("Broker subscriber failed on channel %s", channel)
+
+
+class InMemoryBroker(BaseBroker):
+    """Delivers events synchronously to subscribers in this process."""
+
+    def publish(self, channel, payload):
+        self.deliver(channel, payload)
+
+
+def encode_frame(channel, payload):
+    """Encode a relay frame: 4-byte length, channel, newline, payload."""
+    body = channel.encode() + b'\n' + payload
+    return struct.pack('!I', len(body)) + body
+
+
+def decode_frame(body):
+    """Split a relay frame body into ``(channel, payload)``."""
+    channel, _, payload = body.partition(b'\n')
+    return channel.decode(), payload
+
+
+class RelayBroker(BaseBroker):
+    """
+    Publishes through the ``runbroker`` relay and receives every event back
+    on a background reader thread.
+
+    Until the reader is connected, and whenever the relay is unreachable,
+    events are delivered locally at once, so that a single process keeps
+    working and a publisher never waits on the relay. The reader connects
+    and reconnects on its own.
+    """
+
+    def __init__(self, location='127.0.0.1:8765', reconnect_delay=1.0, **options):
+        super().__init__(**options)
+        host, _, port = location.rpartition(':')
+        self.address = (host or '127.0.0.1', int(port))
+        self.reconnect_delay = reconnect_delay
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._reader = None
+
+    def _ensure_reader(self):
+        # Started lazily so that it runs in the worker process, not in a
+        # preloading master that forks afterwards.
+        if self._reader is not None and self._reader.is_alive():
+            return
+        with self._lock:
+            if self._reader is None or not self._reader.is_alive():
+                self._reader = threading.Thread(
+                    target=self._read_forever, name='chat-broker-relay', daemon=True
+                )
+                self._reader.start()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=5)
+        sock.settimeout(None)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def subscribe(self, channel, callback):
+        unsubscribe = super().subscribe(channel, callback)
+        self._ensure_reader()
+        return unsubscribe
+
+    def publish(self, channel, payload):
+        self._ensure_reader()
+        frame = encode_frame(channel, payload)
+        with self._send_lock:
+            sock = self._sock
+            if sock is not None:
+                try:
+                    sock.sendall(frame)
+                    return
+                except OSError:
+                    logger.warning("Lost connection to chat broker relay")
+        self.deliver(channel, payload)
+
+    def _read_forever(self):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                time.sleep(self.reconnect_delay)
+                continue
+            with self._send_lock:
+                self._sock = sock
+            try:
+                reader = sock.makefile('rb')
+                while True:
+                    header = reader.read(4)
+                    if len(header) < 4:
+                        break
+                    (length,) = struct.unpack('!I', header)
+                    body = reader.read(length)
+                    if len(body) < length:
+                        break
+                    self.deliver(*decode_frame(body))
+            except OSError:
+                pass
+            finally:
+                with self._send_lock:
+                    if self._sock is sock:
+                        self._sock = None
+                sock.close()
+            time.sleep(self.reconnect_delay)
@@ -0,0 +1,230 @@
+"""
+Message change feed.
+
+Triggers created in migration 0007 append a ``MessageChange`` row for every
+insert, text update and delete on ``messages``, in the same statement as
+the write, so the feed commits or rolls back with it whatever the write
+path (the API, the batching writer, the admin, cascades, raw SQL). The
+``seq`` primary key is AUTOINCREMENT: it only grows, and a sequence number
+is never reused even after the rows before it are compacted away.
+
+Clients keep the ``seq`` of the last change they applied and ask
+``/api/rooms/<id>/changes/?since=<seq>`` (``/api/messages/changes/`` for
+the general room) for what follows in that room, so syncing costs
+O(changes) rather than a page refetch. Creates and updates carry the
+message as it was written, with the HTML it was rendered to then (a new
+renderer version changes the list ETags instead); deletes are tombstones
+with only its id.
+Clients apply them in order as upserts and removals. Sequence numbers are
+shared by all rooms: when a room has nothing new, the response moves the
+client up to the newest ``seq``, so a quiet room never holds compaction
+back.
+
+Each request records the ``since`` it was made with as that client's
+acknowledged position in the room (``ChangeCursor``, at most every
+``CURSOR_SAVE_INTERVAL`` seconds per client and room; an older position is
+always safe). ``manage.py compact_changes``, run hourly by ``manage.py
+run_maintenance`` (``MAINTENANCE_SCHEDULE``), deletes the changes every
+client seen within ``CURSOR_TTL_DAYS`` has passed, and drops the cursors of
+clients that have not been seen since. The newest change is always kept, so the
+latest ``seq`` survives compaction. A cursor that points into the
+compacted range, or past the newest change, is expired: the client must
+reload the message list and continue from the current ``seq``.
+
+Archiving deletes rows from ``messages`` without changing any message, so
+it runs inside ``paused()``.
+"""
+import contextlib
+import threading
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections, transaction
+from django.db.models import Max, Min
+from django.utils import timezone
+
+from . import rooms
+from .models import ChangeCursor, Member, MessageChange
+from .readpath import datetime_formatter
+
+PAUSE_TABLE = 'message_changes_paused'
+
+CHANGE_FIELDS = ('seq', 'op', 'message_id', 'author_id', 'text', 'rendered_html', 'created_at', 'changed_at')
+
+
+@contextlib.contextmanager
+def paused(reason, using=DEFAULT_DB_ALIAS):
+    """
+    Silence the change triggers for writes made inside the block. Must be
+    used inside a transaction, so no other connection ever sees the pause.
+    """
+    connection = connections[using]
+    if not connection.in_atomic_block:
+        raise RuntimeError("paused() must be used inside a transaction")
+    with connection.cursor() as cursor:
+        cursor.execute(f'INSERT INTO {PAUSE_TABLE} (reason) VALUES (%s)', [reason])
+    try:
+        yield
+    finally:
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {PAUSE_TABLE}')
+
+
+def latest_seq():
+    """The newest ``seq``, or 0 before the first change."""
+    return MessageChange.objects.order_by('-seq').values_list('seq', flat=True).first() or 0
+
+
+def bounds(room_id):
+    """
+    ``(first, last)``: the oldest and newest ``seq`` of the feed holding
+    a room (shared by every room in its database), or ``(None, None)``.
+    """
+    seqs = MessageChange.objects.using(rooms.database(room_id)).aggregate(
+        first=Min('seq'), last=Max('seq')
+    )
+    return seqs['first'], seqs['last']
+
+
+def is_expired(since, bounds):
+    """
+    Whether changes after ``since`` may be missing, given the feed's
+    ``bounds``: compacted away, or ``since`` is newer than anything in it.
+    """
+    first, last = bounds
+    if last is None:
+        return since != 0
+    return since < first - 1 or since > last
+
+
+def changes_after(room_id, since, limit):
+    """Up to ``limit`` changes in a room after ``since``, oldest first."""
+    return list(
+        MessageChange.objects.using(rooms.database(room_id))
+        .filter(room_id=room_id, seq__gt=since).order_by('seq')
+        .values_list(*CHANGE_FIELDS, named=True)[:limit]
+    )
+
+
+def serialize_changes(changes):
+    """
+    Return ``(events, authors)``: compact events and the authors they
+    mention, keyed by id as in the compact message list.
+    """
+    datetime_value = datetime_formatter()
+    events = []
+    author_ids = set()
+    for change in changes:
+        event = {'seq': change.seq, 'op': change.op, 'id': change.message_id}
+        if change.op != MessageChange.DELETED:
+            event['text'] = change.text
+            event['html'] = change.rendered_html
+            event['author_id'] = change.author_id
+            event['created_at'] = datetime_value(change.created_at)
+            author_ids.add(change.author_id)
+        event['changed_at'] = datetime_value(change.changed_at)
+        events.append(event)
+    authors = {
+        str(pk): {
+            'id': pk,
+            'username': username,
+            'email': email,
+            'created_at': datetime_value(created_at),
+        }
+        for pk, username, email, created_at in Member.objects.filter(
+            id__in=author_ids
+        ).values_list('id', 'username', 'email', 'created_at')
+    } if author_ids else {}
+    return events, authors
+
+
+def feed_page(since, found, limit, latest=0):
+    """
+    The feed response body for the changes ``found`` after ``since``,
+    fetched with ``limit + 1`` to tell whether more follow. ``latest`` is
+    the newest ``seq`` of the whole feed, read before ``found``: the room
+    has no changes up to it beyond those found.
+    """
+    events, authors = serialize_changes(found[:limit])
+    more = len(found) > limit
+    seq = max(since, latest or 0)
+    if events:
+        seq = events[-1]['seq'] if more else max(seq, events[-1]['seq'])
+    return {
+        'seq': seq,
+        'events': events,
+        'authors': authors,
+        'more': more,
+    }
+
+
+class CursorTracker:
+    """
+    Records acknowledged positions, at most once per ``interval`` seconds
+    per client, room and process.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._saved = {}
+        self._lock = threading.Lock()
+
+    def acknowledge(self, member_id, room_id, client, seq):
+        key = (member_id, room_id, client)
+        now = time.monotonic()
+        with self._lock:
+            due = now - self._saved.get(key, float('-inf')) >= self.interval
+            if due:
+                self._saved[key] = now
+        if due:
+            ChangeCursor.objects.update_or_create(
+                member_id=member_id,
+                room_id=room_id,
+                client=client,
+                defaults={'seq': seq, 'seen_at': timezone.now()},
+            )
+
+
+cursor_tracker = CursorTracker(settings.MESSAGE_CHANGES['CURSOR_SAVE_INTERVAL'])
+
+
+def compaction_horizon(ttl_days=None):
+    """
+    Return ``(horizon, expired)``: every live client has acknowledged the
+    changes up to ``horizon``; ``expired`` cursors have not been seen within
+    the TTL and no longer hold changes back.
+    """
+    if ttl_days is None:
+        ttl_days = settings.MESSAGE_CHANGES['CURSOR_TTL_DAYS']
+    cutoff = timezone.now() - timedelta(days=ttl_days)
+    live = ChangeCursor.objects.filter(seen_at__gte=cutoff)
+    expired = ChangeCursor.objects.filter(seen_at__lt=cutoff)
+    # The newest change always stays, so the latest seq is never lost.
+    horizon = latest_seq() - 1
+    oldest = live.aggregate(oldest=Min('seq'))['oldest']
+    if oldest is not None:
+        horizon = min(horizon, oldest)
+    return horizon, expired
+
+
+def compact(batch_size=None, ttl_days=None):
+    """
+    Delete changes every live client has passed, ``batch_size`` per short
+    transaction, and forget expired cursors. Return ``(deleted, expired)``.
+    """
+    if batch_size is None:
+        batch_size = settings.MESSAGE_CHANGES['COMPACT_BATCH_SIZE']
+    horizon, expired = compaction_horizon(ttl_days)
+    expired_count, _ = expired.delete()
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(
+                MessageChange.objects.filter(seq__lte=horizon).order_by('seq')
+                .values_list('seq', flat=True)[:batch_size]
+            )
+            if not ids:
+                return deleted, expired_count
+            # A contiguous prefix, deleted by range rather than a long IN list.
+            deleted += MessageChange.objects.filter(seq__gte=ids[0], seq__lte=ids[-1]).delete()[0]
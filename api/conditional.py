@@ -0,0 +1,133 @@
+"""
+Conditional GET support (ETag / Last-Modified / 304).
+
+Validators are derived from a single indexed lookup so that a client
+revalidating an unchanged resource is answered before any queryset is
+evaluated or any serializer runs.
+"""
+import hashlib
+
+from django.db.models import Subquery
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import rendering, rooms
+from .models import Member, MessageChange
+
+
+def make_etag(*parts):
+    """Build a quoted strong ETag from the given validator parts."""
+    digest = hashlib.sha1('|'.join(str(part) for part in parts).encode())
+    return quote_etag(digest.hexdigest()[:32])
+
+
+def messages_head(room_id):
+    """
+    Return ``(message_id, created_at, members_changed, change_seq,
+    changed_at)`` for the newest message of a room, or None when it has no
+    messages.
+
+    The list changes when a newer message is posted, when any author
+    updates their profile (authors are embedded in every message), or when
+    a message of the room is edited or deleted, so the most recent member
+    change and the room's latest change-feed ``seq`` and its time are
+    fetched alongside the newest message. All of them come from
+    index-backed lookups in one query.
+    """
+    return head_queryset(room_id).first()
+
+
+async def amessages_head(room_id):
+    """``messages_head`` through the async ORM."""
+    return await head_queryset(room_id).afirst()
+
+
+def latest_change(room_id, field='seq'):
+    return MessageChange.objects.using(rooms.database(room_id)).filter(
+        room_id=room_id
+    ).order_by('-seq').values(field)[:1]
+
+
+def head_queryset(room_id):
+    members_changed = Member.objects.order_by('-updated_at').values('updated_at')[:1]
+    return (
+        rooms.messages(room_id).order_by('-created_at', '-id')
+        .annotate(
+            members_changed=Subquery(members_changed),
+            change_seq=Subquery(latest_change(room_id)),
+            changed_at=Subquery(latest_change(room_id, 'changed_at')),
+        )
+        .values_list('id', 'created_at', 'members_changed', 'change_seq', 'changed_at')
+    )
+
+
+def messages_validators(request, head):
+    """
+    Return ``(etag, last_modified)`` for the message list at ``head``, as
+    rendered for the request's URL and negotiated media type, and with the
+    current message renderer. Last-Modified is the latest of the newest
+    message, the last profile update and the last edit or delete.
+    """
+    representation = (request.get_full_path(), request.accepted_media_type)
+    if head is None:
+        return make_etag('messages', *representation), None
+
+    message_id, created_at, members_changed, change_seq, changed_at = head
+    last_modified = max(created_at, members_changed or created_at, changed_at or created_at)
+    etag = make_etag(
+        'messages', *representation, message_id, created_at, members_changed, change_seq,
+        rendering.VERSION
+    )
+    return etag, last_modified
+
+
+def member_validators(member):
+    """Return ``(etag, last_modified)`` for a member's own profile."""
+    return make_etag('member', member.id, member.updated_at), member.updated_at
+
+
+def author_messages_validators(request, author):
+    """
+    Return ``(etag, last_modified)`` for one member's message history in a
+    room, given the author annotated with the room's ``change_seq`` (see
+    ``latest_change``). It changes when they post or edit their profile,
+    both of which show in their own row, or when a message of the room is
+    edited or deleted.
+    """
+    representation = (request.get_full_path(), request.accepted_media_type)
+    last_modified = max(author.updated_at, author.last_message_at or author.updated_at)
+    etag = make_etag(
+        'author-messages', *representation, author.id, author.updated_at,
+        author.message_count, author.last_message_at, author.change_seq, rendering.VERSION
+    )
+    return etag, last_modified
+
+
+def profile_validators(member):
+    """``member_validators`` for a profile that shows the activity counters."""
+    last_modified = max(member.updated_at, member.last_message_at or member.updated_at)
+    etag = make_etag(
+        'profile', member.id, member.updated_at, member.message_count, member.last_message_at
+    )
+    return etag, last_modified
+
+
+def not_modified(request, etag, last_modified=None):
+    """
+    Return a 304 response if the request's conditional headers match the
+    given validators, otherwise None.
+    """
+    return get_conditional_response(
+        request,
+        etag=etag,
+        last_modified=int(last_modified.timestamp()) if last_modified else None,
+    )
+
+
+def set_validators(response, etag, last_modified=None):
+    """Attach validators and require clients to revalidate before reuse."""
+    response['ETag'] = etag
+    if last_modified:
+        response['Last-Modified'] = http_date(last_modified.timestamp())
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
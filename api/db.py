@@ -0,0 +1,41 @@
+"""
+SQLite connection maintenance.
+
+Pragmas are applied to every new connection through the ``init_command`` in
+``DATABASES``. Connections now live for ``CONN_MAX_AGE`` seconds, so this
+module also runs ``PRAGMA optimize`` on them at most once per
+``SQLITE_OPTIMIZE_INTERVAL`` seconds per process, after a request finishes,
+to keep query planner statistics current without an external cron job.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.signals import request_finished
+from django.db import connections
+from django.dispatch import receiver
+
+_lock = threading.Lock()
+_last_optimized = 0.0
+
+
+@receiver(request_finished)
+def optimize_periodically(sender, **kwargs):
+    global _last_optimized
+    interval = settings.SQLITE_OPTIMIZE_INTERVAL
+    if not interval:
+        return
+    now = time.monotonic()
+    with _lock:
+        if _last_optimized and now - _last_optimized < interval:
+            return
+        _last_optimized = now
+
+    for connection in connections.all(initialized_only=True):
+        if (
+            connection.vendor == 'sqlite'
+            and connection.connection is not None
+            and not connection.in_atomic_block
+        ):
+            with connection.cursor() as cursor:
+                cursor.execute('PRAGMA optimize')
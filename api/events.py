@@ -0,0 +1,57 @@
+"""
+Chat events published through the broker.
+
+A new message is serialized and JSON-encoded exactly once, by the process
+that created it. Every subscriber (the long-poll hubs, the WebSocket
+gateway) and the latest-page cache share the same encoded bytes.
+
+Edits and deletions are published as ``message.updated`` and
+``message.deleted``; they reach clients live but are not retained. The
+change feed (``api.changes``) is the durable record of all three.
+
+Each room has its own channel, so subscribers only hear about the rooms
+they follow.
+"""
+from functools import partial
+
+from django.db import transaction
+from rest_framework.renderers import JSONRenderer
+
+from .broker import get_broker
+from .latest import latest_messages
+from .serializers import MessageSerializer
+
+MESSAGES_CHANNEL = 'messages'
+CHANGE_EVENTS = ('message.created', 'message.updated', 'message.deleted')
+
+
+def room_channel(room_id):
+    """The broker channel carrying the events of room ``room_id``."""
+    return f'{MESSAGES_CHANNEL}.{room_id}'
+
+
+def message_created(message):
+    """
+    Serialize a newly saved message, publish it once the surrounding
+    transaction commits, and return the serialized data for the response.
+    """
+    data = MessageSerializer(message).data
+    encoded = JSONRenderer().render(data)
+    payload = b'{"type":"message.created","message":' + encoded + b'}'
+    transaction.on_commit(partial(get_broker().publish, room_channel(message.room_id), payload))
+    transaction.on_commit(partial(latest_messages.push, message, encoded), robust=True)
+    return data
+
+
+def message_updated(message):
+    """``message_created`` for an edited message."""
+    data = MessageSerializer(message).data
+    payload = b'{"type":"message.updated","message":' + JSONRenderer().render(data) + b'}'
+    transaction.on_commit(partial(get_broker().publish, room_channel(message.room_id), payload))
+    return data
+
+
+def message_deleted(message_id, room_id):
+    """Publish the deletion of a message once the transaction commits."""
+    payload = JSONRenderer().render({'type': 'message.deleted', 'id': message_id})
+    transaction.on_commit(partial(get_broker().publish, room_channel(room_id), payload))
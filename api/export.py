@@ -0,0 +1,206 @@
+"""
+Streaming export of the message history.
+
+``manage.py export_messages`` and ``/api/internal/export/`` write every
+message, or only those of one room, one author or a date range, as NDJSON
+(one JSON object per line) or CSV. Rooms are exported one after another,
+each oldest first: its archived messages (see api.archive), then those
+still in ``messages``.
+
+Hot messages are read in keyset batches of ``BATCH_SIZE`` on
+``(created_at, id)``, through the same indexes as the message lists. Each
+batch is one SELECT joined with ``members`` for the author's name, read with
+``iterator(chunk_size=...)`` and encoded as it is read, so no rows pile up;
+only the encoded batch is held, whatever the size of the table. Every
+statement is finished before its batch is sent: a slow client never keeps
+a read open, which in WAL mode would stop checkpoints from getting past it,
+and nothing is exported inside a transaction.
+
+Archived chunks are read the same way, one chunk per query. Before each
+hot batch the archive is checked again for messages the archiver moved
+out of ``messages`` while the export ran, so none are skipped.
+"""
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.db.models import Q
+
+from . import archive, rooms
+from .models import Room
+from .readpath import datetime_formatter
+
+FORMATS = ('ndjson', 'csv')
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+    'csv': 'text/csv; charset=utf-8',
+}
+
+COLUMNS = ('id', 'room_id', 'author_id', 'author', 'created_at', 'text')
+
+HOT_FIELDS = ('id', 'author_id', 'author__username', 'created_at', 'text')
+
+
+def after(key):
+    """Messages after ``(created_at, id)``, in the form the keyset indexes serve."""
+    created_at, pk = key
+    return Q(created_at__gte=created_at) & (Q(created_at__gt=created_at) | Q(id__gt=pk))
+
+
+def export(room_id=None, author_id=None, since=None, until=None, format='ndjson', batch_size=None):
+    """
+    Yield the export as text, a batch at a time: each room's messages
+    (or only room ``room_id``'s) by ``author_id``, created in
+    ``[since, until)``, oldest first.
+    """
+    if batch_size is None:
+        batch_size = settings.MESSAGE_EXPORT['BATCH_SIZE']
+    encoder = CSVEncoder() if format == 'csv' else NDJSONEncoder()
+    header = encoder.header()
+    if header:
+        yield header
+    filters = {'author_id': author_id, 'since': since, 'until': until}
+    room_ids = [room_id] if room_id is not None else Room.objects.order_by('id').values_list('id', flat=True)
+    for room in room_ids:
+        for rows in room_batches(room, batch_size, **filters):
+            text = encoder.encode(room, rows)
+            if text:
+                yield text
+
+
+def room_batches(room_id, batch_size, author_id=None, since=None, until=None):
+    """
+    Yield a room's messages as lazy batches of ``(id, author_id, username,
+    created_at, text)``, archived then hot, each batch to be consumed
+    before the next is requested.
+    """
+    key = None
+    while True:
+        # Whatever was archived past the cursor: everything, the first time.
+        while True:
+            chunk = next_chunk(room_id, key, author_id, since, until)
+            if chunk is None:
+                break
+            yield archived_rows(chunk, key, author_id, since, until)
+            key = (chunk.last_created_at, chunk.last_id)
+        messages = rooms.messages(room_id)
+        if author_id is not None:
+            messages = messages.filter(author_id=author_id)
+        if until is not None:
+            messages = messages.filter(created_at__lt=until)
+        # Only one lower bound, or SQLite may start every batch from since.
+        if key is not None:
+            messages = messages.filter(after(key))
+        elif since is not None:
+            messages = messages.filter(created_at__gte=since)
+        batch = HotBatch(
+            messages.order_by('created_at', 'id').values_list(*HOT_FIELDS)[:batch_size], batch_size
+        )
+        yield batch
+        if batch.count < batch_size:
+            return
+        key = batch.last_key
+
+
+class HotBatch:
+    """One keyset batch of hot messages, read as it is iterated."""
+
+    def __init__(self, queryset, batch_size):
+        self.queryset = queryset
+        self.batch_size = batch_size
+        self.count = 0
+        self.last_key = None
+
+    def __iter__(self):
+        for row in self.queryset.iterator(chunk_size=self.batch_size):
+            self.count += 1
+            self.last_key = (row[3], row[0])
+            yield row
+
+
+def next_chunk(room_id, key, author_id, since, until):
+    """A room's first archive chunk ending after ``key`` with messages in range."""
+    chunks = archive.archive_chunks(room_id, author_id)
+    if key is not None:
+        created_at, pk = key
+        chunks = chunks.filter(
+            Q(last_created_at__gt=created_at) | Q(last_created_at=created_at, last_id__gt=pk)
+        )
+    if since is not None:
+        chunks = chunks.filter(last_created_at__gte=since)
+    if until is not None:
+        chunks = chunks.filter(first_created_at__lt=until)
+    return chunks.order_by('first_created_at', 'first_id').first()
+
+
+def archived_rows(chunk, key, author_id, since, until):
+    """A chunk's messages after ``key`` and in range, in the shape of hot rows."""
+    rows = archive.chunk_rows(
+        chunk,
+        after=None if key is None else (archive.stored(key[0]), key[1]),
+        author_id=author_id,
+    )
+    if since is not None or until is not None:
+        low = '' if since is None else archive.stored(since)
+        rows = [
+            row for row in rows
+            if low <= row[2] and (until is None or row[2] < archive.stored(until))
+        ]
+    return [
+        (row.id, row.author_id, row.author__username, row.created_at, row.text)
+        for row in archive.with_authors(rows)
+    ]
+
+
+class NDJSONEncoder:
+    """One JSON object per message and line."""
+
+    def __init__(self):
+        self.datetime_value = datetime_formatter()
+        self.dumps = json.JSONEncoder(ensure_ascii=False, separators=(',', ':')).encode
+
+    def header(self):
+        return ''
+
+    def encode(self, room_id, rows):
+        datetime_value, dumps = self.datetime_value, self.dumps
+        return ''.join(
+            dumps({
+                'id': pk,
+                'room_id': room_id,
+                'author_id': author_id,
+                'author': username,
+                'created_at': datetime_value(created_at),
+                'text': text,
+            }) + '\n'
+            for pk, author_id, username, created_at, text in rows
+        )
+
+
+class CSVEncoder:
+    """RFC 4180 CSV with a header row."""
+
+    def __init__(self):
+        self.datetime_value = datetime_formatter()
+        self.buffer = io.StringIO()
+        self.writer = csv.writer(self.buffer, lineterminator='\r\n')
+
+    def header(self):
+        self.writer.writerow(COLUMNS)
+        return self.flush()
+
+    def encode(self, room_id, rows):
+        datetime_value = self.datetime_value
+        self.writer.writerows(
+            (pk, room_id, author_id, username, datetime_value(created_at), text)
+            for pk, author_id, username, created_at, text in rows
+        )
+        return self.flush()
+
+    def flush(self):
+        text = self.buffer.getvalue()
+        self.buffer.seek(0)
+        self.buffer.truncate()
+        return text
@@ -0,0 +1,42 @@
+"""
+File-based cache whose writes cost the same however many entries it holds.
+
+Django's ``FileBasedCache`` culls on every ``set()``: it lists the whole
+cache directory to count the entries, so each write (a login, a session
+save) gets slower as the directory grows. ``FileCache`` never culls on
+writes. ``manage.py cull_cache`` deletes the expired entries, then the
+least recently written ones beyond ``MAX_ENTRIES``; it runs hourly from
+``manage.py run_maintenance`` (``MAINTENANCE_SCHEDULE``). Between runs the directory may hold more than
+``MAX_ENTRIES`` entries; expired ones are still never served.
+"""
+import os
+
+from django.core.cache.backends.filebased import FileBasedCache
+
+
+class FileCache(FileBasedCache):
+
+    def _cull(self):
+        pass
+
+    def cull(self):
+        """
+        Delete the expired entries, then the least recently written ones
+        beyond ``MAX_ENTRIES``. Return ``(expired, culled)``.
+        """
+        expired, live = 0, []
+        for fname in self._list_cache_files():
+            try:
+                with open(fname, 'rb') as f:
+                    if self._is_expired(f):
+                        expired += 1
+                        continue
+                live.append((os.path.getmtime(fname), fname))
+            except FileNotFoundError:
+                # Deleted meanwhile, by a request or another run.
+                continue
+        excess = max(len(live) - self._max_entries, 0)
+        live.sort()
+        for _, fname in live[:excess]:
+            self._delete(fname)
+        return expired, excess
@@ -0,0 +1,246 @@
+"""
+WebSocket chat gateway (ASGI).
+
+Clients connect to ``/api/ws/chat/`` for the general room, or to
+``/api/ws/rooms/<room_id>/`` for a room they have joined, with the same
+``sessionid`` cookie the REST API uses. Browsers send that cookie along
+from any page, so a handshake whose ``Origin`` is neither this site (the
+``Host`` the socket was opened on) nor one of ``CSRF_TRUSTED_ORIGINS`` is
+refused before the session is read. Each process holds one broker
+subscription per room with open sockets and fans the room's events out to
+them: the event bytes encoded by the publishing process are decoded to text
+once here, and that one string is queued to every connection in the room.
+
+Client to server::
+
+    {"type": "message.create", "text": "..."}
+
+Server to client::
+
+    {"type": "message.created", "message": {...}}
+    {"type": "message.updated", "message": {...}}
+    {"type": "message.deleted", "id": 123}
+    {"type": "error", "error": "...", "details": {...}}
+"""
+import asyncio
+import json
+import re
+from collections import deque
+from functools import partial
+from importlib import import_module
+from urllib.parse import urlsplit
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import parse_cookie
+from django.http.request import split_domain_port
+from django.utils.http import is_same_domain
+
+from .batching import WriteQueueFull
+from .broker import get_broker
+from . import rooms
+from .events import message_created, room_channel
+from .models import Member, Room
+from .serializers import MessageCreateSerializer
+
+WEBSOCKET_PATH = '/api/ws/chat/'
+ROOM_PATH = re.compile(r'^/api/ws/rooms/(?P<room_id>[0-9]+)/$')
+
+# Events buffered per socket before a client that stopped reading is dropped.
+SEND_BUFFER_SIZE = 256
+
+CLOSE_TRY_AGAIN_LATER = 1013
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_FORBIDDEN = 4403
+CLOSE_NOT_FOUND = 4404
+
+
+class Connection:
+    """One accepted socket with its outgoing event buffer."""
+
+    def __init__(self, send):
+        self.send = send
+        self.pending = deque()
+        self.ready = asyncio.Event()
+        self.overflowed = False
+
+    def push(self, text):
+        if len(self.pending) >= SEND_BUFFER_SIZE:
+            self.overflowed = True
+        else:
+            self.pending.append(text)
+        self.ready.set()
+
+    def push_error(self, error, details=None):
+        self.push(json.dumps(
+            {'type': 'error', 'error': error, 'details': details or {}},
+            separators=(',', ':')
+        ))
+
+    async def write_forever(self):
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            if self.overflowed:
+                await self.send({'type': 'websocket.close', 'code': CLOSE_TRY_AGAIN_LATER})
+                return
+            while self.pending:
+                await self.send({'type': 'websocket.send', 'text': self.pending.popleft()})
+
+
+class Fanout:
+    """
+    Per-process registry of open sockets by room, each room fed by one
+    broker subscription.
+    """
+
+    def __init__(self):
+        self.connections = {}
+        self._loop = None
+        self._unsubscribe = {}
+
+    def add(self, room_id, connection):
+        self._loop = asyncio.get_running_loop()
+        if room_id not in self._unsubscribe:
+            self._unsubscribe[room_id] = get_broker().subscribe(
+                room_channel(room_id), partial(self._on_event, room_id)
+            )
+        self.connections.setdefault(room_id, set()).add(connection)
+
+    def discard(self, room_id, connection):
+        self.connections.get(room_id, set()).discard(connection)
+
+    def _on_event(self, room_id, payload):
+        # Runs on the broker's delivery thread.
+        self._loop.call_soon_threadsafe(self.broadcast, room_id, payload.decode())
+
+    def broadcast(self, room_id, text):
+        for connection in tuple(self.connections.get(room_id, ())):
+            connection.push(text)
+
+
+class ChatGateway:
+    """ASGI application for ``websocket`` scopes."""
+
+    def __init__(self):
+        self.fanout = Fanout()
+
+    async def __call__(self, scope, receive, send):
+        event = await receive()
+        if event['type'] != 'websocket.connect':
+            return
+        room_id = self.room_id(scope['path'])
+        if room_id is None:
+            await send({'type': 'websocket.close', 'code': CLOSE_NOT_FOUND})
+            return
+        if not self.origin_allowed(scope):
+            await send({'type': 'websocket.close', 'code': CLOSE_FORBIDDEN})
+            return
+
+        member = await self.authenticate(scope)
+        if member is None:
+            await send({'type': 'websocket.close', 'code': CLOSE_UNAUTHORIZED})
+            return
+        access = await rooms.aaccess(member, room_id)
+        if access != rooms.FOUND:
+            code = CLOSE_NOT_FOUND if access == rooms.NOT_FOUND else CLOSE_FORBIDDEN
+            await send({'type': 'websocket.close', 'code': code})
+            return
+
+        await send({'type': 'websocket.accept'})
+        connection = Connection(send)
+        self.fanout.add(room_id, connection)
+        writer = asyncio.create_task(connection.write_forever())
+        try:
+            await self.read_forever(receive, member, room_id, connection)
+        finally:
+            self.fanout.discard(room_id, connection)
+            writer.cancel()
+
+    @staticmethod
+    def room_id(path):
+        """The room a socket path is for, or None."""
+        if path == WEBSOCKET_PATH:
+            return Room.GENERAL_ID
+        match = ROOM_PATH.match(path)
+        return int(match['room_id']) if match else None
+
+    @staticmethod
+    def origin_allowed(scope):
+        """
+        Whether the page that opened the socket may use the visitor's
+        session: one served from the same host, or from a trusted origin.
+        Clients that send no ``Origin`` are not browsers and bring their own
+        cookie.
+        """
+        headers = dict(scope['headers'])
+        origin = headers.get(b'origin', b'').decode('latin-1')
+        if not origin:
+            return True
+        parsed = urlsplit(origin)
+        if not parsed.scheme or not parsed.netloc:
+            return False
+        domain = split_domain_port(parsed.netloc)[0]
+        host = split_domain_port(headers.get(b'host', b'').decode('latin-1'))[0]
+        if host and domain == host:
+            return True
+        for trusted in settings.CSRF_TRUSTED_ORIGINS:
+            trusted = urlsplit(trusted)
+            if trusted.scheme != parsed.scheme:
+                continue
+            # As in CsrfViewMiddleware: "https://*.example.com" trusts its subdomains.
+            if trusted.netloc.startswith('*.'):
+                if is_same_domain(parsed.netloc, trusted.netloc[1:]):
+                    return True
+            elif trusted.netloc == parsed.netloc:
+                return True
+        return False
+
+    async def authenticate(self, scope):
+        """Resolve the member from the session cookie, or return None."""
+        cookie = b'; '.join(value for name, value in scope['headers'] if name == b'cookie')
+        session_key = parse_cookie(cookie.decode('latin-1')).get(settings.SESSION_COOKIE_NAME)
+        if not session_key:
+            return None
+        session = import_module(settings.SESSION_ENGINE).SessionStore(session_key)
+        member_id = await session.aget('member_id')
+        if not member_id:
+            return None
+        return await Member.objects.filter(id=member_id).afirst()
+
+    async def read_forever(self, receive, member, room_id, connection):
+        while True:
+            event = await receive()
+            if event['type'] == 'websocket.disconnect':
+                return
+            if event['type'] != 'websocket.receive':
+                continue
+            try:
+                data = json.loads(event.get('text') or event.get('bytes') or b'')
+            except ValueError:
+                connection.push_error("Invalid JSON")
+                continue
+            if not isinstance(data, dict) or data.get('type') != 'message.create':
+                connection.push_error("Unsupported event type")
+                continue
+            errors = await self.create_message(member, room_id, data)
+            if errors:
+                connection.push_error("Validation failed", errors)
+
+    @staticmethod
+    @sync_to_async
+    def create_message(member, room_id, data):
+        """
+        Validate and save a message in a room; it reaches every socket in
+        the room, this one included, through the broker. Return validation
+        errors, if any.
+        """
+        serializer = MessageCreateSerializer(data={'text': data.get('text')})
+        if not serializer.is_valid():
+            return serializer.errors
+        try:
+            message = serializer.save(author=member, room_id=room_id)
+        except (WriteQueueFull, TimeoutError):
+            return {'non_field_errors': ['Server is busy, retry shortly']}
+        message_created(message)
+        return None
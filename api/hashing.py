@@ -0,0 +1,205 @@
+"""
+Password hashing on a bounded per-process pool.
+
+Hashing a password with PBKDF2 costs tens to hundreds of milliseconds of
+CPU. Login and registration, sync and async alike, hand it to one thread
+pool per process, so a login storm is capped at ``PASSWORD_HASHING['WORKERS']``
+hashes at a time instead of occupying every request worker, and never
+blocks the event loop. hashlib releases the GIL while hashing, so the
+pool's threads run in parallel.
+
+At most ``MAX_QUEUE`` hashes wait behind the running ones. Beyond that
+``HashingBusy`` is raised at once, and the views answer 503 with
+``Retry-After`` rather than queueing requests that would time out anyway.
+
+Unknown emails are checked against a dummy hash made with the current
+parameters, so a failed lookup costs one hash like a wrong password does.
+A successful check against a hash made with other parameters (a different
+preferred hasher or iteration count) re-hashes the password and stores it.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+
+from django.conf import settings
+from django.contrib.auth import hashers
+from django.utils.crypto import get_random_string
+
+from . import stats
+from .models import Member
+
+
+class PBKDF2PasswordHasher(hashers.PBKDF2PasswordHasher):
+    """PBKDF2-SHA256 with ``PASSWORD_HASHING['PBKDF2_ITERATIONS']`` iterations."""
+
+    @property
+    def iterations(self):
+        return settings.PASSWORD_HASHING['PBKDF2_ITERATIONS']
+
+
+class HashingBusy(Exception):
+    """The hashing queue is at capacity; the caller should retry later."""
+
+
+class PasswordHashingPool:
+    def __init__(self, workers, max_queue=64, timeout=10.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix='password-hashing'
+        )
+        self._slots = threading.BoundedSemaphore(workers + max_queue)
+        self._lock = threading.Lock()
+        self._dummy_hash = None
+        self.in_flight = 0
+        self.completed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.rehashed = 0
+        self.latency = stats.Histogram(
+            [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0]
+        )
+
+    def submit(self, func, *args):
+        """
+        Run ``func(*args)`` on the pool and return its future.
+
+        Raises ``HashingBusy`` when ``workers + max_queue`` calls are
+        already queued or running.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.rejected += 1
+            raise HashingBusy()
+        with self._lock:
+            self.in_flight += 1
+        started = time.perf_counter()
+
+        def done(future):
+            self.latency.observe(time.perf_counter() - started)
+            with self._lock:
+                self.in_flight -= 1
+                self.completed += 1
+            self._slots.release()
+
+        try:
+            future = self._executor.submit(func, *args)
+        except BaseException:
+            done(None)
+            raise
+        future.add_done_callback(done)
+        return future
+
+    def run(self, func, *args):
+        """``submit`` and wait; raises ``TimeoutError`` after ``timeout``."""
+        future = self.submit(func, *args)
+        try:
+            return future.result(timeout=self.timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            self._timed_out()
+
+    async def arun(self, func, *args):
+        """``run`` for async views."""
+        future = asyncio.wrap_future(self.submit(func, *args))
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._timed_out()
+
+    def _timed_out(self):
+        with self._lock:
+            self.timeouts += 1
+        raise TimeoutError("Password hashing timed out")
+
+    def dummy_hash(self):
+        """A hash of a random password, made with the current parameters."""
+        encoded = self._dummy_hash
+        preferred = hashers.get_hasher()
+        if (encoded is None or not encoded.startswith(preferred.algorithm + '$')
+                or preferred.must_update(encoded)):
+            encoded = self._dummy_hash = hashers.make_password(get_random_string(32))
+        return encoded
+
+    def verify(self, raw_password, encoded):
+        """
+        Return ``(valid, new_hash)``; ``new_hash`` is set when the password is
+        valid but ``encoded`` was made with other hasher parameters.
+        Runs on the pool.
+        """
+        if encoded is None:
+            hashers.check_password(raw_password, self.dummy_hash())
+            return False, None
+        new_hash = []
+        valid = hashers.check_password(
+            raw_password, encoded,
+            setter=lambda raw: new_hash.append(hashers.make_password(raw)),
+        )
+        return valid, (new_hash[0] if new_hash else None)
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'max_queue': self.max_queue,
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'rehashed': self.rehashed,
+            'latency_seconds': self.latency.snapshot(),
+        }
+
+
+password_hashing = PasswordHashingPool(
+    workers=settings.PASSWORD_HASHING['WORKERS'],
+    max_queue=settings.PASSWORD_HASHING['MAX_QUEUE'],
+    timeout=settings.PASSWORD_HASHING['TIMEOUT'],
+)
+stats.register('password_hashing', password_hashing.stats)
+
+
+def make_password(raw_password):
+    """``make_password`` on the hashing pool."""
+    return password_hashing.run(hashers.make_password, raw_password)
+
+
+async def amake_password(raw_password):
+    """``make_password`` for async views."""
+    return await password_hashing.arun(hashers.make_password, raw_password)
+
+
+def _encoded(member):
+    return member.password_hash if member is not None else None
+
+
+# A new hash is stored with a queryset update: it is in no cached
+# representation or ETag, so it neither bumps updated_at nor fires the
+# member signals.
+
+def check_password(member, raw_password):
+    """
+    Check ``raw_password`` for ``member`` (None for an unknown email) on the
+    hashing pool, re-hashing it if the hasher parameters have changed.
+    """
+    valid, new_hash = password_hashing.run(
+        password_hashing.verify, raw_password, _encoded(member)
+    )
+    if new_hash:
+        member.password_hash = new_hash
+        Member.objects.filter(pk=member.pk).update(password_hash=new_hash)
+        password_hashing.rehashed += 1
+    return valid
+
+
+async def acheck_password(member, raw_password):
+    """``check_password`` for async views."""
+    valid, new_hash = await password_hashing.arun(
+        password_hashing.verify, raw_password, _encoded(member)
+    )
+    if new_hash:
+        member.password_hash = new_hash
+        await Member.objects.filter(pk=member.pk).aupdate(password_hash=new_hash)
+        password_hashing.rehashed += 1
+    return valid
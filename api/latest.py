@@ -0,0 +1,318 @@
+"""
+Pre-encoded first page of each room's message list.
+
+Nearly all list traffic asks for the newest page. This cache keeps the newest
+``LATEST_MESSAGES_CACHE['SIZE']`` messages of a room already rendered to
+JSON, one fragment per message, in a cache shared by every worker (point the
+``latest-messages`` alias at a LocMemCache to keep it per process instead).
+A first-page request is answered by joining fragments, without evaluating a
+queryset or running a serializer.
+
+There is one entry per room, so posts to a busy room never touch a quiet
+room's entry. Entries are kept current incrementally: a posted message is
+prepended and a member's profile change rewrites the author of their
+messages in every cached room. Each entry records the newest message,
+member change and change-feed ``seq`` of the room it reflects, and it is
+only served when those match the head already looked up for the ETag, so a
+lost or out-of-order update (say, an edit committed while the entry was
+being rebuilt) costs a rebuild, never a stale page. Entries built by an older renderer (see
+api.rendering) are rebuilt the same way.
+"""
+import json
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import Subquery
+from django.db.models.expressions import RawSQL
+from django.http import HttpResponse
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import rendering, rooms, stats
+from .conditional import latest_change
+from .models import Member, Message, MessageArchiveChunk, MessageChange
+from .pagination import MessagesCursorPagination, MessagesPagination
+from .readpath import COMPACT_PARAM, FIELDS_PARAM, message_rows, serialize_messages
+from .renderers import FastJSONRenderer
+from .serializers import MessageAuthorSerializer
+
+
+class LatestMessagesCache:
+    prefix = 'latest-messages'
+    # The rooms that may have an entry, for re-embedding changed members.
+    rooms_key = 'latest-messages:rooms'
+
+    def __init__(self, alias, size, enabled=True):
+        self.alias = alias
+        self.size = size
+        self.enabled = enabled
+        self.renderer = FastJSONRenderer()
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.pushes = 0
+        self.conflicts = 0
+        self.author_updates = 0
+        self.invalidations = 0
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, room_id):
+        return f'{self.prefix}:{room_id}'
+
+    def encode(self, data):
+        return self.renderer.render(data)
+
+    def get_page_size(self, request):
+        """
+        Return the page size if ``request`` asks for the first page in a
+        form this cache can answer, otherwise None.
+        """
+        params = request.query_params
+        if COMPACT_PARAM in params or FIELDS_PARAM in params:
+            return None
+        if MessagesCursorPagination.is_requested(request):
+            if params.get(MessagesCursorPagination.before_query_param) or \
+                    MessagesCursorPagination.after_query_param in params:
+                return None
+            page_size = MessagesCursorPagination().get_page_size(request)
+        else:
+            if params.get(MessagesPagination.page_query_param, '1') != '1':
+                return None
+            page_size = MessagesPagination().get_page_size(request)
+        return page_size if page_size <= self.size else None
+
+    def cacheable_page_size(self, request):
+        """Return the page size to serve from the cache, or None to bypass it."""
+        if not self.enabled:
+            return None
+        page_size = self.get_page_size(request)
+        if page_size is None or request.accepted_media_type != JSONRenderer.media_type:
+            self.bypassed += 1
+            return None
+        return page_size
+
+    def response(self, request, room_id, head):
+        """
+        Serve a room's first page from the cache, rebuilding it if it does
+        not match ``head`` (see ``conditional.messages_head``). Return None
+        if the request is not for a first page rendered as plain JSON.
+        """
+        page_size = self.cacheable_page_size(request)
+        if page_size is None:
+            return None
+
+        state = self.cache.get(self.key(room_id))
+        if state is None or not self.matches(state, head):
+            self.misses += 1
+            state = self.rebuild(room_id)
+        else:
+            self.hits += 1
+        return self.render_page(request, state, page_size)
+
+    async def aresponse(self, request, room_id, head):
+        """``response`` for async views."""
+        page_size = self.cacheable_page_size(request)
+        if page_size is None:
+            return None
+
+        state = await self.cache.aget(self.key(room_id))
+        if state is None or not self.matches(state, head):
+            self.misses += 1
+            state = await self.arebuild(room_id)
+        else:
+            self.hits += 1
+        return self.render_page(request, state, page_size)
+
+    def render_page(self, request, state, page_size):
+        rows = state['rows'][:page_size]
+        has_more = state['count'] > page_size
+        url = request.build_absolute_uri()
+        if MessagesCursorPagination.is_requested(request):
+            next_link = None
+            if rows and has_more:
+                message_id, created_at = rows[-1][:2]
+                next_link = replace_query_param(
+                    remove_query_param(url, MessagesCursorPagination.after_query_param),
+                    MessagesCursorPagination.before_query_param,
+                    MessagesCursorPagination.make_cursor(created_at, message_id),
+                )
+            envelope = {'next': next_link, 'previous': None}
+        else:
+            next_link = None
+            if has_more:
+                next_link = replace_query_param(url, MessagesPagination.page_query_param, 2)
+            envelope = {'count': state['count'], 'next': next_link, 'previous': None}
+
+        # Same bytes JSONRenderer produces for the envelope with 'results' last.
+        body = b''.join([
+            self.encode(envelope)[:-1],
+            b',"results":[',
+            b','.join(row[3] for row in rows),
+            b']}',
+        ])
+        return HttpResponse(body, content_type=JSONRenderer.media_type)
+
+    @staticmethod
+    def matches(state, head):
+        if state.get('renderer_version') != rendering.VERSION:
+            return False
+        if head is None:
+            return state['head_id'] is None
+        message_id, members_changed, change_seq = head[0], head[2], head[3]
+        return (
+            state['head_id'] == message_id
+            and state['members_changed'] == members_changed
+            # Entries from before change_seq was recorded never match.
+            and state.get('change_seq', -1) == change_seq
+        )
+
+    def rebuild_queryset(self, room_id):
+        """A room's newest messages, total and head, in one statement."""
+        members_changed = Member.objects.order_by('-updated_at').values('updated_at')[:1]
+        return message_rows(
+            rooms.messages(room_id).annotate(
+                members_changed=Subquery(members_changed),
+                change_seq=Subquery(latest_change(room_id)),
+                # Page-number counts include the archive (see api.archive.History).
+                total=RawSQL(
+                    f'SELECT (SELECT COUNT(*) FROM "{Message._meta.db_table}" WHERE "room_id" = %s) + '
+                    f'(SELECT COALESCE(SUM("count"), 0) FROM "{MessageArchiveChunk._meta.db_table}" '
+                    f'WHERE "room_id" = %s)',
+                    (room_id, room_id)
+                ),
+            ).order_by('-created_at', '-id'),
+            'members_changed',
+            'change_seq',
+            'total',
+        )[:self.size]
+
+    def build_state(self, messages):
+        newest = messages[0] if messages else None
+        return {
+            'head_id': newest.id if newest else None,
+            'members_changed': newest.members_changed if newest else None,
+            'change_seq': newest.change_seq if newest else None,
+            'count': newest.total if newest else 0,
+            'renderer_version': rendering.VERSION,
+            'rows': [
+                (message.id, message.created_at, message.author_id, self.encode(data))
+                for message, data in zip(messages, serialize_messages(messages))
+            ],
+        }
+
+    def rebuild(self, room_id):
+        state = self.build_state(list(self.rebuild_queryset(room_id)))
+        cached = self.cache.get(self.rooms_key) or set()
+        if room_id not in cached:
+            self.cache.set(self.rooms_key, cached | {room_id}, None)
+        self.cache.set(self.key(room_id), state, None)
+        return state
+
+    async def arebuild(self, room_id):
+        messages = [row async for row in self.rebuild_queryset(room_id)]
+        state = self.build_state(await rendering.arefresh(messages))
+        cached = await self.cache.aget(self.rooms_key) or set()
+        if room_id not in cached:
+            await self.cache.aset(self.rooms_key, cached | {room_id}, None)
+        await self.cache.aset(self.key(room_id), state, None)
+        return state
+
+    def push(self, message, encoded):
+        """
+        Prepend a committed message, given its rendered JSON. The entry is
+        only extended if it ends at the message just before this one, and
+        if the message's creation is the room's next change after it.
+        """
+        if not self.enabled:
+            return
+        key = self.key(message.room_id)
+        state = self.cache.get(key)
+        if state is None:
+            return
+        previous_id = (
+            rooms.messages(message.room_id).filter(
+                MessagesCursorPagination.older_than(message.created_at, message.id)
+            )
+            .order_by('-created_at', '-id')
+            .values_list('id', flat=True)
+            .first()
+        )
+        if previous_id != state['head_id']:
+            self.conflicts += 1
+            return
+        next_change = (
+            MessageChange.objects.using(rooms.database(message.room_id))
+            .filter(room_id=message.room_id, seq__gt=state.get('change_seq') or 0)
+            .order_by('seq')
+            .values_list('op', 'message_id', 'seq')
+            .first()
+        )
+        if next_change is None or next_change[:2] != (MessageChange.CREATED, message.id):
+            self.conflicts += 1
+            return
+        state['head_id'] = message.id
+        state['change_seq'] = next_change[2]
+        state['count'] += 1
+        state['rows'].insert(0, (message.id, message.created_at, message.author_id, encoded))
+        del state['rows'][self.size:]
+        self.cache.set(key, state, None)
+        self.pushes += 1
+
+    def member_changed(self, member):
+        """Re-embed a saved member's current details in their cached messages."""
+        if not self.enabled:
+            return
+        keys = [self.key(room_id) for room_id in self.cache.get(self.rooms_key) or ()]
+        if not keys:
+            return
+        author = MessageAuthorSerializer(member).data
+        states = self.cache.get_many(keys)
+        for state in states.values():
+            rows = []
+            for row in state['rows']:
+                if row[2] == member.pk:
+                    data = json.loads(row[3])
+                    data['author'] = author
+                    row = row[:3] + (self.encode(data),)
+                rows.append(row)
+            state['rows'] = rows
+            if state['members_changed'] is None or member.updated_at > state['members_changed']:
+                state['members_changed'] = member.updated_at
+        self.cache.set_many(states, None)
+        self.author_updates += 1
+
+    def invalidate(self, room_id):
+        """Drop a room's entry, e.g. after one of its messages was edited or deleted."""
+        self.cache.delete(self.key(room_id))
+        self.invalidations += 1
+
+    def clear(self):
+        """Drop every room's entry."""
+        keys = [self.key(room_id) for room_id in self.cache.get(self.rooms_key) or ()]
+        self.cache.delete_many([*keys, self.rooms_key])
+        self.invalidations += 1
+
+    def stats(self):
+        served = self.hits + self.misses
+        return {
+            'enabled': self.enabled,
+            'hits': self.hits,
+            'misses': self.misses,
+            'bypassed': self.bypassed,
+            'hit_ratio': self.hits / served if served else None,
+            'pushes': self.pushes,
+            'conflicts': self.conflicts,
+            'author_updates': self.author_updates,
+            'invalidations': self.invalidations,
+        }
+
+
+latest_messages = LatestMessagesCache(
+    alias=settings.LATEST_MESSAGES_CACHE['ALIAS'],
+    size=settings.LATEST_MESSAGES_CACHE['SIZE'],
+    enabled=settings.LATEST_MESSAGES_CACHE['ENABLED'],
+)
+stats.register('latest_messages', latest_messages.stats)
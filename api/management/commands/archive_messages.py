@@ -0,0 +1,48 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import archive
+from api.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Move messages older than the hot window into compressed monthly "
+        "archive chunks, room by room, one short transaction per batch (see "
+        "api.archive). Safe to run while the server is up; run_maintenance "
+        "runs it daily."
+    )
+
+    def add_arguments(self, parser):
+        retention = settings.MESSAGE_RETENTION
+        parser.add_argument('--hot-days', type=float, default=retention['HOT_DAYS'],
+                            help=f"keep messages newer than this many days (default: {retention['HOT_DAYS']:g})")
+        parser.add_argument('--batch-size', type=int, default=retention['BATCH_SIZE'],
+                            help=f"messages per transaction (default: {retention['BATCH_SIZE']})")
+        parser.add_argument('--pause', type=float, default=retention['PAUSE'],
+                            help=f"seconds between batches (default: {retention['PAUSE']:g})")
+        parser.add_argument('--max-batches', type=int,
+                            help='stop after this many batches (default: until done)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        started = time.monotonic()
+        moved = batches = 0
+        for room in Room.objects.order_by('id'):
+            cutoff, keep = archive.hot_bounds(room.id, options['hot_days'])
+            while options['max_batches'] is None or batches < options['max_batches']:
+                count = archive.archive_batch(room.id, cutoff, keep, options['batch_size'])
+                if not count:
+                    break
+                moved += count
+                batches += 1
+                self.stdout.write(
+                    f"archived {moved} messages older than {cutoff:%Y-%m-%d %H:%M} (room {room.name})"
+                )
+                time.sleep(options['pause'])
+        elapsed = time.monotonic() - started
+        self.stdout.write(f"Archived {moved} messages in {batches} batches ({elapsed:.1f}s).")
+
@@ -0,0 +1,25 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import attachments
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete uploads left unfinished beyond the TTL, and stored files and "
+        "thumbnails no attachment uses (see api.attachments). Safe to run "
+        "while the server is up; run_maintenance runs it hourly."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--ttl-hours', type=float,
+                            default=settings.ATTACHMENTS['UPLOAD_TTL_HOURS'],
+                            help='delete uploads idle for this many hours (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if options['ttl_hours'] < 0:
+            raise CommandError("--ttl-hours must not be negative.")
+        uploads, files = attachments.clean(options['ttl_hours'])
+        self.stdout.write(
+            f"Cleaned attachments: {uploads} unfinished uploads, {files} unused files deleted."
+        )
@@ -0,0 +1,30 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from api import changes
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the message changes every client has synced past and forget "
+        "clients not seen within the TTL (see api.changes). Safe to run "
+        "while the server is up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.MESSAGE_CHANGES['COMPACT_BATCH_SIZE'],
+                            help='changes deleted per transaction (default: %(default)s)')
+        parser.add_argument('--ttl-days', type=float,
+                            default=settings.MESSAGE_CHANGES['CURSOR_TTL_DAYS'],
+                            help='forget clients not seen for this many days (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        if options['ttl_days'] < 0:
+            raise CommandError("--ttl-days must not be negative.")
+        deleted, expired = changes.compact(options['batch_size'], options['ttl_days'])
+        self.stdout.write(
+            f"Compacted message changes: {deleted} deleted, {expired} expired client cursors."
+        )
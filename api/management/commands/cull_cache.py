@@ -0,0 +1,28 @@
+from django.core.cache import InvalidCacheBackendError, caches
+from django.core.management.base import BaseCommand, CommandError
+
+from api.filecache import FileCache
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete the expired entries of a file cache, then the least recently "
+        "written ones beyond its MAX_ENTRIES (see api.filecache). Run it "
+        "periodically; safe to run while the server is up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--alias', default='sessions',
+                            help='cache to cull (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        try:
+            cache = caches[options['alias']]
+        except InvalidCacheBackendError:
+            raise CommandError(f"No cache named {options['alias']!r}.")
+        if not isinstance(cache, FileCache):
+            raise CommandError(f"Cache {options['alias']!r} is not an api.filecache.FileCache.")
+        expired, culled = cache.cull()
+        self.stdout.write(
+            f"Culled cache {options['alias']!r}: {expired} expired, {culled} beyond MAX_ENTRIES."
+        )
@@ -0,0 +1,56 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from api import export
+
+
+def datetime_argument(value):
+    parsed = parse_datetime(value)
+    if parsed is None:
+        raise ValueError(value)
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+
+class Command(BaseCommand):
+    help = (
+        "Write every message, or one room's, one author's or those in a date "
+        "range, oldest first, as NDJSON or CSV (see api.export). Reads in "
+        "short batches, so it is safe to run while the server is up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=export.FORMATS, default='ndjson',
+                            help='output format (default: %(default)s)')
+        parser.add_argument('--room', type=int, help='only this room')
+        parser.add_argument('--author', type=int, help='only messages by this member')
+        parser.add_argument('--since', type=datetime_argument,
+                            help='only messages created at or after this ISO 8601 time')
+        parser.add_argument('--until', type=datetime_argument,
+                            help='only messages created before this ISO 8601 time')
+        parser.add_argument('--batch-size', type=int,
+                            default=settings.MESSAGE_EXPORT['BATCH_SIZE'],
+                            help='messages per query (default: %(default)s)')
+        parser.add_argument('--output', help='write to this file (default: standard output)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        if options['since'] and options['until'] and options['since'] >= options['until']:
+            raise CommandError("--until must be later than --since.")
+        batches = export.export(
+            room_id=options['room'],
+            author_id=options['author'],
+            since=options['since'],
+            until=options['until'],
+            format=options['format'],
+            batch_size=options['batch_size'],
+        )
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as output:
+                for text in batches:
+                    output.write(text)
+            return
+        for text in batches:
+            self.stdout.write(text, ending='')
@@ -0,0 +1,217 @@
+import contextlib
+import itertools
+import math
+import random
+import time
+from datetime import datetime, timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.utils import timezone
+
+from api import activity, changes, rendering
+from api.latest import latest_messages
+from api.models import (
+    ChangeCursor,
+    Member,
+    Message,
+    MessageArchiveAuthor,
+    MessageArchiveChunk,
+    MessageChange,
+    Room,
+    RoomMembership,
+)
+
+WORDS = (
+    'the be to of and a in that have it for not on with he as you do at this '
+    'but his by from they we say her she or an will my one all would there '
+    'their what so up out if about who get which go me when make can like '
+    'time no just him know take people into year your good some could them '
+    'see other than then now look only come its over think also back after '
+    'use two how our work first well way even new want because any these '
+    'give day most us deploy build release merge review ship test bug fix '
+    'lunch coffee meeting standup later tomorrow today thanks ok sure yes '
+    'lol nice great done ping pong chat message server client cache query'
+).split()
+
+
+@contextlib.contextmanager
+def explicit_timestamps(*fields):
+    """Let bulk_create keep the given auto_now/auto_now_add values."""
+    saved = [(field, field.auto_now, field.auto_now_add) for field in fields]
+    for field in fields:
+        field.auto_now = field.auto_now_add = False
+    try:
+        yield
+    finally:
+        for field, auto_now, auto_now_add in saved:
+            field.auto_now, field.auto_now_add = auto_now, auto_now_add
+
+
+class Command(BaseCommand):
+    help = (
+        "Generate synthetic members and messages for load and performance "
+        "testing: Zipf-skewed authors, log-normal text lengths and timestamps "
+        "spread over a time window. The same seed produces the same dataset."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000,
+                            help='members to create (default: 1000)')
+        parser.add_argument('--messages', type=int, default=100000,
+                            help='messages to create (default: 100000)')
+        parser.add_argument('--author-skew', type=float, default=1.1,
+                            help='Zipf exponent of messages per author; 0 is uniform (default: 1.1)')
+        parser.add_argument('--text-median', type=int, default=60,
+                            help='median message length in characters (default: 60)')
+        parser.add_argument('--text-sigma', type=float, default=1.0,
+                            help='log-normal sigma of message lengths (default: 1.0)')
+        parser.add_argument('--days', type=float, default=365,
+                            help='messages are spread over this many days (default: 365)')
+        parser.add_argument('--end', type=datetime.fromisoformat,
+                            help='timestamp of the newest message, ISO 8601 (default: now)')
+        parser.add_argument('--password', default='password123',
+                            help='password of every generated member (default: password123)')
+        parser.add_argument('--prefix', default='user',
+                            help='username and email prefix (default: user)')
+        parser.add_argument('--seed', type=int, default=0,
+                            help='random seed (default: 0)')
+        parser.add_argument('--chunk-size', type=int, default=10000,
+                            help='rows per bulk_create call (default: 10000)')
+        parser.add_argument('--transaction-size', type=int, default=500000,
+                            help='rows per transaction (default: 500000)')
+        parser.add_argument('--clear', action='store_true',
+                            help='delete all members and messages first')
+
+    def handle(self, *args, **options):
+        if options['members'] < 1 and options['messages'] > 0:
+            raise CommandError("Messages need at least one member.")
+        if options['chunk_size'] < 1 or options['transaction_size'] < 1:
+            raise CommandError("--chunk-size and --transaction-size must be positive.")
+
+        self.rng = random.Random(options['seed'])
+        self.chunk_size = options['chunk_size']
+        self.transaction_size = options['transaction_size']
+
+        if options['clear']:
+            self.clear()
+
+        end = options['end'] or timezone.now()
+        if timezone.is_naive(end):
+            end = timezone.make_aware(end)
+        start = end - timedelta(days=options['days'])
+
+        member_ids = self.create_members(options, start)
+        self.create_messages(options, member_ids, start, end)
+        # bulk_create bypasses the posting path, so count in one pass at the end.
+        fixed = activity.reconcile()
+        self.stdout.write(f"member counters: {fixed} updated")
+
+        with connection.cursor() as cursor:
+            if connection.vendor == 'sqlite':
+                cursor.execute('PRAGMA optimize')
+
+    def clear(self):
+        # Plain DELETEs: the ORM would load every row to send delete signals.
+        with transaction.atomic(), changes.paused('generate_dataset'), connection.cursor() as cursor:
+            for model in (MessageArchiveAuthor, MessageArchiveChunk, MessageChange, ChangeCursor,
+                          RoomMembership, Message):
+                cursor.execute(f'DELETE FROM {connection.ops.quote_name(model._meta.db_table)}')
+            cursor.execute(
+                f'DELETE FROM {connection.ops.quote_name(Room._meta.db_table)} WHERE id != %s',
+                [Room.GENERAL_ID]
+            )
+            cursor.execute(f'DELETE FROM {connection.ops.quote_name(Member._meta.db_table)}')
+        latest_messages.clear()
+
+    def create_members(self, options, start):
+        count = options['members']
+        # One hash for everyone: hashing a million passwords would take
+        # longer than generating every other row.
+        password_hash = make_password(options['password'])
+        prefix = options['prefix']
+        first = Member.objects.filter(username__startswith=prefix).count()
+        created = []
+
+        def members(offset, size):
+            for n in range(first + offset, first + offset + size):
+                joined = start + timedelta(seconds=n % 86400)
+                member = Member(
+                    username=f'{prefix}{n}',
+                    email=f'{prefix}{n}@example.com',
+                    password_hash=password_hash,
+                    created_at=joined,
+                    updated_at=joined,
+                )
+                created.append(member)
+                yield member
+
+        self.load(Member, count, members, 'members')
+        # bulk_create sets primary keys on SQLite 3.35+ (RETURNING).
+        return [member.pk for member in created]
+
+    def create_messages(self, options, member_ids, start, end):
+        count = options['messages']
+        if not count:
+            return
+        rng = self.rng
+
+        # Zipf: the author at rank r posts in proportion to 1 / r**skew.
+        # Ranks are shuffled so the most active author is not the oldest.
+        authors = list(member_ids)
+        rng.shuffle(authors)
+        skew = options['author_skew']
+        cum_weights = list(itertools.accumulate(
+            1 / rank ** skew for rank in range(1, len(authors) + 1)
+        ))
+
+        # Texts are slices of one long random corpus, cut at log-normal lengths.
+        corpus = ' '.join(rng.choices(WORDS, k=200000))
+        max_length = Message._meta.get_field('text').max_length
+        mu, sigma = math.log(max(options['text_median'], 1)), options['text_sigma']
+
+        # Timestamps are evenly spaced with jitter, so they rise with the id
+        # just as real posts do.
+        step = (end - start).total_seconds() / count
+
+        def messages(offset, size):
+            chosen = rng.choices(authors, cum_weights=cum_weights, k=size)
+            for i, author_id in enumerate(chosen, offset):
+                length = min(max(int(rng.lognormvariate(mu, sigma)), 1), max_length)
+                at = rng.randrange(len(corpus) - max_length)
+                text = corpus[at:at + length].strip() or 'hi'
+                created_at = start + timedelta(seconds=(i + rng.random()) * step)
+                yield Message(
+                    author_id=author_id,
+                    text=text,
+                    # The corpus mentions nobody: no members to look up.
+                    rendered_html=rendering.render(text, {}),
+                    renderer_version=rendering.VERSION,
+                    created_at=created_at,
+                )
+
+        self.load(Message, count, messages, 'messages')
+
+    def load(self, model, count, generate, label):
+        """Insert ``count`` rows made by ``generate(offset, size)`` in chunks."""
+        timestamps = [
+            field for field in model._meta.concrete_fields
+            if getattr(field, 'auto_now', False) or getattr(field, 'auto_now_add', False)
+        ]
+        started = time.monotonic()
+        done = 0
+        with explicit_timestamps(*timestamps):
+            while done < count:
+                # Seed data is history, not changes for clients to sync.
+                with transaction.atomic(), changes.paused('generate_dataset'):
+                    end = min(done + self.transaction_size, count)
+                    while done < end:
+                        size = min(self.chunk_size, end - done)
+                        model.objects.bulk_create(generate(done, size), batch_size=size)
+                        done += size
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f"{label}: {done}/{count} ({done / elapsed if elapsed else 0:.0f} rows/s)"
+                )
+
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from api import activity
+
+
+class Command(BaseCommand):
+    help = (
+        "Recompute every member's message_count and last_message_at from "
+        "the messages and the archive, and fix the ones that drifted (see "
+        "api.activity). Safe to run while the server is up."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='members per transaction (default: 1000)')
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        fixed = activity.reconcile(options['batch_size'])
+        self.stdout.write(f"Reconciled member counters: {fixed} corrected.")
@@ -0,0 +1,108 @@
+import multiprocessing
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction
+
+from api import archive, rendering, rooms
+from api.models import Room
+
+
+class Command(BaseCommand):
+    help = (
+        "Render the messages stored by an older version of the message "
+        "renderer again, hot and archived, room by room (see api.rendering). "
+        "Rendering runs on a pool of worker processes; each batch is written "
+        "back in a short transaction, skipping messages edited meanwhile. "
+        "Safe to run while the server is up."
+    )
+
+    def add_arguments(self, parser):
+        rendering_settings = settings.MESSAGE_RENDERING
+        parser.add_argument('--workers', type=int, default=rendering_settings['WORKERS'],
+                            help='worker processes (default: %(default)s)')
+        parser.add_argument('--batch-size', type=int, default=rendering_settings['BATCH_SIZE'],
+                            help='messages per task and transaction (default: %(default)s)')
+
+    def handle(self, *args, **options):
+        if options['workers'] < 1:
+            raise CommandError("--workers must be positive.")
+        if options['batch_size'] < 1:
+            raise CommandError("--batch-size must be positive.")
+        started = time.monotonic()
+        self.messages = self.chunks = 0
+        # Workers only render: spawned, they never inherit the database connections.
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(options['workers'], mp_context=context) as pool:
+            # Enough tasks in flight to keep every worker busy while batches are read and written.
+            self.pool, self.in_flight = pool, deque()
+            self.limit = 2 * options['workers']
+            for room in Room.objects.order_by('id'):
+                self.render_hot(room.id, options['batch_size'])
+                self.render_archive(room.id)
+            self.drain(0)
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            f"Rendered {self.messages} messages and {self.chunks} archive chunks "
+            f"with renderer version {rendering.VERSION} ({elapsed:.1f}s)."
+        )
+
+    def submit(self, texts, write):
+        """Render ``texts`` on the pool, then call ``write(html)`` here."""
+        self.drain(self.limit - 1)
+        future = self.pool.submit(rendering.render_batch, texts, rendering.members_for(texts))
+        self.in_flight.append((future, write))
+
+    def drain(self, keep):
+        """Write finished tasks, oldest first, until at most ``keep`` are in flight."""
+        while len(self.in_flight) > keep:
+            future, write = self.in_flight.popleft()
+            write(future.result())
+
+    def render_hot(self, room_id, batch_size):
+        stale = rooms.messages(room_id).exclude(renderer_version=rendering.VERSION).order_by('id')
+        last_id = 0
+        while True:
+            rows = list(stale.filter(id__gt=last_id).values_list('id', 'text')[:batch_size])
+            if not rows:
+                return
+            self.submit([text for _, text in rows], self.hot_writer(rooms.database(room_id), rows))
+            last_id = rows[-1][0]
+
+    def hot_writer(self, using, rows):
+        def write(html):
+            # Rendering is not a change to the text: the feed triggers do not fire.
+            with transaction.atomic(using=using), connections[using].cursor() as cursor:
+                cursor.executemany(
+                    'UPDATE messages SET rendered_html = %s, renderer_version = %s '
+                    'WHERE id = %s AND text = %s',
+                    [(value, rendering.VERSION, pk, text) for (pk, text), value in zip(rows, html)]
+                )
+                self.messages += cursor.rowcount
+        return write
+
+    def render_archive(self, room_id):
+        chunks = archive.archive_chunks(room_id)
+        # One chunk per query, so no read stays open while batches are written.
+        for pk in list(chunks.order_by('first_created_at', 'first_id').values_list('id', flat=True)):
+            chunk = chunks.get(pk=pk)
+            rows = [archive.rendered_row(row) for row in archive.decode_payload(chunk.payload)[0]]
+            stale = [row for row in rows if row[5] != rendering.VERSION]
+            if stale:
+                self.submit([row[3] for row in stale], self.chunk_writer(chunk, rows, stale))
+
+    def chunk_writer(self, chunk, rows, stale):
+        def write(html):
+            for row, value in zip(stale, html):
+                row[4:] = [value, rendering.VERSION]
+            payload, checksum = archive.encode_payload(rows)
+            # Unless the chunk was rewritten meanwhile.
+            if archive.archive_chunks(chunk.room_id).filter(pk=chunk.pk, checksum=chunk.checksum).update(
+                payload=payload, checksum=checksum
+            ):
+                self.chunks += 1
+                self.messages += len(stale)
+        return write
@@ -0,0 +1,41 @@
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the maintenance commands of settings.MAINTENANCE_SCHEDULE, each "
+        "every so many seconds, until stopped (supervisord's maintenance "
+        "program). A command that fails is logged and run again when next due."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='run every scheduled command once, then exit')
+
+    def handle(self, *args, **options):
+        schedule = {name: interval for name, interval in settings.MAINTENANCE_SCHEDULE.items() if interval > 0}
+        if not schedule:
+            raise CommandError("No maintenance command is scheduled.")
+        due = dict.fromkeys(schedule, 0.0)
+        while True:
+            for name, interval in schedule.items():
+                if due[name] <= time.monotonic():
+                    self.run(name)
+                    due[name] = time.monotonic() + interval
+            if options['once']:
+                return
+            time.sleep(max(min(due.values()) - time.monotonic(), 0))
+
+    def run(self, name):
+        try:
+            call_command(name, stdout=self.stdout, stderr=self.stderr)
+        except Exception as exc:
+            self.stderr.write(f"{name} failed: {exc!r}")
+        finally:
+            # Hold no database connection while sleeping.
+            connections.close_all()
@@ -0,0 +1,51 @@
+import asyncio
+import struct
+
+from django.core.management.base import BaseCommand
+
+MAX_PEER_BACKLOG = 16 * 1024 * 1024
+
+
+class Command(BaseCommand):
+    help = (
+        "Run the chat broker relay: every frame received from one connected "
+        "process is forwarded to all of them (see api.broker.RelayBroker)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--bind',
+            default='127.0.0.1:8765',
+            help='host:port to listen on (default: 127.0.0.1:8765)'
+        )
+
+    def handle(self, *args, **options):
+        host, _, port = options['bind'].rpartition(':')
+        asyncio.run(self.serve(host or '127.0.0.1', int(port)))
+
+    async def serve(self, host, port):
+        self.peers = set()
+        server = await asyncio.start_server(self.handle_peer, host, port)
+        self.stdout.write(f"Chat broker relay listening on {host}:{port}")
+        async with server:
+            await server.serve_forever()
+
+    async def handle_peer(self, reader, writer):
+        self.peers.add(writer)
+        try:
+            while True:
+                header = await reader.readexactly(4)
+                (length,) = struct.unpack('!I', header)
+                frame = header + await reader.readexactly(length)
+                for peer in tuple(self.peers):
+                    if peer.transport.get_write_buffer_size() > MAX_PEER_BACKLOG:
+                        # A process that stopped reading must not stall the rest.
+                        self.peers.discard(peer)
+                        peer.close()
+                        continue
+                    peer.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.peers.discard(writer)
+            writer.close()
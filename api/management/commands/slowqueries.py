@@ -0,0 +1,58 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.slowqueries import group_records, slow_query_log
+
+
+class Command(BaseCommand):
+    help = (
+        "Show the slow queries captured by every server process, newest "
+        "first, with their callers and query plans (see api.slowqueries)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--limit', type=int, default=20,
+                            help='newest captures to show (default: 20)')
+        parser.add_argument('--group', action='store_true',
+                            help='aggregate captures by SQL shape, slowest total first')
+        parser.add_argument('--json', action='store_true',
+                            help='print the captures as JSON')
+        parser.add_argument('--clear', action='store_true',
+                            help='delete all captures')
+
+    def handle(self, *args, **options):
+        if options['clear']:
+            slow_query_log.clear()
+            self.stdout.write("Slow-query captures deleted.")
+            return
+
+        records = slow_query_log.records(options['limit'])
+        entries = group_records(records) if options['group'] else records
+        if options['json']:
+            self.stdout.write(json.dumps(entries, indent=2))
+            return
+        if not settings.SLOW_QUERIES['ENABLED']:
+            self.stderr.write("Capture is disabled: set SLOW_QUERIES=1 on the server.")
+        if not entries:
+            self.stdout.write("No slow queries captured.")
+        for entry in entries:
+            if options['group']:
+                self.stdout.write(
+                    f"{entry['count']}x  total {entry['total_ms']:.1f} ms  "
+                    f"max {entry['max_ms']:.1f} ms  last {entry['last_seen']}"
+                )
+            else:
+                self.stdout.write(
+                    f"{entry['time']}  {entry['duration_ms']:.1f} ms  "
+                    f"{entry['params']} params  pid {entry['pid']}  {entry['database']}"
+                )
+            self.stdout.write(f"  {entry['sql']}")
+            for caller in entry['callers']:
+                self.stdout.write(f"    at {caller}")
+            for line in entry['plan'] or ():
+                self.stdout.write(f"    | {line}")
+            for warning in entry['warnings']:
+                self.stdout.write(self.style.WARNING(f"    ! {warning}"))
+            self.stdout.write("")
@@ -0,0 +1,87 @@
+import zlib
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api import archive, rooms
+from api.models import Member, Message, MessageArchiveChunk
+
+
+class Command(BaseCommand):
+    help = (
+        "Check the message archive against itself and the hot table: chunk "
+        "checksums, counts and authors, chunk order, no message both hot and "
+        "archived, and every archived message older than every hot one of "
+        "its room."
+    )
+
+    def handle(self, *args, **options):
+        problems = []
+        buckets = {}
+        newest = {}
+        archived_ids = set()
+        author_ids = set()
+
+        chunks = MessageArchiveChunk.objects.order_by('room', 'first_created_at', 'first_id')
+        for chunk in chunks.iterator():
+            label = f"chunk {chunk.pk} (room {chunk.room_id}, {chunk.bucket:%Y-%m})"
+            try:
+                rows, checksum = archive.decode_payload(chunk.payload)
+            except (ValueError, zlib.error) as exc:
+                problems.append(f"{label}: unreadable payload: {exc}")
+                continue
+            if checksum != chunk.checksum:
+                problems.append(f"{label}: checksum {checksum} != {chunk.checksum}")
+            if len(rows) != chunk.count:
+                problems.append(f"{label}: {len(rows)} rows, count says {chunk.count}")
+            if not rows:
+                continue
+            keys = [(archive.parse_created_at(row[2]), row[0]) for row in rows]
+            if keys != sorted(keys):
+                problems.append(f"{label}: rows out of order")
+            if keys[0] != (chunk.first_created_at, chunk.first_id) or \
+                    keys[-1] != (chunk.last_created_at, chunk.last_id):
+                problems.append(f"{label}: bounds do not match its rows")
+            if any(archive.month(key[0]) != chunk.bucket for key in keys):
+                problems.append(f"{label}: rows outside its month")
+            previous = newest.get(chunk.room_id)
+            if previous is not None and keys[0] <= previous:
+                problems.append(f"{label}: overlaps the chunk before it")
+            newest[chunk.room_id] = keys[-1]
+            listed = {
+                author.author_id: [author.count, archive.stored(author.last_created_at)]
+                for author in chunk.authors.all()
+            }
+            if listed != archive.chunk_authors(rows):
+                problems.append(f"{label}: author counts do not match its rows")
+            duplicates = archived_ids.intersection(row[0] for row in rows)
+            if duplicates:
+                problems.append(f"{label}: {len(duplicates)} messages archived twice")
+            archived_ids.update(row[0] for row in rows)
+            author_ids.update(row[1] for row in rows)
+            bucket = buckets.setdefault(chunk.bucket, [0, 0, 0])
+            bucket[0] += 1
+            bucket[1] += len(rows)
+            bucket[2] += len(chunk.payload)
+
+        hot_count = Message.objects.count()
+        both = Message.objects.filter(id__in=archived_ids).count() if archived_ids else 0
+        if both:
+            problems.append(f"{both} messages are both hot and archived")
+        for room_id, previous in sorted(newest.items()):
+            oldest = rooms.messages(room_id).order_by('created_at', 'id').values_list('created_at', 'id').first()
+            if oldest is not None and oldest <= previous:
+                problems.append(
+                    f"room {room_id}: the newest archived message is not older than the oldest hot one"
+                )
+        orphans = len(author_ids - set(Member.objects.filter(id__in=author_ids).values_list('id', flat=True)))
+
+        for bucket, (chunks, count, size) in sorted(buckets.items()):
+            self.stdout.write(f"{bucket:%Y-%m}: {count} messages in {chunks} chunks, {size / 1024:.0f} KiB")
+        self.stdout.write(f"{hot_count} hot and {len(archived_ids)} archived messages.")
+        if orphans:
+            self.stdout.write(f"{orphans} archived authors no longer exist; their messages are hidden.")
+        if problems:
+            for problem in problems:
+                self.stderr.write(problem)
+            raise CommandError(f"Archive verification failed with {len(problems)} problem(s).")
+        self.stdout.write("Archive verified.")
@@ -0,0 +1,406 @@
+"""
+Per-request performance metrics.
+
+``RequestMetricsMiddleware`` measures every request and records per route:
+
+- total time, database queries and time spent in them;
+- time in DRF serializers (``validate``: ``is_valid``; ``serialize``:
+  ``.data`` and the fast list path) and in rendering;
+- session load time;
+- response size.
+
+Each response carries them in a ``Server-Timing`` header, and they are
+aggregated into per-route histograms (``stats.Histogram``). Every process
+periodically writes its aggregate to its own file in
+``REQUEST_METRICS['DIRECTORY']``; ``/api/metrics/`` merges the files of all
+gunicorn workers and serves the sum in the Prometheus text format. Files of
+processes that have exited are folded into one ``retired.json``, on every
+scrape and by each process's flush at most every ``REAP_INTERVAL`` seconds,
+so recycled workers neither lose their counts nor pile up, scraped or not.
+
+Timings overlap: queries run by a serializer count towards both.
+Measurements attach to the request through a context variable, so they also
+cover ORM calls that async views make through ``sync_to_async``, but not
+queries run by other threads such as the group-commit writer.
+"""
+import contextlib
+import fcntl
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from . import stats
+
+SECONDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# name: (help, buckets); all are per-request histograms.
+HISTOGRAMS = {
+    'request_duration_seconds': ('Time to handle the request.', SECONDS),
+    'db_queries': ('Database queries per request.', [0, 1, 2, 3, 5, 10, 20, 50, 100]),
+    'db_duration_seconds': ('Time spent in database queries per request.', SECONDS),
+    'validate_duration_seconds': ('Time spent validating input with DRF serializers.', SECONDS),
+    'serialize_duration_seconds': ('Time spent serializing output.', SECONDS),
+    'render_duration_seconds': ('Time spent rendering response bodies.', SECONDS),
+    'session_load_duration_seconds': ('Time spent loading the session.', SECONDS),
+    'response_size_bytes': (
+        'Response body size.', [256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304]
+    ),
+}
+# Server-Timing name of each timer, in header order.
+TIMERS = {
+    'validate': 'validate_duration_seconds',
+    'serialize': 'serialize_duration_seconds',
+    'render': 'render_duration_seconds',
+    'session': 'session_load_duration_seconds',
+}
+PREFIX = 'api_'
+
+_current = ContextVar('request_metrics', default=None)
+
+
+class RequestMetrics:
+    __slots__ = ('queries', 'db', 'timers')
+
+    def __init__(self):
+        self.queries = 0
+        self.db = 0.0
+        self.timers = {}
+
+
+@contextlib.contextmanager
+def timer(name):
+    """Add the time spent in the block to the current request's ``name`` timer."""
+    metrics = _current.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.timers[name] = metrics.timers.get(name, 0.0) + time.perf_counter() - started
+
+
+def timed(name):
+    """Decorator form of ``timer``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with timer(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_query(execute, sql, params, many, context):
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.db += time.perf_counter() - started
+
+
+@receiver(connection_created)
+def install_query_recorder(sender, connection, **kwargs):
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+class MetricsRegistry:
+    """Per-route aggregates of this process, shared with the others via files."""
+
+    def __init__(self, directory, flush_interval=1.0, reap_interval=300.0):
+        self.directory = str(directory)
+        self.flush_interval = flush_interval
+        self.reap_interval = reap_interval
+        self.path = os.path.join(self.directory, f'{os.getpid()}-{uuid.uuid4().hex[:8]}.json')
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._requests = {}
+        self._histograms = {}
+        self._flushed = 0.0
+        self._reaped = time.monotonic()
+        self._dirty = False
+
+    def observe(self, route, method, status, values):
+        key = (route, method)
+        with self._lock:
+            self._requests[key + (str(status),)] = self._requests.get(key + (str(status),), 0) + 1
+            self._dirty = True
+        for name, value in values.items():
+            histogram = self._histograms.get(key + (name,))
+            if histogram is None:
+                with self._lock:
+                    histogram = self._histograms.setdefault(
+                        key + (name,), stats.Histogram(HISTOGRAMS[name][1])
+                    )
+            histogram.observe(value)
+
+    def _check_fork(self):
+        # A preloaded master may have imported this module before forking.
+        if os.getpid() != self._pid:
+            with self._lock:
+                self._pid = os.getpid()
+                self.path = os.path.join(
+                    self.directory, f'{self._pid}-{uuid.uuid4().hex[:8]}.json'
+                )
+                self._requests.clear()
+                self._histograms.clear()
+
+    def flush(self, force=False):
+        """Write this process's aggregate, at most once per ``flush_interval``."""
+        self._check_fork()
+        now = time.monotonic()
+        if not force and (not self._dirty or now - self._flushed < self.flush_interval):
+            return
+        # One writer at a time; a request thread skips if another is writing.
+        if not self._flush_lock.acquire(blocking=force):
+            return
+        try:
+            with self._lock:
+                self._flushed = now
+                self._dirty = False
+                requests = [list(key) + [count] for key, count in self._requests.items()]
+                histograms = list(self._histograms.items())
+            os.makedirs(self.directory, exist_ok=True)
+            _write(self.path, {
+                'requests': requests,
+                'histograms': [
+                    list(key) + [histogram.snapshot()] for key, histogram in histograms
+                ],
+            })
+            if now - self._reaped >= self.reap_interval:
+                self._reaped = now
+                # Never wait for a scrape or another process's reap.
+                with self._directory_lock(blocking=False) as locked:
+                    if locked:
+                        self._reap()
+        finally:
+            self._flush_lock.release()
+
+    def collect(self):
+        """Merged aggregates of every process, live and exited."""
+        self.flush(force=True)
+        with self._directory_lock():
+            self._reap()
+            merged = _merge([])
+            for name in os.listdir(self.directory):
+                if name.endswith('.json'):
+                    data = _read(os.path.join(self.directory, name))
+                    if data is not None:
+                        merged = _merge([data], merged)
+        return merged
+
+    def _reap(self):
+        """Fold the files of exited processes into ``retired.json``."""
+        dead = []
+        for name in os.listdir(self.directory):
+            pid = name.split('-')[0]
+            if name.endswith('.json') and pid.isdigit() and not _alive(int(pid)):
+                dead.append(os.path.join(self.directory, name))
+        if not dead:
+            return
+        retired_path = os.path.join(self.directory, 'retired.json')
+        retired = _merge([data for data in map(_read, [retired_path] + dead) if data])
+        _write(retired_path, _unmerge(retired))
+        for path in dead:
+            os.remove(path)
+
+    @contextlib.contextmanager
+    def _directory_lock(self, blocking=True):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, '.lock'), 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def render_prometheus(self):
+        merged = self.collect()
+        lines = [
+            f'# HELP {PREFIX}requests_total Requests handled, by route, method and status.',
+            f'# TYPE {PREFIX}requests_total counter',
+        ]
+        for (route, method, status), count in sorted(merged['requests'].items()):
+            labels = _labels(route=route, method=method, status=status)
+            lines.append(f'{PREFIX}requests_total{{{labels}}} {count}')
+
+        for name, (help_text, _) in HISTOGRAMS.items():
+            series = sorted(
+                (key[:2], value) for key, value in merged['histograms'].items() if key[2] == name
+            )
+            if not series:
+                continue
+            lines.append(f'# HELP {PREFIX}{name} {help_text}')
+            lines.append(f'# TYPE {PREFIX}{name} histogram')
+            for (route, method), snapshot in series:
+                labels = _labels(route=route, method=method)
+                cumulative = 0
+                for bound, count in snapshot['buckets'].items():
+                    cumulative += count
+                    lines.append(
+                        f'{PREFIX}{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+                    )
+                lines.append(f'{PREFIX}{name}_sum{{{labels}}} {snapshot["sum"]!r}')
+                lines.append(f'{PREFIX}{name}_count{{{labels}}} {snapshot["count"]}')
+        return '\n'.join(lines) + '\n'
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, data):
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _merge(files, into=None):
+    merged = into or {'requests': {}, 'histograms': {}}
+    requests, histograms = merged['requests'], merged['histograms']
+    for data in files:
+        for *key, count in data.get('requests', ()):
+            key = tuple(key)
+            requests[key] = requests.get(key, 0) + count
+        for *key, snapshot in data.get('histograms', ()):
+            key = tuple(key)
+            total = histograms.get(key)
+            if total is None:
+                histograms[key] = {
+                    'buckets': dict(snapshot['buckets']),
+                    'count': snapshot['count'],
+                    'sum': snapshot['sum'],
+                }
+                continue
+            for bound, count in snapshot['buckets'].items():
+                total['buckets'][bound] = total['buckets'].get(bound, 0) + count
+            total['count'] += snapshot['count']
+            total['sum'] += snapshot['sum']
+    return merged
+
+
+def _unmerge(merged):
+    """The file format of merged aggregates."""
+    return {
+        'requests': [list(key) + [count] for key, count in merged['requests'].items()],
+        'histograms': [list(key) + [value] for key, value in merged['histograms'].items()],
+    }
+
+
+def _labels(**labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{name}="{escape(value)}"' for name, value in labels.items())
+
+
+registry = MetricsRegistry(
+    directory=settings.REQUEST_METRICS['DIRECTORY'],
+    flush_interval=settings.REQUEST_METRICS['FLUSH_INTERVAL'],
+    reap_interval=settings.REQUEST_METRICS['REAP_INTERVAL'],
+)
+
+
+class RequestMetricsMiddleware:
+    """
+    Measure each request, add a ``Server-Timing`` header and record the
+    measurements in ``registry``. Works in both WSGI and ASGI stacks.
+    """
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.enabled = settings.REQUEST_METRICS['ENABLED']
+        self.server_timing = settings.REQUEST_METRICS['SERVER_TIMING']
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.enabled:
+            return self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    async def __acall__(self, request):
+        if not self.enabled:
+            return await self.get_response(request)
+        metrics = RequestMetrics()
+        token = _current.set(metrics)
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self.finish(request, response, metrics, time.perf_counter() - started)
+
+    def finish(self, request, response, metrics, elapsed):
+        values = {
+            'request_duration_seconds': elapsed,
+            'db_queries': metrics.queries,
+            'db_duration_seconds': metrics.db,
+        }
+        for name, histogram in TIMERS.items():
+            if name in metrics.timers:
+                values[histogram] = metrics.timers[name]
+        if not response.streaming:
+            values['response_size_bytes'] = len(response.content)
+
+        if self.server_timing:
+            timings = [f'db;dur={metrics.db * 1000:.2f};desc="{metrics.queries} queries"']
+            timings.extend(
+                f'{name};dur={metrics.timers[name] * 1000:.2f}'
+                for name in TIMERS if name in metrics.timers
+            )
+            timings.append(f'total;dur={elapsed * 1000:.2f}')
+            existing = response.get('Server-Timing')
+            response['Server-Timing'] = ', '.join(([existing] if existing else []) + timings)
+
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else 'unmatched'
+        registry.observe(route, request.method, response.status_code, values)
+        registry.flush()
+        return response
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.7
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['created_at', 'id'], name='messages_created_id_idx'),
+        ),
+    ]
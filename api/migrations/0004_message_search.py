@@ -0,0 +1,50 @@
+from django.db import migrations
+
+# External-content FTS5 index over messages.text; see api.search. The
+# triggers keep it in sync with every write, including raw SQL and cascades.
+CREATE_INDEX = [
+    """
+    CREATE VIRTUAL TABLE messages_fts USING fts5(
+        text,
+        content='messages',
+        content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2',
+        prefix='2 3'
+    )
+    """,
+    """
+    CREATE TRIGGER messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END
+    """,
+    """
+    CREATE TRIGGER messages_fts_update AFTER UPDATE OF text ON messages BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END
+    """,
+    "INSERT INTO messages_fts(messages_fts) VALUES ('rebuild')",
+]
+
+DROP_INDEX = [
+    "DROP TRIGGER IF EXISTS messages_fts_update",
+    "DROP TRIGGER IF EXISTS messages_fts_delete",
+    "DROP TRIGGER IF EXISTS messages_fts_insert",
+    "DROP TABLE IF EXISTS messages_fts",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0003_member_updated_at'),
+    ]
+
+    operations = [
+        migrations.RunSQL(CREATE_INDEX, DROP_INDEX),
+    ]
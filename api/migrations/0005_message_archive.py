@@ -0,0 +1,33 @@
+# Generated by Django 5.2.7
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_message_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchiveChunk',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.DateField()),
+                ('first_created_at', models.DateTimeField()),
+                ('first_id', models.BigIntegerField()),
+                ('last_created_at', models.DateTimeField()),
+                ('last_id', models.BigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('checksum', models.CharField(max_length=64)),
+                ('payload', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'db_table': 'message_archive',
+                'ordering': ['first_created_at', 'first_id'],
+                'indexes': [models.Index(fields=['first_created_at', 'first_id'], name='message_archive_first_idx')],
+            },
+        ),
+    ]
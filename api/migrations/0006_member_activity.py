@@ -0,0 +1,96 @@
+# Generated by Django 5.2.7
+
+import json
+import zlib
+from collections import defaultdict
+from datetime import datetime, timezone
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def index_archive_authors(apps, schema_editor):
+    """Record the authors of chunks archived before this migration."""
+    MessageArchiveChunk = apps.get_model('api', 'MessageArchiveChunk')
+    MessageArchiveAuthor = apps.get_model('api', 'MessageArchiveAuthor')
+    for chunk in MessageArchiveChunk.objects.iterator():
+        authors = defaultdict(lambda: [0, ''])
+        for _, author_id, created_at, _ in json.loads(zlib.decompress(chunk.payload)):
+            authors[author_id][0] += 1
+            authors[author_id][1] = max(authors[author_id][1], created_at)
+        MessageArchiveAuthor.objects.bulk_create(
+            MessageArchiveAuthor(
+                chunk=chunk,
+                author_id=author_id,
+                count=count,
+                last_created_at=datetime.fromisoformat(last).replace(tzinfo=timezone.utc),
+            )
+            for author_id, (count, last) in authors.items()
+        )
+
+
+# The same totals as api.activity.reconcile, for every member at once.
+COUNT_MESSAGES = """
+UPDATE members SET message_count = totals.count, last_message_at = totals.last
+FROM (
+    SELECT author_id, SUM(count) AS count, MAX(last) AS last FROM (
+        SELECT author_id, COUNT(*) AS count, MAX(created_at) AS last
+        FROM messages GROUP BY author_id
+        UNION ALL
+        SELECT author_id, SUM(count), MAX(last_created_at)
+        FROM message_archive_authors GROUP BY author_id
+    ) GROUP BY author_id
+) AS totals
+WHERE members.id = totals.author_id
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_message_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageArchiveAuthor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('author_id', models.BigIntegerField()),
+                ('count', models.PositiveIntegerField()),
+                ('last_created_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'message_archive_authors',
+            },
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='last_message_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='message_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='member',
+            index=models.Index(fields=['-message_count', 'id'], name='members_top_posters_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['author', 'created_at', 'id'], name='messages_author_created_idx'),
+        ),
+        migrations.AddField(
+            model_name='messagearchiveauthor',
+            name='chunk',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='authors', to='api.messagearchivechunk'),
+        ),
+        migrations.AddConstraint(
+            model_name='messagearchiveauthor',
+            constraint=models.UniqueConstraint(fields=('author_id', 'chunk'), name='message_archive_author_chunk_uniq'),
+        ),
+        migrations.RunPython(index_archive_authors, migrations.RunPython.noop),
+        migrations.RunSQL(COUNT_MESSAGES, migrations.RunSQL.noop),
+    ]
@@ -0,0 +1,85 @@
+# Generated by Django 5.2.7
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Every write to messages appends to the change feed in the same statement,
+# so no write path can skip it; see api.changes. A row in
+# message_changes_paused (inserted and deleted inside one transaction)
+# silences the triggers for moves that are not changes, like archiving.
+CREATE_TRIGGERS = [
+    "CREATE TABLE message_changes_paused (reason TEXT NOT NULL)",
+    """
+    CREATE TRIGGER message_changes_insert AFTER INSERT ON messages
+    WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+        INSERT INTO message_changes(op, message_id, author_id, text, created_at, changed_at)
+        VALUES ('created', new.id, new.author_id, new.text, new.created_at,
+                strftime('%Y-%m-%d %H:%M:%f', 'now'));
+    END
+    """,
+    """
+    CREATE TRIGGER message_changes_update AFTER UPDATE OF text ON messages
+    WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+        INSERT INTO message_changes(op, message_id, author_id, text, created_at, changed_at)
+        VALUES ('updated', new.id, new.author_id, new.text, new.created_at,
+                strftime('%Y-%m-%d %H:%M:%f', 'now'));
+    END
+    """,
+    """
+    CREATE TRIGGER message_changes_delete AFTER DELETE ON messages
+    WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+        INSERT INTO message_changes(op, message_id, author_id, text, created_at, changed_at)
+        VALUES ('deleted', old.id, old.author_id, '', old.created_at,
+                strftime('%Y-%m-%d %H:%M:%f', 'now'));
+    END
+    """,
+]
+
+DROP_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS message_changes_delete",
+    "DROP TRIGGER IF EXISTS message_changes_update",
+    "DROP TRIGGER IF EXISTS message_changes_insert",
+    "DROP TABLE IF EXISTS message_changes_paused",
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_member_activity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageChange',
+            fields=[
+                ('seq', models.BigAutoField(primary_key=True, serialize=False)),
+                ('op', models.CharField(choices=[('created', 'Created'), ('updated', 'Updated'), ('deleted', 'Deleted')], max_length=7)),
+                ('message_id', models.BigIntegerField()),
+                ('author_id', models.BigIntegerField()),
+                ('text', models.TextField(blank=True)),
+                ('created_at', models.DateTimeField()),
+                ('changed_at', models.DateTimeField()),
+            ],
+            options={
+                'db_table': 'message_changes',
+                'ordering': ['seq'],
+            },
+        ),
+        migrations.CreateModel(
+            name='ChangeCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('client', models.CharField(blank=True, max_length=64)),
+                ('seq', models.BigIntegerField()),
+                ('seen_at', models.DateTimeField()),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='change_cursors', to='api.member')),
+            ],
+            options={
+                'db_table': 'change_cursors',
+                'indexes': [models.Index(fields=['seen_at'], name='change_cursors_seen_idx')],
+                'constraints': [models.UniqueConstraint(fields=('member', 'client'), name='change_cursor_client_uniq')],
+            },
+        ),
+        migrations.RunSQL(CREATE_TRIGGERS, DROP_TRIGGERS),
+    ]
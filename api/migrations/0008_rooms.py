@@ -0,0 +1,172 @@
+# Generated by Django 5.2.7
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Adding a NOT NULL column with a default makes Django copy the whole table
+# on SQLite, which would drop the search and change-feed triggers on
+# messages. ALTER TABLE ADD COLUMN with a constant default instead leaves
+# the rows where they are: existing messages read as the general room
+# without being rewritten.
+ADD_ROOM_COLUMNS = [
+    'ALTER TABLE "messages" ADD COLUMN "room_id" bigint DEFAULT 1 NOT NULL '
+    'REFERENCES "rooms" ("id") DEFERRABLE INITIALLY DEFERRED',
+    'ALTER TABLE "message_archive" ADD COLUMN "room_id" bigint DEFAULT 1 NOT NULL '
+    'REFERENCES "rooms" ("id") DEFERRABLE INITIALLY DEFERRED',
+    'ALTER TABLE "message_changes" ADD COLUMN "room_id" bigint DEFAULT 1 NOT NULL',
+]
+
+DROP_ROOM_COLUMNS = [
+    'ALTER TABLE "message_changes" DROP COLUMN "room_id"',
+    'ALTER TABLE "message_archive" DROP COLUMN "room_id"',
+    'ALTER TABLE "messages" DROP COLUMN "room_id"',
+]
+
+# A sample is enough to tell the planner how selective room_id is.
+ANALYZE_MESSAGES = [
+    'PRAGMA analysis_limit = 1000',
+    'ANALYZE "messages"',
+    'PRAGMA analysis_limit = 0',
+]
+
+DROP_CHANGE_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS message_changes_delete",
+    "DROP TRIGGER IF EXISTS message_changes_update",
+    "DROP TRIGGER IF EXISTS message_changes_insert",
+]
+
+
+def change_triggers(room):
+    """The change-feed triggers of migration 0007, with or without room_id."""
+    columns, new, old = ('room_id, ', 'new.room_id, ', 'old.room_id, ') if room else ('', '', '')
+    return [
+        f"""
+        CREATE TRIGGER message_changes_insert AFTER INSERT ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, {columns}message_id, author_id, text, created_at, changed_at)
+            VALUES ('created', {new}new.id, new.author_id, new.text, new.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+        f"""
+        CREATE TRIGGER message_changes_update AFTER UPDATE OF text ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, {columns}message_id, author_id, text, created_at, changed_at)
+            VALUES ('updated', {new}new.id, new.author_id, new.text, new.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+        f"""
+        CREATE TRIGGER message_changes_delete AFTER DELETE ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, {columns}message_id, author_id, text, created_at, changed_at)
+            VALUES ('deleted', {old}old.id, old.author_id, '', old.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+    ]
+
+
+def create_general_room(apps, schema_editor):
+    Room = apps.get_model('api', 'Room')
+    Room.objects.create(id=1, name='general')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0007_message_changes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Room',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('created_by', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='api.member')),
+            ],
+            options={
+                'db_table': 'rooms',
+                'ordering': ['id'],
+            },
+        ),
+        migrations.CreateModel(
+            name='RoomMembership',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('joined_at', models.DateTimeField(auto_now_add=True)),
+                ('member', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='room_memberships', to='api.member')),
+                ('room', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='memberships', to='api.room')),
+            ],
+            options={
+                'db_table': 'room_memberships',
+                'ordering': ['joined_at'],
+                'constraints': [models.UniqueConstraint(fields=('room', 'member'), name='room_membership_uniq')],
+            },
+        ),
+        migrations.RunPython(create_general_room, migrations.RunPython.noop),
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(ADD_ROOM_COLUMNS, DROP_ROOM_COLUMNS),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='message',
+                    name='room',
+                    field=models.ForeignKey(db_index=False, default=1, on_delete=django.db.models.deletion.PROTECT, related_name='messages', to='api.room'),
+                ),
+                migrations.AddField(
+                    model_name='messagearchivechunk',
+                    name='room',
+                    field=models.ForeignKey(db_index=False, default=1, on_delete=django.db.models.deletion.PROTECT, related_name='archive_chunks', to='api.room'),
+                ),
+                migrations.AddField(
+                    model_name='messagechange',
+                    name='room_id',
+                    field=models.BigIntegerField(default=1),
+                ),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room', 'created_at', 'id'], name='messages_room_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['room'], name='messages_room_idx'),
+        ),
+        # Until it has statistics for the new indexes the planner assumes a
+        # room holds few messages, and reads the general room through them.
+        migrations.RunSQL(ANALYZE_MESSAGES, migrations.RunSQL.noop),
+        migrations.RemoveIndex(
+            model_name='messagearchivechunk',
+            name='message_archive_first_idx',
+        ),
+        migrations.AddIndex(
+            model_name='messagearchivechunk',
+            index=models.Index(fields=['room', 'first_created_at', 'first_id'], name='message_archive_room_first_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messagechange',
+            index=models.Index(fields=['room_id', 'seq'], name='message_changes_room_idx'),
+        ),
+        migrations.RunSQL(
+            DROP_CHANGE_TRIGGERS + change_triggers(room=True),
+            DROP_CHANGE_TRIGGERS + change_triggers(room=False),
+        ),
+        migrations.RemoveConstraint(
+            model_name='changecursor',
+            name='change_cursor_client_uniq',
+        ),
+        migrations.AddField(
+            model_name='changecursor',
+            name='room',
+            field=models.ForeignKey(db_index=False, default=1, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='api.room'),
+        ),
+        migrations.AddConstraint(
+            model_name='changecursor',
+            constraint=models.UniqueConstraint(fields=('member', 'room', 'client'), name='change_cursor_room_client_uniq'),
+        ),
+    ]
@@ -0,0 +1,92 @@
+# Generated by Django 5.2.7
+
+from django.db import migrations, models
+
+# As in 0008: ALTER TABLE ADD COLUMN with constant defaults leaves the rows
+# and the triggers on messages where they are. Existing messages read as
+# never rendered until manage.py render_messages gets to them.
+ADD_RENDERING_COLUMNS = [
+    'ALTER TABLE "messages" ADD COLUMN "rendered_html" text DEFAULT \'\' NOT NULL',
+    'ALTER TABLE "messages" ADD COLUMN "renderer_version" smallint unsigned DEFAULT 0 NOT NULL '
+    'CHECK ("renderer_version" >= 0)',
+    'ALTER TABLE "message_changes" ADD COLUMN "rendered_html" text DEFAULT \'\' NOT NULL',
+]
+
+DROP_RENDERING_COLUMNS = [
+    'ALTER TABLE "message_changes" DROP COLUMN "rendered_html"',
+    'ALTER TABLE "messages" DROP COLUMN "renderer_version"',
+    'ALTER TABLE "messages" DROP COLUMN "rendered_html"',
+]
+
+DROP_CHANGE_TRIGGERS = [
+    "DROP TRIGGER IF EXISTS message_changes_delete",
+    "DROP TRIGGER IF EXISTS message_changes_update",
+    "DROP TRIGGER IF EXISTS message_changes_insert",
+]
+
+
+def change_triggers(rendered):
+    """The change-feed triggers of migration 0008, with or without rendered_html."""
+    column, value = (', rendered_html', ', new.rendered_html') if rendered else ('', '')
+    return [
+        f"""
+        CREATE TRIGGER message_changes_insert AFTER INSERT ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, room_id, message_id, author_id, text{column}, created_at, changed_at)
+            VALUES ('created', new.room_id, new.id, new.author_id, new.text{value}, new.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+        f"""
+        CREATE TRIGGER message_changes_update AFTER UPDATE OF text ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, room_id, message_id, author_id, text{column}, created_at, changed_at)
+            VALUES ('updated', new.room_id, new.id, new.author_id, new.text{value}, new.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+        """
+        CREATE TRIGGER message_changes_delete AFTER DELETE ON messages
+        WHEN NOT EXISTS (SELECT 1 FROM message_changes_paused) BEGIN
+            INSERT INTO message_changes(op, room_id, message_id, author_id, text, created_at, changed_at)
+            VALUES ('deleted', old.room_id, old.id, old.author_id, '', old.created_at,
+                    strftime('%Y-%m-%d %H:%M:%f', 'now'));
+        END
+        """,
+    ]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_attachments'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            database_operations=[
+                migrations.RunSQL(ADD_RENDERING_COLUMNS, DROP_RENDERING_COLUMNS),
+            ],
+            state_operations=[
+                migrations.AddField(
+                    model_name='message',
+                    name='rendered_html',
+                    field=models.TextField(blank=True, default=''),
+                ),
+                migrations.AddField(
+                    model_name='message',
+                    name='renderer_version',
+                    field=models.PositiveSmallIntegerField(default=0),
+                ),
+                migrations.AddField(
+                    model_name='messagechange',
+                    name='rendered_html',
+                    field=models.TextField(blank=True, default=''),
+                ),
+            ],
+        ),
+        migrations.RunSQL(
+            DROP_CHANGE_TRIGGERS + change_triggers(rendered=True),
+            DROP_CHANGE_TRIGGERS + change_triggers(rendered=False),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 5.2.7
+
+from django.db import migrations, models
+
+# Brings Member.id and Message.id up to DEFAULT_AUTO_FIELD in the state only.
+# Altering the columns would make SQLite rebuild both tables, which drops
+# the search and change-feed triggers on messages; an INTEGER PRIMARY KEY
+# is 64-bit in SQLite already.
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0010_message_rendering'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='member',
+                    name='id',
+                    field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+                ),
+                migrations.AlterField(
+                    model_name='message',
+                    name='id',
+                    field=models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID'),
+                ),
+            ],
+        ),
+    ]
@@ -11,10 +11,17 @@ class Member(models.Model):
     email = models.EmailField(unique=True)
     password_hash = models.CharField(max_length=128)
     created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Maintained with each post (see api.activity), including archived messages.
+    message_count = models.PositiveIntegerField(default=0)
+    last_message_at = models.DateTimeField(null=True, blank=True)
 
     class Meta:
         db_table = 'members'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['-message_count', 'id'], name='members_top_posters_idx'),
+        ]
 
     def __str__(self):
         return self.username
@@ -46,6 +53,57 @@ class Member(models.Model):
         return True
 
 
+class Room(models.Model):
+    """
+    A chat room. Every message belongs to one; the general room, created
+    by migration 0008, holds the messages posted before rooms existed and
+    is open to every member (see api.rooms).
+    """
+    GENERAL_ID = 1
+
+    name = models.CharField(max_length=100, unique=True)
+    created_by = models.ForeignKey(
+        Member,
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='+'
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'rooms'
+        ordering = ['id']
+
+    def __str__(self):
+        return self.name
+
+
+class RoomMembership(models.Model):
+    """A member who has joined a room."""
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name='memberships'
+    )
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='room_memberships'
+    )
+    joined_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'room_memberships'
+        ordering = ['joined_at']
+        constraints = [
+            models.UniqueConstraint(fields=['room', 'member'], name='room_membership_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.member_id} in room {self.room_id}"
+
+
 class Message(models.Model):
     """
     Message model for chat messages.
@@ -55,12 +113,222 @@ class Message(models.Model):
         on_delete=models.CASCADE,
         related_name='messages'
     )
+    # Indexed below: by time for pages and cursors, and on its own, which
+    # SQLite extends with the rowid, for long-polls and id lookups.
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.PROTECT,
+        related_name='messages',
+        default=Room.GENERAL_ID,
+        db_index=False
+    )
     text = models.TextField(max_length=5000)
+    # The text rendered to HTML when it was written, and the version of the
+    # renderer that did it (see api.rendering); 0 before the first render.
+    rendered_html = models.TextField(blank=True, default='')
+    renderer_version = models.PositiveSmallIntegerField(default=0)
     created_at = models.DateTimeField(auto_now_add=True)
 
     class Meta:
         db_table = 'messages'
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at', 'id'], name='messages_created_id_idx'),
+            models.Index(fields=['room', 'created_at', 'id'], name='messages_room_created_idx'),
+            models.Index(fields=['room'], name='messages_room_idx'),
+            models.Index(fields=['author', 'created_at', 'id'], name='messages_author_created_idx'),
+        ]
 
     def __str__(self):
         return f"Message by {self.author.username} at {self.created_at}"
+
+
+class MessageArchiveChunk(models.Model):
+    """
+    A compressed run of archived messages from one room and calendar month.
+
+    Retention moves old messages here from ``messages`` (see api.archive).
+    The chunks of a room never overlap, and every archived message is older
+    than every message of its room still in ``messages``.
+    """
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.PROTECT,
+        related_name='archive_chunks',
+        default=Room.GENERAL_ID,
+        db_index=False
+    )
+    bucket = models.DateField()
+    first_created_at = models.DateTimeField()
+    first_id = models.BigIntegerField()
+    last_created_at = models.DateTimeField()
+    last_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    checksum = models.CharField(max_length=64)
+    payload = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'message_archive'
+        ordering = ['first_created_at', 'first_id']
+        indexes = [
+            models.Index(fields=['room', 'first_created_at', 'first_id'], name='message_archive_room_first_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.count} archived messages from {self.bucket:%Y-%m}"
+
+
+class MessageArchiveAuthor(models.Model):
+    """How many messages of one author an archive chunk holds."""
+    chunk = models.ForeignKey(
+        MessageArchiveChunk,
+        on_delete=models.CASCADE,
+        related_name='authors'
+    )
+    author_id = models.BigIntegerField()
+    count = models.PositiveIntegerField()
+    last_created_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'message_archive_authors'
+        constraints = [
+            models.UniqueConstraint(fields=['author_id', 'chunk'], name='message_archive_author_chunk_uniq'),
+        ]
+
+    def __str__(self):
+        return f"{self.count} archived messages by member {self.author_id}"
+
+
+class MessageChange(models.Model):
+    """
+    One entry of the message change feed, written by triggers on
+    ``messages`` (see api.changes). Deletions are tombstones without text.
+    """
+    CREATED = 'created'
+    UPDATED = 'updated'
+    DELETED = 'deleted'
+    OPS = [(CREATED, 'Created'), (UPDATED, 'Updated'), (DELETED, 'Deleted')]
+
+    seq = models.BigAutoField(primary_key=True)
+    op = models.CharField(max_length=7, choices=OPS)
+    room_id = models.BigIntegerField(default=Room.GENERAL_ID)
+    message_id = models.BigIntegerField()
+    author_id = models.BigIntegerField()
+    text = models.TextField(blank=True)
+    rendered_html = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField()
+    changed_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'message_changes'
+        ordering = ['seq']
+        indexes = [
+            models.Index(fields=['room_id', 'seq'], name='message_changes_room_idx'),
+        ]
+
+    def __str__(self):
+        return f"#{self.seq} message {self.message_id} {self.op}"
+
+
+class ChangeCursor(models.Model):
+    """The last change-feed position a client has acknowledged in a room."""
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='change_cursors'
+    )
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name='+',
+        default=Room.GENERAL_ID,
+        db_index=False
+    )
+    client = models.CharField(max_length=64, blank=True)
+    seq = models.BigIntegerField()
+    seen_at = models.DateTimeField()
+
+    class Meta:
+        db_table = 'change_cursors'
+        constraints = [
+            models.UniqueConstraint(fields=['member', 'room', 'client'], name='change_cursor_room_client_uniq'),
+        ]
+        indexes = [
+            models.Index(fields=['seen_at'], name='change_cursors_seen_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.member_id}/{self.client or '-'} in room {self.room_id} at #{self.seq}"
+
+
+class Upload(models.Model):
+    """
+    A resumable upload in progress (see api.attachments). The bytes received
+    so far are in a part file; completing it turns it into an ``Attachment``.
+    """
+    member = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='uploads'
+    )
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    size = models.BigIntegerField()
+    received = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = 'uploads'
+        indexes = [
+            models.Index(fields=['updated_at'], name='uploads_updated_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.filename}: {self.received} of {self.size} bytes"
+
+
+class Attachment(models.Model):
+    """
+    A file attached to a message, or uploaded and not attached yet. The
+    bytes are stored once per SHA-256, however many attachments share them.
+    """
+    uploader = models.ForeignKey(
+        Member,
+        on_delete=models.CASCADE,
+        related_name='attachments'
+    )
+    # Archiving deletes messages with raw SQL and keeps their attachments,
+    # so there is no database constraint; the room stays for access checks.
+    message = models.ForeignKey(
+        Message,
+        on_delete=models.CASCADE,
+        related_name='attachments',
+        null=True,
+        blank=True,
+        db_constraint=False
+    )
+    room = models.ForeignKey(
+        Room,
+        on_delete=models.CASCADE,
+        related_name='+',
+        null=True,
+        blank=True,
+        db_index=False
+    )
+    sha256 = models.CharField(max_length=64)
+    size = models.BigIntegerField()
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        db_table = 'attachments'
+        ordering = ['id']
+        indexes = [
+            models.Index(fields=['sha256'], name='attachments_sha256_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.filename} ({self.size} bytes)"
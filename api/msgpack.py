@@ -0,0 +1,105 @@
+"""
+Minimal MessagePack encoder (https://msgpack.org/), pure Python.
+
+Covers the types API payloads are made of: None, booleans, integers, floats,
+strings, bytes, lists/tuples and dicts. Anything else is first converted
+with DRF's JSON encoder (datetimes to ISO 8601, decimals, lazy strings...),
+so a payload packs to the same values it would render to as JSON.
+"""
+import struct
+
+from rest_framework.utils.encoders import JSONEncoder
+
+_json_encoder = JSONEncoder()
+
+
+def packb(obj):
+    """Return the MessagePack encoding of ``obj`` as bytes."""
+    buffer = bytearray()
+    _pack(obj, buffer)
+    return bytes(buffer)
+
+
+def _pack(obj, buffer):
+    if obj is None:
+        buffer.append(0xc0)
+    elif obj is True:
+        buffer.append(0xc3)
+    elif obj is False:
+        buffer.append(0xc2)
+    elif isinstance(obj, int):
+        _pack_int(obj, buffer)
+    elif isinstance(obj, float):
+        buffer.append(0xcb)
+        buffer += struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        size = len(data)
+        if size < 32:
+            buffer.append(0xa0 | size)
+        elif size < 0x100:
+            buffer += struct.pack('>BB', 0xd9, size)
+        elif size < 0x10000:
+            buffer += struct.pack('>BH', 0xda, size)
+        else:
+            buffer += struct.pack('>BI', 0xdb, size)
+        buffer += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        size = len(data)
+        if size < 0x100:
+            buffer += struct.pack('>BB', 0xc4, size)
+        elif size < 0x10000:
+            buffer += struct.pack('>BH', 0xc5, size)
+        else:
+            buffer += struct.pack('>BI', 0xc6, size)
+        buffer += data
+    elif isinstance(obj, (list, tuple)):
+        _pack_header(len(obj), 0x90, 0xdc, 0xdd, buffer)
+        for item in obj:
+            _pack(item, buffer)
+    elif isinstance(obj, dict):
+        _pack_header(len(obj), 0x80, 0xde, 0xdf, buffer)
+        for key, value in obj.items():
+            _pack(key, buffer)
+            _pack(value, buffer)
+    else:
+        _pack(_json_encoder.default(obj), buffer)
+
+
+def _pack_header(size, fix, code16, code32, buffer):
+    if size < 16:
+        buffer.append(fix | size)
+    elif size < 0x10000:
+        buffer += struct.pack('>BH', code16, size)
+    else:
+        buffer += struct.pack('>BI', code32, size)
+
+
+def _pack_int(value, buffer):
+    if 0 <= value < 0x80:
+        buffer.append(value)
+    elif -32 <= value < 0:
+        buffer += struct.pack('>b', value)
+    elif value >= 0:
+        if value < 0x100:
+            buffer += struct.pack('>BB', 0xcc, value)
+        elif value < 0x10000:
+            buffer += struct.pack('>BH', 0xcd, value)
+        elif value < 0x100000000:
+            buffer += struct.pack('>BI', 0xce, value)
+        elif value < 0x10000000000000000:
+            buffer += struct.pack('>BQ', 0xcf, value)
+        else:
+            raise OverflowError('Integer too large for MessagePack')
+    else:
+        if value >= -0x80:
+            buffer += struct.pack('>Bb', 0xd0, value)
+        elif value >= -0x8000:
+            buffer += struct.pack('>Bh', 0xd1, value)
+        elif value >= -0x80000000:
+            buffer += struct.pack('>Bi', 0xd2, value)
+        elif value >= -0x8000000000000000:
+            buffer += struct.pack('>Bq', 0xd3, value)
+        else:
+            raise OverflowError('Integer too large for MessagePack')
@@ -0,0 +1,117 @@
+"""
+In-process notification hubs for chat messages.
+
+Long-poll requests park on a hub instead of re-querying the database in
+a loop. ``hub`` listens to ``message.created`` events on the chat broker,
+so a message posted through any process wakes the waiters in this one;
+``change_hub`` wakes change-feed requests on creates, edits and deletes.
+
+Hubs keep their state per room and subscribe to a room's channel the first
+time a request waits on it, so a busy room never wakes waiters in a quiet
+one.
+"""
+import asyncio
+import json
+import threading
+from functools import partial
+
+from .broker import get_broker
+from .events import CHANGE_EVENTS, room_channel
+
+
+class MessageHub:
+    """
+    Wakes waiting threads (and event-loop futures) when a message newer than
+    theirs is published in their room.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._latest = {}
+        self._unsubscribe = {}
+        self._futures = set()
+
+    def latest_id(self, room_id):
+        return self._latest.get(room_id, 0)
+
+    def listen(self, room_id):
+        """Subscribe to a room's channel on the chat broker, once per process."""
+        if room_id not in self._unsubscribe:
+            with self._condition:
+                if room_id not in self._unsubscribe:
+                    self._unsubscribe[room_id] = get_broker().subscribe(
+                        room_channel(room_id), partial(self._on_event, room_id)
+                    )
+
+    def _on_event(self, room_id, payload):
+        event = json.loads(payload)
+        if event.get('type') == 'message.created':
+            self.publish(room_id, event['message']['id'])
+
+    def publish(self, room_id, message_id):
+        """Record a committed message and wake every waiter behind it."""
+        with self._condition:
+            if message_id > self.latest_id(room_id):
+                self._latest[room_id] = message_id
+                self._condition.notify_all()
+                for waiter_room, loop, future in self._futures:
+                    if waiter_room == room_id:
+                        loop.call_soon_threadsafe(_resolve, future)
+
+    def wait(self, room_id, after_id, timeout):
+        """
+        Block until a message newer than ``after_id`` is published in the
+        room or ``timeout`` seconds pass. Return True if a newer message
+        arrived.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: self.latest_id(room_id) > after_id, timeout
+            )
+
+    async def await_newer(self, room_id, after_id, timeout):
+        """
+        ``wait`` for the event loop: park a future instead of a thread until
+        a message newer than ``after_id`` is published in the room or
+        ``timeout`` passes.
+        """
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self._condition:
+                if self.latest_id(room_id) > after_id:
+                    return True
+                waiter = (room_id, loop, loop.create_future())
+                self._futures.add(waiter)
+            try:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                await asyncio.wait_for(waiter[2], remaining)
+            except asyncio.TimeoutError:
+                return self.latest_id(room_id) > after_id
+            finally:
+                with self._condition:
+                    self._futures.discard(waiter)
+
+
+def _resolve(future):
+    if not future.done():
+        future.set_result(None)
+
+
+class ChangeHub(MessageHub):
+    """
+    ``MessageHub`` for the change feed. Edits and deletes carry no new id,
+    so it counts the events this process has seen in each room instead: a
+    waiter reads ``latest_id`` before querying and waits for it to move.
+    """
+
+    def _on_event(self, room_id, payload):
+        if json.loads(payload).get('type') in CHANGE_EVENTS:
+            with self._condition:
+                self.publish(room_id, self.latest_id(room_id) + 1)
+
+
+hub = MessageHub()
+change_hub = ChangeHub()
@@ -0,0 +1,219 @@
+import binascii
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.core.paginator import InvalidPage
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from . import archive
+
+
+class MessagesPagination(PageNumberPagination):
+    """
+    Custom pagination for a room's messages. Pages continue from the hot
+    table into the room's archive (see ``api.archive.History``).
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+
+    def __init__(self, room_id=None):
+        self.room_id = room_id
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return super().paginate_queryset(archive.History(queryset, self.room_id), request, view)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` through the async ORM."""
+        self.request = request
+        page_size = self.get_page_size(request)
+        if not page_size:
+            return None
+
+        history = archive.History(queryset, self.room_id)
+        paginator = self.django_paginator_class(history, page_size)
+        paginator.count = await history.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            number = paginator.validate_number(page_number)
+        except InvalidPage as exc:
+            msg = self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)
+            )
+            raise NotFound(msg)
+
+        bottom = (number - 1) * page_size
+        rows = await history.aslice(bottom, bottom + page_size)
+        self.page = paginator._get_page(rows, number, paginator)
+        return rows
+
+
+class MessagesCursorPagination(BasePagination):
+    """
+    Keyset pagination for messages over (created_at, id).
+
+    Pages are addressed by opaque ``before``/``after`` cursors instead of a
+    page number, so no COUNT(*) is issued and every page is the same indexed
+    range scan no matter how deep into history it is. Results are always
+    ordered newest first, like the page-number mode.
+
+    The archive read-through covers room ``room_id``, narrowed to one
+    member's messages by ``author_id``; the hot queryset must be filtered
+    the same way by the caller.
+    """
+    page_size = 20
+    page_size_query_param = 'page_size'
+    max_page_size = 100
+    before_query_param = 'before'
+    after_query_param = 'after'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def __init__(self, room_id=None, author_id=None):
+        self.room_id = room_id
+        self.author_id = author_id
+
+    @classmethod
+    def is_requested(cls, request):
+        """Cursor mode is selected by passing ``before`` or ``after``."""
+        params = request.query_params
+        return cls.before_query_param in params or cls.after_query_param in params
+
+    def get_page_size(self, request):
+        try:
+            size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if size <= 0:
+            return self.page_size
+        return min(size, self.max_page_size)
+
+    def encode_cursor(self, message):
+        return self.make_cursor(message.created_at, message.id)
+
+    @staticmethod
+    def make_cursor(created_at, pk):
+        raw = f"{created_at.isoformat()}|{pk}"
+        return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+    @staticmethod
+    def older_than(created_at, pk):
+        """Messages before ``(created_at, pk)`` in keyset order."""
+        # Same rows as created_at < c OR (created_at = c AND id < pk), but the
+        # leading bound lets SQLite range-scan the (created_at, id) index in
+        # order instead of merging two index searches and sorting the result.
+        return Q(created_at__lte=created_at) & (Q(created_at__lt=created_at) | Q(id__lt=pk))
+
+    @staticmethod
+    def newer_than(created_at, pk):
+        """Messages after ``(created_at, pk)`` in keyset order."""
+        return Q(created_at__gte=created_at) & (Q(created_at__gt=created_at) | Q(id__gt=pk))
+
+    def decode_cursor(self, value):
+        """Return ``(created_at, id)`` for a cursor, or None for an empty one."""
+        if not value:
+            return None
+        try:
+            padded = value + '=' * (-len(value) % 4)
+            created_at, pk = urlsafe_b64decode(padded).decode().rsplit('|', 1)
+            created_at = datetime.fromisoformat(created_at)
+            pk = int(pk)
+        except (TypeError, ValueError, UnicodeDecodeError, binascii.Error):
+            raise NotFound(self.invalid_cursor_message)
+        if timezone.is_naive(created_at):
+            raise NotFound(self.invalid_cursor_message)
+        return created_at, pk
+
+    def paginate_queryset(self, queryset, request, view=None):
+        queryset = self.filter_queryset(queryset, request)
+        rows = list(queryset[:self.page_size + 1])
+        if self.reads_archive(rows):
+            rows = self.read_through(rows)
+        return self.set_page(rows)
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """``paginate_queryset`` through the async ORM."""
+        queryset = self.filter_queryset(queryset, request)
+        rows = [row async for row in queryset[:self.page_size + 1]]
+        if self.reads_archive(rows):
+            rows = await sync_to_async(self.read_through)(rows)
+        return self.set_page(rows)
+
+    def reads_archive(self, rows):
+        """
+        Whether the archive may hold rows of this page. It is older than
+        every hot row, so backward pages only reach it when they run out of
+        hot rows; forward pages ask it whether the cursor is inside it.
+        """
+        return self.after is not None or len(rows) <= self.page_size
+
+    def read_through(self, rows):
+        """Complete the fetched hot ``rows`` with archived ones."""
+        limit = self.page_size + 1
+        if self.after is not None:
+            return (archive.newer_than(self.room_id, self.after, limit, self.author_id) + rows)[:limit]
+        return rows + archive.older_than(self.room_id, self.before, limit - len(rows), self.author_id)
+
+    def filter_queryset(self, queryset, request):
+        """Narrow and order ``queryset`` to the requested page (plus one row)."""
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.before = self.decode_cursor(request.query_params.get(self.before_query_param))
+        self.after = self.decode_cursor(request.query_params.get(self.after_query_param))
+
+        if self.after is not None:
+            created_at, pk = self.after
+            return queryset.filter(
+                self.newer_than(created_at, pk)
+            ).order_by('created_at', 'id')
+        if self.before is not None:
+            created_at, pk = self.before
+            queryset = queryset.filter(self.older_than(created_at, pk))
+        return queryset.order_by('-created_at', '-id')
+
+    def set_page(self, rows):
+        """Record the fetched rows as the page, newest first."""
+        if self.after is not None:
+            self.has_newer = len(rows) > self.page_size
+            self.has_older = True
+            rows = rows[:self.page_size]
+            rows.reverse()
+        else:
+            self.has_older = len(rows) > self.page_size
+            self.has_newer = self.before is not None
+            rows = rows[:self.page_size]
+
+        self.page = rows
+        return rows
+
+    def get_next_link(self):
+        if not self.page or not self.has_older:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.after_query_param
+        )
+        return replace_query_param(
+            url, self.before_query_param, self.encode_cursor(self.page[-1])
+        )
+
+    def get_previous_link(self):
+        if not self.page or not self.has_newer:
+            return None
+        url = remove_query_param(
+            self.request.build_absolute_uri(), self.before_query_param
+        )
+        return replace_query_param(
+            url, self.after_query_param, self.encode_cursor(self.page[0])
+        )
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        })
@@ -0,0 +1,29 @@
+from django.conf import settings
+from django.contrib.auth import get_user
+from django.utils.crypto import constant_time_compare
+from rest_framework.permissions import BasePermission
+
+
+class IsStaffSession(BasePermission):
+    """
+    Allows access to Django admin staff only.
+
+    Members are not Django users, and DRF replaces ``request.user`` with the
+    authenticated member, so the admin user is loaded from the session.
+    """
+
+    def has_permission(self, request, view):
+        user = get_user(request._request)
+        return bool(user.is_active and user.is_staff)
+
+
+class HasMetricsToken(BasePermission):
+    """
+    Allows requests bearing ``REQUEST_METRICS['TOKEN']``, for scrapers that
+    cannot hold a session. Denies everything when no token is configured.
+    """
+
+    def has_permission(self, request, view):
+        token = settings.REQUEST_METRICS['TOKEN']
+        header = request.META.get('HTTP_AUTHORIZATION', '')
+        return bool(token) and constant_time_compare(header, f'Bearer {token}')
@@ -0,0 +1,51 @@
+import json
+
+from rest_framework.compat import LONG_SEPARATORS, SHORT_SEPARATORS
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+from . import metrics
+from .msgpack import packb
+
+
+class FastJSONRenderer(JSONRenderer):
+    """
+    Drop-in JSONRenderer for plain JSON data (dicts, lists, strings,
+    numbers, booleans and None), producing the same bytes.
+
+    A single shared C encoder is used with no circular-reference tracking.
+    Anything it cannot encode, or an indented rendering requested through
+    the Accept header, is handed to JSONRenderer.
+    """
+    encoder = json.JSONEncoder(
+        ensure_ascii=JSONRenderer.ensure_ascii,
+        allow_nan=not JSONRenderer.strict,
+        separators=SHORT_SEPARATORS if JSONRenderer.compact else LONG_SEPARATORS,
+        check_circular=False,
+    )
+
+    @metrics.timed('render')
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if self.get_indent(accepted_media_type, renderer_context or {}) is not None:
+            return super().render(data, accepted_media_type, renderer_context)
+        try:
+            ret = self.encoder.encode(data)
+        except TypeError:
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = ret.replace('\u2028', '\\u2028').replace('\u2029', '\\u2029')
+        return ret.encode()
+
+
+class MessagePackRenderer(BaseRenderer):
+    """Binary MessagePack rendering, selected with ``Accept: application/msgpack``."""
+    media_type = 'application/msgpack'
+    format = 'msgpack'
+    charset = None
+    render_style = 'binary'
+
+    @metrics.timed('render')
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return packb(data)
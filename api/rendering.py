@@ -0,0 +1,202 @@
+"""
+Message rendering.
+
+Messages are rendered to HTML when they are written, not when they are
+read: ``MessageCreateSerializer`` and ``MessageEditSerializer`` store the
+result in ``Message.rendered_html``, along with the ``VERSION`` of the
+renderer that produced it, and the list endpoints send it as ``html``.
+Archived messages keep theirs in their chunk payload (see api.archive).
+
+Rendering escapes the whole text, so the only markup in the output is the
+renderer's own: links for ``http(s)://`` and ``www.`` URLs, a highlighted
+span for ``@username`` mentions of existing members, Unicode emoji for the
+``:shortcode:`` names in ``EMOJI``, and ``<br>`` for line breaks.
+
+Changing the output means bumping ``VERSION``. Until ``manage.py
+render_messages`` has re-rendered the stored messages, the read path
+renders the stale ones of each page itself, so every response already
+shows the new version; the command only takes that cost off it. The
+version is part of the list ETags and of the latest-messages cache entries.
+
+This module only imports Django where it looks members up, so that the
+command's worker processes can load it without setting Django up.
+"""
+import html
+import re
+
+from asgiref.sync import sync_to_async
+
+VERSION = 1
+
+EMOJI = {
+    '+1': '\U0001F44D',
+    '-1': '\U0001F44E',
+    'thumbsup': '\U0001F44D',
+    'thumbsdown': '\U0001F44E',
+    'smile': '\U0001F604',
+    'smiley': '\U0001F603',
+    'grin': '\U0001F601',
+    'laughing': '\U0001F606',
+    'joy': '\U0001F602',
+    'wink': '\U0001F609',
+    'blush': '\U0001F60A',
+    'heart_eyes': '\U0001F60D',
+    'thinking': '\U0001F914',
+    'neutral_face': '\U0001F610',
+    'confused': '\U0001F615',
+    'cry': '\U0001F622',
+    'sob': '\U0001F62D',
+    'angry': '\U0001F620',
+    'scream': '\U0001F631',
+    'sunglasses': '\U0001F60E',
+    'heart': '\u2764\ufe0f',
+    'broken_heart': '\U0001F494',
+    'fire': '\U0001F525',
+    'star': '\u2b50',
+    'sparkles': '\u2728',
+    'tada': '\U0001F389',
+    'rocket': '\U0001F680',
+    'eyes': '\U0001F440',
+    'clap': '\U0001F44F',
+    'wave': '\U0001F44B',
+    'pray': '\U0001F64F',
+    'ok_hand': '\U0001F44C',
+    'muscle': '\U0001F4AA',
+    'coffee': '\u2615',
+    'beer': '\U0001F37A',
+    'pizza': '\U0001F355',
+    'check': '\u2714\ufe0f',
+    'x': '\u274c',
+    'warning': '\u26a0\ufe0f',
+    'bug': '\U0001F41B',
+    '100': '\U0001F4AF',
+}
+
+TOKENS = re.compile(
+    r"(?P<url>\b(?:https?://|www\.)[^\s<>\"']+)"
+    r'|(?<![\w@])@(?P<mention>\w[\w.+-]*)'
+    r'|:(?P<emoji>[\w+-]+):'
+)
+
+# Punctuation that ends a sentence rather than a URL or a username.
+URL_TRAILING = '.,;:!?)]'
+MENTION_TRAILING = '.+-'
+
+# Usernames per query when looking mentions up.
+LOOKUP_SIZE = 500
+
+
+def render(text, members):
+    """
+    Render ``text`` to HTML, highlighting mentions of the usernames in
+    ``members`` (``{username: member_id}``).
+    """
+    parts = []
+    position = 0
+    for match in TOKENS.finditer(text):
+        if match['url']:
+            url = trim_url(match['url'])
+            href = url if '://' in url else 'https://' + url
+            markup = (
+                f'<a href="{html.escape(href)}" rel="nofollow noopener noreferrer" '
+                f'target="_blank">{html.escape(url)}</a>'
+            )
+            end = match.start() + len(url)
+        elif match['mention']:
+            username = match['mention'].rstrip(MENTION_TRAILING)
+            if username not in members:
+                continue
+            markup = (
+                f'<span class="mention" data-member-id="{members[username]}">'
+                f'@{html.escape(username)}</span>'
+            )
+            end = match.start('mention') + len(username)
+        else:
+            emoji = EMOJI.get(match['emoji'])
+            if emoji is None:
+                continue
+            markup = emoji
+            end = match.end()
+        parts.append(escape(text[position:match.start()]))
+        parts.append(markup)
+        position = end
+    parts.append(escape(text[position:]))
+    return ''.join(parts)
+
+
+def escape(text):
+    return html.escape(text).replace('\r\n', '\n').replace('\n', '<br>')
+
+
+def trim_url(url):
+    """Drop trailing punctuation, keeping closing parentheses that are balanced."""
+    while url and url[-1] in URL_TRAILING:
+        if url[-1] == ')' and url.count('(') >= url.count(')'):
+            break
+        url = url[:-1]
+    return url
+
+
+def mentioned(texts):
+    """The usernames ``texts`` may mention."""
+    return {
+        match['mention'].rstrip(MENTION_TRAILING)
+        for text in texts
+        for match in TOKENS.finditer(text)
+        if match['mention']
+    }
+
+
+def members_for(texts):
+    """``{username: member_id}`` for the existing members ``texts`` mention."""
+    from .models import Member
+
+    usernames = sorted(mentioned(texts))
+    members = {}
+    for start in range(0, len(usernames), LOOKUP_SIZE):
+        members.update(
+            Member.objects.filter(username__in=usernames[start:start + LOOKUP_SIZE])
+            .values_list('username', 'id')
+        )
+    return members
+
+
+def render_text(text):
+    """Render one message's text, looking up the members it mentions."""
+    return render(text, members_for([text]))
+
+
+def render_batch(texts, members):
+    """Render several texts; run in ``render_messages`` worker processes."""
+    return [render(text, members) for text in texts]
+
+
+def message_html(message):
+    """A message's HTML, rendered now if it was stored by an older version."""
+    if message.renderer_version == VERSION:
+        return message.rendered_html
+    return render_text(message.text)
+
+
+def refresh(rows):
+    """
+    ``rows`` (named rows with ``id``, ``text``, ``rendered_html`` and
+    ``renderer_version``), with those stored by an older version rendered
+    now, looking up the members they mention at once.
+    """
+    stale = [row for row in rows if row.renderer_version != VERSION]
+    if not stale:
+        return rows
+    members = members_for([row.text for row in stale])
+    return [
+        row if row.renderer_version == VERSION
+        else row._replace(rendered_html=render(row.text, members), renderer_version=VERSION)
+        for row in rows
+    ]
+
+
+async def arefresh(rows):
+    """``refresh`` for async views; only stale rows cost a thread hop."""
+    if all(row.renderer_version == VERSION for row in rows):
+        return rows
+    return await sync_to_async(refresh)(rows)
@@ -0,0 +1,88 @@
+"""
+Chat rooms.
+
+Every message belongs to a room, and every message read path is scoped to
+one: the list and its long poll, the ETag head, the cached first page, the
+archive, search and the change feed each look a room up through an index
+that leads with its id, and key their caches, hub channels and cursors by
+it. A request to a quiet room costs the same however busy the others are.
+
+The general room (``Room.GENERAL_ID``) is open to every member; the
+original ``/api/messages/`` endpoints serve it. Any member may join another
+room, and only its members read or post there.
+
+``database(room_id)`` is the one place that decides which database holds a
+room's messages; the room-scoped reads, search, the archive and the change
+feed go through it. All rooms live in the default database today. Moving
+a room to its own file means returning another alias there, routing
+message writes the same way, and giving that database the app's migrations
+(``migrate --database``) and the members its messages join.
+"""
+from django.db import DEFAULT_DB_ALIAS
+from django.db.models import BooleanField, Exists, ExpressionWrapper, OuterRef, Q
+
+from .models import Message, Room, RoomMembership
+
+FOUND, NOT_FOUND, NOT_MEMBER = 'found', 'not_found', 'not_member'
+
+
+def database(room_id):
+    """The database alias holding the messages of room ``room_id``."""
+    return DEFAULT_DB_ALIAS
+
+
+def messages(room_id):
+    """The messages of room ``room_id``."""
+    return Message.objects.using(database(room_id)).filter(room_id=room_id)
+
+
+def access_queryset(member, room_id):
+    joined = RoomMembership.objects.filter(room=OuterRef('pk'), member=member)
+    return Room.objects.filter(pk=room_id).annotate(joined=Exists(joined)).values_list('joined', flat=True)
+
+
+def access(member, room_id):
+    """
+    Whether ``member`` may read and post in room ``room_id``: ``FOUND``,
+    ``NOT_FOUND`` or ``NOT_MEMBER``. One indexed lookup, none for the
+    general room.
+    """
+    if room_id == Room.GENERAL_ID:
+        return FOUND
+    return _access(access_queryset(member, room_id).first())
+
+
+async def aaccess(member, room_id):
+    """``access`` through the async ORM."""
+    if room_id == Room.GENERAL_ID:
+        return FOUND
+    return _access(await access_queryset(member, room_id).afirst())
+
+
+def _access(joined):
+    if joined is None:
+        return NOT_FOUND
+    return FOUND if joined else NOT_MEMBER
+
+
+def visible(member):
+    """
+    Rooms ``member`` can see, annotated with whether they may use them:
+    joined, or the general room.
+    """
+    joined = RoomMembership.objects.filter(room=OuterRef('pk'), member=member)
+    return Room.objects.annotate(
+        joined=ExpressionWrapper(Q(pk=Room.GENERAL_ID) | Q(Exists(joined)), BooleanField())
+    ).order_by('id')
+
+
+def join(member, room):
+    """Add ``member`` to ``room``; return True if they were not in it yet."""
+    _, created = RoomMembership.objects.get_or_create(room=room, member=member)
+    return created
+
+
+def leave(member, room):
+    """Remove ``member`` from ``room``; return True if they were in it."""
+    deleted, _ = RoomMembership.objects.filter(room=room, member=member).delete()
+    return bool(deleted)
@@ -0,0 +1,145 @@
+"""
+Full-text message search over the ``messages_fts`` FTS5 index.
+
+The index is an external-content table: it stores only the tokens and
+reads ``text`` back from ``messages``. Triggers created in migration 0004
+keep it in step with every insert, update and delete, so writers need no
+code of their own; ``manage.py rebuild_search`` rebuilds it from scratch.
+
+Queries accept words, ``"quoted phrases"`` and a trailing ``*`` on either
+for prefix matches; all terms must match. Everything else is treated as
+text, so user input can never be an FTS5 syntax error. Results are ordered
+by bm25 rank (``rank``) or newest first (``recent``) and paginated by an
+opaque keyset cursor over ``(rank, id)`` or ``id``. Every search covers one
+room.
+
+Only hot messages are searched: the index follows ``messages``, so messages
+moved to the archive (see api.archive, older than ``HOT_DAYS``) drop out of
+it. ``archive_excluded`` tells whether archived messages fall within a
+search's filters, so the response can say its results may be incomplete.
+"""
+import binascii
+import html
+import re
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.db import connection, connections
+
+from . import archive, rooms
+
+FTS_TABLE = 'messages_fts'
+ORDERS = ('rank', 'recent')
+
+# Snippet markers that cannot survive HTML escaping, replaced by <mark>.
+_OPEN, _CLOSE = '\x02', '\x03'
+SNIPPET_TOKENS = 16
+
+_TERM = re.compile(r'"([^"]*)"(\*?)|([^\s"]+)')
+_WORD = re.compile(r'\w')
+
+
+def match_expression(query):
+    """
+    Translate a user query into an FTS5 MATCH expression, or return None
+    when it contains nothing searchable.
+    """
+    terms = []
+    for phrase, phrase_prefix, word in _TERM.findall(query):
+        if word:
+            text, prefix = word.rstrip('*'), '*' if word.endswith('*') else ''
+        else:
+            text, prefix = phrase, phrase_prefix
+        if not _WORD.search(text):
+            continue
+        terms.append('"{}"{}'.format(text.replace('"', '""'), prefix))
+    return ' AND '.join(terms) or None
+
+
+def encode_cursor(order, row):
+    raw = f'{row[1]!r}|{row[0]}' if order == 'rank' else str(row[0])
+    return urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(order, value):
+    """Return the keyset for a cursor; raise ValueError if it is malformed."""
+    try:
+        raw = urlsafe_b64decode(value + '=' * (-len(value) % 4)).decode()
+    except (binascii.Error, UnicodeDecodeError):
+        raise ValueError(value)
+    if order == 'rank':
+        rank, pk = raw.split('|')
+        return float(rank), int(pk)
+    return (int(raw),)
+
+
+def search(match, room_id, *, author_id=None, since=None, until=None, order='rank', cursor=None,
+           limit=20):
+    """
+    Return up to ``limit`` ``(id, rank, snippet)`` rows for a MATCH
+    expression in a room, in ``order``, after the keyset ``cursor``.
+
+    Snippets are HTML-escaped with matches wrapped in ``<mark>``.
+    """
+    db = connections[rooms.database(room_id)]
+    where = [f'{FTS_TABLE} MATCH %s', 'm.room_id = %s']
+    params = [match, room_id]
+    if author_id is not None:
+        where.append('m.author_id = %s')
+        params.append(author_id)
+    if since is not None:
+        where.append('m.created_at >= %s')
+        params.append(db.ops.adapt_datetimefield_value(since))
+    if until is not None:
+        where.append('m.created_at < %s')
+        params.append(db.ops.adapt_datetimefield_value(until))
+    if order == 'rank':
+        # bm25 ranks are negative: more relevant is smaller. Ties go newest first.
+        if cursor is not None:
+            where.append('(f.rank > %s OR (f.rank = %s AND f.rowid < %s))')
+            params.extend([cursor[0], cursor[0], cursor[1]])
+        order_by = 'f.rank, f.rowid DESC'
+    else:
+        if cursor is not None:
+            where.append('f.rowid < %s')
+            params.append(cursor[0])
+        order_by = 'f.rowid DESC'
+
+    # Ranking scores every match, and each one is checked against its room.
+    sql = (
+        f"SELECT f.rowid, f.rank, snippet({FTS_TABLE}, 0, %s, %s, '…', %s) "
+        f"FROM {FTS_TABLE} f JOIN messages m ON m.id = f.rowid "
+        f"WHERE {' AND '.join(where)} ORDER BY {order_by} LIMIT %s"
+    )
+    with db.cursor() as cursor:
+        cursor.execute(sql, [_OPEN, _CLOSE, SNIPPET_TOKENS, *params, limit])
+        rows = cursor.fetchall()
+    return [(pk, rank, highlight(snippet)) for pk, rank, snippet in rows]
+
+
+def archive_excluded(room_id, *, author_id=None, since=None, until=None):
+    """Whether a room has archived messages, which are not searched, in a search's range."""
+    chunks = archive.archive_chunks(room_id, author_id)
+    if since is not None:
+        chunks = chunks.filter(last_created_at__gte=since)
+    if until is not None:
+        chunks = chunks.filter(first_created_at__lt=until)
+    return chunks.exists()
+
+
+def highlight(snippet):
+    return html.escape(snippet).replace(_OPEN, '<mark>').replace(_CLOSE, '</mark>')
+
+
+def rebuild():
+    """Re-index every message and merge the index into one segment."""
+    with connection.cursor() as cursor:
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+        cursor.execute(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')")
+
+
+def integrity_check():
+    """Raise DatabaseError if the index does not match ``messages``."""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}, rank) VALUES ('integrity-check', 1)"
+        )
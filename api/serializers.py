@@ -1,8 +1,26 @@
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Member, Message
+from . import activity, attachments, export, hashing, metrics, rendering, search
+from .batching import message_batcher
+from .models import Attachment, Member, Message, Room, Upload
 
 
-class MemberSerializer(serializers.ModelSerializer):
+class MeasuredMixin:
+    """Count ``is_valid`` and ``.data`` towards the request metrics."""
+
+    def is_valid(self, *args, **kwargs):
+        with metrics.timer('validate'):
+            return super().is_valid(*args, **kwargs)
+
+    @property
+    def data(self):
+        with metrics.timer('serialize'):
+            return super().data
+
+
+class MemberSerializer(MeasuredMixin, serializers.ModelSerializer):
     """Serializer for Member model - used for displaying user data."""
     
     class Meta:
@@ -11,7 +29,23 @@ class MemberSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'created_at']
 
 
-class RegisterSerializer(serializers.ModelSerializer):
+class ProfileSerializer(MemberSerializer):
+    """Serializer for the current user's profile, with activity counters."""
+
+    class Meta(MemberSerializer.Meta):
+        fields = [*MemberSerializer.Meta.fields, 'message_count', 'last_message_at']
+        read_only_fields = [*MemberSerializer.Meta.read_only_fields, 'message_count', 'last_message_at']
+
+
+class TopPosterSerializer(serializers.ModelSerializer):
+    """Serializer for an entry of the top posters list."""
+
+    class Meta:
+        model = Member
+        fields = ['id', 'username', 'message_count', 'last_message_at']
+
+
+class RegisterSerializer(MeasuredMixin, serializers.ModelSerializer):
     """Serializer for user registration."""
     password = serializers.CharField(
         write_only=True,
@@ -46,15 +80,15 @@ class RegisterSerializer(serializers.ModelSerializer):
         return value
 
     def create(self, validated_data):
-        """Create a new member with hashed password."""
+        """Create a new member, hashing the password on the hashing pool."""
         password = validated_data.pop('password')
         member = Member(**validated_data)
-        member.set_password(password)
+        member.password_hash = hashing.make_password(password)
         member.save()
         return member
 
 
-class LoginSerializer(serializers.Serializer):
+class LoginSerializer(MeasuredMixin, serializers.Serializer):
     """Serializer for user login."""
     email = serializers.EmailField(required=True)
     password = serializers.CharField(
@@ -71,19 +105,17 @@ class LoginSerializer(serializers.Serializer):
         if not email or not password:
             raise serializers.ValidationError("Email and password are required")
 
-        try:
-            member = Member.objects.get(email=email)
-        except Member.DoesNotExist:
-            raise serializers.ValidationError("Invalid email or password")
-
-        if not member.check_password(password):
+        # An unknown email is checked against a dummy hash, so it costs the
+        # same as a wrong password. Raises HashingBusy when the pool is full.
+        member = Member.objects.filter(email=email).first()
+        if not hashing.check_password(member, password):
             raise serializers.ValidationError("Invalid email or password")
 
         attrs['member'] = member
         return attrs
 
 
-class ProfileUpdateSerializer(serializers.ModelSerializer):
+class ProfileUpdateSerializer(MeasuredMixin, serializers.ModelSerializer):
     """Serializer for updating user profile."""
     
     class Meta:
@@ -113,6 +145,16 @@ class ProfileUpdateSerializer(serializers.ModelSerializer):
             raise serializers.ValidationError("This email is already in use")
         return value
 
+    def update(self, instance, validated_data):
+        """
+        Save only the edited fields: the instance may be a cached member
+        whose activity counters are stale and must not be written back.
+        """
+        for attr, value in validated_data.items():
+            setattr(instance, attr, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+
 
 class MessageAuthorSerializer(serializers.ModelSerializer):
     """Serializer for message author information."""
@@ -122,15 +164,19 @@ class MessageAuthorSerializer(serializers.ModelSerializer):
         fields = ['id', 'username', 'email', 'created_at']
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(MeasuredMixin, serializers.ModelSerializer):
     """Serializer for Message model."""
     author = MessageAuthorSerializer(read_only=True)
+    html = serializers.SerializerMethodField()
     
     class Meta:
         model = Message
-        fields = ['id', 'text', 'author', 'created_at']
+        fields = ['id', 'text', 'html', 'author', 'created_at']
         read_only_fields = ['id', 'author', 'created_at']
 
+    def get_html(self, message):
+        return rendering.message_html(message)
+
     def validate_text(self, value):
         """Validate message text."""
         if not value or not value.strip():
@@ -140,12 +186,18 @@ class MessageSerializer(serializers.ModelSerializer):
         return value
 
 
-class MessageCreateSerializer(serializers.ModelSerializer):
+class MessageCreateSerializer(MeasuredMixin, serializers.ModelSerializer):
     """Serializer for creating messages."""
+    attachments = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        required=False,
+        write_only=True,
+        max_length=settings.ATTACHMENTS['MAX_PER_MESSAGE']
+    )
     
     class Meta:
         model = Message
-        fields = ['text']
+        fields = ['text', 'attachments']
         extra_kwargs = {
             'text': {
                 'required': True,
@@ -159,3 +211,169 @@ class MessageCreateSerializer(serializers.ModelSerializer):
         if not value or not value.strip():
             raise serializers.ValidationError("This field is required")
         return value
+
+    def validate_attachments(self, value):
+        """Drop repeated ids."""
+        return list(dict.fromkeys(value))
+
+    def create(self, validated_data):
+        """
+        Render the text, insert directly, or through the group-commit writer
+        when enabled, and attach the uploads listed in ``attachments``. Raises
+        ``attachments.AttachmentsUnavailable`` if one cannot be attached.
+
+        Posts with attachments bypass the writer: the message is only
+        inserted together with its attachments, in one transaction.
+        """
+        ids = validated_data.pop('attachments', None)
+        if ids:
+            attachments.check_available(validated_data['author'], ids)
+        validated_data['rendered_html'] = rendering.render_text(validated_data['text'])
+        validated_data['renderer_version'] = rendering.VERSION
+        if settings.MESSAGES_WRITE_BATCHING['ENABLED'] and not ids:
+            return message_batcher.save(**validated_data)
+        with transaction.atomic():
+            message = super().create(validated_data)
+            activity.record_posts([message])
+            if ids:
+                attachments.attach(message, ids)
+        return message
+
+
+class RoomSerializer(MeasuredMixin, serializers.ModelSerializer):
+    """Serializer for rooms, with whether the requesting member has joined."""
+    joined = serializers.BooleanField(read_only=True)
+
+    class Meta:
+        model = Room
+        fields = ['id', 'name', 'created_at', 'joined']
+        read_only_fields = ['id', 'created_at']
+
+    def validate_name(self, value):
+        """Validate room name."""
+        if not value.strip():
+            raise serializers.ValidationError("This field is required")
+        return value.strip()
+
+
+class MessageEditSerializer(MessageCreateSerializer):
+    """Serializer for editing the text of a message."""
+    attachments = None
+
+    class Meta(MessageCreateSerializer.Meta):
+        fields = ['text']
+
+    def update(self, instance, validated_data):
+        """
+        Write only the text, which the change feed triggers watch, and its
+        rendering in the same statement.
+        """
+        instance.text = validated_data['text']
+        instance.rendered_html = rendering.render_text(instance.text)
+        instance.renderer_version = rendering.VERSION
+        instance.save(update_fields=['text', 'rendered_html', 'renderer_version'])
+        return instance
+
+
+class UploadSerializer(MeasuredMixin, serializers.ModelSerializer):
+    """Serializer for starting a resumable upload and reporting its offset."""
+    offset = serializers.IntegerField(source='received', read_only=True)
+
+    class Meta:
+        model = Upload
+        fields = ['id', 'filename', 'content_type', 'size', 'offset', 'created_at']
+        read_only_fields = ['id', 'created_at']
+        extra_kwargs = {
+            'content_type': {'required': False, 'allow_blank': True},
+            'size': {'min_value': 1, 'max_value': settings.ATTACHMENTS['MAX_SIZE']},
+        }
+
+    def validate_filename(self, value):
+        """Keep only the last path component."""
+        value = value.replace('\\', '/').rsplit('/', 1)[-1].strip()
+        if not value:
+            raise serializers.ValidationError("This field is required")
+        return value
+
+    def create(self, validated_data):
+        return attachments.start_upload(**validated_data)
+
+
+class AttachmentSerializer(MeasuredMixin, serializers.ModelSerializer):
+    """Serializer for attachments, with where to download them."""
+    message_id = serializers.IntegerField(read_only=True)
+    url = serializers.SerializerMethodField()
+    thumbnail_url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Attachment
+        fields = ['id', 'filename', 'content_type', 'size', 'message_id', 'created_at', 'url', 'thumbnail_url']
+        read_only_fields = fields
+
+    def get_url(self, attachment):
+        return reverse('attachment-download', args=[attachment.pk])
+
+    def get_thumbnail_url(self, attachment):
+        if not attachments.has_thumbnail(attachment):
+            return None
+        return reverse('attachment-thumbnail', args=[attachment.pk])
+
+
+class MessageSearchSerializer(MeasuredMixin, serializers.Serializer):
+    """Serializer for message search query parameters."""
+    q = serializers.CharField(max_length=500, trim_whitespace=True)
+    room = serializers.IntegerField(required=False, min_value=1, default=Room.GENERAL_ID)
+    author = serializers.IntegerField(required=False, min_value=1)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+    order = serializers.ChoiceField(choices=search.ORDERS, default='rank')
+    cursor = serializers.CharField(required=False, allow_blank=True)
+    page_size = serializers.IntegerField(required=False, min_value=1, max_value=100, default=20)
+
+    def validate_q(self, value):
+        """Reduce the query to an FTS5 expression."""
+        match = search.match_expression(value)
+        if match is None:
+            raise serializers.ValidationError("Enter at least one word to search for")
+        return match
+
+    def validate(self, attrs):
+        """Decode the cursor for the requested order."""
+        if attrs.get('since') and attrs.get('until') and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError({'until': ["Must be later than since"]})
+        cursor = attrs.get('cursor')
+        if cursor:
+            try:
+                attrs['cursor'] = search.decode_cursor(attrs['order'], cursor)
+            except ValueError:
+                raise serializers.ValidationError({'cursor': ["Invalid cursor"]})
+        else:
+            attrs['cursor'] = None
+        return attrs
+
+
+class MessageExportSerializer(MeasuredMixin, serializers.Serializer):
+    """Serializer for message export query parameters."""
+    type = serializers.ChoiceField(choices=export.FORMATS, default='ndjson')
+    room = serializers.IntegerField(required=False, min_value=1)
+    author = serializers.IntegerField(required=False, min_value=1)
+    since = serializers.DateTimeField(required=False)
+    until = serializers.DateTimeField(required=False)
+
+    def validate(self, attrs):
+        if attrs.get('since') and attrs.get('until') and attrs['since'] >= attrs['until']:
+            raise serializers.ValidationError({'until': ["Must be later than since"]})
+        return attrs
+
+
+class MessageChangesSerializer(MeasuredMixin, serializers.Serializer):
+    """Serializer for change feed query parameters."""
+    since = serializers.IntegerField(required=False, min_value=0)
+    limit = serializers.IntegerField(
+        required=False,
+        min_value=1,
+        max_value=settings.MESSAGE_CHANGES['MAX_BATCH'],
+        default=settings.MESSAGE_CHANGES['BATCH']
+    )
+    wait = serializers.FloatField(required=False, min_value=0, default=0)
+    client = serializers.CharField(required=False, allow_blank=True, max_length=64, default='')
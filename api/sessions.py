@@ -0,0 +1,22 @@
+"""
+Session engine that times session loads for the request metrics.
+
+Behaves exactly like the engine named by ``settings.SESSION_BACKEND``.
+"""
+from importlib import import_module
+
+from django.conf import settings
+
+from . import metrics
+
+_backend = import_module(settings.SESSION_BACKEND)
+
+
+class SessionStore(_backend.SessionStore):
+    def load(self):
+        with metrics.timer('session'):
+            return super().load()
+
+    async def aload(self):
+        with metrics.timer('session'):
+            return await super().aload()
@@ -0,0 +1,49 @@
+from functools import partial
+
+from django.apps import apps as global_apps
+from django.db import DEFAULT_DB_ALIAS, router, transaction
+from django.db.models.signals import post_delete, post_migrate, post_save
+from django.dispatch import receiver
+
+from .authentication import member_cache
+from .latest import latest_messages
+from .models import Member, Message, Room
+
+
+@receiver(post_save, sender=Member)
+@receiver(post_delete, sender=Member)
+def invalidate_cached_member(sender, instance, **kwargs):
+    """Drop a saved or deleted member from the authentication cache."""
+    member_cache.invalidate(instance.pk)
+    transaction.on_commit(partial(member_cache.broadcast_invalidate, instance.pk))
+
+
+@receiver(post_save, sender=Member)
+def refresh_latest_messages_author(sender, instance, **kwargs):
+    """Re-embed a saved member in the pre-encoded latest messages."""
+    transaction.on_commit(partial(latest_messages.member_changed, instance), robust=True)
+
+
+@receiver(post_save, sender=Message)
+@receiver(post_delete, sender=Message)
+def invalidate_latest_messages(sender, instance, created=False, **kwargs):
+    """New messages are pushed by events.message_created; edits and deletes drop the cache."""
+    if not created:
+        transaction.on_commit(partial(latest_messages.invalidate, instance.room_id))
+
+
+@receiver(post_migrate)
+def create_general_room(sender, using=DEFAULT_DB_ALIAS, apps=global_apps, **kwargs):
+    """
+    Recreate the general room after ``flush``, which empties every table
+    the migrations filled, including the one migration 0008 created it in.
+    """
+    try:
+        room_model = apps.get_model('api', 'Room')
+    except LookupError:
+        return
+    if not router.allow_migrate_model(using, room_model):
+        return
+    room_model.objects.using(using).get_or_create(
+        pk=Room.GENERAL_ID, defaults={'name': 'general'}
+    )
@@ -0,0 +1,245 @@
+"""
+Slow-query capture.
+
+When ``SLOW_QUERIES['ENABLED']`` is set, every database connection gets an
+execute wrapper that times each query. A query slower than
+``THRESHOLD_MS`` (sampled at ``SAMPLE_RATE``) is recorded with:
+
+- its SQL shape (placeholders only, whitespace and ``IN`` lists collapsed)
+  and parameter count, never parameter values;
+- the innermost project frames that ran it, e.g.
+  ``ProfileUpdateSerializer.validate_email`` called from ``ProfileView.put``;
+- its ``EXPLAIN QUERY PLAN`` on SQLite, with full scans and temporary
+  B-trees flagged. Plans are cached per shape for ``PLAN_TTL`` seconds.
+
+Each process keeps the newest ``BUFFER_SIZE`` records in a ring buffer and
+mirrors it to its own file in ``DIRECTORY``, so ``/api/internal/slow-queries/``
+and ``manage.py slowqueries`` see every worker's captures.
+"""
+import collections
+import contextlib
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+_capturing = ContextVar('slow_query_capturing', default=False)
+
+_PROJECT_DIR = str(settings.BASE_DIR) + os.sep
+_SKIP_DIRS = tuple(
+    os.path.join(str(settings.BASE_DIR), name) + os.sep for name in ('venv', '.venv')
+)
+# Execute wrappers sit between every query and the code that ran it.
+_WRAPPER_FILES = (__file__, os.path.join(os.path.dirname(__file__), 'metrics.py'))
+_WHITESPACE = re.compile(r'\s+')
+_IN_LIST = re.compile(r'IN \((?:%s, )*%s\)')
+
+
+def sql_shape(sql):
+    """``sql`` with whitespace normalized and ``IN (%s, %s, ...)`` collapsed."""
+    return _IN_LIST.sub('IN (...)', _WHITESPACE.sub(' ', sql).strip())
+
+
+def callers(limit=3):
+    """The innermost ``limit`` frames of project code, innermost first."""
+    frames = []
+    frame = sys._getframe(1)
+    while frame is not None and len(frames) < limit:
+        filename = frame.f_code.co_filename
+        if (filename.startswith(_PROJECT_DIR) and not filename.startswith(_SKIP_DIRS)
+                and filename not in _WRAPPER_FILES):
+            path = os.path.relpath(filename, settings.BASE_DIR)
+            frames.append(f'{frame.f_code.co_qualname} ({path}:{frame.f_lineno})')
+        frame = frame.f_back
+    return frames
+
+
+def explain(connection, sql, params):
+    """``EXPLAIN QUERY PLAN`` rows for ``sql`` as indented lines, or None."""
+    if connection.vendor != 'sqlite' or not sql.lstrip()[:7].upper().startswith(('SELECT', 'WITH')):
+        return None
+    # The backend cursor under Django's wrapper: it converts placeholders
+    # but skips execute wrappers, so this is neither captured nor counted.
+    with connection.cursor() as cursor:
+        cursor.cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        rows = cursor.cursor.fetchall()
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append('  ' * depth[node] + detail)
+    return lines
+
+
+def plan_warnings(plan):
+    return [
+        line.strip() for line in plan or ()
+        if line.lstrip().startswith('SCAN ') or 'TEMP B-TREE' in line
+    ]
+
+
+class SlowQueryLog:
+    def __init__(self, directory, threshold_ms=100, sample_rate=1.0, size=200, plan_ttl=60):
+        self.directory = str(directory)
+        self.threshold = threshold_ms / 1000
+        self.sample_rate = sample_rate
+        self.plan_ttl = plan_ttl
+        self.size = size
+        self._records = collections.deque(maxlen=size)
+        self._plans = {}
+        self._lock = threading.Lock()
+        self._pid = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, f'{os.getpid()}.json')
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            if (elapsed >= self.threshold and not _capturing.get()
+                    and (self.sample_rate >= 1 or random.random() < self.sample_rate)):
+                token = _capturing.set(True)
+                try:
+                    self.capture(context['connection'], sql, params, many, elapsed)
+                except Exception:
+                    # Capturing must never fail the query it observed.
+                    pass
+                finally:
+                    _capturing.reset(token)
+
+    def capture(self, connection, sql, params, many, elapsed):
+        shape = sql_shape(sql)
+        plan = None
+        if not many:
+            cached = self._plans.get(shape)
+            if cached is not None and time.monotonic() - cached[0] < self.plan_ttl:
+                plan = cached[1]
+            else:
+                plan = explain(connection, sql, params)
+                self._plans[shape] = (time.monotonic(), plan)
+                if len(self._plans) > 4 * self.size:
+                    self._plans.clear()
+        record = {
+            'time': datetime.now(timezone.utc).isoformat(timespec='milliseconds'),
+            'duration_ms': round(elapsed * 1000, 3),
+            'sql': shape,
+            'params': len(params[0] if many and params else params or ()),
+            'many': many,
+            'database': connection.alias,
+            'callers': callers(),
+            'plan': plan,
+            'warnings': plan_warnings(plan),
+            'pid': os.getpid(),
+        }
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked from a preloading master: start a buffer of our own.
+                self._pid = os.getpid()
+                self._records.clear()
+            self._records.append(record)
+            records = list(self._records)
+            os.makedirs(self.directory, exist_ok=True)
+            tmp = f'{self.path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(records, f)
+            os.replace(tmp, self.path)
+
+    def records(self, limit=None):
+        """Captures of every process, newest first, at most ``limit`` (default size)."""
+        limit = limit or self.size
+        records = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    records.extend(json.load(f))
+            except (OSError, ValueError):
+                continue
+        # Each file is oldest first; a stable sort reversed keeps ties newest first.
+        records.sort(key=lambda record: record['time'])
+        records.reverse()
+        kept = records[:limit]
+        # Files of exited processes go once none of their captures is recent.
+        current = {record['pid'] for record in kept} | {os.getpid()}
+        for pid in {record['pid'] for record in records} - current:
+            if not _alive(pid):
+                with contextlib.suppress(OSError):
+                    os.remove(os.path.join(self.directory, f'{pid}.json'))
+        return kept
+
+    def clear(self):
+        with self._lock:
+            self._records.clear()
+            self._plans.clear()
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.directory, name))
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def group_records(records):
+    """Aggregate captures by SQL shape, slowest total first."""
+    groups = {}
+    for record in records:
+        group = groups.setdefault(record['sql'], {
+            'sql': record['sql'],
+            'count': 0,
+            'total_ms': 0.0,
+            'max_ms': 0.0,
+            'callers': record['callers'],
+            'plan': record['plan'],
+            'warnings': record['warnings'],
+            'last_seen': record['time'],
+        })
+        group['count'] += 1
+        group['total_ms'] += record['duration_ms']
+        group['max_ms'] = max(group['max_ms'], record['duration_ms'])
+    for group in groups.values():
+        group['total_ms'] = round(group['total_ms'], 3)
+    return sorted(groups.values(), key=lambda group: group['total_ms'], reverse=True)
+
+
+slow_query_log = SlowQueryLog(
+    directory=settings.SLOW_QUERIES['DIRECTORY'],
+    threshold_ms=settings.SLOW_QUERIES['THRESHOLD_MS'],
+    sample_rate=settings.SLOW_QUERIES['SAMPLE_RATE'],
+    size=settings.SLOW_QUERIES['BUFFER_SIZE'],
+    plan_ttl=settings.SLOW_QUERIES['PLAN_TTL'],
+)
+
+
+@receiver(connection_created)
+def install_slow_query_log(sender, connection, **kwargs):
+    if settings.SLOW_QUERIES['ENABLED'] and slow_query_log not in connection.execute_wrappers:
+        connection.execute_wrappers.append(slow_query_log)
@@ -0,0 +1,52 @@
+"""
+Process-local counters for internal diagnostics.
+
+Components register a provider returning a dict of their counters; the
+snapshot is served to staff at ``/api/internal/stats/``. Values describe the
+process that answered the request only.
+"""
+import bisect
+import os
+import threading
+
+_providers = {}
+
+
+def register(name, provider):
+    """Expose ``provider()`` under ``name`` in the stats snapshot."""
+    _providers[name] = provider
+
+
+def snapshot():
+    stats = {name: provider() for name, provider in _providers.items()}
+    stats['pid'] = os.getpid()
+    return stats
+
+
+class Histogram:
+    """Thread-safe fixed-bucket histogram (upper bounds, inclusive)."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self._counts)
+            count, total = self.count, self.sum
+        labels = [str(bound) for bound in self.buckets] + ['+Inf']
+        return {
+            'buckets': dict(zip(labels, counts)),
+            'count': count,
+            'sum': total,
+        }
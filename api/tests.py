@@ -1,3 +1,1848 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import socket
+import struct
+import tempfile
+import threading
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone as dt_timezone
+from io import StringIO
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.contrib.sessions.models import Session
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from config.asgi_server import (
+    WS_OP_BINARY, WS_OP_CLOSE, WS_OP_CONTINUATION, WS_OP_PING, WS_OP_PONG, WS_OP_TEXT, Server, ws_frame,
+    ws_unmask,
+)
+
+from . import attachments, changes, db, rendering
+from .authentication import MEMBERS_CHANNEL, MemberCache, member_cache
+from .batching import MessageWriteBatcher, _Pending
+from .broker import InMemoryBroker, RelayBroker, get_broker
+from .hashing import HashingBusy, PasswordHashingPool, password_hashing
+from .events import room_channel
+from .gateway import ChatGateway
+from .latest import latest_messages
+from .management.commands.runbroker import Command as RelayCommand
+from .metrics import MetricsRegistry
+from .models import (
+    Attachment, ChangeCursor, Member, Message, MessageArchiveChunk, MessageChange, Room, Upload
+)
+from .msgpack import packb
+from .notify import MessageHub
+from .pagination import MessagesCursorPagination
+from .readpath import message_rows, serialize_messages
+from .renderers import FastJSONRenderer
+from .serializers import MessageSerializer
+from .slowqueries import SlowQueryLog
+from .views import MessagesView
+
+
+def login(member):
+    """An ``APIClient`` signed in as ``member`` through a saved session."""
+    client = APIClient()
+    session = client.session
+    session['member_id'] = member.id
+    session.save()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+    return client
+
+
+class MessageCursorPaginationTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        start = datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        # Two messages share a timestamp: the id breaks the tie.
+        for n, seconds in enumerate([0, 1, 2, 2, 3]):
+            message = Message.objects.create(author=cls.alice, text=f'message {n}')
+            Message.objects.filter(pk=message.pk).update(created_at=start + timedelta(seconds=seconds))
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+
+    def texts(self, response):
+        return [item['text'] for item in response.json()['results']]
+
+    def test_pages_walk_the_history_both_ways(self):
+        response = self.client.get('/api/messages/?before=&page_size=2')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('count', response.json())
+        self.assertIsNone(response.json()['previous'])
+        self.assertEqual(self.texts(response), ['message 4', 'message 3'])
+
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(self.texts(response), ['message 2', 'message 1'])
+        response = self.client.get(response.json()['next'])
+        self.assertEqual(self.texts(response), ['message 0'])
+        self.assertIsNone(response.json()['next'])
+
+        response = self.client.get(response.json()['previous'])
+        self.assertEqual(self.texts(response), ['message 2', 'message 1'])
+        response = self.client.get(response.json()['previous'])
+        self.assertEqual(self.texts(response), ['message 4', 'message 3'])
+        self.assertIsNone(response.json()['previous'])
+
+    def test_page_numbers_still_work(self):
+        response = self.client.get('/api/messages/?page=2&page_size=2')
+        self.assertEqual(response.json()['count'], 5)
+        self.assertEqual(self.texts(response), ['message 2', 'message 1'])
+
+    def test_invalid_cursor_is_not_found(self):
+        for cursor in ['not-a-cursor', 'bm90fGE', MessagesCursorPagination.make_cursor(datetime(2024, 1, 1), 1)]:
+            with self.subTest(cursor=cursor):
+                response = self.client.get(f'/api/messages/?before={cursor}')
+                self.assertEqual(response.status_code, 404)
+
+
+class ConditionalGetTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.message = Message.objects.create(author=cls.alice, text='hello')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+
+    def revalidate(self, url, etag):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+
+    def test_unchanged_messages_answer_304(self):
+        url = '/api/messages/?page=1&page_size=20'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertIn('Last-Modified', response)
+        self.assertIn('no-cache', response['Cache-Control'])
+
+        response = self.revalidate(url, etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+        # Another representation of the same list has its own validator.
+        self.assertEqual(self.revalidate('/api/messages/?page=1&page_size=10', etag).status_code, 200)
+
+    def test_messages_change_with_posts_edits_and_authors(self):
+        url = '/api/messages/'
+        changes = [
+            lambda: self.client.post(url, {'text': 'new'}, format='json'),
+            lambda: self.client.patch(f'/api/messages/{self.message.id}/', {'text': 'edited'}, format='json'),
+            lambda: self.client.put('/api/profile/', {'username': 'alice2'}, format='json'),
+        ]
+        for change in changes:
+            etag = self.client.get(url)['ETag']
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIn(change().status_code, (200, 201))
+            response = self.revalidate(url, etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    def test_messages_last_modified_follows_edits_and_deletes(self):
+        url = '/api/messages/'
+        older = Message.objects.create(author=self.alice, text='older')
+        then = datetime(2020, 1, 1, tzinfo=dt_timezone.utc)
+        Message.objects.update(created_at=then)
+        Member.objects.update(updated_at=then)
+        changes = [
+            lambda: self.client.patch(f'/api/messages/{self.message.id}/', {'text': 'edited'}, format='json'),
+            lambda: self.client.delete(f'/api/messages/{older.id}/'),
+        ]
+        for change in changes:
+            MessageChange.objects.update(changed_at=then)
+            latest_messages.clear()
+            last_modified = self.client.get(url)['Last-Modified']
+            self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIn(change().status_code, (200, 204))
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['Last-Modified'], last_modified)
+
+    def test_own_member_and_profile_answer_304_until_changed(self):
+        for url in ('/api/auth/me/', '/api/profile/'):
+            with self.subTest(url=url):
+                etag = self.client.get(url)['ETag']
+                self.assertEqual(self.revalidate(url, etag).status_code, 304)
+                with self.captureOnCommitCallbacks(execute=True):
+                    self.client.put('/api/profile/', {'email': f'alice@{len(url)}.example.com'}, format='json')
+                response = self.revalidate(url, etag)
+                self.assertEqual(response.status_code, 200)
+                self.assertNotEqual(response['ETag'], etag)
+
+
+class LongPollTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.first = Message.objects.create(author=cls.alice, text='first')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+        patcher = mock.patch('api.views.hub', MessageHub())
+        self.hub = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def poll(self, after_id, wait):
+        return self.client.get(f'/api/messages/?after_id={after_id}&wait={wait}')
+
+    def test_newer_messages_are_returned_at_once(self):
+        Message.objects.create(author=self.alice, text='second')
+        Message.objects.create(author=self.alice, text='third')
+        with mock.patch.object(self.hub, 'wait') as wait:
+            response = self.poll(self.first.id, 25)
+        wait.assert_not_called()
+        self.assertEqual([item['text'] for item in response.json()['results']], ['third', 'second'])
+
+    def test_waiter_is_woken_by_a_post(self):
+        second = Message.objects.create(author=self.alice, text='second')
+        real = MessagesView.get_messages_after
+        # Posted while the request is parked: invisible to its first query.
+        lookups = [lambda *args: [], real]
+        threading.Timer(0.05, self.hub.publish, (Room.GENERAL_ID, second.id)).start()
+        with mock.patch.object(MessagesView, 'get_messages_after',
+                               lambda view, *args: lookups.pop(0)(view, *args)):
+            started = time.monotonic()
+            response = self.poll(self.first.id, 25)
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([item['text'] for item in response.json()['results']], ['second'])
+
+    def test_wait_times_out_with_no_messages(self):
+        started = time.monotonic()
+        response = self.poll(self.first.id, 0.1)
+        self.assertGreaterEqual(time.monotonic() - started, 0.1)
+        self.assertEqual((response.status_code, response.json()['results']), (200, []))
+
+    def test_invalid_parameters_are_rejected(self):
+        response = self.client.get('/api/messages/?after_id=x&wait=soon')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(set(response.json()['details']), {'after_id', 'wait'})
+
+    def test_hub_wakes_only_the_room_of_a_broker_event(self):
+        broker = InMemoryBroker()
+        with mock.patch('api.notify.get_broker', return_value=broker):
+            self.hub.listen(1)
+            self.hub.listen(2)
+        payload = b'{"type":"message.created","message":{"id":7}}'
+        threading.Timer(0.05, broker.publish, (room_channel(1), payload)).start()
+        self.assertTrue(self.hub.wait(1, 6, 5))
+        self.assertFalse(self.hub.wait(2, 0, 0.05))
+        self.assertTrue(self.hub.wait(1, 6, 0))
+
+
+class ChatGatewayTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.session_key = login(self.alice).cookies[settings.SESSION_COOKIE_NAME].value
+        self.broker = InMemoryBroker()
+        for module in ('api.gateway', 'api.events'):
+            patcher = mock.patch(f'{module}.get_broker', return_value=self.broker)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.gateway = ChatGateway()
+
+    def connect(self, origin=None, path='/api/ws/chat/'):
+        headers = [
+            (b'host', b'chat.example.com'),
+            (b'cookie', f'{settings.SESSION_COOKIE_NAME}={self.session_key}'.encode()),
+        ]
+        if origin:
+            headers.append((b'origin', origin.encode()))
+        inbox, outbox = asyncio.Queue(), asyncio.Queue()
+        scope = {'type': 'websocket', 'path': path, 'headers': headers}
+        inbox.put_nowait({'type': 'websocket.connect'})
+        task = asyncio.create_task(self.gateway(scope, inbox.get, outbox.put))
+        return inbox, outbox, task
+
+    async def next_event(self, outbox):
+        return await asyncio.wait_for(outbox.get(), 5)
+
+    @override_settings(CSRF_TRUSTED_ORIGINS=['https://*.trusted.example', 'http://localhost:8080'])
+    async def test_only_same_host_and_trusted_origins_may_connect(self):
+        for origin, expected in [
+            (None, {'type': 'websocket.accept'}),
+            ('https://chat.example.com', {'type': 'websocket.accept'}),
+            ('https://app.trusted.example', {'type': 'websocket.accept'}),
+            ('http://localhost:8080', {'type': 'websocket.accept'}),
+            ('https://evil.example', {'type': 'websocket.close', 'code': 4403}),
+            ('http://app.trusted.example', {'type': 'websocket.close', 'code': 4403}),
+            ('null', {'type': 'websocket.close', 'code': 4403}),
+        ]:
+            with self.subTest(origin=origin):
+                inbox, outbox, task = self.connect(origin)
+                self.assertEqual(await self.next_event(outbox), expected)
+                inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+                await asyncio.wait_for(task, 5)
+
+    async def test_messages_fan_out_to_every_socket_in_the_room(self):
+        sockets = [self.connect() for _ in range(2)]
+        for _, outbox, _ in sockets:
+            self.assertEqual(await self.next_event(outbox), {'type': 'websocket.accept'})
+        self.assertEqual(len(self.gateway.fanout.connections[Room.GENERAL_ID]), 2)
+
+        # Entered and left in the thread that owns the test's connection.
+        commit = self.captureOnCommitCallbacks(execute=True)
+        await sync_to_async(commit.__enter__)()
+        sockets[0][0].put_nowait({'type': 'websocket.receive',
+                                  'text': '{"type":"message.create","text":"hi all"}'})
+        while not await Message.objects.filter(text='hi all').aexists():
+            await asyncio.sleep(0.01)
+        await sync_to_async(commit.__exit__)(None, None, None)
+        for _, outbox, _ in sockets:
+            event = await self.next_event(outbox)
+            self.assertEqual(event['type'], 'websocket.send')
+            data = json.loads(event['text'])
+            self.assertEqual((data['type'], data['message']['text']), ('message.created', 'hi all'))
+
+        sockets[1][0].put_nowait({'type': 'websocket.receive', 'text': 'not json'})
+        event = await self.next_event(sockets[1][1])
+        self.assertEqual(json.loads(event['text'])['error'], 'Invalid JSON')
+
+        for inbox, _, task in sockets:
+            inbox.put_nowait({'type': 'websocket.disconnect', 'code': 1000})
+            await asyncio.wait_for(task, 5)
+        self.assertFalse(self.gateway.fanout.connections[Room.GENERAL_ID])
+
+    async def test_socket_without_a_session_is_refused(self):
+        self.session_key = 'missing'
+        inbox, outbox, task = self.connect()
+        self.assertEqual(await self.next_event(outbox), {'type': 'websocket.close', 'code': 4401})
+        await asyncio.wait_for(task, 5)
+
+
+class RelayBrokerTests(SimpleTestCase):
+    """Fan-out across processes through the ``runbroker`` relay."""
+
+    def start_relay(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        loop = asyncio.new_event_loop()
+        self.relay = RelayCommand(stdout=StringIO())
+        serving = loop.create_task(self.relay.serve('127.0.0.1', port))
+
+        def run():
+            try:
+                loop.run_until_complete(serving)
+            except asyncio.CancelledError:
+                pass
+            finally:
+                # Hang up on the brokers, and let their handlers see it.
+                for peer in tuple(self.relay.peers):
+                    peer.close()
+                loop.run_until_complete(asyncio.gather(*asyncio.all_tasks(loop)))
+                loop.close()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(loop.call_soon_threadsafe, serving.cancel)
+        self.wait_for(lambda: self.relay.__dict__.get('peers') is not None)
+        return port
+
+    def wait_for(self, condition):
+        deadline = time.monotonic() + 5
+        while not condition():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def test_events_reach_every_process(self):
+        port = self.start_relay()
+        brokers = [RelayBroker(location=f'127.0.0.1:{port}') for _ in range(2)]
+        received = [[], []]
+        for broker, events in zip(brokers, received):
+            broker.subscribe(room_channel(1), events.append)
+            broker.subscribe(room_channel(2), lambda payload: self.fail('wrong room'))
+        # Connected, and known to the relay.
+        self.wait_for(lambda: len(self.relay.peers) == 2 and all(broker._sock for broker in brokers))
+        brokers[0].publish(room_channel(1), b'{"type":"message.created"}')
+        self.wait_for(lambda: all(received))
+        self.assertEqual(received, [[b'{"type":"message.created"}']] * 2)
+
+    def test_events_stay_local_without_the_relay(self):
+        with socket.socket() as probe:
+            probe.bind(('127.0.0.1', 0))
+            port = probe.getsockname()[1]
+        broker = RelayBroker(location=f'127.0.0.1:{port}')
+        received = []
+        broker.subscribe(room_channel(1), received.append)
+        # Without waiting for the reader to give up on the relay.
+        started = time.monotonic()
+        broker.publish(room_channel(1), b'event')
+        self.assertLess(time.monotonic() - started, 0.1)
+        self.assertEqual(received, [b'event'])
+
+
+class AsgiServerTests(SimpleTestCase):
+    """config.asgi_server's WebSocket handshake, framing and close, and its HTTP disconnects."""
+
+    KEY = b'dGhlIHNhbXBsZSBub25jZQ=='
+
+    @asynccontextmanager
+    async def serve(self, **options):
+        """An echo application served on a free port, for the test's own event loop."""
+        self.disconnects = asyncio.Queue()
+        self.writers = []
+
+        async def echo(scope, receive, send):
+            if scope['type'] == 'http':
+                await respond(scope, receive, send)
+                return
+            await receive()
+            if scope['path'] == '/refuse/':
+                await send({'type': 'websocket.close'})
+                return
+            await send({'type': 'websocket.accept'})
+            while True:
+                event = await receive()
+                if event['type'] == 'websocket.disconnect':
+                    self.disconnects.put_nowait(event['code'])
+                    return
+                await send({'type': 'websocket.send', 'text': event.get('text'), 'bytes': event.get('bytes')})
+
+        async def respond(scope, receive, send):
+            while (await receive()).get('more_body'):
+                pass
+            if scope['path'] == '/wait/':
+                self.disconnects.put_nowait((await receive())['type'])
+                return
+            # Listens for a disconnect while it works, as Django does.
+            listener = asyncio.ensure_future(receive())
+            await asyncio.sleep(0.05)
+            await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+            await send({'type': 'http.response.body', 'body': scope['path'].encode()})
+            listener.cancel()
+
+        server = Server(echo, **options)
+        async with await asyncio.start_server(server.handle_connection, '127.0.0.1', 0) as listener:
+            try:
+                yield listener.sockets[0].getsockname()[1]
+            finally:
+                for writer in self.writers:
+                    writer.close()
+
+    async def open(self, port, path='/chat/', key=KEY):
+        reader, writer = await asyncio.open_connection('127.0.0.1', port)
+        self.writers.append(writer)
+        request = [f'GET {path} HTTP/1.1', 'Host: chat.example.com', 'Upgrade: websocket',
+                   'Connection: Upgrade', 'Sec-WebSocket-Version: 13']
+        if key:
+            request.append(f'Sec-WebSocket-Key: {key.decode()}')
+        writer.write(('\r\n'.join(request) + '\r\n\r\n').encode())
+        head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+        return reader, writer, head
+
+    @staticmethod
+    def frame(opcode, payload, fin=True, masked=True):
+        mask = b'\x01\x02\x03\x04'
+        if not masked:
+            return bytes([0x80 * fin | opcode, len(payload)]) + payload
+        return bytes([0x80 * fin | opcode, 0x80 | len(payload)]) + mask + ws_unmask(payload, mask)
+
+    @staticmethod
+    async def read_frame(reader):
+        first, length = await asyncio.wait_for(reader.readexactly(2), 5)
+        return first & 0x0F, await reader.readexactly(length)
+
+    async def test_handshake_answers_the_key(self):
+        async with self.serve() as port:
+            _, _, head = await self.open(port)
+            self.assertTrue(head.startswith(b'HTTP/1.1 101 Switching Protocols\r\n'))
+            # The example of RFC 6455, section 1.3.
+            self.assertIn(b'sec-websocket-accept: s3pPLMBiTxaQ9kYGzzhZRbK+xOo=\r\n', head)
+
+    async def test_handshake_is_refused_without_a_key_or_by_the_app(self):
+        async with self.serve() as port:
+            _, _, head = await self.open(port, key=None)
+            self.assertTrue(head.startswith(b'HTTP/1.1 400 '))
+            _, _, head = await self.open(port, path='/refuse/')
+            self.assertTrue(head.startswith(b'HTTP/1.1 403 '))
+
+    async def test_fragments_are_delivered_whole_and_pings_answered(self):
+        async with self.serve() as port:
+            reader, writer, _ = await self.open(port)
+            writer.write(self.frame(WS_OP_TEXT, b'hel', fin=False)
+                         + self.frame(WS_OP_PING, b'are you there')
+                         + self.frame(WS_OP_CONTINUATION, 'lo ✓'.encode()))
+            self.assertEqual(await self.read_frame(reader), (WS_OP_PONG, b'are you there'))
+            self.assertEqual(await self.read_frame(reader), (WS_OP_TEXT, 'hello ✓'.encode()))
+            writer.write(self.frame(WS_OP_BINARY, b'\x00\xff'))
+            self.assertEqual(await self.read_frame(reader), (WS_OP_BINARY, b'\x00\xff'))
+
+    async def test_close_is_echoed_and_reaches_the_app(self):
+        async with self.serve() as port:
+            reader, writer, _ = await self.open(port)
+            writer.write(self.frame(WS_OP_CLOSE, struct.pack('!H', 1001)))
+            self.assertEqual(await self.read_frame(reader), (WS_OP_CLOSE, struct.pack('!H', 1001)))
+            self.assertEqual(await asyncio.wait_for(self.disconnects.get(), 5), 1001)
+
+    async def test_protocol_errors_close_the_socket(self):
+        async with self.serve() as port:
+            for frame, code in [
+                (self.frame(WS_OP_TEXT, b'unmasked', masked=False), 1002),
+                (self.frame(WS_OP_TEXT, b'\xff\xfe'), 1007),
+            ]:
+                with self.subTest(code=code):
+                    reader, writer, _ = await self.open(port)
+                    writer.write(frame)
+                    self.assertEqual(await self.read_frame(reader), (WS_OP_CLOSE, struct.pack('!H', code)))
+                    self.assertEqual(await asyncio.wait_for(self.disconnects.get(), 5), code)
+
+    async def test_peer_hanging_up_disconnects_a_running_request(self):
+        async with self.serve() as port:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            writer.write(b'GET /wait/ HTTP/1.1\r\nHost: chat.example.com\r\n\r\n')
+            await asyncio.sleep(0.05)
+            self.assertTrue(self.disconnects.empty())
+            writer.close()
+            self.assertEqual(await asyncio.wait_for(self.disconnects.get(), 5), 'http.disconnect')
+
+    async def test_pipelined_request_survives_the_disconnect_watch(self):
+        async with self.serve() as port:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            self.writers.append(writer)
+            writer.write(b'GET /first/ HTTP/1.1\r\nHost: a\r\n\r\nGET /second/ HTTP/1.1\r\nHost: a\r\n\r\n')
+            for path in (b'/first/', b'/second/'):
+                head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+                self.assertTrue(head.startswith(b'HTTP/1.1 200 '))
+                self.assertEqual(await reader.readexactly(len(path)), path)
+
+    async def test_oversized_chunk_size_line_is_a_bad_request(self):
+        async with self.serve() as port:
+            reader, writer = await asyncio.open_connection('127.0.0.1', port)
+            self.writers.append(writer)
+            writer.write(b'POST /upload/ HTTP/1.1\r\nHost: a\r\nTransfer-Encoding: chunked\r\n\r\n'
+                         + b'1' * 70000)
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 5)
+            self.assertTrue(head.startswith(b'HTTP/1.1 400 '))
+
+    async def test_peer_that_stops_answering_pings_is_dropped(self):
+        async with self.serve(ws_ping_interval=0.05, ws_pong_timeout=0.1) as port:
+            reader, writer, _ = await self.open(port)
+            # Answered pings keep the socket open...
+            for _ in range(3):
+                opcode, payload = await self.read_frame(reader)
+                self.assertEqual(opcode, WS_OP_PING)
+                writer.write(self.frame(WS_OP_PONG, payload))
+            self.assertTrue(self.disconnects.empty())
+            # ...a silent peer is cut off, and the app told so.
+            self.assertEqual(await asyncio.wait_for(self.disconnects.get(), 5), 1006)
+            self.assertEqual(await asyncio.wait_for(reader.read(), 5), ws_frame(WS_OP_PING, b''))
+
+
+class MemberCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+        member_cache.clear()
+        self.client = login(self.alice)
+
+    def me(self):
+        return self.client.get('/api/auth/me/')
+
+    def test_members_are_looked_up_once(self):
+        self.me()
+        hits = member_cache.hits
+        with self.assertNumQueries(0):
+            self.assertEqual(self.me().json()['username'], 'alice')
+        self.assertEqual(member_cache.hits, hits + 1)
+
+    def test_profile_change_drops_the_cached_member(self):
+        self.me()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put('/api/profile/', {'username': 'alice2'}, format='json')
+        self.assertEqual(self.me().json()['username'], 'alice2')
+
+    def test_deleted_member_is_logged_out(self):
+        self.me()
+        with self.captureOnCommitCallbacks(execute=True):
+            Member.objects.filter(pk=self.alice.pk).delete()
+        self.assertEqual(self.me().status_code, 401)
+        self.assertNotIn('member_id', self.client.session.keys())
+
+    def test_logout_ends_the_session_not_the_cache(self):
+        self.me()
+        self.assertEqual(self.client.post('/api/auth/logout/').status_code, 200)
+        self.assertEqual(self.me().status_code, 401)
+        self.assertIsNotNone(member_cache.lookup(self.alice.id))
+
+    def test_other_processes_invalidate_through_the_broker(self):
+        self.me()
+        get_broker().publish(MEMBERS_CHANNEL, str(self.alice.id).encode())
+        self.assertIsNone(member_cache.lookup(self.alice.id))
+
+    def test_entries_expire_and_least_recently_used_are_evicted(self):
+        cache = MemberCache(max_size=2, ttl=60)
+        members = [Member(id=n, username=f'member {n}') for n in (1, 2, 3)]
+        cache.set(members[0])
+        cache.set(members[1])
+        cache.lookup(1)
+        cache.set(members[2])
+        self.assertIsNone(cache.lookup(2))
+        self.assertEqual(cache.lookup(1).username, 'member 1')
+        self.assertEqual(cache.evictions, 1)
+        with mock.patch('api.authentication.time.monotonic', return_value=time.monotonic() + 61):
+            self.assertIsNone(cache.lookup(3))
+
+
+@override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, 'PBKDF2_ITERATIONS': 1000})
+class SessionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(
+            username='alice', email='alice@example.com', password_hash=make_password('secret123')
+        )
+
+    def setUp(self):
+        self.cache_dir = self.enterContext(tempfile.TemporaryDirectory())
+        sessions = {**settings.CACHES['sessions'], 'LOCATION': self.cache_dir}
+        self.enterContext(override_settings(CACHES={**settings.CACHES, 'sessions': sessions}))
+        member_cache.clear()
+        self.client = APIClient()
+        response = self.client.post(
+            '/api/auth/login/', {'email': 'alice@example.com', 'password': 'secret123'}, format='json'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.session_key = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+
+    def client_with_session(self):
+        client = APIClient()
+        client.cookies[settings.SESSION_COOKIE_NAME] = self.session_key
+        return client
+
+    def test_sessions_are_read_without_the_database(self):
+        client = self.client_with_session()
+        client.get('/api/auth/me/')
+        with self.assertNumQueries(0):
+            self.assertEqual(client.get('/api/auth/me/').status_code, 200)
+
+    def test_sessions_outlive_the_cache(self):
+        caches[settings.SESSION_CACHE_ALIAS].clear()
+        self.assertEqual(self.client_with_session().get('/api/auth/me/').status_code, 200)
+
+    def test_logout_revokes_the_session_for_every_holder(self):
+        self.assertEqual(self.client.post('/api/auth/logout/').status_code, 200)
+        self.assertEqual(self.client_with_session().get('/api/auth/me/').status_code, 401)
+        self.assertFalse(Session.objects.filter(session_key=self.session_key).exists())
+
+    def test_cache_is_culled_by_the_command_not_by_writes(self):
+        cache = caches[settings.SESSION_CACHE_ALIAS]
+        with mock.patch.object(cache, '_list_cache_files') as list_files:
+            for n in range(3):
+                cache.set(f'session-{n}', n)
+        list_files.assert_not_called()
+        cache.set('expired', 0, timeout=0)
+        for n, fname in enumerate(sorted(cache._list_cache_files(), key=os.path.getmtime)):
+            os.utime(fname, (n, n))
+
+        out = StringIO()
+        with mock.patch.object(cache, '_max_entries', 2):
+            call_command('cull_cache', stdout=out)
+        self.assertIn('1 expired, 2 beyond MAX_ENTRIES', out.getvalue())
+        # The login's session and the oldest write made way.
+        self.assertEqual(cache.get_many(['session-0', 'session-1', 'session-2', 'expired']),
+                         {'session-1': 1, 'session-2': 2})
+        with self.assertRaises(CommandError):
+            call_command('cull_cache', alias='default')
+
+    def test_maintenance_runs_the_scheduled_commands(self):
+        cache = caches[settings.SESSION_CACHE_ALIAS]
+        cache.set('expired', 0, timeout=0)
+        out, err = StringIO(), StringIO()
+        schedule = {'no_such_command': 60, 'cull_cache': 3600, 'compact_changes': 0}
+        with override_settings(MAINTENANCE_SCHEDULE=schedule):
+            call_command('run_maintenance', once=True, stdout=out, stderr=err)
+        # A failing command does not keep the others from running.
+        self.assertIn('no_such_command failed', err.getvalue())
+        self.assertIn("Culled cache 'sessions': 1 expired", out.getvalue())
+        self.assertNotIn('compact', out.getvalue())
+        with override_settings(MAINTENANCE_SCHEDULE={'cull_cache': 0}), self.assertRaises(CommandError):
+            call_command('run_maintenance', once=True)
+
+
+class SQLiteProfileTests(TestCase):
+    def pragma(self, name):
+        with connection.cursor() as cursor:
+            cursor.execute(f'PRAGMA {name}')
+            return cursor.fetchone()[0]
+
+    def test_pragmas_are_applied_to_new_connections(self):
+        pragmas = settings.SQLITE_PRAGMAS
+        self.assertEqual(self.pragma('busy_timeout'), pragmas['busy_timeout'])
+        self.assertEqual(self.pragma('cache_size'), pragmas['cache_size'])
+        # NORMAL and MEMORY.
+        self.assertEqual((self.pragma('synchronous'), self.pragma('temp_store')), (1, 2))
+        self.assertEqual(settings.DATABASES['default']['OPTIONS']['transaction_mode'], 'IMMEDIATE')
+
+    @override_settings(SQLITE_OPTIMIZE_INTERVAL=3600)
+    def test_optimize_runs_once_per_interval(self):
+        with mock.patch.object(db, '_last_optimized', 0.0), \
+                mock.patch.object(db, 'connections') as connections:
+            optimizable = mock.MagicMock(vendor='sqlite', in_atomic_block=False)
+            connections.all.return_value = [optimizable]
+            db.optimize_periodically(sender=None)
+            db.optimize_periodically(sender=None)
+        optimizable.cursor.return_value.__enter__.return_value.execute.assert_called_once_with('PRAGMA optimize')
+
+
+class MessageWriteBatcherTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+
+    def test_batch_commits_together_in_order(self):
+        batch = [_Pending(Message(author=self.alice, text=f'batched {n}')) for n in range(3)]
+        MessageWriteBatcher()._commit(batch)
+        messages = [pending.future.result() for pending in batch]
+        self.assertEqual([message.text for message in messages], ['batched 0', 'batched 1', 'batched 2'])
+        ids = [message.id for message in messages]
+        self.assertEqual(ids, sorted(ids))
+        self.assertEqual(list(Message.objects.filter(id__in=ids).order_by('id').values_list('text', flat=True)),
+                         ['batched 0', 'batched 1', 'batched 2'])
+
+    def test_bad_row_fails_alone(self):
+        batch = [_Pending(Message(author=self.alice, text=text)) for text in ('first', None, 'third')]
+        batcher = MessageWriteBatcher()
+        batcher._commit(batch)
+        self.assertEqual(batch[0].future.result().text, 'first')
+        self.assertEqual(batch[2].future.result().text, 'third')
+        self.assertIsInstance(batch[1].future.exception(), IntegrityError)
+        self.assertEqual(batcher.failed, 1)
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_posts_the_writer_cannot_take_answer_503_and_are_never_written(self):
+        batcher = MessageWriteBatcher(max_queue_size=1, commit_timeout=0.01)
+        batching = {**settings.MESSAGES_WRITE_BATCHING, 'ENABLED': True}
+        with override_settings(MESSAGES_WRITE_BATCHING=batching), \
+                mock.patch('api.serializers.message_batcher', batcher), \
+                mock.patch.object(batcher, '_ensure_writer'):
+            timed_out = self.client.post('/api/messages/', {'text': 'late'}, format='json')
+            full = self.client.post('/api/messages/', {'text': 'rejected'}, format='json')
+        self.assertEqual((timed_out.status_code, full.status_code), (503, 503))
+        self.assertEqual(batcher.rejected, 1)
+        # The writer gets to the timed-out post after all, and skips it.
+        batcher._commit([batcher._queue.get_nowait()])
+        self.assertFalse(Message.objects.exists())
+
+
+class LatestMessagesCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        for n in range(3):
+            Message.objects.create(author=cls.alice, text=f'message {n}')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+
+    def texts(self):
+        return [item['text'] for item in self.client.get('/api/messages/').json()['results']]
+
+    def test_entry_built_before_an_edit_is_not_served(self):
+        # Rebuilt from rows read before the edit, stored after its invalidation.
+        latest_messages.rebuild(Room.GENERAL_ID)
+        newest = Message.objects.order_by('-created_at', '-id').first()
+        Message.objects.filter(pk=newest.pk).update(text='edited')
+        misses = latest_messages.misses
+        self.assertEqual(self.texts(), ['edited', 'message 1', 'message 0'])
+        self.assertEqual(latest_messages.misses, misses + 1)
+
+        # Posts still extend the entry once it reflects the edit.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/messages/', {'text': 'new'}, format='json')
+        hits = latest_messages.hits
+        self.assertEqual(self.texts(), ['new', 'edited', 'message 1', 'message 0'])
+        self.assertEqual(latest_messages.hits, hits + 1)
+
+    def test_posts_are_pushed_and_served_from_the_cache(self):
+        self.texts()
+        pushes, hits = latest_messages.pushes, latest_messages.hits
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post('/api/messages/', {'text': 'new'}, format='json')
+        cached = self.client.get('/api/messages/')
+        self.assertEqual((latest_messages.pushes, latest_messages.hits), (pushes + 1, hits + 1))
+        with mock.patch.object(latest_messages, 'enabled', False):
+            uncached = self.client.get('/api/messages/')
+        self.assertEqual(cached.json(), uncached.json())
+        self.assertEqual(cached.json()['count'], 4)
+        self.assertEqual(cached.json()['results'][0]['text'], 'new')
+
+    def test_push_out_of_order_is_a_conflict(self):
+        self.texts()
+        skipped = Message.objects.create(author=self.alice, text='skipped')
+        newest = Message.objects.create(author=self.alice, text='newest')
+        conflicts = latest_messages.conflicts
+        latest_messages.push(newest, JSONRenderer().render(MessageSerializer(newest).data))
+        self.assertEqual(latest_messages.conflicts, conflicts + 1)
+        misses = latest_messages.misses
+        self.assertEqual(self.texts()[:2], ['newest', skipped.text])
+        self.assertEqual(latest_messages.misses, misses + 1)
+
+    def test_rename_rewrites_the_cached_authors(self):
+        self.texts()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.put('/api/profile/', {'username': 'alice2'}, format='json')
+        hits = latest_messages.hits
+        results = self.client.get('/api/messages/').json()['results']
+        self.assertEqual(latest_messages.hits, hits + 1)
+        self.assertEqual({item['author']['username'] for item in results}, {'alice2'})
+
+    def test_edits_and_deletes_drop_the_entry(self):
+        newest = Message.objects.order_by('-created_at', '-id').first()
+        for change in [
+            lambda: self.client.patch(f'/api/messages/{newest.id}/', {'text': 'edited'}, format='json'),
+            lambda: self.client.delete(f'/api/messages/{newest.id}/'),
+        ]:
+            self.texts()
+            with self.captureOnCommitCallbacks(execute=True):
+                self.assertIn(change().status_code, (200, 204))
+            self.assertIsNone(latest_messages.cache.get(latest_messages.key(Room.GENERAL_ID)))
+        self.assertEqual(self.texts(), ['message 1', 'message 0'])
+
+
+class MessageReadPathTests(TestCase):
+    """The fast read path must match MessageSerializer byte for byte."""
+
+    @classmethod
+    def setUpTestData(cls):
+        authors = [
+            Member.objects.create(username='alice', email='alice@example.com'),
+            Member.objects.create(username='Jörg "JJ" Ünal', email='jorg@example.com'),
+        ]
+        texts = [
+            'hello',
+            'quotes " and \\ backslashes',
+            'unicode ü 漢字 😀',
+            'separators \u2028 and \u2029',
+            '<script>alert(1)</script>\nnew line\ttab',
+        ]
+        for index, text in enumerate(texts * 3):
+            Message.objects.create(author=authors[index % 2], text=text)
+        # Whole seconds render without a fractional part.
+        Message.objects.filter(pk=Message.objects.order_by('id').first().pk).update(
+            created_at=datetime(2024, 1, 2, 3, 4, 5, tzinfo=dt_timezone.utc)
+        )
+        Member.objects.filter(pk=authors[0].pk).update(
+            created_at=datetime(2024, 1, 1, tzinfo=dt_timezone.utc)
+        )
+
+    def assert_same_output(self):
+        expected = MessageSerializer(
+            Message.objects.select_related('author'), many=True
+        ).data
+        actual = serialize_messages(message_rows(Message.objects.all()))
+        self.assertEqual(actual, expected)
+        self.assertEqual(
+            FastJSONRenderer().render(actual), JSONRenderer().render(expected)
+        )
+
+    def test_matches_message_serializer(self):
+        self.assert_same_output()
+
+    def test_matches_message_serializer_in_other_timezone(self):
+        with timezone.override('America/New_York'):
+            self.assert_same_output()
+
+    def test_fast_renderer_falls_back_for_other_types(self):
+        data = {'when': datetime(2024, 1, 2, tzinfo=dt_timezone.utc), 'n': [1, 2.5, None]}
+        self.assertEqual(FastJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(
+            FastJSONRenderer().render(data, 'application/json; indent=2'),
+            JSONRenderer().render(data, 'application/json; indent=2'),
+        )
+
+
+class MessagePackTests(TestCase):
+    def test_encodings(self):
+        cases = [
+            (None, b'\xc0'),
+            (True, b'\xc3'),
+            (False, b'\xc2'),
+            (5, b'\x05'),
+            (-1, b'\xff'),
+            (200, b'\xcc\xc8'),
+            (-200, b'\xd1\xff\x38'),
+            (70000, b'\xce\x00\x01\x11\x70'),
+            (2 ** 40, b'\xcf\x00\x00\x01\x00\x00\x00\x00\x00'),
+            (1.5, b'\xcb\x3f\xf8\x00\x00\x00\x00\x00\x00'),
+            ('ü', b'\xa2\xc3\xbc'),
+            ('x' * 40, b'\xd9\x28' + b'x' * 40),
+            ([1, 2], b'\x92\x01\x02'),
+            ({'a': 1}, b'\x81\xa1a\x01'),
+            (list(range(16)), b'\xdc\x00\x10' + bytes(range(16))),
+        ]
+        for value, expected in cases:
+            self.assertEqual(packb(value), expected, value)
+
+    def test_other_types_pack_as_json_values(self):
+        value = datetime(2024, 1, 2, tzinfo=dt_timezone.utc)
+        self.assertEqual(packb(value), packb('2024-01-02T00:00:00Z'))
+
+
+class CompactMessageListTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.client.post(
+            '/api/auth/register/',
+            {'username': 'alice', 'email': 'alice@example.com', 'password': 'secret123'},
+            format='json',
+        )
+        self.client.post(
+            '/api/auth/login/',
+            {'email': 'alice@example.com', 'password': 'secret123'},
+            format='json',
+        )
+        member = Member.objects.get(username='alice')
+        for index in range(3):
+            Message.objects.create(author=member, text=f'message {index}')
+
+    def test_authors_are_sideloaded(self):
+        full = self.client.get('/api/messages/').json()
+        compact = self.client.get('/api/messages/?compact=1').json()
+        author = full['results'][0]['author']
+        self.assertEqual(compact['authors'], {str(author['id']): author})
+        self.assertEqual(
+            compact['results'],
+            [
+                {**{k: v for k, v in item.items() if k != 'author'}, 'author_id': author['id']}
+                for item in full['results']
+            ],
+        )
+
+    def test_sparse_fieldsets(self):
+        data = self.client.get('/api/messages/?fields=text,id').json()
+        self.assertEqual(list(data['results'][0]), ['id', 'text'])
+        data = self.client.get('/api/messages/?compact=1&fields=text').json()
+        self.assertNotIn('authors', data)
+        response = self.client.get('/api/messages/?fields=author_id')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('fields', response.json()['details'])
+
+    def test_messagepack_is_compact(self):
+        response = self.client.get('/api/messages/', HTTP_ACCEPT='application/msgpack')
+        self.assertEqual(response['Content-Type'], 'application/msgpack')
+        compact = self.client.get('/api/messages/?compact=1')
+        self.assertEqual(response.content, packb(compact.json()))
+        self.assertNotEqual(response['ETag'], self.client.get('/api/messages/')['ETag'])
+
+
+def hashing_settings(**overrides):
+    return override_settings(PASSWORD_HASHING={**settings.PASSWORD_HASHING, **overrides})
+
+
+@hashing_settings(PBKDF2_ITERATIONS=1000)
+class PasswordHashingTests(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.member = Member.objects.create(
+            username='alice', email='alice@example.com', password_hash=make_password('secret123')
+        )
+
+    def post_login(self, email='alice@example.com', password='secret123'):
+        return self.client.post(
+            '/api/auth/login/', {'email': email, 'password': password}, format='json'
+        )
+
+    def test_login_rehashes_when_parameters_change(self):
+        with hashing_settings(PBKDF2_ITERATIONS=2000):
+            self.assertEqual(self.post_login().status_code, 200)
+            self.member.refresh_from_db()
+            self.assertTrue(self.member.password_hash.startswith('pbkdf2_sha256$2000$'))
+            self.assertTrue(self.member.check_password('secret123'))
+
+    def test_unknown_email_checks_a_dummy_hash_in_one_query(self):
+        with mock.patch.object(
+            password_hashing, 'verify', wraps=password_hashing.verify
+        ) as verify, self.assertNumQueries(1):
+            response = self.post_login(email='nobody@example.com')
+        self.assertEqual(response.status_code, 400)
+        verify.assert_called_once_with('secret123', None)
+
+    def test_saturated_pool_answers_503(self):
+        pool = PasswordHashingPool(workers=1, max_queue=0)
+        release = threading.Event()
+        pool.submit(release.wait)
+        try:
+            with self.assertRaises(HashingBusy):
+                pool.submit(release.wait)
+            with mock.patch.object(password_hashing, 'submit', pool.submit):
+                response = self.post_login()
+        finally:
+            release.set()
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '1')
+        self.assertEqual(pool.stats()['rejected'], 2)
+
+
+class GenerateDatasetTests(TestCase):
+    def generate(self, **options):
+        options = {
+            'members': 20, 'messages': 500, 'seed': 7, 'chunk_size': 64,
+            'transaction_size': 200, 'clear': True, **options,
+        }
+        call_command(
+            'generate_dataset', '--end=2024-06-01T00:00:00+00:00', stdout=StringIO(), **options
+        )
+        return list(Message.objects.order_by('id').values_list(
+            'author__username', 'text', 'created_at'
+        ))
+
+    def test_same_seed_same_dataset(self):
+        rows = self.generate()
+        self.assertEqual(Member.objects.count(), 20)
+        self.assertEqual(len(rows), 500)
+        self.assertEqual(rows, self.generate())
+        self.assertNotEqual(rows, self.generate(seed=8))
+
+    def test_shape(self):
+        rows = self.generate(author_skew=1.5, days=10)
+        created = [row[2] for row in rows]
+        self.assertEqual(created, sorted(created))
+        self.assertEqual(created[-1].date().isoformat(), '2024-05-31')
+        self.assertLess(created[0], datetime(2024, 5, 23, tzinfo=dt_timezone.utc))
+        top = Counter(row[0] for row in rows).most_common()
+        self.assertGreater(top[0][1], 5 * top[-1][1])
+        member = Member.objects.first()
+        self.assertTrue(member.check_password('password123'))
+
+
+class RequestMetricsTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.registry = MetricsRegistry(self.directory.name, flush_interval=0)
+        patcher = mock.patch('api.metrics.registry', self.registry)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        member = Member.objects.create(
+            username='alice', email='alice@example.com', password_hash=make_password('secret123')
+        )
+        Message.objects.create(author=member, text='hello')
+        self.client = login(member)
+
+    def test_server_timing(self):
+        response = self.client.get('/api/messages/?page_size=1&compact=1')
+        timings = dict(
+            item.strip().split(';', 1) for item in response['Server-Timing'].split(',')
+        )
+        self.assertEqual(set(timings), {'db', 'serialize', 'render', 'session', 'total'})
+        self.assertRegex(timings['db'], r'^dur=[0-9.]+;desc="[1-9][0-9]* queries"$')
+
+    def test_aggregates_across_processes(self):
+        self.client.get('/api/auth/me/')
+        self.client.get('/api/auth/me/')
+        other = MetricsRegistry(self.directory.name)
+        other.observe('api/auth/me/', 'GET', 200, {'request_duration_seconds': 0.5})
+        other.flush(force=True)
+        # A process that has exited: its file is folded into retired.json.
+        exited = os.path.join(self.directory.name, '999999999-dead.json')
+        with open(exited, 'w') as f:
+            json.dump({'requests': [['api/auth/me/', 'GET', '200', 4]], 'histograms': []}, f)
+
+        for _ in range(2):
+            merged = self.registry.collect()
+            self.assertEqual(merged['requests'][('api/auth/me/', 'GET', '200')], 7)
+            self.assertEqual(
+                merged['histograms'][('api/auth/me/', 'GET', 'request_duration_seconds')]['count'],
+                3
+            )
+            self.assertFalse(os.path.exists(exited))
+
+    def test_flush_reaps_exited_processes(self):
+        exited = os.path.join(self.directory.name, '999999999-dead.json')
+        with open(exited, 'w') as f:
+            json.dump({'requests': [['api/auth/me/', 'GET', '200', 4]], 'histograms': []}, f)
+        self.client.get('/api/auth/me/')
+        self.assertTrue(os.path.exists(exited))
+
+        self.registry.reap_interval = 0
+        self.client.get('/api/auth/me/')
+        self.assertFalse(os.path.exists(exited))
+        with open(os.path.join(self.directory.name, 'retired.json')) as f:
+            self.assertEqual(json.load(f)['requests'], [['api/auth/me/', 'GET', '200', 4]])
+
+    def test_test_runs_write_no_deployment_files(self):
+        self.assertFalse(
+            Path(settings.REQUEST_METRICS['DIRECTORY']).is_relative_to(settings.BASE_DIR)
+        )
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/hello/')
+        self.assertEqual(self.client.get('/api/metrics/').status_code, 403)
+        metrics_settings = {**settings.REQUEST_METRICS, 'TOKEN': 'scrape'}
+        with override_settings(REQUEST_METRICS=metrics_settings):
+            response = APIClient().get('/api/metrics/', HTTP_AUTHORIZATION='Bearer scrape')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+        body = response.content.decode()
+        self.assertIn('api_requests_total{route="api/hello/",method="GET",status="200"} 1', body)
+        self.assertIn(
+            'api_request_duration_seconds_bucket{route="api/hello/",method="GET",le="+Inf"} 1',
+            body
+        )
+
+
+class SlowQueryTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.log = SlowQueryLog(directory.name, threshold_ms=0, size=2)
+        patcher = mock.patch('api.views.slow_query_log', self.log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        member = Member.objects.create(username='alice', email='alice@example.com')
+        Message.objects.create(author=member, text='hello')
+
+    def run_queries(self):
+        with connection.execute_wrapper(self.log):
+            list(Message.objects.filter(author__username__in=['alice', 'bob']))
+            Message.objects.filter(text__contains='hell').count()
+            Member.objects.filter(email='alice@example.com').exists()
+
+    def test_captures_shape_caller_and_plan(self):
+        self.run_queries()
+        records = self.log.records()
+        # The ring buffer keeps the newest two.
+        self.assertEqual(len(records), 2)
+        count = records[1]
+        self.assertEqual(count['params'], 1)
+        self.assertNotIn('hell', count['sql'])
+        self.assertTrue(count['callers'][0].startswith('SlowQueryTests.run_queries (api/tests.py:'))
+        self.assertIn('SCAN messages', count['warnings'])
+
+        self.log.clear()
+        with connection.execute_wrapper(self.log):
+            list(Message.objects.filter(author__username__in=['alice', 'bob']))
+        (record,) = self.log.records()
+        self.assertIn('IN (...)', record['sql'])
+        self.assertEqual(record['params'], 2)
+
+    def test_endpoint_is_staff_only(self):
+        self.run_queries()
+        client = APIClient()
+        self.assertEqual(client.get('/api/internal/slow-queries/').status_code, 403)
+        client.force_login(User.objects.create_user('admin', is_staff=True))
+        response = client.get('/api/internal/slow-queries/?group=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([group['count'] for group in response.json()['groups']], [1, 1])
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+        for author, text in [
+            (cls.alice, 'deploy the release <today>'),
+            (cls.bob, 'the release deploy went fine'),
+            (cls.alice, 'Café at noon'),
+            (cls.bob, 'deployment deployment deployment'),
+        ]:
+            Message.objects.create(author=author, text=text)
+
+    def setUp(self):
+        self.client = login(self.alice)
+
+    def search(self, **params):
+        response = self.client.get('/api/messages/search/', params)
+        self.assertEqual(response.status_code, 200, response.content)
+        return response.json()
+
+    def texts(self, **params):
+        return [result['text'] for result in self.search(**params)['results']]
+
+    def test_phrase_prefix_and_filters(self):
+        self.assertEqual(self.texts(q='"deploy the release"'), ['deploy the release <today>'])
+        self.assertEqual(self.texts(q='cafe'), ['Café at noon'])
+        self.assertEqual(len(self.texts(q='depl*')), 3)
+        self.assertEqual(self.texts(q='depl*', author=self.bob.id, order='recent'), [
+            'deployment deployment deployment',
+            'the release deploy went fine',
+        ])
+        self.assertEqual(self.texts(q='release', until='2000-01-01T00:00:00Z'), [])
+        # Operators are plain text, never FTS5 syntax errors.
+        self.assertEqual(self.texts(q='release) OR NEAR(x'), [])
+
+    def test_snippets_are_escaped(self):
+        (result,) = self.search(q='today')['results']
+        self.assertEqual(result['snippet'], 'deploy the release &lt;<mark>today</mark>&gt;')
+        self.assertEqual(result['author']['username'], 'alice')
+
+    def test_cursor_pages_through_ranked_results(self):
+        data = self.search(q='depl*', page_size=1)
+        seen = [result['id'] for result in data['results']]
+        while data['next']:
+            data = self.client.get(data['next']).json()
+            seen += [result['id'] for result in data['results']]
+        self.assertEqual(len(seen), 3)
+        self.assertEqual(seen, [result['id'] for result in self.search(q='depl*')['results']])
+
+    def test_index_follows_updates_and_deletes(self):
+        message = Message.objects.get(text='Café at noon')
+        Message.objects.filter(pk=message.pk).update(text='lunch at noon')
+        self.assertEqual(self.texts(q='cafe'), [])
+        self.assertEqual(self.texts(q='lunch'), ['lunch at noon'])
+        message.delete()
+        self.assertEqual(self.texts(q='noon'), [])
+        call_command('rebuild_search', '--check', stdout=StringIO())
+
+
+class MessageArchiveTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.member = Member.objects.create(username='alice', email='alice@example.com')
+        gone = Member.objects.create(username='gone', email='gone@example.com')
+        now = timezone.now()
+        messages = [
+            Message(author=cls.member, text=f'message {n}', created_at=now - timedelta(days=140 - n))
+            for n in range(140)
+        ]
+        # Two messages at the same instant straddle a chunk boundary.
+        messages[10].created_at = messages[11].created_at
+        messages[20].author = gone
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+
+    def setUp(self):
+        self.client = login(self.member)
+
+    def history(self, url):
+        ids = []
+        while url:
+            data = self.client.get(url).json()
+            ids += [result['id'] for result in data['results']]
+            url = data['next']
+        return ids, data
+
+    def test_history_reads_through_the_archive(self):
+        before, _ = self.history('/api/messages/?before=&page_size=10')
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 0, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--batch-size=9', '--pause=0',
+                         stdout=StringIO())
+        # The newest 101 stay hot for the largest first page.
+        self.assertEqual(Message.objects.count(), 101)
+        self.assertEqual(sum(MessageArchiveChunk.objects.values_list('count', flat=True)), 39)
+        call_command('verify_archive', stdout=StringIO())
+        # A rebuilt first page counts the archive, like the uncached one.
+        latest_messages.invalidate(Room.GENERAL_ID)
+        self.assertEqual(self.client.get('/api/messages/').json()['count'], 140)
+        self.assertEqual(self.client.get('/api/messages/?compact=1').json()['count'], 140)
+
+        Member.objects.filter(username='gone').delete()
+        expected = before[:119] + before[120:]
+        after, last = self.history('/api/messages/?before=&page_size=10')
+        self.assertEqual(after, expected)
+        pages = []
+        for page in range(1, 15):
+            response = self.client.get(f'/api/messages/?page={page}&page_size=10')
+            pages += [result['id'] for result in response.json()['results']]
+        self.assertEqual(pages, expected)
+        # Forward from the oldest page back into the hot table.
+        url, forward = last['previous'], [result['id'] for result in last['results']]
+        while url:
+            data = self.client.get(url).json()
+            forward = [result['id'] for result in data['results']] + forward
+            url = data['previous']
+        self.assertEqual(forward, expected)
+
+    @override_settings(MESSAGE_RETENTION={**settings.MESSAGE_RETENTION, 'MIN_HOT': 0})
+    def test_verify_detects_tampering(self):
+        call_command('archive_messages', '--hot-days=90', stdout=StringIO())
+        MessageArchiveChunk.objects.filter(pk=MessageArchiveChunk.objects.first().pk).update(count=1)
+        with self.assertRaisesMessage(CommandError, 'Archive verification failed'):
+            call_command('verify_archive', stdout=StringIO(), stderr=StringIO())
+
+    @override_settings(MESSAGE_RETENTION={**settings.MESSAGE_RETENTION, 'MIN_HOT': 0})
+    def test_search_reports_the_archive_it_leaves_out(self):
+        self.assertFalse(self.client.get('/api/messages/search/?q=message').json()['archive_excluded'])
+        call_command('archive_messages', '--hot-days=90', stdout=StringIO())
+
+        data = self.client.get('/api/messages/search/', {'q': '"message 5"'}).json()
+        self.assertEqual((data['results'], data['archive_excluded']), ([], True))
+        since = (timezone.now() - timedelta(days=30)).isoformat()
+        data = self.client.get('/api/messages/search/', {'q': '"message 139"', 'since': since}).json()
+        self.assertEqual([result['text'] for result in data['results']], ['message 139'])
+        self.assertFalse(data['archive_excluded'])
+
+
+class MemberActivityTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+        now = timezone.now()
+        messages = [
+            Message(author=cls.alice if n % 3 else cls.bob, text=f'message {n}',
+                    created_at=now - timedelta(days=200 - n))
+            for n in range(150)
+        ]
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+        call_command('reconcile_member_counters', stdout=StringIO())
+
+    def setUp(self):
+        self.client = login(self.alice)
+
+    def counters(self, member):
+        member.refresh_from_db()
+        return member.message_count, member.last_message_at
+
+    def test_posts_update_counters(self):
+        profile = self.client.get('/api/profile/')
+        self.assertEqual(profile.json()['message_count'], 100)
+        response = self.client.post('/api/messages/', {'text': 'hi'}, format='json')
+        created = Message.objects.get(pk=response.json()['id'])
+        self.assertEqual(self.counters(self.alice), (101, created.created_at))
+        # The profile revalidates, and saving it keeps the fresher counters.
+        stale = self.client.get('/api/profile/', HTTP_IF_NONE_MATCH=profile['ETag'])
+        self.assertEqual(stale.status_code, 200)
+        self.assertEqual(stale.json()['message_count'], 101)
+        self.client.put('/api/profile/', {'username': 'alicia'}, format='json')
+        self.assertEqual(self.counters(self.alice)[0], 101)
+
+        batcher = MessageWriteBatcher()
+        batch = [_Pending(Message(author=self.bob, text=f'batched {n}')) for n in range(3)]
+        batcher._commit(batch)
+        self.assertEqual(self.counters(self.bob), (53, batch[-1].future.result().created_at))
+
+    def test_history_reads_one_author_through_the_archive(self):
+        expected = list(
+            Message.objects.filter(author=self.bob).order_by('-created_at', '-id')
+            .values_list('id', flat=True)
+        )
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 0, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--pause=0', stdout=StringIO())
+        self.assertLess(Message.objects.filter(author=self.bob).count(), len(expected))
+        call_command('verify_archive', stdout=StringIO())
+
+        url, ids = f'/api/members/{self.bob.id}/messages/?page_size=15', []
+        while url:
+            data = self.client.get(url).json()
+            ids += [result['id'] for result in data['results']]
+            url = data['next']
+        self.assertEqual(ids, expected)
+        self.assertEqual(self.client.get('/api/members/999/messages/').status_code, 404)
+
+        top = self.client.get('/api/members/top/').json()['results']
+        self.assertEqual(
+            [(member['username'], member['message_count']) for member in top],
+            [('alice', 100), ('bob', 50)]
+        )
+
+    def test_reconcile_repairs_drift(self):
+        Member.objects.filter(pk=self.alice.pk).update(message_count=7, last_message_at=None)
+        out = StringIO()
+        call_command('reconcile_member_counters', '--batch-size=1', stdout=out)
+        self.assertIn('1 corrected', out.getvalue())
+        newest = Message.objects.filter(author=self.alice).latest('created_at').created_at
+        self.assertEqual(self.counters(self.alice), (100, newest))
+
+
+class MessageChangeTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+        now = timezone.now()
+        messages = [
+            Message(author=cls.bob, text=f'old {n}', created_at=now - timedelta(days=200 - n))
+            for n in range(150)
+        ]
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+
+    def setUp(self):
+        self.client = login(self.alice)
+
+    def feed(self, **params):
+        return self.client.get('/api/messages/changes/', params)
+
+    def test_feed_follows_creates_edits_and_deletes(self):
+        seq = self.feed().json()['seq']
+        self.assertEqual(seq, changes.latest_seq())
+        etag = self.client.get('/api/messages/')['ETag']
+
+        message_id = self.client.post('/api/messages/', {'text': 'hi'}, format='json').json()['id']
+        edited = self.client.patch(f'/api/messages/{message_id}/', {'text': 'hello'}, format='json')
+        self.assertEqual(edited.json()['text'], 'hello')
+        self.assertNotEqual(self.client.get('/api/messages/')['ETag'], etag)
+        self.assertEqual(self.client.delete(f'/api/messages/{message_id}/').status_code, 204)
+        self.alice.refresh_from_db()
+        self.assertEqual((self.alice.message_count, self.alice.last_message_at), (0, None))
+
+        bobs = Message.objects.filter(author=self.bob).first()
+        self.assertEqual(self.client.delete(f'/api/messages/{bobs.id}/').status_code, 403)
+        self.assertEqual(self.client.patch('/api/messages/999/', {'text': 'x'}, format='json').status_code, 404)
+
+        data = self.feed(since=seq, limit=2).json()
+        self.assertEqual(
+            [(event['op'], event['id'], event.get('text')) for event in data['events']],
+            [('created', message_id, 'hi'), ('updated', message_id, 'hello')]
+        )
+        self.assertEqual(data['authors'][str(self.alice.id)]['username'], 'alice')
+        self.assertTrue(data['more'])
+        data = self.feed(since=data['seq']).json()
+        self.assertEqual(data['events'], [
+            {'seq': seq + 3, 'op': 'deleted', 'id': message_id,
+             'changed_at': data['events'][0]['changed_at']}
+        ])
+        self.assertEqual((data['seq'], data['authors'], data['more']), (seq + 3, {}, False))
+        self.assertEqual(self.feed(since=seq + 3).json()['events'], [])
+
+        # Moving messages to the archive is not a change.
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 0, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--pause=0', stdout=StringIO())
+        self.assertLess(Message.objects.count(), 150)
+        self.assertEqual(changes.latest_seq(), seq + 3)
+
+    def test_compaction_waits_for_live_cursors(self):
+        latest = changes.latest_seq()
+        with mock.patch.object(changes.cursor_tracker, 'interval', 0):
+            self.feed(since=5, client='phone')
+            self.feed(since=latest, client='laptop')
+        ChangeCursor.objects.filter(client='laptop').update(seen_at=timezone.now() - timedelta(days=30))
+
+        out = StringIO()
+        call_command('compact_changes', stdout=out)
+        self.assertIn('5 deleted, 1 expired', out.getvalue())
+        self.assertEqual(self.feed(since=5).json()['events'][0]['seq'], 6)
+        response = self.feed(since=4)
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(response.json()['details']['seq'], latest)
+        self.assertEqual(self.feed(since=latest + 1).status_code, 410)
+
+        # Once nobody follows, only the newest change stays.
+        ChangeCursor.objects.all().delete()
+        changes.compact(batch_size=3)
+        self.assertEqual(list(MessageChange.objects.values_list('seq', flat=True)), [latest])
+        self.assertEqual(self.feed(since=latest).json()['events'], [])
+
+
+
+class RoomTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+
+    def create_old_messages(self, room, count):
+        now = timezone.now()
+        messages = [
+            Message(author=self.alice, room=room, text=f'{room.name} {n}',
+                    created_at=now - timedelta(days=200 - n))
+            for n in range(count)
+        ]
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+
+    def test_rooms_are_members_only_and_isolated(self):
+        alice, bob = login(self.alice), login(self.bob)
+        response = alice.post('/api/rooms/', {'name': ' ops '}, format='json')
+        self.assertEqual(response.status_code, 201)
+        room = response.json()
+        self.assertEqual((room['name'], room['joined']), ('ops', True))
+        self.assertEqual(alice.post('/api/rooms/', {'name': 'ops'}, format='json').status_code, 400)
+        url = f"/api/rooms/{room['id']}/"
+
+        self.assertEqual(bob.get(url + 'messages/').status_code, 403)
+        self.assertEqual(bob.post(url + 'messages/', {'text': 'hi'}, format='json').status_code, 403)
+        self.assertEqual(bob.get('/api/rooms/999/messages/').status_code, 404)
+        self.assertEqual(bob.post('/api/rooms/1/join/').status_code, 400)
+        self.assertEqual(
+            [(r['name'], r['joined']) for r in bob.get('/api/rooms/').json()['results']],
+            [('general', True), ('ops', False)]
+        )
+        self.assertEqual(bob.post(url + 'join/').status_code, 201)
+        self.assertEqual(bob.post(url + 'join/').status_code, 200)
+
+        general_seq = alice.get('/api/messages/changes/').json()['seq']
+        room_seq = alice.get(url + 'changes/').json()['seq']
+        secret = bob.post(url + 'messages/', {'text': 'deploy secret'}, format='json').json()
+        alice.post('/api/messages/', {'text': 'deploy public'}, format='json')
+
+        self.assertEqual([m['text'] for m in alice.get(url + 'messages/').json()['results']],
+                         ['deploy secret'])
+        self.assertEqual([m['text'] for m in alice.get('/api/messages/').json()['results']],
+                         ['deploy public'])
+        self.assertEqual([m['text'] for m in alice.get('/api/messages/?after_id=0').json()['results']],
+                         ['deploy public'])
+        self.assertEqual(
+            [e['text'] for e in alice.get(url + 'changes/', {'since': room_seq}).json()['events']],
+            ['deploy secret']
+        )
+        self.assertEqual(
+            [e['text'] for e in alice.get('/api/messages/changes/', {'since': general_seq}).json()['events']],
+            ['deploy public']
+        )
+        search = alice.get('/api/messages/search/', {'q': 'deploy'}).json()['results']
+        self.assertEqual([m['text'] for m in search], ['deploy public'])
+        search = alice.get('/api/messages/search/', {'q': 'deploy', 'room': room['id']}).json()
+        self.assertEqual([m['id'] for m in search['results']], [secret['id']])
+        self.assertEqual(alice.get(f'/api/members/{self.bob.id}/messages/').json()['results'], [])
+        self.assertEqual(
+            len(alice.get(f"/api/members/{self.bob.id}/messages/?room={room['id']}").json()['results']), 1
+        )
+
+        self.assertEqual(bob.delete(url + 'join/').status_code, 204)
+        self.assertEqual(bob.get(url + 'messages/').status_code, 403)
+        self.assertEqual(bob.get('/api/messages/search/', {'q': 'deploy', 'room': room['id']}).status_code, 403)
+        self.assertEqual(bob.get(url + 'changes/').status_code, 403)
+
+    def test_cache_validators_and_archive_are_per_room(self):
+        room = Room.objects.create(name='ops', created_by=self.alice)
+        room.memberships.create(member=self.alice)
+        general = Room.objects.get(pk=Room.GENERAL_ID)
+        self.create_old_messages(room, 130)
+        self.create_old_messages(general, 130)
+        alice = login(self.alice)
+        url = f'/api/rooms/{room.id}/messages/'
+
+        etag = alice.get(url)['ETag']
+        alice.post('/api/messages/', {'text': 'elsewhere'}, format='json')
+        self.assertEqual(alice.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        self.assertEqual(latest_messages.cache.get(latest_messages.key(room.id))['count'], 130)
+        self.assertEqual(latest_messages.cache.get(latest_messages.key(Room.GENERAL_ID)), None)
+
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 0, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--pause=0', stdout=StringIO())
+        # Each room keeps its own newest 101 hot.
+        self.assertEqual(Message.objects.filter(room=room).count(), 101)
+        self.assertEqual(Message.objects.filter(room=general).count(), 101)
+        self.assertEqual(
+            set(MessageArchiveChunk.objects.values_list('room_id', flat=True)), {room.id, general.id}
+        )
+        call_command('verify_archive', stdout=StringIO())
+
+        ids, data = [], {'next': url + '?before=&page_size=50'}
+        while data['next']:
+            data = alice.get(data['next']).json()
+            ids += [m['id'] for m in data['results']]
+        expected = list(room.messages.order_by('-created_at', '-id').values_list('id', flat=True))
+        self.assertEqual(ids[:101], expected)
+        self.assertEqual(len(ids), 130)
+        self.assertEqual(alice.get(url + '?page=3&page_size=50').json()['count'], 130)
+
+
+class AttachmentTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.root = directory.name
+        patcher = override_settings(ATTACHMENTS={**settings.ATTACHMENTS, 'ROOT': self.root, 'BLOCK_SIZE': 3})
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def send(self, client, upload, offset, data):
+        return client.patch(
+            f"/api/uploads/{upload['id']}/", data, content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def upload(self, client, data, name='notes.txt'):
+        upload = client.post('/api/uploads/', {'filename': name, 'size': len(data)}, format='json').json()
+        return self.send(client, upload, 0, data).json()
+
+    def test_resumable_upload_is_deduplicated_and_access_checked(self):
+        alice, bob = login(self.alice), login(self.bob)
+        response = alice.post('/api/uploads/', {'filename': '../x/notes.txt', 'size': 10}, format='json')
+        self.assertEqual(response.status_code, 201)
+        upload = response.json()
+        self.assertEqual((upload['filename'], upload['content_type'], upload['offset']),
+                         ('notes.txt', 'text/plain', 0))
+        self.assertEqual(self.send(alice, upload, 0, b'0123').json()['offset'], 4)
+        response = self.send(alice, upload, 2, b'2345')
+        self.assertEqual((response.status_code, response['Upload-Offset']), (409, '4'))
+        self.assertEqual(self.send(alice, upload, 4, b'456789xx').status_code, 400)
+        self.assertEqual(bob.get(f"/api/uploads/{upload['id']}/").status_code, 404)
+        self.assertEqual(alice.get(f"/api/uploads/{upload['id']}/").json()['offset'], 4)
+        # Resumed in a process that did not see the first chunk.
+        attachments.running_hashes.discard(upload['id'])
+        response = self.send(alice, upload, 4, b'456789')
+        self.assertEqual(response.status_code, 201)
+        attachment = response.json()
+        digest = hashlib.sha256(b'0123456789').hexdigest()
+        self.assertEqual(Attachment.objects.get().sha256, digest)
+        self.assertEqual(alice.get(f"/api/uploads/{upload['id']}/").status_code, 404)
+
+        copy = self.upload(bob, b'0123456789', 'copy.txt')
+        self.assertEqual(copy['size'], 10)
+        stored = [path.name for path in Path(self.root).rglob('*') if path.is_file()]
+        self.assertEqual(stored, [digest])
+
+        url = attachment['url']
+        response = alice.get(url)
+        self.assertEqual(response['X-Accel-Redirect'], f'/media/private/blobs/{digest[:2]}/{digest[2:4]}/{digest}')
+        self.assertIn('attachment; filename="notes.txt"', response['Content-Disposition'])
+        self.assertEqual(bob.get(url).status_code, 404)
+        self.assertEqual(bob.post('/api/messages/', {'text': 'mine', 'attachments': [attachment['id']]},
+                                  format='json').status_code, 400)
+
+        message = alice.post('/api/messages/', {'text': 'notes', 'attachments': [attachment['id']]},
+                             format='json').json()
+        self.assertEqual([a['id'] for a in message['attachments']], [attachment['id']])
+        self.assertEqual(bob.get(url).status_code, 200)
+        listed = bob.get(f"/api/messages/{message['id']}/attachments/").json()['results']
+        self.assertEqual([(a['filename'], a['message_id']) for a in listed], [('notes.txt', message['id'])])
+        self.assertEqual(alice.post('/api/messages/', {'text': 'again', 'attachments': [attachment['id']]},
+                                    format='json').status_code, 400)
+
+        room = Room.objects.create(name='ops')
+        room.memberships.create(member=self.alice)
+        private = self.upload(alice, b'secret', 'secret.txt')
+        alice.post(f'/api/rooms/{room.id}/messages/', {'text': 'x', 'attachments': [private['id']]}, format='json')
+        self.assertEqual(alice.get(private['url']).status_code, 200)
+        self.assertEqual(bob.get(private['url']).status_code, 404)
+
+    def test_post_fails_whole_when_an_attachment_is_taken_meanwhile(self):
+        alice = login(self.alice)
+        first, second = self.upload(alice, b'first'), self.upload(alice, b'second', 'second.txt')
+        check_available = attachments.check_available
+        other = Message.objects.create(author=self.alice, text='other')
+
+        def taken_after_check(author, ids):
+            check_available(author, ids)
+            Attachment.objects.filter(pk=second['id']).update(message=other)
+
+        count = Message.objects.count()
+        for enabled in (False, True):
+            batching = {**settings.MESSAGES_WRITE_BATCHING, 'ENABLED': enabled}
+            with override_settings(MESSAGES_WRITE_BATCHING=batching), \
+                    mock.patch.object(attachments, 'check_available', taken_after_check):
+                response = alice.post('/api/messages/', {'text': 'both', 'attachments': [first['id'], second['id']]},
+                                      format='json')
+            self.assertEqual(response.status_code, 400)
+            Attachment.objects.filter(pk=second['id']).update(message=None)
+        self.assertEqual(Message.objects.count(), count)
+        self.assertIsNone(Attachment.objects.get(pk=first['id']).message_id)
+
+    def test_clean_removes_idle_uploads_and_unused_files(self):
+        alice = login(self.alice)
+        kept = self.upload(alice, b'kept')
+        dropped = self.upload(alice, b'dropped')
+        Attachment.objects.filter(pk=dropped['id']).delete()
+        idle = alice.post('/api/uploads/', {'filename': 'idle.bin', 'size': 5}, format='json').json()
+        self.send(alice, idle, 0, b'id')
+        past = timezone.now() - timedelta(days=2)
+        Upload.objects.update(updated_at=past)
+        for path in Path(self.root).rglob('*'):
+            os.utime(path, (past.timestamp(), past.timestamp()))
+
+        call_command('clean_attachments', stdout=StringIO())
+
+        self.assertFalse(Upload.objects.exists())
+        stored = [path.name for path in Path(self.root).rglob('*') if path.is_file()]
+        self.assertEqual(stored, [Attachment.objects.get(pk=kept['id']).sha256])
+
+
+class MessageExportTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+        cls.room = Room.objects.create(name='ops')
+        cls.start = timezone.now() - timedelta(days=400)
+        messages = [
+            Message(author=(cls.alice, cls.bob)[n % 2], room_id=(Room.GENERAL_ID, cls.room.id)[n % 3 != 0],
+                    text=f'line {n}, "quoted"\nü', created_at=cls.start + timedelta(hours=n))
+            for n in range(400)
+        ]
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 10, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--pause=0', stdout=StringIO())
+        cls.expected = [
+            (m.id, m.room_id, m.author_id, m.text, m.created_at)
+            for m in sorted(messages, key=lambda m: (m.room_id, m.created_at))
+        ]
+
+    def export(self, *args):
+        output = StringIO()
+        call_command('export_messages', '--batch-size=4', *args, stdout=output)
+        return [json.loads(line) for line in output.getvalue().splitlines()]
+
+    def test_exports_archived_and_hot_messages_oldest_first(self):
+        self.assertEqual(
+            set(MessageArchiveChunk.objects.values_list('room_id', flat=True)), {Room.GENERAL_ID, self.room.id}
+        )
+        rows = self.export()
+        self.assertEqual([(r['id'], r['room_id'], r['author_id'], r['text']) for r in rows],
+                         [expected[:4] for expected in self.expected])
+        self.assertEqual(rows[0]['author'], 'alice')
+
+        # From inside the archive to the hot messages.
+        since, until = self.start + timedelta(hours=200), self.start + timedelta(hours=350)
+        rows = self.export(f'--room={self.room.id}', f'--author={self.alice.id}',
+                           f'--since={since.isoformat()}', f'--until={until.isoformat()}')
+        self.assertEqual(
+            [r['id'] for r in rows],
+            [pk for pk, room_id, author_id, _, created_at in self.expected
+             if room_id == self.room.id and author_id == self.alice.id and since <= created_at < until]
+        )
+
+    def test_endpoint_streams_csv_to_staff(self):
+        client = APIClient()
+        self.assertEqual(client.get('/api/internal/export/').status_code, 403)
+        client.force_login(User.objects.create_user('admin', is_staff=True))
+        self.assertEqual(client.get('/api/internal/export/?type=xml').status_code, 400)
+        response = client.get('/api/internal/export/', {'type': 'csv', 'author': self.bob.id})
+        self.assertTrue(response.streaming)
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        body = b''.join(response.streaming_content).decode()
+        rows = list(csv.reader(StringIO(body)))
+        self.assertEqual(rows[0], ['id', 'room_id', 'author_id', 'author', 'created_at', 'text'])
+        self.assertEqual(
+            [(int(r[0]), r[5]) for r in rows[1:]],
+            [(pk, text) for pk, _, author_id, text, _ in self.expected if author_id == self.bob.id]
+        )
+
+
+class MigrationTests(TestCase):
+    def test_models_match_migrations_and_keep_the_triggers(self):
+        call_command('makemigrations', 'api', '--check', '--dry-run', stdout=StringIO())
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'trigger' AND tbl_name = 'messages'")
+            triggers = {name for name, in cursor.fetchall()}
+        self.assertLessEqual(
+            {'messages_fts_insert', 'message_changes_insert', 'message_changes_update', 'message_changes_delete'},
+            triggers
+        )
+
+
+class MessageRenderingTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = Member.objects.create(username='alice', email='alice@example.com')
+        cls.bob = Member.objects.create(username='bob', email='bob@example.com')
+
+    def setUp(self):
+        latest_messages.clear()
+        self.client = login(self.alice)
+
+    def test_messages_are_rendered_when_written(self):
+        self.assertEqual(
+            rendering.render('<b>@bob</b> @carol, see https://example.com/a?b=1&c=2. :tada: :nope:\nbye',
+                             {'bob': self.bob.id}),
+            f'&lt;b&gt;<span class="mention" data-member-id="{self.bob.id}">@bob</span>&lt;/b&gt; @carol, '
+            'see <a href="https://example.com/a?b=1&amp;c=2" rel="nofollow noopener noreferrer" '
+            'target="_blank">https://example.com/a?b=1&amp;c=2</a>. \U0001F389 :nope:<br>bye'
+        )
+        seq = changes.latest_seq()
+        posted = self.client.post('/api/messages/', {'text': 'hi @bob'}, format='json').json()
+        mention = f'hi <span class="mention" data-member-id="{self.bob.id}">@bob</span>'
+        self.assertEqual(posted['html'], mention)
+        message = Message.objects.get(pk=posted['id'])
+        self.assertEqual((message.rendered_html, message.renderer_version), (mention, rendering.VERSION))
+        self.assertEqual(self.client.get('/api/messages/').json()['results'][0]['html'], mention)
+
+        self.client.patch(f'/api/messages/{message.id}/', {'text': 'www.example.com'}, format='json')
+        link = ('<a href="https://www.example.com" rel="nofollow noopener noreferrer" '
+                'target="_blank">www.example.com</a>')
+        data = self.client.get('/api/messages/', {'compact': 1, 'fields': 'id,html'}).json()
+        self.assertEqual(data['results'], [{'id': message.id, 'html': link}])
+        events = self.client.get('/api/messages/changes/', {'since': seq}).json()['events']
+        self.assertEqual([event['html'] for event in events], [mention, link])
+
+    def test_render_messages_renders_stale_messages_again(self):
+        now = timezone.now()
+        messages = [
+            Message(author=self.bob, text=f'@alice :fire: {n}', created_at=now - timedelta(days=200 - n))
+            for n in range(150)
+        ]
+        field = Message._meta.get_field('created_at')
+        field.auto_now_add = False
+        try:
+            Message.objects.bulk_create(messages)
+        finally:
+            field.auto_now_add = True
+        retention = {**settings.MESSAGE_RETENTION, 'MIN_HOT': 20, 'CHUNK_SIZE': 7}
+        with override_settings(MESSAGE_RETENTION=retention):
+            call_command('archive_messages', '--hot-days=90', '--pause=0', stdout=StringIO())
+        self.assertTrue(MessageArchiveChunk.objects.exists())
+
+        # Never rendered: the read path renders them itself, archived or not.
+        expected = [
+            f'<span class="mention" data-member-id="{self.alice.id}">@alice</span> \U0001F525 {n}'
+            for n in reversed(range(150))
+        ]
+        pages = [self.client.get('/api/messages/', {'page': page, 'page_size': 50}).json()['results']
+                 for page in (1, 2, 3)]
+        self.assertEqual([item['html'] for page in pages for item in page], expected)
+
+        out = StringIO()
+        call_command('render_messages', '--workers=2', '--batch-size=16', stdout=out)
+        self.assertIn('Rendered 150 messages', out.getvalue())
+        self.assertFalse(Message.objects.exclude(renderer_version=rendering.VERSION).exists())
+        with mock.patch.object(rendering, 'render', side_effect=AssertionError):
+            latest_messages.clear()
+            pages = [self.client.get('/api/messages/', {'page': page, 'page_size': 50}).json()['results']
+                     for page in (1, 2, 3)]
+        self.assertEqual([item['html'] for page in pages for item in page], expected)
+        call_command('verify_archive', stdout=StringIO())
+        out = StringIO()
+        call_command('render_messages', '--workers=1', stdout=out)
+        self.assertIn('Rendered 0 messages', out.getvalue())
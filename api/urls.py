@@ -6,7 +6,23 @@ from .views import (
     LogoutView,
     CurrentUserView,
     ProfileView,
-    MessagesView
+    MessagesView,
+    MessageSearchView,
+    MessageDetailView,
+    MessageChangesView,
+    MemberMessagesView,
+    TopPostersView,
+    RoomsView,
+    RoomMembershipView,
+    UploadsView,
+    UploadDetailView,
+    AttachmentView,
+    AttachmentThumbnailView,
+    MessageAttachmentsView,
+    InternalStatsView,
+    MessageExportView,
+    SlowQueriesView,
+    MetricsView
 )
 
 urlpatterns = [
@@ -17,4 +33,22 @@ urlpatterns = [
     path("auth/me/", CurrentUserView.as_view(), name="auth-me"),
     path("profile/", ProfileView.as_view(), name="profile"),
     path("messages/", MessagesView.as_view(), name="messages"),
+    path("messages/search/", MessageSearchView.as_view(), name="messages-search"),
+    path("messages/changes/", MessageChangesView.as_view(), name="messages-changes"),
+    path("messages/<int:message_id>/", MessageDetailView.as_view(), name="message-detail"),
+    path("messages/<int:message_id>/attachments/", MessageAttachmentsView.as_view(), name="message-attachments"),
+    path("members/top/", TopPostersView.as_view(), name="members-top"),
+    path("members/<int:member_id>/messages/", MemberMessagesView.as_view(), name="member-messages"),
+    path("rooms/", RoomsView.as_view(), name="rooms"),
+    path("rooms/<int:room_id>/join/", RoomMembershipView.as_view(), name="room-membership"),
+    path("rooms/<int:room_id>/messages/", MessagesView.as_view(), name="room-messages"),
+    path("rooms/<int:room_id>/changes/", MessageChangesView.as_view(), name="room-changes"),
+    path("uploads/", UploadsView.as_view(), name="uploads"),
+    path("uploads/<int:upload_id>/", UploadDetailView.as_view(), name="upload-detail"),
+    path("attachments/<int:attachment_id>/", AttachmentView.as_view(), name="attachment-download"),
+    path("attachments/<int:attachment_id>/thumbnail/", AttachmentThumbnailView.as_view(), name="attachment-thumbnail"),
+    path("internal/stats/", InternalStatsView.as_view(), name="internal-stats"),
+    path("internal/export/", MessageExportView.as_view(), name="internal-export"),
+    path("internal/slow-queries/", SlowQueriesView.as_view(), name="internal-slow-queries"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 ]
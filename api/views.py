@@ -1,18 +1,138 @@
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Subquery
+from django.http import HttpResponse, StreamingHttpResponse
 from django.utils import timezone
-from drf_spectacular.utils import extend_schema
+from drf_spectacular.types import OpenApiTypes
+from drf_spectacular.utils import OpenApiParameter, extend_schema
 from .serializers import (
     MessageSerializer,
     MessageCreateSerializer,
     MemberSerializer,
     RegisterSerializer,
     LoginSerializer,
-    ProfileUpdateSerializer
+    MessageChangesSerializer,
+    MessageEditSerializer,
+    MessageExportSerializer,
+    MessageSearchSerializer,
+    ProfileSerializer,
+    ProfileUpdateSerializer,
+    RoomSerializer,
+    TopPosterSerializer,
+    UploadSerializer,
+    AttachmentSerializer
 )
-from .models import Member, Message
+from .conditional import (
+    author_messages_validators,
+    latest_change,
+    member_validators,
+    messages_head,
+    messages_validators,
+    not_modified,
+    profile_validators,
+    set_validators
+)
+from .batching import WriteQueueFull
+from .hashing import HashingBusy
+from .events import message_created, message_deleted, message_updated
+from .latest import latest_messages
+from . import activity, attachments, changes, export, metrics, rooms, search, stats
+from .attachments import AttachmentsUnavailable, UploadConflict
+from .models import Attachment, Member, Message, Room, Upload
+from .notify import change_hub, hub
+from .pagination import MessagesCursorPagination, MessagesPagination
+from .permissions import HasMetricsToken, IsStaffSession
+from .readpath import (
+    COMPACT_OUTPUT_FIELDS,
+    COMPACT_PARAM,
+    FIELDS_PARAM,
+    MESSAGE_OUTPUT_FIELDS,
+    message_rows,
+    select_fields,
+    serialize_messages,
+    serialize_messages_compact
+)
+from .renderers import MessagePackRenderer
+from .slowqueries import group_records, slow_query_log
+
+
+def get_authenticated_member(request):
+    """Return the member authenticated by SessionMemberAuthentication, or None."""
+    user = request.user
+    return user if isinstance(user, Member) else None
+
+
+def server_busy_response():
+    """503 for a full write or hashing queue; the client should retry."""
+    return Response(
+        {
+            "error": "Server is busy, retry shortly",
+            "details": {}
+        },
+        status=status.HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": "1"}
+    )
+
+
+def room_error_response(access):
+    """404 or 403 for a room the member may not use (see ``rooms.access``), else None."""
+    if access == rooms.NOT_FOUND:
+        return Response(
+            {
+                "error": "Room not found",
+                "details": {}
+            },
+            status=status.HTTP_404_NOT_FOUND
+        )
+    if access == rooms.NOT_MEMBER:
+        return Response(
+            {
+                "error": "Join the room first",
+                "details": {}
+            },
+            status=status.HTTP_403_FORBIDDEN
+        )
+    return None
+
+
+def attachments_unavailable_response():
+    """400 for a message posting attachments that are not the author's to post."""
+    return Response(
+        {
+            "error": "Validation failed",
+            "details": {
+                "attachments": ["Attachments must be your own uploads, not posted yet."]
+            }
+        },
+        status=status.HTTP_400_BAD_REQUEST
+    )
+
+
+def upload_not_found_response():
+    """404 for an upload that is not the member's, or is complete or cancelled."""
+    return Response(
+        {
+            "error": "Upload not found",
+            "details": {}
+        },
+        status=status.HTTP_404_NOT_FOUND
+    )
+
+
+def get_room_param(request):
+    """Return ``(room_id, errors)`` for the optional ``room`` query parameter."""
+    try:
+        room_id = int(request.query_params.get('room', Room.GENERAL_ID))
+    except ValueError:
+        room_id = 0
+    if room_id < 1:
+        return None, {"room": ["A valid room id is required."]}
+    return room_id, {}
 
 
 class HelloView(APIView):
@@ -39,7 +159,8 @@ class RegisterView(APIView):
         request=RegisterSerializer,
         responses={
             201: MemberSerializer,
-            400: dict
+            400: dict,
+            503: dict
         },
         description="Register a new user account"
     )
@@ -55,7 +176,10 @@ class RegisterView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        member = serializer.save()
+        try:
+            member = serializer.save()
+        except (HashingBusy, TimeoutError):
+            return server_busy_response()
         member_serializer = MemberSerializer(member)
         
         return Response(
@@ -80,14 +204,19 @@ class LoginView(APIView):
         responses={
             200: MemberSerializer,
             400: dict,
-            401: dict
+            401: dict,
+            503: dict
         },
         description="Login user with email and password"
     )
     def post(self, request):
         serializer = LoginSerializer(data=request.data)
         
-        if not serializer.is_valid():
+        try:
+            valid = serializer.is_valid()
+        except (HashingBusy, TimeoutError):
+            return server_busy_response()
+        if not valid:
             return Response(
                 {
                     "error": "Invalid credentials",
@@ -129,9 +258,9 @@ class LogoutView(APIView):
         description="Logout current user"
     )
     def post(self, request):
-        member_id = request.session.get('member_id')
+        member = get_authenticated_member(request)
         
-        if not member_id:
+        if not member:
             return Response(
                 {
                     "error": "Authentication required",
@@ -164,9 +293,9 @@ class CurrentUserView(APIView):
         description="Get current authenticated user"
     )
     def get(self, request):
-        member_id = request.session.get('member_id')
+        member = get_authenticated_member(request)
         
-        if not member_id:
+        if not member:
             return Response(
                 {
                     "error": "Authentication required",
@@ -175,20 +304,14 @@ class CurrentUserView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        try:
-            member = Member.objects.get(id=member_id)
-        except Member.DoesNotExist:
-            request.session.flush()
-            return Response(
-                {
-                    "error": "Authentication required",
-                    "details": {}
-                },
-                status=status.HTTP_401_UNAUTHORIZED
-            )
+        etag, last_modified = member_validators(member)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
         
         serializer = MemberSerializer(member)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        response = Response(serializer.data, status=status.HTTP_200_OK)
+        return set_validators(response, etag, last_modified)
 
 
 class ProfileView(APIView):
@@ -196,28 +319,15 @@ class ProfileView(APIView):
     API endpoint to get and update current user profile.
     """
 
-    def get_authenticated_member(self, request):
-        """Helper method to get authenticated member."""
-        member_id = request.session.get('member_id')
-        
-        if not member_id:
-            return None
-        
-        try:
-            return Member.objects.get(id=member_id)
-        except Member.DoesNotExist:
-            request.session.flush()
-            return None
-
     @extend_schema(
         responses={
-            200: MemberSerializer,
+            200: ProfileSerializer,
             401: dict
         },
         description="Get current user profile"
     )
     def get(self, request):
-        member = self.get_authenticated_member(request)
+        member = get_authenticated_member(request)
         
         if not member:
             return Response(
@@ -228,20 +338,28 @@ class ProfileView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        serializer = MemberSerializer(member)
-        return Response(serializer.data, status=status.HTTP_200_OK)
+        # The cached member's counters are stale; read them from its row.
+        activity.load_counters(member)
+        etag, last_modified = profile_validators(member)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        
+        serializer = ProfileSerializer(member)
+        response = Response(serializer.data, status=status.HTTP_200_OK)
+        return set_validators(response, etag, last_modified)
 
     @extend_schema(
         request=ProfileUpdateSerializer,
         responses={
-            200: MemberSerializer,
+            200: ProfileSerializer,
             400: dict,
             401: dict
         },
         description="Update current user profile"
     )
     def put(self, request):
-        member = self.get_authenticated_member(request)
+        member = get_authenticated_member(request)
         
         if not member:
             return Response(
@@ -264,45 +382,190 @@ class ProfileView(APIView):
             )
         
         serializer.save()
-        response_serializer = MemberSerializer(member)
+        response_serializer = ProfileSerializer(activity.load_counters(member))
         
         return Response(response_serializer.data, status=status.HTTP_200_OK)
 
 
-class MessagesPagination(PageNumberPagination):
-    """Custom pagination for messages."""
-    page_size = 20
-    page_size_query_param = 'page_size'
-    max_page_size = 100
+class MessageListMixin:
+    """
+    Request parsing and payload building shared by ``MessagesView`` and its
+    async counterpart in ``api.async_views``.
+    """
+
+    def get_representation(self, request):
+        """
+        Return ``(compact, fields, errors)`` for the requested list format.
+
+        The compact format (``compact=1``, and the default for MessagePack)
+        sends each author once in an ``authors`` map. ``fields`` is a
+        comma-separated sparse fieldset for the messages.
+        """
+        params = request.query_params
+        compact = (
+            params.get(COMPACT_PARAM, '').lower() in ('1', 'true')
+            or isinstance(request.accepted_renderer, MessagePackRenderer)
+        )
+        allowed = COMPACT_OUTPUT_FIELDS if compact else MESSAGE_OUTPUT_FIELDS
+        fields, errors = None, {}
+        if FIELDS_PARAM in params:
+            requested = {name.strip() for name in params[FIELDS_PARAM].split(',') if name.strip()}
+            unknown = sorted(requested - set(allowed))
+            if not requested:
+                errors[FIELDS_PARAM] = ["At least one field is required."]
+            elif unknown:
+                errors[FIELDS_PARAM] = [
+                    f"Unknown field(s): {', '.join(unknown)}. "
+                    f"Available: {', '.join(allowed)}."
+                ]
+            else:
+                fields = [name for name in allowed if name in requested]
+        return compact, fields, errors
+
+    def represent(self, messages, compact, fields):
+        """Return the serialized messages and, in compact format, the authors map."""
+        with metrics.timer('serialize'):
+            if compact:
+                results, authors = serialize_messages_compact(messages)
+            else:
+                results, authors = serialize_messages(messages), None
+            if fields:
+                results = select_fields(results, fields)
+                if 'author_id' not in fields:
+                    authors = None
+        return results, authors
+
+    def get_wait_params(self, request):
+        """Return ``(after_id, wait, limit, errors)`` for a long-poll request."""
+        errors = {}
+        after_id = wait = None
+        try:
+            after_id = int(request.query_params['after_id'])
+        except ValueError:
+            errors['after_id'] = ["A valid integer is required."]
+        try:
+            wait = float(request.query_params.get('wait', 0))
+        except ValueError:
+            errors['wait'] = ["A valid number is required."]
+        if errors:
+            return after_id, wait, None, errors
+        
+        wait = max(0.0, min(wait, settings.MESSAGES_LONGPOLL_MAX_WAIT))
+        limit = MessagesCursorPagination().get_page_size(request)
+        return after_id, wait, limit, errors
+
+    def get_messages_after(self, room_id, after_id, limit):
+        """
+        Return rows for up to ``limit`` messages of a room newer than
+        ``after_id``, oldest first.
+        """
+        return message_rows(rooms.messages(room_id).filter(id__gt=after_id).order_by('id'))[:limit]
+
+    def get_paginator(self, request, room_id):
+        if MessagesCursorPagination.is_requested(request):
+            return MessagesCursorPagination(room_id=room_id)
+        return MessagesPagination(room_id=room_id)
+
+    def results_data(self, messages, compact, fields):
+        results, authors = self.represent(messages, compact, fields)
+        data = {"results": results}
+        if authors is not None:
+            data["authors"] = authors
+        return data
 
 
-class MessagesView(APIView):
+class MessagesView(MessageListMixin, APIView):
     """
-    API endpoint to get paginated list of messages and create new messages.
+    API endpoint to get paginated list of messages and create new messages,
+    in the general room or, under ``/api/rooms/<room_id>/``, any other.
     """
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
 
-    def get_authenticated_member(self, request):
-        """Helper method to get authenticated member."""
-        member_id = request.session.get('member_id')
+    def wait_for_messages(self, request, room_id, compact, fields):
+        """
+        Long-poll: answer immediately if messages newer than ``after_id``
+        exist, otherwise park on the notification hub for up to ``wait``
+        seconds and answer as soon as one is posted.
+        """
+        after_id, wait, limit, errors = self.get_wait_params(request)
+        if errors:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
         
-        if not member_id:
-            return None
+        hub.listen(room_id)
+        messages = list(self.get_messages_after(room_id, after_id, limit))
+        if not messages and wait and hub.wait(room_id, after_id, wait):
+            messages = list(self.get_messages_after(room_id, after_id, limit))
+        messages.reverse()
         
-        try:
-            return Member.objects.get(id=member_id)
-        except Member.DoesNotExist:
-            request.session.flush()
-            return None
+        return Response(self.results_data(messages, compact, fields), status=status.HTTP_200_OK)
 
     @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='before',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Cursor mode: return messages older than this cursor '
+                            '(pass an empty value for the newest page)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='after',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Cursor mode: return messages newer than this cursor',
+                required=False
+            ),
+            OpenApiParameter(
+                name='compact',
+                type=OpenApiTypes.BOOL,
+                location=OpenApiParameter.QUERY,
+                description='Send each author once in an "authors" map keyed by id; '
+                            'messages carry only author_id. Default for MessagePack',
+                required=False
+            ),
+            OpenApiParameter(
+                name='fields',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Comma-separated message fields to return '
+                            '(id, text, author or author_id, created_at)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='after_id',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Long-poll mode: return messages with an id greater '
+                            'than this one',
+                required=False
+            ),
+            OpenApiParameter(
+                name='wait',
+                type=OpenApiTypes.NUMBER,
+                location=OpenApiParameter.QUERY,
+                description='Long-poll mode: seconds to hold the request open '
+                            'until a newer message is posted',
+                required=False
+            ),
+        ],
         responses={
             200: dict,
-            401: dict
+            400: dict,
+            401: dict,
+            403: dict,
+            404: dict
         },
         description="Get paginated list of chat messages"
     )
-    def get(self, request):
-        member = self.get_authenticated_member(request)
+    def get(self, request, room_id=Room.GENERAL_ID):
+        member = get_authenticated_member(request)
         
         if not member:
             return Response(
@@ -313,26 +576,57 @@ class MessagesView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
-        messages = Message.objects.all().select_related('author')
+        response = room_error_response(rooms.access(member, room_id))
+        if response is not None:
+            return response
         
-        paginator = MessagesPagination()
-        paginated_messages = paginator.paginate_queryset(messages, request)
+        compact, fields, errors = self.get_representation(request)
+        if errors:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if 'after_id' in request.query_params:
+            return self.wait_for_messages(request, room_id, compact, fields)
+        
+        head = messages_head(room_id)
+        etag, last_modified = messages_validators(request, head)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        
+        response = latest_messages.response(request, room_id, head)
+        if response is not None:
+            return set_validators(response, etag, last_modified)
         
-        serializer = MessageSerializer(paginated_messages, many=True)
+        messages = message_rows(rooms.messages(room_id))
+        paginator = self.get_paginator(request, room_id)
+        paginated_messages = paginator.paginate_queryset(messages, request)
         
-        return paginator.get_paginated_response(serializer.data)
+        results, authors = self.represent(paginated_messages, compact, fields)
+        response = paginator.get_paginated_response(results)
+        if authors is not None:
+            response.data['authors'] = authors
+        return set_validators(response, etag, last_modified)
 
     @extend_schema(
         request=MessageCreateSerializer,
         responses={
             201: MessageSerializer,
             400: dict,
-            401: dict
+            401: dict,
+            403: dict,
+            404: dict,
+            503: dict
         },
         description="Create a new chat message"
     )
-    def post(self, request):
-        member = self.get_authenticated_member(request)
+    def post(self, request, room_id=Room.GENERAL_ID):
+        member = get_authenticated_member(request)
         
         if not member:
             return Response(
@@ -343,6 +637,10 @@ class MessagesView(APIView):
                 status=status.HTTP_401_UNAUTHORIZED
             )
         
+        response = room_error_response(rooms.access(member, room_id))
+        if response is not None:
+            return response
+        
         serializer = MessageCreateSerializer(data=request.data)
         
         if not serializer.is_valid():
@@ -354,7 +652,1051 @@ class MessagesView(APIView):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        message = serializer.save(author=member)
-        response_serializer = MessageSerializer(message)
+        try:
+            message = serializer.save(author=member, room_id=room_id)
+        except (WriteQueueFull, TimeoutError):
+            return server_busy_response()
+        except AttachmentsUnavailable:
+            return attachments_unavailable_response()
+        data = message_created(message)
+        if serializer.validated_data.get('attachments'):
+            data['attachments'] = AttachmentSerializer(message.attachments.all(), many=True).data
+        
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+class MessageSearchView(MessageListMixin, APIView):
+    """
+    API endpoint for ranked full-text search over messages (see api.search).
+    """
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='q',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Words to find; "quoted phrases" and a trailing * for prefixes',
+                required=True
+            ),
+            OpenApiParameter(
+                name='room',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Search this room (default: the general room)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='author',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Only messages by the member with this id',
+                required=False
+            ),
+            OpenApiParameter(
+                name='since',
+                type=OpenApiTypes.DATETIME,
+                location=OpenApiParameter.QUERY,
+                description='Only messages posted at or after this time',
+                required=False
+            ),
+            OpenApiParameter(
+                name='until',
+                type=OpenApiTypes.DATETIME,
+                location=OpenApiParameter.QUERY,
+                description='Only messages posted before this time',
+                required=False
+            ),
+            OpenApiParameter(
+                name='order',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='rank (best match first, default) or recent (newest first)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='cursor',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Return results after this cursor (taken from next)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='page_size',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Number of results per page (max 100)',
+                required=False
+            ),
+        ],
+        responses={
+            200: dict,
+            400: dict,
+            401: dict,
+            403: dict,
+            404: dict
+        },
+        description=(
+            "Search a room's messages by text, with highlighted snippets. Only messages "
+            "in the hot window are searched; archive_excluded is true when archived "
+            "messages match the room and filters and were left out."
+        )
+    )
+    def get(self, request):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        serializer = MessageSearchSerializer(data=request.query_params)
+        compact, fields, errors = self.get_representation(request)
+        if not serializer.is_valid() or errors:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": {**serializer.errors, **errors}
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        params = serializer.validated_data
+        response = room_error_response(rooms.access(member, params['room']))
+        if response is not None:
+            return response
+        
+        page_size = params['page_size']
+        hits = search.search(
+            params['q'],
+            params['room'],
+            author_id=params.get('author'),
+            since=params.get('since'),
+            until=params.get('until'),
+            order=params['order'],
+            cursor=params['cursor'],
+            limit=page_size + 1
+        )
+        next_link = None
+        if len(hits) > page_size:
+            next_link = replace_query_param(
+                request.build_absolute_uri(),
+                'cursor',
+                search.encode_cursor(params['order'], hits[page_size - 1])
+            )
+        
+        ids = [pk for pk, _, _ in hits[:page_size]]
+        rows = {row.id: row for row in message_rows(rooms.messages(params['room']).filter(id__in=ids))}
+        # A message deleted since the index lookup simply drops out of the page.
+        page = [hit for hit in hits[:page_size] if hit[0] in rows]
+        
+        results, authors = self.represent([rows[pk] for pk, _, _ in page], compact, fields)
+        for result, (_, _, snippet) in zip(results, page):
+            result['snippet'] = snippet
+        data = {
+            "next": next_link,
+            "results": results,
+            "archive_excluded": search.archive_excluded(
+                params['room'],
+                author_id=params.get('author'),
+                since=params.get('since'),
+                until=params.get('until'),
+            ),
+        }
+        if authors is not None:
+            data["authors"] = authors
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class MemberMessagesView(MessageListMixin, APIView):
+    """
+    API endpoint to page through one member's messages, newest first.
+    """
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, MessagePackRenderer]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='before',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Return messages older than this cursor (taken from next)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='after',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Return messages newer than this cursor (taken from previous)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='page_size',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Number of messages per page (max 100)',
+                required=False
+            ),
+            OpenApiParameter(
+                name='compact',
+                type=OpenApiTypes.BOOL,
+                location=OpenApiParameter.QUERY,
+                description='Send the author once in an "authors" map keyed by id',
+                required=False
+            ),
+            OpenApiParameter(
+                name='fields',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Comma-separated message fields to return',
+                required=False
+            ),
+            OpenApiParameter(
+                name='room',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Messages in this room (default: the general room)',
+                required=False
+            ),
+        ],
+        responses={
+            200: dict,
+            400: dict,
+            401: dict,
+            403: dict,
+            404: dict
+        },
+        description="Get a member's messages in a room, newest first, by cursor"
+    )
+    def get(self, request, member_id):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        compact, fields, errors = self.get_representation(request)
+        room_id, room_errors = get_room_param(request)
+        if errors or room_errors:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": {**errors, **room_errors}
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        response = room_error_response(rooms.access(member, room_id))
+        if response is not None:
+            return response
+        
+        author = Member.objects.filter(pk=member_id).only(
+            'updated_at', 'message_count', 'last_message_at'
+        ).annotate(change_seq=Subquery(latest_change(room_id))).first()
+        if author is None:
+            return Response(
+                {
+                    "error": "Member not found",
+                    "details": {}
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        etag, last_modified = author_messages_validators(request, author)
+        response = not_modified(request, etag, last_modified)
+        if response is not None:
+            return response
+        
+        # Served by the (author_id, created_at, id) index in keyset order.
+        messages = message_rows(rooms.messages(room_id).filter(author_id=author.id))
+        paginator = MessagesCursorPagination(room_id=room_id, author_id=author.id)
+        paginated_messages = paginator.paginate_queryset(messages, request)
+        
+        results, authors = self.represent(paginated_messages, compact, fields)
+        response = paginator.get_paginated_response(results)
+        if authors is not None:
+            response.data['authors'] = authors
+        return set_validators(response, etag, last_modified)
+
+
+class TopPostersView(APIView):
+    """
+    API endpoint listing the members with the most messages.
+    """
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='limit',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description=f'Number of members to return (default '
+                            f'{activity.TOP_POSTERS_LIMIT}, max {activity.TOP_POSTERS_MAX_LIMIT})',
+                required=False
+            ),
+        ],
+        responses={
+            200: TopPosterSerializer(many=True),
+            400: dict,
+            401: dict
+        },
+        description="Get the members with the most messages"
+    )
+    def get(self, request):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        try:
+            limit = int(request.query_params.get('limit', activity.TOP_POSTERS_LIMIT))
+        except ValueError:
+            limit = 0
+        if not 1 <= limit <= activity.TOP_POSTERS_MAX_LIMIT:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": {
+                        "limit": [
+                            f"Must be an integer between 1 and {activity.TOP_POSTERS_MAX_LIMIT}."
+                        ]
+                    }
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        serializer = TopPosterSerializer(activity.top_posters(limit), many=True)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
+
+
+class MessageDetailView(APIView):
+    """
+    API endpoint to edit or delete one of your own messages.
+    """
+
+    def get_own_message(self, request, message_id):
+        """Return ``(message, None)``, or ``(None, error response)``."""
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return None, Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        # Archived messages are history and cannot be changed.
+        message = Message.objects.select_related('author').filter(pk=message_id).first()
+        if message is None:
+            return None, Response(
+                {
+                    "error": "Message not found",
+                    "details": {}
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        if message.author_id != member.id:
+            return None, Response(
+                {
+                    "error": "You can only change your own messages",
+                    "details": {}
+                },
+                status=status.HTTP_403_FORBIDDEN
+            )
+        return message, None
+
+    @extend_schema(
+        request=MessageEditSerializer,
+        responses={
+            200: MessageSerializer,
+            400: dict,
+            401: dict,
+            403: dict,
+            404: dict
+        },
+        description="Edit the text of your own message"
+    )
+    def patch(self, request, message_id):
+        message, response = self.get_own_message(request, message_id)
+        if response is not None:
+            return response
+        
+        serializer = MessageEditSerializer(message, data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        with transaction.atomic():
+            data = message_updated(serializer.save())
+        
+        return Response(data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        responses={
+            204: None,
+            401: dict,
+            403: dict,
+            404: dict
+        },
+        description="Delete your own message"
+    )
+    def delete(self, request, message_id):
+        message, response = self.get_own_message(request, message_id)
+        if response is not None:
+            return response
+        
+        with transaction.atomic():
+            message_id = message.pk
+            message.delete()
+            activity.record_delete(message)
+            message_deleted(message_id, message.room_id)
+        
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class MessageChangesView(APIView):
+    """
+    API endpoint streaming a room's message creates, edits and deletes in
+    order (see api.changes).
+    """
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter(
+                name='since',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Return changes after this seq; omit to get the current seq',
+                required=False
+            ),
+            OpenApiParameter(
+                name='limit',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.QUERY,
+                description='Maximum number of changes to return',
+                required=False
+            ),
+            OpenApiParameter(
+                name='wait',
+                type=OpenApiTypes.NUMBER,
+                location=OpenApiParameter.QUERY,
+                description='Seconds to hold the request open until a change is made',
+                required=False
+            ),
+            OpenApiParameter(
+                name='client',
+                type=OpenApiTypes.STR,
+                location=OpenApiParameter.QUERY,
+                description='Identifies this client among the member\'s devices and tabs',
+                required=False
+            ),
+        ],
+        responses={
+            200: dict,
+            400: dict,
+            401: dict,
+            403: dict,
+            404: dict,
+            410: dict
+        },
+        description="Get message changes after a sequence number"
+    )
+    def get(self, request, room_id=Room.GENERAL_ID):
+        member = get_authenticated_member(request)
         
-        return Response(response_serializer.data, status=status.HTTP_201_CREATED)
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        response = room_error_response(rooms.access(member, room_id))
+        if response is not None:
+            return response
+        
+        serializer = MessageChangesSerializer(data=request.query_params)
+        if not serializer.is_valid():
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        params = serializer.validated_data
+        since = params.get('since')
+        bounds = changes.bounds(room_id)
+        latest = bounds[1] or 0
+        if since is None:
+            return Response(changes.feed_page(latest, [], 0), status=status.HTTP_200_OK)
+        if changes.is_expired(since, bounds):
+            return Response(
+                {
+                    "error": "Change cursor expired, reload the messages",
+                    "details": {"seq": latest}
+                },
+                status=status.HTTP_410_GONE
+            )
+        changes.cursor_tracker.acknowledge(member.id, room_id, params['client'], since)
+        
+        # Read the hub before the database, so no change can slip between.
+        change_hub.listen(room_id)
+        seen = change_hub.latest_id(room_id)
+        limit = params['limit']
+        found = changes.changes_after(room_id, since, limit + 1)
+        wait = min(params['wait'], settings.MESSAGES_LONGPOLL_MAX_WAIT)
+        if not found and wait and change_hub.wait(room_id, seen, wait):
+            found = changes.changes_after(room_id, since, limit + 1)
+        
+        return Response(changes.feed_page(since, found, limit, latest), status=status.HTTP_200_OK)
+
+
+class RoomsView(APIView):
+    """
+    API endpoint to list chat rooms and create new ones (see api.rooms).
+    """
+
+    @extend_schema(
+        responses={
+            200: RoomSerializer(many=True),
+            401: dict
+        },
+        description="List chat rooms and whether you have joined them"
+    )
+    def get(self, request):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        serializer = RoomSerializer(rooms.visible(member), many=True)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request=RoomSerializer,
+        responses={
+            201: RoomSerializer,
+            400: dict,
+            401: dict
+        },
+        description="Create a chat room and join it"
+    )
+    def post(self, request):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        serializer = RoomSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        with transaction.atomic():
+            room = serializer.save(created_by=member)
+            rooms.join(member, room)
+        room.joined = True
+        
+        return Response(RoomSerializer(room).data, status=status.HTTP_201_CREATED)
+
+
+class RoomMembershipView(APIView):
+    """
+    API endpoint to join or leave a chat room.
+    """
+
+    def get_room(self, request, room_id):
+        """Return ``(member, room, None)``, or ``(None, None, error response)``."""
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return None, None, Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        room = Room.objects.filter(pk=room_id).first()
+        if room is None:
+            return None, None, room_error_response(rooms.NOT_FOUND)
+        if room.pk == Room.GENERAL_ID:
+            return None, None, Response(
+                {
+                    "error": "Every member is in the general room",
+                    "details": {}
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return member, room, None
+
+    @extend_schema(
+        request=None,
+        responses={
+            200: dict,
+            201: dict,
+            400: dict,
+            401: dict,
+            404: dict
+        },
+        description="Join a chat room"
+    )
+    def post(self, request, room_id):
+        member, room, response = self.get_room(request, room_id)
+        if response is not None:
+            return response
+        
+        created = rooms.join(member, room)
+        return Response(
+            {"message": "Joined the room"},
+            status=status.HTTP_201_CREATED if created else status.HTTP_200_OK
+        )
+
+    @extend_schema(
+        responses={
+            204: None,
+            400: dict,
+            401: dict,
+            404: dict
+        },
+        description="Leave a chat room"
+    )
+    def delete(self, request, room_id):
+        member, room, response = self.get_room(request, room_id)
+        if response is not None:
+            return response
+        
+        rooms.leave(member, room)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadsView(APIView):
+    """
+    API endpoint to start a resumable upload (see api.attachments).
+    """
+
+    @extend_schema(
+        request=UploadSerializer,
+        responses={
+            201: UploadSerializer,
+            400: dict,
+            401: dict
+        },
+        description="Start a resumable upload; send its bytes with PATCH"
+    )
+    def post(self, request):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        serializer = UploadSerializer(data=request.data)
+        
+        if not serializer.is_valid():
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        upload = serializer.save(member=member)
+        return Response(UploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+
+
+class UploadDetailView(APIView):
+    """
+    API endpoint to send the bytes of an upload in chunks, see how far it
+    got, or cancel it.
+    """
+
+    def get_upload(self, request, upload_id):
+        """Return ``(upload, None)``, or ``(None, error response)``."""
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return None, Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        upload = Upload.objects.filter(pk=upload_id, member=member).first()
+        if upload is None:
+            return None, upload_not_found_response()
+        return upload, None
+
+    @extend_schema(
+        responses={
+            200: UploadSerializer,
+            401: dict,
+            404: dict
+        },
+        description="Get the offset an interrupted upload resumes from"
+    )
+    def get(self, request, upload_id):
+        upload, response = self.get_upload(request, upload_id)
+        if response is not None:
+            return response
+        
+        return Response(UploadSerializer(upload).data, status=status.HTTP_200_OK)
+
+    @extend_schema(
+        request={'application/offset+octet-stream': OpenApiTypes.BINARY},
+        parameters=[
+            OpenApiParameter(
+                name='Upload-Offset',
+                type=OpenApiTypes.INT,
+                location=OpenApiParameter.HEADER,
+                description='Offset in the file of the first byte of the body: '
+                            'the offset the upload reported last',
+                required=True
+            ),
+        ],
+        responses={
+            200: UploadSerializer,
+            201: AttachmentSerializer,
+            400: dict,
+            401: dict,
+            404: dict,
+            409: dict
+        },
+        description="Append a chunk of the file, read from the request body as it arrives"
+    )
+    def patch(self, request, upload_id):
+        upload, response = self.get_upload(request, upload_id)
+        if response is not None:
+            return response
+        
+        errors = {}
+        try:
+            offset = int(request.headers.get('Upload-Offset', ''))
+        except ValueError:
+            offset = -1
+        if offset < 0:
+            errors['Upload-Offset'] = ["A valid offset is required."]
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = -1
+        if length < 0 or (offset >= 0 and offset + length > upload.size):
+            errors['Content-Length'] = ["The chunk must end within the declared size."]
+        if errors:
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        try:
+            upload, attachment = attachments.receive(upload, offset, request.stream, length)
+        except UploadConflict as exc:
+            return Response(
+                {
+                    "error": "The upload is at another offset, or busy",
+                    "details": {"offset": exc.received}
+                },
+                status=status.HTTP_409_CONFLICT,
+                headers={"Upload-Offset": str(exc.received)}
+            )
+        except Upload.DoesNotExist:
+            return upload_not_found_response()
+        
+        if attachment is not None:
+            return Response(AttachmentSerializer(attachment).data, status=status.HTTP_201_CREATED)
+        return Response(
+            UploadSerializer(upload).data,
+            status=status.HTTP_200_OK,
+            headers={"Upload-Offset": str(upload.received)}
+        )
+
+    @extend_schema(
+        responses={
+            204: None,
+            401: dict,
+            404: dict
+        },
+        description="Cancel an upload"
+    )
+    def delete(self, request, upload_id):
+        upload, response = self.get_upload(request, upload_id)
+        if response is not None:
+            return response
+        
+        attachments.cancel(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class AttachmentView(APIView):
+    """
+    API endpoint to download an attachment, for its uploader and the
+    members of its message's room. nginx sends the bytes.
+    """
+    thumbnail = False
+
+    @extend_schema(
+        responses={
+            (200, '*/*'): OpenApiTypes.BINARY,
+            401: dict,
+            404: dict
+        },
+        description="Download an attachment"
+    )
+    def get(self, request, attachment_id):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        attachment = Attachment.objects.filter(pk=attachment_id).first()
+        # Attachments the member may not read are not found.
+        if attachment is None or not attachments.can_read(member, attachment):
+            return Response(
+                {
+                    "error": "Attachment not found",
+                    "details": {}
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        
+        if not self.thumbnail:
+            return attachments.download_response(attachment)
+        if not attachments.has_thumbnail(attachment):
+            return Response(
+                {
+                    "error": "No thumbnail for this attachment",
+                    "details": {}
+                },
+                status=status.HTTP_404_NOT_FOUND
+            )
+        return attachments.thumbnail_response(attachment)
+
+
+class AttachmentThumbnailView(AttachmentView):
+    """
+    API endpoint to download the thumbnail of an image attachment.
+    """
+    thumbnail = True
+
+    @extend_schema(
+        responses={
+            (200, 'image/jpeg'): OpenApiTypes.BINARY,
+            401: dict,
+            404: dict
+        },
+        description="Download the thumbnail of an image attachment"
+    )
+    def get(self, request, attachment_id):
+        return super().get(request, attachment_id)
+
+
+class MessageAttachmentsView(APIView):
+    """
+    API endpoint to list the attachments of a message.
+    """
+
+    @extend_schema(
+        responses={
+            200: AttachmentSerializer(many=True),
+            401: dict,
+            403: dict,
+            404: dict
+        },
+        description="List the attachments of a message"
+    )
+    def get(self, request, message_id):
+        member = get_authenticated_member(request)
+        
+        if not member:
+            return Response(
+                {
+                    "error": "Authentication required",
+                    "details": {}
+                },
+                status=status.HTTP_401_UNAUTHORIZED
+            )
+        
+        # The attachments carry their room, so archived messages keep them.
+        found = list(Attachment.objects.filter(message_id=message_id))
+        if found:
+            response = room_error_response(rooms.access(member, found[0].room_id))
+            if response is not None:
+                return response
+        
+        serializer = AttachmentSerializer(found, many=True)
+        return Response({"results": serializer.data}, status=status.HTTP_200_OK)
+
+
+class InternalStatsView(APIView):
+    """
+    API endpoint exposing process-local cache and queue counters to staff.
+    """
+    permission_classes = [IsStaffSession]
+
+    @extend_schema(
+        responses={200: dict, 403: dict},
+        description="Get internal counters of the process serving the request"
+    )
+    def get(self, request):
+        return Response(stats.snapshot(), status=status.HTTP_200_OK)
+
+
+class SlowQueriesView(APIView):
+    """
+    API endpoint exposing the slow queries captured by every worker process
+    (see ``api.slowqueries``) to staff.
+    """
+    permission_classes = [IsStaffSession]
+
+    @extend_schema(
+        parameters=[
+            OpenApiParameter('limit', int, description='Newest captures to return'),
+            OpenApiParameter('group', bool, description='Aggregate captures by SQL shape'),
+        ],
+        responses={200: dict, 403: dict},
+        description="Get recently captured slow queries with their callers and query plans"
+    )
+    def get(self, request):
+        try:
+            limit = max(int(request.query_params.get('limit', 0)), 0)
+        except ValueError:
+            limit = 0
+        records = slow_query_log.records(limit or None)
+        data = {
+            'enabled': settings.SLOW_QUERIES['ENABLED'],
+            'threshold_ms': settings.SLOW_QUERIES['THRESHOLD_MS'],
+        }
+        if request.query_params.get('group') in ('1', 'true'):
+            data['groups'] = group_records(records)
+        else:
+            data['queries'] = records
+        return Response(data, status=status.HTTP_200_OK)
+
+
+class MessageExportView(APIView):
+    """
+    API endpoint streaming the message history as NDJSON or CSV to staff
+    (see ``api.export``).
+    """
+    permission_classes = [IsStaffSession]
+
+    @extend_schema(
+        parameters=[MessageExportSerializer],
+        responses={
+            (200, 'application/x-ndjson'): OpenApiTypes.STR,
+            (200, 'text/csv'): OpenApiTypes.STR,
+            400: dict,
+            403: dict
+        },
+        description="Stream every message, or one room's, one author's or a date range, "
+                    "oldest first, as NDJSON or CSV"
+    )
+    def get(self, request):
+        serializer = MessageExportSerializer(data=request.query_params)
+        
+        if not serializer.is_valid():
+            return Response(
+                {
+                    "error": "Validation failed",
+                    "details": serializer.errors
+                },
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        params = serializer.validated_data
+        output = params['type']
+        response = StreamingHttpResponse(
+            export.export(
+                room_id=params.get('room'),
+                author_id=params.get('author'),
+                since=params.get('since'),
+                until=params.get('until'),
+                format=output,
+            ),
+            content_type=export.CONTENT_TYPES[output]
+        )
+        response['Content-Disposition'] = f'attachment; filename="messages.{output}"'
+        # Sent as it is read, not after nginx has buffered it.
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+
+class MetricsView(APIView):
+    """
+    API endpoint exposing per-route request metrics of all worker processes
+    in the Prometheus text format.
+    """
+    permission_classes = [IsStaffSession | HasMetricsToken]
+
+    @extend_schema(
+        responses={(200, 'text/plain'): str, 403: dict},
+        description="Get request metrics in the Prometheus text exposition format"
+    )
+    def get(self, request):
+        return HttpResponse(
+            metrics.registry.render_prometheus(),
+            content_type='text/plain; version=0.0.4; charset=utf-8'
+        )
@@ -0,0 +1,238 @@
+"""
+Sync (gunicorn, WSGI) vs async (config.asgi_server, ASGI) deployment benchmark.
+
+Starts each deployment the way supervisord does (two processes each) against
+a throwaway seeded database, then holds N keep-alive connections open, each
+sending authenticated GET requests back to back, and reports throughput,
+latency percentiles and errors per deployment and concurrency level.
+
+Usage::
+
+    python -m benchmarks.asgi_vs_wsgi --connections 50 500 5000 --seconds 10
+
+The load generator is a single asyncio process; at high concurrency on a
+small machine it competes with the servers for CPU, so compare deployments
+with each other rather than reading the numbers as absolute capacity.
+"""
+import argparse
+import asyncio
+import os
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEPLOYMENTS = {
+    'wsgi': [
+        'gunicorn', '--config', 'gunicorn.conf.py', '--bind', '127.0.0.1:{port}',
+        '--access-logfile', '/dev/null', 'config.wsgi:application',
+    ],
+    'asgi': [
+        sys.executable, '-m', 'config.asgi_server', 'config.asgi:application',
+        '--bind', '127.0.0.1:{port}', '--reuse-port', '--backlog', '4096',
+    ],
+}
+ASGI_PROCESSES = 2
+
+
+def environment(tmp):
+    env = dict(os.environ)
+    env.update({
+        'DJANGO_SETTINGS_MODULE': 'config.settings',
+        'DJANGO_SQLITE_PATH': os.path.join(tmp, 'db.sqlite3'),
+        'SESSION_CACHE_LOCATION': os.path.join(tmp, 'sessions'),
+        'LATEST_MESSAGES_CACHE_LOCATION': os.path.join(tmp, 'latest-messages'),
+        'GUNICORN_WORKERS': '2',
+    })
+    return env
+
+
+def seed(env, messages):
+    """Migrate and seed the database; return a session id for one member."""
+    subprocess.run(
+        [sys.executable, 'manage.py', 'migrate', '--noinput', '-v', '0'],
+        cwd=ROOT, env=env, check=True,
+    )
+    script = (
+        'import django; django.setup()\n'
+        'from django.contrib.sessions.backends.cached_db import SessionStore\n'
+        'from api.models import Member, Message\n'
+        'member = Member(username="bench", email="bench@example.com")\n'
+        'member.set_password("benchmark"); member.save()\n'
+        f'Message.objects.bulk_create(Message(author=member, text=f"message {{i}}") '
+        f'for i in range({messages}))\n'
+        'session = SessionStore(); session["member_id"] = member.id; session.create()\n'
+        'print(session.session_key)\n'
+    )
+    result = subprocess.run(
+        [sys.executable, '-c', script],
+        cwd=ROOT, env=env, check=True, capture_output=True, text=True,
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start(deployment, port, env):
+    command = [part.format(port=port) for part in DEPLOYMENTS[deployment]]
+    count = ASGI_PROCESSES if deployment == 'asgi' else 1
+    processes = [
+        subprocess.Popen(command, cwd=ROOT, env=env,
+                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for _ in range(count)
+    ]
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return processes
+        except OSError:
+            time.sleep(0.2)
+    stop(processes)
+    raise SystemExit(f'{deployment} server did not start on port {port}')
+
+
+def stop(processes):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response; return ``(status, keep_alive)``."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError('connection closed')
+    status = int(status_line.split()[1])
+    length, chunked, keep_alive = 0, False, True
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        name, value = name.strip().lower(), value.strip().lower()
+        if name == 'content-length':
+            length = int(value)
+        elif name == 'transfer-encoding' and 'chunked' in value:
+            chunked = True
+        elif name == 'connection' and value == 'close':
+            keep_alive = False
+    if chunked:
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    elif length:
+        await reader.readexactly(length)
+    return status, keep_alive
+
+
+async def client(port, request, deadline, latencies, errors, timeout):
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection('127.0.0.1', port), timeout
+                )
+            started = time.monotonic()
+            writer.write(request)
+            status, keep_alive = await asyncio.wait_for(read_response(reader), timeout)
+            if status == 200:
+                latencies.append(time.monotonic() - started)
+            else:
+                errors[f'http {status}'] = errors.get(f'http {status}', 0) + 1
+            if not keep_alive:
+                writer.close()
+                writer = None
+        except (OSError, ConnectionError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+                ValueError, IndexError) as exc:
+            errors[type(exc).__name__] = errors.get(type(exc).__name__, 0) + 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.05)
+    if writer is not None:
+        writer.close()
+
+
+async def load(port, path, session_key, connections, seconds, timeout):
+    request = (
+        f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n'
+        f'Cookie: sessionid={session_key}\r\nAccept: application/json\r\n\r\n'
+    ).encode()
+    latencies, errors = [], {}
+    deadline = time.monotonic() + seconds
+    await asyncio.gather(*(
+        client(port, request, deadline, latencies, errors, timeout)
+        for _ in range(connections)
+    ))
+    return latencies, errors
+
+
+def summarize(latencies, errors, seconds):
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+    return {
+        'requests_per_sec': len(latencies) / seconds,
+        'p50_ms': quantiles[49] * 1000,
+        'p99_ms': quantiles[98] * 1000,
+        'errors': sum(errors.values()),
+        'error_kinds': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--connections', type=int, nargs='+', default=[50, 500, 5000])
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--path', default='/api/messages/')
+    parser.add_argument('--messages', type=int, default=1000)
+    parser.add_argument('--timeout', type=float, default=30.0,
+                        help='per-request timeout in seconds')
+    parser.add_argument('--deployments', nargs='+', choices=DEPLOYMENTS, default=list(DEPLOYMENTS))
+    options = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    needed = max(options.connections) * 2 + 100
+    if hard < needed:
+        print(f'warning: open file limit {hard} is below the {needed} needed', file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = environment(tmp)
+        session_key = seed(env, options.messages)
+        print(f'GET {options.path}, {options.seconds:g}s per run')
+        print(f'{"server":<6} {"conns":>6} {"req/s":>9} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}')
+        for deployment in options.deployments:
+            port = free_port()
+            processes = start(deployment, port, env)
+            try:
+                for connections in options.connections:
+                    latencies, errors = asyncio.run(load(
+                        port, options.path, session_key, connections,
+                        options.seconds, options.timeout,
+                    ))
+                    row = summarize(latencies, errors, options.seconds)
+                    print(f'{deployment:<6} {connections:>6} {row["requests_per_sec"]:>9.1f} '
+                          f'{row["p50_ms"]:>9.1f} {row["p99_ms"]:>9.1f} {row["errors"]:>7}'
+                          + (f'  {row["error_kinds"]}' if row['errors'] else ''))
+            finally:
+                stop(processes)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,431 @@
+"""
+Endpoint micro-benchmarks with regression thresholds.
+
+Exercises every route in ``api/urls.py`` through the Django test client
+against generated datasets (``manage.py generate_dataset``) of several
+sizes, and reports per scenario:
+
+- p50/p95/p99 and mean latency;
+- database queries per request (median and max);
+- memory allocated per request: the peak traced by tracemalloc above the
+  level before the request, measured in a separate, shorter pass because
+  tracing slows everything down.
+
+Usage::
+
+    python -m benchmarks.endpoints run --sizes 1000 100000 1000000 --output after.json
+    python -m benchmarks.endpoints compare before.json after.json
+
+``compare`` exits with status 1 if any scenario got slower than
+``--latency-threshold`` (relative, on p50 and p95, ignoring changes under
+``--min-ms``) or runs more queries than ``--query-threshold`` extra.
+Generated databases are kept in ``--data-dir`` (default: a temporary
+directory) and reused by later runs with the same size and seed.
+
+Login and registration hash a password per request with the production
+hasher settings, so they run at most ``--slow-requests`` times.
+"""
+import argparse
+import itertools
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = 'password123'
+
+
+def dataset(data_dir, size, seed):
+    """Path of a generated database with ``size`` messages, creating it once."""
+    path = os.path.join(data_dir, f'messages-{size}-seed{seed}.sqlite3')
+    if os.path.exists(path):
+        # Bring a dataset generated by an older revision up to the current schema.
+        subprocess.run([sys.executable, 'manage.py', 'migrate', '--noinput', '-v', '0'],
+                       cwd=ROOT, env=dict(os.environ, DJANGO_SQLITE_PATH=path), check=True,
+                       stdout=subprocess.DEVNULL)
+    else:
+        env = dict(os.environ, DJANGO_SQLITE_PATH=path + '.tmp')
+        for command in (
+            ['migrate', '--noinput', '-v', '0'],
+            ['generate_dataset', '--members', str(max(size // 100, 10)),
+             '--messages', str(size), '--seed', str(seed), '--password', PASSWORD,
+             '--end', '2025-01-01T00:00:00+00:00'],
+        ):
+            subprocess.run([sys.executable, 'manage.py', *command],
+                           cwd=ROOT, env=env, check=True, stdout=subprocess.DEVNULL)
+        # Fold the WAL into the main file before it is copied.
+        with sqlite3.connect(path + '.tmp') as conn:
+            conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        os.replace(path + '.tmp', path)
+        for suffix in ('-wal', '-shm'):
+            if os.path.exists(path + '.tmp' + suffix):
+                os.remove(path + '.tmp' + suffix)
+    return path
+
+
+def use_database(path, workdir):
+    """Point the default connection at a working copy of ``path``."""
+    from django.core.cache import caches
+    from django.db import connection
+
+    copy = os.path.join(workdir, 'db.sqlite3')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(copy + suffix):
+            os.remove(copy + suffix)
+    shutil.copyfile(path, copy)
+    connection.close()
+    connection.settings_dict['NAME'] = copy
+    for alias in ('default', 'sessions', 'latest-messages'):
+        if alias in caches:
+            caches[alias].clear()
+
+
+class Scenarios:
+    """Requests for each scenario; built once per dataset."""
+
+    def __init__(self):
+        from django.contrib.auth.models import User
+        from django.test import Client
+
+        from django.db import transaction
+
+        from api import activity, changes, rooms
+        from api.models import Member, Message, Room
+        from api.pagination import MessagesCursorPagination, MessagesPagination
+
+        self.member = Member.objects.order_by('id').first()
+        self.client = Client()
+        response = self.client.post(
+            '/api/auth/login/', {'email': self.member.email, 'password': PASSWORD},
+            content_type='application/json',
+        )
+        assert response.status_code == 200, response.content
+
+        staff = User.objects.filter(username='benchmark-staff').first() or \
+            User.objects.create_user('benchmark-staff', is_staff=True)
+        self.staff = Client()
+        self.staff.force_login(staff)
+        self.anonymous = Client()
+
+        # Both deep scenarios read the middle of the table.
+        total = Message.objects.count()
+        self.deep_page = max(total // MessagesPagination.page_size // 2, 1)
+        middle = (
+            Message.objects.order_by('-created_at', '-id')
+            .values_list('created_at', 'id')[total // 2:total // 2 + 1].first()
+        )
+        self.deep_cursor = MessagesCursorPagination.make_cursor(*middle) if middle else ''
+        # The busiest author has the longest history to page through.
+        self.top_poster = Member.objects.order_by('-message_count', 'id').first()
+        # A quiet room next to the busy general one: reading it should cost
+        # the same whatever the size of the dataset.
+        self.quiet_room, created = Room.objects.get_or_create(name='benchmark-quiet')
+        if created:
+            with transaction.atomic():
+                rooms.join(self.member, self.quiet_room)
+                quiet = Message.objects.bulk_create(
+                    Message(author=self.member, room=self.quiet_room, text=f'quiet {n}')
+                    for n in range(20)
+                )
+                activity.record_posts(quiet)
+        # The change feed is read from before the writes the run makes.
+        self.changes_since = changes.latest_seq()
+        self.counter = itertools.count()
+
+    # Each scenario returns (client, method, path, body).
+
+    def hello(self):
+        return self.anonymous, 'get', '/api/hello/', None
+
+    def register(self):
+        n = next(self.counter)
+        body = {'username': f'bench-{os.getpid()}-{n}',
+                'email': f'bench-{os.getpid()}-{n}@example.com', 'password': PASSWORD}
+        return self.anonymous, 'post', '/api/auth/register/', body
+
+    def login(self):
+        body = {'email': self.member.email, 'password': PASSWORD}
+        return self.anonymous, 'post', '/api/auth/login/', body
+
+    def logout(self):
+        # Logs out a fresh session, not the one the other scenarios use.
+        from importlib import import_module
+
+        from django.conf import settings
+        from django.test import Client
+
+        session = import_module(settings.SESSION_ENGINE).SessionStore()
+        session['member_id'] = self.member.id
+        session.create()
+        client = Client()
+        client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        return client, 'post', '/api/auth/logout/', None
+
+    def me(self):
+        return self.client, 'get', '/api/auth/me/', None
+
+    def profile_get(self):
+        return self.client, 'get', '/api/profile/', None
+
+    def profile_put(self):
+        username = f'{self.member.username}-{next(self.counter) % 2}'
+        return self.client, 'put', '/api/profile/', {'username': username}
+
+    def messages_first_page(self):
+        return self.client, 'get', '/api/messages/', None
+
+    def messages_first_page_cursor(self):
+        return self.client, 'get', '/api/messages/?before=', None
+
+    def messages_compact(self):
+        return self.client, 'get', '/api/messages/?compact=1', None
+
+    def messages_deep_page(self):
+        return self.client, 'get', f'/api/messages/?page={self.deep_page}', None
+
+    def messages_deep_cursor(self):
+        return self.client, 'get', f'/api/messages/?before={self.deep_cursor}', None
+
+    def room_messages_quiet(self):
+        return self.client, 'get', f'/api/rooms/{self.quiet_room.id}/messages/', None
+
+    def room_messages_quiet_cursor(self):
+        return self.client, 'get', f'/api/rooms/{self.quiet_room.id}/messages/?before=', None
+
+    def messages_search(self):
+        return self.client, 'get', '/api/messages/search/?q=coffee', None
+
+    def messages_search_recent(self):
+        return self.client, 'get', '/api/messages/search/?q=coffee&order=recent', None
+
+    def member_messages(self):
+        return self.client, 'get', f'/api/members/{self.top_poster.id}/messages/', None
+
+    def members_top(self):
+        return self.client, 'get', '/api/members/top/', None
+
+    def messages_post(self):
+        return self.client, 'post', '/api/messages/', {'text': f'benchmark {next(self.counter)}'}
+
+    def messages_changes(self):
+        return self.client, 'get', f'/api/messages/changes/?since={self.changes_since}', None
+
+    def internal_stats(self):
+        return self.staff, 'get', '/api/internal/stats/', None
+
+
+# Read-only scenarios first so that writes do not change what they read;
+# messages_changes follows messages_post to read the changes it made.
+SCENARIOS = [
+    'hello', 'me', 'profile_get', 'messages_first_page', 'messages_first_page_cursor',
+    'messages_compact', 'messages_deep_page', 'messages_deep_cursor', 'room_messages_quiet',
+    'room_messages_quiet_cursor', 'messages_search',
+    'messages_search_recent', 'member_messages', 'members_top', 'internal_stats',
+    'profile_put', 'messages_post', 'messages_changes', 'logout', 'login', 'register',
+]
+SLOW_SCENARIOS = {'login', 'register'}
+
+
+def prepare(scenarios, name):
+    """Build the next request of scenario ``name``; return a callable sending it."""
+    client, method, path, body = getattr(scenarios, name)()
+    kwargs = {'content_type': 'application/json', 'data': json.dumps(body)} if body else {}
+
+    def send():
+        response = getattr(client, method)(path, **kwargs)
+        if response.status_code >= 400:
+            raise SystemExit(f'{name}: {method.upper()} {path} returned '
+                             f'{response.status_code}: {response.content[:200]!r}')
+
+    return send
+
+
+def measure(scenarios, name, requests, warmup):
+    from django.db import connection
+    from django.test.utils import CaptureQueriesContext
+
+    for _ in range(warmup):
+        prepare(scenarios, name)()
+
+    latencies, queries = [], []
+    for _ in range(requests):
+        send = prepare(scenarios, name)
+        with CaptureQueriesContext(connection) as captured:
+            started = time.perf_counter()
+            send()
+            latencies.append(time.perf_counter() - started)
+        queries.append(len(captured))
+
+    allocated = []
+    tracemalloc.start()
+    try:
+        for _ in range(max(requests // 10, 1)):
+            send = prepare(scenarios, name)
+            baseline = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            send()
+            allocated.append(tracemalloc.get_traced_memory()[1] - baseline)
+    finally:
+        tracemalloc.stop()
+
+    quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+    return {
+        'requests': requests,
+        'p50_ms': round(quantiles[49] * 1000, 3),
+        'p95_ms': round(quantiles[94] * 1000, 3),
+        'p99_ms': round(quantiles[98] * 1000, 3),
+        'mean_ms': round(statistics.fmean(latencies) * 1000, 3),
+        'queries': statistics.median_low(queries),
+        'queries_max': max(queries),
+        'allocated_kib': round(statistics.median(allocated) / 1024, 1),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(options):
+    workdir = tempfile.mkdtemp(prefix='endpoint-bench-')
+    data_dir = options.data_dir or os.path.join(workdir, 'datasets')
+    os.makedirs(data_dir, exist_ok=True)
+    os.environ['DJANGO_SQLITE_PATH'] = os.path.join(workdir, 'db.sqlite3')
+    os.environ['SESSION_CACHE_LOCATION'] = os.path.join(workdir, 'sessions')
+    os.environ['LATEST_MESSAGES_CACHE_LOCATION'] = os.path.join(workdir, 'latest-messages')
+    os.environ.setdefault('REQUEST_METRICS_DIR', os.path.join(workdir, 'metrics'))
+
+    import django
+
+    django.setup()
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    # Lets the test client's "testserver" host through ALLOWED_HOSTS.
+    setup_test_environment()
+
+    names = options.scenarios or SCENARIOS
+    results = {}
+    try:
+        for size in options.sizes:
+            use_database(dataset(data_dir, size, options.seed), workdir)
+            scenarios = Scenarios()
+            results[str(size)] = {}
+            for name in names:
+                requests = options.requests
+                if name in SLOW_SCENARIOS:
+                    requests = min(requests, options.slow_requests)
+                row = measure(scenarios, name, requests, options.warmup)
+                results[str(size)][name] = row
+                print(f'{size:>8} {name:<28} p50 {row["p50_ms"]:>8.2f}  p95 {row["p95_ms"]:>8.2f}  '
+                      f'p99 {row["p99_ms"]:>8.2f} ms  {row["queries"]:>3} queries  '
+                      f'{row["allocated_kib"]:>8.1f} KiB', flush=True)
+    finally:
+        connection.close()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'created': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'machine': platform.machine(),
+            'cpus': os.cpu_count(),
+            'seed': options.seed,
+        },
+        'results': results,
+    }
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+        print(f'Results written to {options.output}')
+    return report
+
+
+def compare(options):
+    with open(options.baseline) as f:
+        baseline = json.load(f)['results']
+    with open(options.current) as f:
+        current = json.load(f)['results']
+
+    regressions = []
+    print(f'{"size":>8} {"scenario":<28} {"p50 ms":>17} {"p95 ms":>17} {"queries":>9}')
+    for size, scenarios in current.items():
+        for name, row in scenarios.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            problems = []
+            for key in ('p50_ms', 'p95_ms'):
+                delta = row[key] - before[key]
+                if delta > options.min_ms and row[key] > before[key] * (1 + options.latency_threshold):
+                    problems.append(f'{key} {before[key]:.2f} -> {row[key]:.2f}')
+            if row['queries'] > before['queries'] + options.query_threshold:
+                problems.append(f'queries {before["queries"]} -> {row["queries"]}')
+            print(f'{size:>8} {name:<28} {before["p50_ms"]:>7.2f} -> {row["p50_ms"]:>7.2f} '
+                  f'{before["p95_ms"]:>7.2f} -> {row["p95_ms"]:>7.2f} '
+                  f'{before["queries"]:>3} -> {row["queries"]:<3}'
+                  + ('  REGRESSION' if problems else ''))
+            regressions.extend(f'{size} {name}: {problem}' for problem in problems)
+
+    if regressions:
+        print('\nRegressions:\n  ' + '\n  '.join(regressions))
+        return 1
+    print('\nNo regressions.')
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='benchmark every scenario')
+    run_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 100000, 1000000])
+    run_parser.add_argument('--requests', type=int, default=200,
+                            help='measured requests per scenario (default: 200)')
+    run_parser.add_argument('--slow-requests', type=int, default=10,
+                            help='measured requests for login and register (default: 10)')
+    run_parser.add_argument('--warmup', type=int, default=5)
+    run_parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--data-dir', help='keep generated datasets here for reuse')
+    run_parser.add_argument('--output', help='write results to this JSON file')
+
+    compare_parser = commands.add_parser('compare', help='fail on regressions between two runs')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--latency-threshold', type=float, default=0.2,
+                                help='allowed relative p50/p95 increase (default: 0.2)')
+    compare_parser.add_argument('--min-ms', type=float, default=0.5,
+                                help='ignore latency changes smaller than this (default: 0.5)')
+    compare_parser.add_argument('--query-threshold', type=int, default=0,
+                                help='allowed extra queries per request (default: 0)')
+
+    options = parser.parse_args()
+    if options.command == 'run':
+        run(options)
+    else:
+        sys.exit(compare(options))
+
+
+if __name__ == '__main__':
+    main()
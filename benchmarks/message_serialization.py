@@ -0,0 +1,104 @@
+"""
+Message list serialization benchmark.
+
+Compares, at several page sizes, the time to fetch and render a page of the
+message list through:
+
+- ``serializer``: select_related queryset, ``MessageSerializer`` and DRF's
+  ``JSONRenderer`` (the previous list path);
+- ``fast``: ``readpath.message_rows``, ``readpath.serialize_messages`` and
+  ``FastJSONRenderer``.
+
+Both paths run against a throwaway SQLite database and their output is
+checked to be identical before timing.
+
+Usage::
+
+    python -m benchmarks.message_serialization --sizes 20 100 1000 --seconds 2
+"""
+import argparse
+import os
+import tempfile
+import time
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+
+def setup(path, messages):
+    os.environ['DJANGO_SQLITE_PATH'] = path
+    import django
+
+    django.setup()
+    from django.core.management import call_command
+
+    from api.models import Member, Message
+
+    call_command('migrate', verbosity=0)
+    authors = Member.objects.bulk_create(
+        Member(username=f'user{i}', email=f'user{i}@example.com', password_hash='!')
+        for i in range(100)
+    )
+    Message.objects.bulk_create(
+        Message(author=authors[i % len(authors)], text=f'message {i} ' * 5)
+        for i in range(messages)
+    )
+
+
+def serializer_path(size):
+    from rest_framework.renderers import JSONRenderer
+
+    from api.models import Message
+    from api.serializers import MessageSerializer
+
+    messages = Message.objects.select_related('author')[:size]
+    return JSONRenderer().render(MessageSerializer(messages, many=True).data)
+
+
+def fast_path(size):
+    from api.models import Message
+    from api.readpath import message_rows, serialize_messages
+    from api.renderers import FastJSONRenderer
+
+    rows = message_rows(Message.objects.all())[:size]
+    return FastJSONRenderer().render(serialize_messages(rows))
+
+
+PATHS = {'serializer': serializer_path, 'fast': fast_path}
+
+
+def measure(func, size, seconds):
+    runs = 0
+    started = time.perf_counter()
+    deadline = started + seconds
+    while time.perf_counter() < deadline:
+        func(size)
+        runs += 1
+    elapsed = time.perf_counter() - started
+    return runs * size / elapsed, elapsed / runs
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[20, 100, 1000])
+    parser.add_argument('--seconds', type=float, default=2.0)
+    options = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        setup(os.path.join(tmp, 'bench.sqlite3'), max(options.sizes))
+        for size in options.sizes:
+            outputs = {name: func(size) for name, func in PATHS.items()}
+            if len(set(outputs.values())) != 1:
+                raise SystemExit(f'Outputs differ at page size {size}')
+
+        print(f'{"page":>6} {"path":<11} {"rows/s":>12} {"ms/page":>9} {"speedup":>8}')
+        for size in options.sizes:
+            baseline = None
+            for name, func in PATHS.items():
+                rows_per_sec, per_page = measure(func, size, options.seconds)
+                baseline = baseline or rows_per_sec
+                print(f'{size:>6} {name:<11} {rows_per_sec:>12.0f} {per_page * 1000:>9.3f} '
+                      f'{rows_per_sec / baseline:>7.2f}x')
+
+
+if __name__ == '__main__':
+    main()
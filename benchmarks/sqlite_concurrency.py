@@ -0,0 +1,175 @@
+"""
+SQLite read/write concurrency benchmark.
+
+Runs the same mixed workload (reader threads fetching the newest page of
+messages, writer threads posting messages) against two profiles:
+
+- ``default``: rollback journal, synchronous=FULL, deferred transactions
+  and a new connection per operation (Django's previous behaviour);
+- ``tuned``: the pragmas from ``settings.SQLITE_PRAGMAS``, IMMEDIATE
+  transactions and one persistent connection per thread.
+
+Usage::
+
+    python -m benchmarks.sqlite_concurrency --readers 8 --writers 4 --seconds 10
+"""
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+SCHEMA = """
+CREATE TABLE members (id INTEGER PRIMARY KEY, username TEXT NOT NULL);
+CREATE TABLE messages (
+    id INTEGER PRIMARY KEY,
+    author_id INTEGER NOT NULL REFERENCES members (id),
+    text TEXT NOT NULL,
+    created_at DATETIME NOT NULL
+);
+CREATE INDEX messages_created_id_idx ON messages (created_at, id);
+"""
+
+READ_SQL = (
+    'SELECT m.id, m.text, m.created_at, a.id, a.username FROM messages m '
+    'JOIN members a ON a.id = m.author_id ORDER BY m.created_at DESC, m.id DESC LIMIT 20'
+)
+WRITE_SQL = 'INSERT INTO messages (author_id, text, created_at) VALUES (?, ?, ?)'
+
+
+def tuned_pragmas():
+    from django.conf import settings
+
+    return dict(settings.SQLITE_PRAGMAS)
+
+
+PROFILES = {
+    'default': {
+        'pragmas': {'journal_mode': 'DELETE', 'synchronous': 'FULL'},
+        'begin': 'BEGIN',
+        'persistent': False,
+    },
+    'tuned': {
+        'pragmas': None,  # filled from settings
+        'begin': 'BEGIN IMMEDIATE',
+        'persistent': True,
+    },
+}
+
+
+def seed(path, messages):
+    conn = sqlite3.connect(path)
+    conn.executescript(SCHEMA)
+    conn.executemany(
+        'INSERT INTO members (id, username) VALUES (?, ?)',
+        [(i, f'user{i}') for i in range(1, 101)],
+    )
+    start = datetime(2024, 1, 1, tzinfo=timezone.utc)
+    conn.executemany(
+        WRITE_SQL,
+        (
+            (i % 100 + 1, f'message {i}', (start + timedelta(seconds=i)).isoformat(' '))
+            for i in range(messages)
+        ),
+    )
+    conn.commit()
+    conn.close()
+
+
+def connect(path, profile):
+    conn = sqlite3.connect(path, timeout=5.0, isolation_level=None, check_same_thread=False)
+    for name, value in profile['pragmas'].items():
+        conn.execute(f'PRAGMA {name}={value}')
+    return conn
+
+
+def worker(path, profile, kind, deadline, results):
+    latencies, errors = [], 0
+    conn = connect(path, profile) if profile['persistent'] else None
+    counter = 0
+    while time.perf_counter() < deadline:
+        started = time.perf_counter()
+        c = conn or connect(path, profile)
+        try:
+            if kind == 'read':
+                c.execute(READ_SQL).fetchall()
+            else:
+                counter += 1
+                c.execute(profile['begin'])
+                c.execute(
+                    WRITE_SQL,
+                    (counter % 100 + 1, f'bench {counter}',
+                     datetime.now(timezone.utc).isoformat(' ')),
+                )
+                c.execute('COMMIT')
+            latencies.append(time.perf_counter() - started)
+        except sqlite3.OperationalError:
+            errors += 1
+            if c.in_transaction:
+                c.execute('ROLLBACK')
+        finally:
+            if conn is None:
+                c.close()
+    results.append((kind, latencies, errors))
+
+
+def run(profile_name, readers, writers, seconds, messages):
+    profile = dict(PROFILES[profile_name])
+    if profile['pragmas'] is None:
+        profile['pragmas'] = tuned_pragmas()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench.sqlite3')
+        seed(path, messages)
+        connect(path, profile).close()  # switch journal mode before the run
+
+        results = []
+        deadline = time.perf_counter() + seconds
+        threads = [
+            threading.Thread(target=worker, args=(path, profile, kind, deadline, results))
+            for kind in ['read'] * readers + ['write'] * writers
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    summary = {}
+    for kind in ('read', 'write'):
+        latencies = [value for k, values, _ in results if k == kind for value in values]
+        errors = sum(e for k, _, e in results if k == kind)
+        quantiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else [0] * 99
+        summary[kind] = {
+            'ops_per_sec': len(latencies) / seconds,
+            'p50_ms': quantiles[49] * 1000,
+            'p99_ms': quantiles[98] * 1000,
+            'errors': errors,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10.0)
+    parser.add_argument('--messages', type=int, default=50000)
+    options = parser.parse_args()
+
+    print(f'{options.readers} readers, {options.writers} writers, '
+          f'{options.seconds:g}s, {options.messages} seeded messages')
+    print(f'{"profile":<8} {"op":<6} {"ops/s":>10} {"p50 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for name in PROFILES:
+        summary = run(name, options.readers, options.writers, options.seconds, options.messages)
+        for kind, row in summary.items():
+            print(f'{name:<8} {kind:<6} {row["ops_per_sec"]:>10.1f} {row["p50_ms"]:>9.2f} '
+                  f'{row["p99_ms"]:>9.2f} {row["errors"]:>7}')
+
+
+if __name__ == '__main__':
+    main()
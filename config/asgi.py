@@ -0,0 +1,32 @@
+"""
+ASGI config for config project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+HTTP requests go to Django, with async views for the hot API endpoints;
+WebSocket connections go to the chat gateway.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "config.settings")
+# Serve the hot API endpoints with the async views (see config/urls_async.py).
+os.environ.setdefault("DJANGO_ROOT_URLCONF", "config.urls_async")
+
+django_application = get_asgi_application()
+
+# Imported after Django is set up: the gateway uses models and settings.
+from api.gateway import ChatGateway  # noqa: E402
+
+websocket_application = ChatGateway()
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "websocket":
+        await websocket_application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
@@ -0,0 +1,640 @@
+"""
+Minimal asyncio HTTP/1.1 and WebSocket server for ASGI applications.
+
+The project may only use the packages pinned in requirements.txt, and none
+of them can serve ASGI. This module provides just enough of a server to run
+``config.asgi`` behind nginx:
+
+- keep-alive HTTP/1.1 with Content-Length or chunked request bodies;
+- streamed responses (chunked when no Content-Length is given);
+- RFC 6455 WebSockets (fragmentation, ping/pong, close handshake); a peer
+  that sends nothing, not even a pong, within ``ws_pong_timeout`` of a ping
+  is dropped, and the application gets its ``websocket.disconnect``.
+
+Usage::
+
+    python -m config.asgi_server config.asgi:application --bind 127.0.0.1:8002
+
+Run several processes on the same port with ``--reuse-port``.
+"""
+import argparse
+import asyncio
+import base64
+import hashlib
+import importlib
+import logging
+import os
+import signal
+import struct
+from urllib.parse import unquote
+
+logger = logging.getLogger('config.asgi_server')
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_HEADER_BYTES = 64 * 1024
+BODY_CHUNK_SIZE = 64 * 1024
+
+STATUS_PHRASES = {
+    100: 'Continue', 101: 'Switching Protocols', 200: 'OK', 201: 'Created',
+    202: 'Accepted', 204: 'No Content', 206: 'Partial Content',
+    301: 'Moved Permanently', 302: 'Found', 303: 'See Other',
+    304: 'Not Modified', 307: 'Temporary Redirect', 308: 'Permanent Redirect',
+    400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+    404: 'Not Found', 405: 'Method Not Allowed', 406: 'Not Acceptable',
+    408: 'Request Timeout', 409: 'Conflict', 410: 'Gone',
+    412: 'Precondition Failed', 413: 'Payload Too Large',
+    415: 'Unsupported Media Type', 416: 'Range Not Satisfiable',
+    429: 'Too Many Requests', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 502: 'Bad Gateway',
+    503: 'Service Unavailable', 504: 'Gateway Timeout',
+    505: 'HTTP Version Not Supported',
+}
+
+WS_OP_CONTINUATION = 0x0
+WS_OP_TEXT = 0x1
+WS_OP_BINARY = 0x2
+WS_OP_CLOSE = 0x8
+WS_OP_PING = 0x9
+WS_OP_PONG = 0xA
+
+
+class BadRequest(Exception):
+    def __init__(self, status=400):
+        super().__init__(status)
+        self.status = status
+
+
+class WebSocketError(Exception):
+    def __init__(self, code):
+        super().__init__(code)
+        self.code = code
+
+
+def load_application(path):
+    module_name, _, attribute = path.partition(':')
+    return getattr(importlib.import_module(module_name), attribute or 'application')
+
+
+def status_line(status):
+    return f'HTTP/1.1 {status} {STATUS_PHRASES.get(status, "Unknown")}\r\n'.encode()
+
+
+def encode_headers(headers):
+    return b''.join(name + b': ' + value + b'\r\n' for name, value in headers)
+
+
+def ws_unmask(payload, mask):
+    if not payload:
+        return payload
+    length = len(payload)
+    key = (mask * (length // 4 + 1))[:length]
+    masked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return masked.to_bytes(length, 'big')
+
+
+def ws_frame(opcode, payload):
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+class Request:
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers
+
+    def header(self, name):
+        for key, value in self.headers:
+            if key == name:
+                return value
+        return None
+
+    def header_tokens(self, name):
+        value = self.header(name) or b''
+        return {token.strip().lower() for token in value.split(b',')}
+
+    @property
+    def keep_alive(self):
+        tokens = self.header_tokens(b'connection')
+        if self.version == 'HTTP/1.0':
+            return b'keep-alive' in tokens
+        return b'close' not in tokens
+
+    @property
+    def is_websocket(self):
+        return (
+            self.method == 'GET'
+            and (self.header(b'upgrade') or b'').lower() == b'websocket'
+            and b'upgrade' in self.header_tokens(b'connection')
+        )
+
+
+class Server:
+    def __init__(self, app, host='127.0.0.1', port=8002, reuse_port=False,
+                 keepalive=5.0, max_body_size=100 * 1024 * 1024,
+                 ws_max_message_size=1024 * 1024, ws_ping_interval=20.0,
+                 ws_pong_timeout=20.0, graceful_timeout=30.0, backlog=2048):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.keepalive = keepalive
+        self.max_body_size = max_body_size
+        self.ws_max_message_size = ws_max_message_size
+        self.ws_ping_interval = ws_ping_interval
+        self.ws_pong_timeout = ws_pong_timeout
+        self.graceful_timeout = graceful_timeout
+        self.backlog = backlog
+        self.connections = set()
+        self.stopping = False
+
+    async def serve(self):
+        server = await asyncio.start_server(
+            self.handle_connection,
+            self.host,
+            self.port,
+            limit=MAX_HEADER_BYTES,
+            backlog=self.backlog,
+            reuse_port=self.reuse_port or None,
+        )
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        logger.info('ASGI server (pid %s) listening on %s:%s', os.getpid(), self.host, self.port)
+
+        async with server:
+            await stop.wait()
+            self.stopping = True
+            server.close()
+            if self.connections:
+                await asyncio.wait(tuple(self.connections), timeout=self.graceful_timeout)
+            for task in tuple(self.connections):
+                task.cancel()
+
+    async def handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        # Bytes of the next request read while watching for a disconnect.
+        pipelined = bytearray()
+        try:
+            while not self.stopping:
+                try:
+                    request = await asyncio.wait_for(
+                        self.read_request(reader, bytes(pipelined)), self.keepalive
+                    )
+                    pipelined.clear()
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError):
+                    break
+                except BadRequest as exc:
+                    writer.write(
+                        status_line(exc.status)
+                        + b'content-length: 0\r\nconnection: close\r\n\r\n'
+                    )
+                    break
+                if request is None:
+                    break
+                if request.is_websocket:
+                    await WebSocketSession(self, request, reader, writer).run()
+                    break
+                if not await self.handle_http(request, reader, writer, pipelined):
+                    break
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception:
+            logger.exception('Unhandled error in ASGI server connection')
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    async def read_request(self, reader, pipelined=b''):
+        try:
+            head = pipelined + await reader.readuntil(b'\r\n\r\n')
+        except asyncio.LimitOverrunError:
+            raise BadRequest(431)
+        except asyncio.IncompleteReadError as exc:
+            if exc.partial or pipelined:
+                raise BadRequest()
+            return None
+        lines = head[:-4].split(b'\r\n')
+        try:
+            method, target, version = lines[0].decode('latin-1').split(' ')
+        except ValueError:
+            raise BadRequest()
+        if version not in ('HTTP/1.0', 'HTTP/1.1'):
+            raise BadRequest(505 if version.startswith('HTTP/') else 400)
+        headers = []
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise BadRequest()
+            headers.append((name.strip().lower(), value.strip()))
+        return Request(method, target, version, headers)
+
+    def build_scope(self, request, writer, scope_type):
+        path, _, query = request.target.partition('?')
+        peer = writer.get_extra_info('peername')
+        sock = writer.get_extra_info('sockname')
+        scope = {
+            'type': scope_type,
+            'asgi': {'version': '3.0', 'spec_version': '2.3'},
+            'http_version': request.version[5:],
+            'scheme': 'http' if scope_type == 'http' else 'ws',
+            'path': unquote(path),
+            'raw_path': path.encode('latin-1'),
+            'query_string': query.encode('latin-1'),
+            'root_path': '',
+            'headers': request.headers,
+            'client': tuple(peer[:2]) if peer else None,
+            'server': tuple(sock[:2]) if sock else None,
+        }
+        if scope_type == 'http':
+            scope['method'] = request.method
+        else:
+            protocols = request.header(b'sec-websocket-protocol')
+            scope['subprotocols'] = [
+                token.strip().decode('latin-1')
+                for token in protocols.split(b',')
+            ] if protocols else []
+        return scope
+
+    @staticmethod
+    async def read_line(reader):
+        """Read a chunk-size or trailer line; one longer than the limit is a bad request."""
+        try:
+            return await reader.readuntil(b'\r\n')
+        except asyncio.LimitOverrunError:
+            raise BadRequest()
+
+    async def read_body(self, request, reader):
+        """Yield request body chunks."""
+        transfer = request.header_tokens(b'transfer-encoding')
+        if b'chunked' in transfer:
+            received = 0
+            while True:
+                size_line = await self.read_line(reader)
+                try:
+                    size = int(size_line.split(b';', 1)[0], 16)
+                except ValueError:
+                    raise BadRequest()
+                if size == 0:
+                    # Skip trailers up to the blank line.
+                    while await self.read_line(reader) != b'\r\n':
+                        pass
+                    return
+                received += size
+                if received > self.max_body_size:
+                    raise BadRequest(413)
+                yield await reader.readexactly(size)
+                await reader.readexactly(2)
+        length = request.header(b'content-length')
+        if length is None:
+            return
+        try:
+            remaining = int(length)
+        except ValueError:
+            raise BadRequest()
+        if remaining > self.max_body_size:
+            raise BadRequest(413)
+        while remaining > 0:
+            chunk = await reader.read(min(remaining, BODY_CHUNK_SIZE))
+            if not chunk:
+                raise asyncio.IncompleteReadError(b'', remaining)
+            remaining -= len(chunk)
+            yield chunk
+
+    async def handle_http(self, request, reader, writer, pipelined):
+        """
+        Run one HTTP request through the app; return whether to keep the
+        connection. Bytes of a pipelined next request read meanwhile are
+        added to ``pipelined``.
+        """
+        scope = self.build_scope(request, writer, 'http')
+        body = self.read_body(request, reader)
+        finished = asyncio.Event()
+        state = {'started': False, 'chunked': False, 'complete': False, 'body_done': False}
+        keep_alive = request.keep_alive and not self.stopping
+
+        async def receive():
+            if not state['body_done']:
+                try:
+                    chunk = await body.__anext__()
+                except StopAsyncIteration:
+                    state['body_done'] = True
+                    return {'type': 'http.request', 'body': b'', 'more_body': False}
+                return {'type': 'http.request', 'body': chunk, 'more_body': True}
+            if 'peer' not in state and not finished.is_set() and await peer_hung_up():
+                return {'type': 'http.disconnect'}
+            await finished.wait()
+            return {'type': 'http.disconnect'}
+
+        async def peer_hung_up():
+            """
+            Wait until the response is finished or the peer hangs up, so
+            that the application can stop working on its behalf (say, in a
+            long-poll); return whether it hung up.
+            """
+            response_done = asyncio.ensure_future(finished.wait())
+            peer = state['peer'] = asyncio.ensure_future(reader.read(1))
+            peer.add_done_callback(keep_pipelined)
+            try:
+                await asyncio.wait((response_done, peer), return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                response_done.cancel()
+            if not peer.done() or peer.cancelled():
+                return False
+            return peer.exception() is not None or not peer.result()
+
+        def keep_pipelined(peer):
+            # Data instead of EOF is the next request, pipelined.
+            if not peer.cancelled() and peer.exception() is None:
+                pipelined.extend(peer.result())
+
+        async def send(message):
+            nonlocal keep_alive
+            if message['type'] == 'http.response.start':
+                state['started'] = True
+                state['status'] = message['status']
+                state['headers'] = [
+                    (bytes(name).lower(), bytes(value))
+                    for name, value in message.get('headers', [])
+                ]
+                return
+            if message['type'] != 'http.response.body' or state['complete']:
+                return
+            chunk = message.get('body', b'')
+            more_body = message.get('more_body', False)
+            if 'head_sent' not in state:
+                headers = state['headers']
+                names = {name for name, _ in headers}
+                if b'content-length' not in names and state['status'] not in (204, 304):
+                    if more_body:
+                        state['chunked'] = True
+                        headers.append((b'transfer-encoding', b'chunked'))
+                    else:
+                        headers.append((b'content-length', str(len(chunk)).encode()))
+                if not keep_alive:
+                    headers.append((b'connection', b'close'))
+                writer.write(status_line(state['status']) + encode_headers(headers) + b'\r\n')
+                state['head_sent'] = True
+            if request.method != 'HEAD':
+                if state['chunked']:
+                    if chunk:
+                        writer.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+                    if not more_body:
+                        writer.write(b'0\r\n\r\n')
+                elif chunk:
+                    writer.write(chunk)
+            await writer.drain()
+            if not more_body:
+                state['complete'] = True
+                finished.set()
+
+        try:
+            await self.app(scope, receive, send)
+        except BadRequest as exc:
+            if not state.get('head_sent'):
+                writer.write(
+                    status_line(exc.status) + b'content-length: 0\r\nconnection: close\r\n\r\n'
+                )
+            return False
+        except Exception:
+            logger.exception('Exception in ASGI application')
+            if not state.get('head_sent'):
+                writer.write(
+                    status_line(500) + b'content-length: 0\r\nconnection: close\r\n\r\n'
+                )
+            return False
+        finally:
+            finished.set()
+            peer = state.get('peer')
+            if peer is not None and not peer.done():
+                # Give the reader back before the next request is read.
+                peer.cancel()
+                await asyncio.wait((peer,))
+
+        if not state['complete']:
+            return False
+        # Drain an unread request body so the next request parses cleanly.
+        if not state['body_done']:
+            try:
+                async for _ in body:
+                    pass
+            except BadRequest:
+                return False
+        return keep_alive
+
+
+class WebSocketSession:
+    def __init__(self, server, request, reader, writer):
+        self.server = server
+        self.request = request
+        self.reader = reader
+        self.writer = writer
+        self.inbox = asyncio.Queue()
+        self.handshake_done = asyncio.Event()
+        self.accepted = False
+        self.closed = False
+        self.last_frame_at = 0.0
+
+    async def run(self):
+        scope = self.server.build_scope(self.request, self.writer, 'websocket')
+        key = self.request.header(b'sec-websocket-key')
+        if not key:
+            self.writer.write(status_line(400) + b'content-length: 0\r\n\r\n')
+            return
+        await self.inbox.put({'type': 'websocket.connect'})
+        reader_task = None
+        try:
+            app = asyncio.create_task(self.server.app(scope, self.inbox.get, self.send))
+            handshake = asyncio.create_task(self.handshake_done.wait())
+            await asyncio.wait((app, handshake), return_when=asyncio.FIRST_COMPLETED)
+            handshake.cancel()
+            if self.accepted:
+                self.last_frame_at = asyncio.get_running_loop().time()
+                reader_task = asyncio.create_task(self.read_frames())
+                pinger = asyncio.create_task(self.ping_forever())
+                try:
+                    await app
+                finally:
+                    pinger.cancel()
+            else:
+                await app
+        except Exception:
+            logger.exception('Exception in ASGI WebSocket application')
+        finally:
+            if reader_task is not None:
+                reader_task.cancel()
+            if self.accepted:
+                self.write_close(1011)
+            elif not self.closed:
+                self.reject()
+
+    def reject(self):
+        self.closed = True
+        self.handshake_done.set()
+        self.writer.write(status_line(403) + b'content-length: 0\r\n\r\n')
+
+    async def send(self, message):
+        kind = message['type']
+        if kind == 'websocket.accept':
+            if self.accepted or self.closed:
+                return
+            accept = base64.b64encode(
+                hashlib.sha1(self.request.header(b'sec-websocket-key') + WS_GUID).digest()
+            )
+            headers = [
+                (b'upgrade', b'websocket'),
+                (b'connection', b'Upgrade'),
+                (b'sec-websocket-accept', accept),
+            ]
+            if message.get('subprotocol'):
+                headers.append((b'sec-websocket-protocol', message['subprotocol'].encode()))
+            headers.extend(
+                (bytes(name), bytes(value)) for name, value in message.get('headers', [])
+            )
+            self.writer.write(status_line(101) + encode_headers(headers) + b'\r\n')
+            self.accepted = True
+            self.handshake_done.set()
+        elif kind == 'websocket.send':
+            if not self.accepted or self.closed:
+                return
+            if message.get('text') is not None:
+                self.writer.write(ws_frame(WS_OP_TEXT, message['text'].encode()))
+            elif message.get('bytes') is not None:
+                self.writer.write(ws_frame(WS_OP_BINARY, message['bytes']))
+        elif kind == 'websocket.close':
+            if self.closed:
+                return
+            if not self.accepted:
+                self.reject()
+                await self.inbox.put({'type': 'websocket.disconnect', 'code': 1006})
+                return
+            self.write_close(message.get('code', 1000), message.get('reason') or '')
+            await self.inbox.put({'type': 'websocket.disconnect', 'code': message.get('code', 1000)})
+        await self.writer.drain()
+
+    def write_close(self, code, reason=''):
+        if self.closed:
+            return
+        self.closed = True
+        self.writer.write(ws_frame(WS_OP_CLOSE, struct.pack('!H', code) + reason.encode()[:120]))
+
+    async def ping_forever(self):
+        loop = asyncio.get_running_loop()
+        while not self.closed:
+            await asyncio.sleep(self.server.ws_ping_interval)
+            if self.closed:
+                return
+            pinged_at = loop.time()
+            self.writer.write(ws_frame(WS_OP_PING, b''))
+            await asyncio.sleep(self.server.ws_pong_timeout)
+            if not self.closed and self.last_frame_at < pinged_at:
+                # Nothing since the ping: the peer is gone, and so is any
+                # chance of a close handshake.
+                self.closed = True
+                self.writer.transport.abort()
+                await self.inbox.put({'type': 'websocket.disconnect', 'code': 1006})
+                return
+
+    async def read_frame(self):
+        first, second = await self.reader.readexactly(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if not second & 0x80:
+            raise WebSocketError(1002)
+        if length == 126:
+            (length,) = struct.unpack('!H', await self.reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack('!Q', await self.reader.readexactly(8))
+        if length > self.server.ws_max_message_size:
+            raise WebSocketError(1009)
+        mask = await self.reader.readexactly(4)
+        payload = ws_unmask(await self.reader.readexactly(length), mask)
+        return fin, opcode, payload
+
+    async def read_frames(self):
+        code = 1006
+        fragments, fragment_opcode, size = [], None, 0
+        try:
+            while True:
+                fin, opcode, payload = await self.read_frame()
+                self.last_frame_at = asyncio.get_running_loop().time()
+                if opcode == WS_OP_PING:
+                    self.writer.write(ws_frame(WS_OP_PONG, payload))
+                    continue
+                if opcode == WS_OP_PONG:
+                    continue
+                if opcode == WS_OP_CLOSE:
+                    code = struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else 1005
+                    self.write_close(1000 if code == 1005 else code)
+                    break
+                if opcode != WS_OP_CONTINUATION:
+                    fragment_opcode, fragments, size = opcode, [], 0
+                fragments.append(payload)
+                size += len(payload)
+                if size > self.server.ws_max_message_size:
+                    raise WebSocketError(1009)
+                if not fin:
+                    continue
+                data = b''.join(fragments)
+                fragments = []
+                if fragment_opcode == WS_OP_TEXT:
+                    event = {'type': 'websocket.receive', 'text': data.decode('utf-8')}
+                else:
+                    event = {'type': 'websocket.receive', 'bytes': data}
+                await self.inbox.put(event)
+        except WebSocketError as exc:
+            code = exc.code
+            self.write_close(code)
+        except UnicodeDecodeError:
+            code = 1007
+            self.write_close(code)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            self.closed = True
+        await self.inbox.put({'type': 'websocket.disconnect', 'code': code})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('application', help='ASGI application, e.g. config.asgi:application')
+    parser.add_argument('--bind', default='127.0.0.1:8002', help='host:port to listen on')
+    parser.add_argument('--reuse-port', action='store_true',
+                        help='set SO_REUSEPORT so several processes can share the port')
+    parser.add_argument('--keepalive', type=float, default=5.0,
+                        help='seconds to keep an idle HTTP connection open')
+    parser.add_argument('--ws-ping-interval', type=float, default=20.0,
+                        help='seconds between pings on an open WebSocket')
+    parser.add_argument('--ws-pong-timeout', type=float, default=20.0,
+                        help='seconds a WebSocket peer has to answer a ping before it is dropped')
+    parser.add_argument('--backlog', type=int, default=2048)
+    parser.add_argument('--graceful-timeout', type=float, default=30.0)
+    options = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] [%(process)d] %(message)s')
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+    host, _, port = options.bind.rpartition(':')
+    server = Server(
+        load_application(options.application),
+        host=host or '127.0.0.1',
+        port=int(port),
+        reuse_port=options.reuse_port,
+        keepalive=options.keepalive,
+        ws_ping_interval=options.ws_ping_interval,
+        ws_pong_timeout=options.ws_pong_timeout,
+        graceful_timeout=options.graceful_timeout,
+        backlog=options.backlog,
+    )
+    asyncio.run(server.serve())
+
+
+if __name__ == '__main__':
+    main()
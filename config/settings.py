@@ -62,6 +62,28 @@ SESSION_COOKIE_SECURE = False  # Set to True in production with HTTPS
 SESSION_COOKIE_NAME = 'sessionid'
 SESSION_COOKIE_AGE = 1209600  # 2 weeks in seconds
 
+# Session storage. The default cached_db engine reads sessions from the
+# "sessions" cache and writes through to the database, so authenticated
+# requests do not read django_session from the SQLite file chat writes go
+# to; flush() (logout) deletes the session from both, revoking it for
+# every worker. The cache must be shared by all worker processes: the
+# file-based backend is a local stand-in for memcached/Redis, and LocMemCache
+# may be used for a single process. api.sessions wraps SESSION_BACKEND to
+# time session loads for the request metrics.
+#
+# The file cache is api.filecache.FileCache: unlike FileBasedCache, its
+# set() does not list the directory to cull it, so a login or session save
+# costs the same with a million sessions as with ten. The price is that the
+# directory only shrinks when `manage.py cull_cache` runs (hourly, see
+# MAINTENANCE_SCHEDULE): it deletes the expired sessions, then the least recently
+# saved ones beyond SESSION_CACHE_MAX_ENTRIES. Culled sessions are reloaded
+# from the database on their next request.
+SESSION_BACKEND = os.environ.get(
+    "DJANGO_SESSION_ENGINE", "django.contrib.sessions.backends.cached_db"
+)
+SESSION_ENGINE = "api.sessions"
+SESSION_CACHE_ALIAS = "sessions"
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -81,6 +103,174 @@ INSTALLED_APPS = [
 # REST Framework configuration
 REST_FRAMEWORK = {
     "DEFAULT_SCHEMA_CLASS": "drf_spectacular.openapi.AutoSchema",
+    "DEFAULT_AUTHENTICATION_CLASSES": [
+        "api.authentication.SessionMemberAuthentication",
+    ],
+    # API_JSON_RENDERER=rest_framework.renderers.JSONRenderer reverts to
+    # DRF's encoder; both produce the same bytes.
+    "DEFAULT_RENDERER_CLASSES": [
+        os.environ.get("API_JSON_RENDERER", "api.renderers.FastJSONRenderer"),
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+}
+
+# Per-process cache of authenticated members (see api.authentication).
+MEMBER_CACHE = {
+    "MAX_SIZE": int(os.environ.get("MEMBER_CACHE_MAX_SIZE", "10000")),
+    "TTL": float(os.environ.get("MEMBER_CACHE_TTL", "30")),
+}
+
+# Long-poll: the longest a GET /api/messages/?after_id=N&wait=S request may
+# be held open waiting for a new message. Set to 0 when serving with sync
+# gunicorn workers, which cannot park requests.
+MESSAGES_LONGPOLL_MAX_WAIT = float(os.environ.get("MESSAGES_LONGPOLL_MAX_WAIT", "25"))
+
+# Group commit for POST /api/messages/ (see api.batching): messages arriving
+# within WINDOW_MS are inserted with one bulk_create in one transaction.
+# Posts are rejected with 503 once MAX_QUEUE_SIZE messages are waiting, or
+# when the writer has not taken them within COMMIT_TIMEOUT seconds (they are
+# then never written).
+MESSAGES_WRITE_BATCHING = {
+    "ENABLED": os.environ.get("MESSAGES_WRITE_BATCHING") == "1",
+    "WINDOW_MS": float(os.environ.get("MESSAGES_WRITE_BATCH_WINDOW_MS", "5")),
+    "MAX_BATCH_SIZE": int(os.environ.get("MESSAGES_WRITE_BATCH_SIZE", "100")),
+    "MAX_QUEUE_SIZE": int(os.environ.get("MESSAGES_WRITE_QUEUE_SIZE", "1000")),
+    "COMMIT_TIMEOUT": float(os.environ.get("MESSAGES_WRITE_COMMIT_TIMEOUT", "10")),
+}
+
+# Pre-encoded first page of the message list (see api.latest), stored in the
+# "latest-messages" cache. SIZE must be at least the largest page size for
+# every first-page request to be served from it.
+LATEST_MESSAGES_CACHE = {
+    "ENABLED": os.environ.get("LATEST_MESSAGES_CACHE", "1") == "1",
+    "ALIAS": "latest-messages",
+    "SIZE": int(os.environ.get("LATEST_MESSAGES_CACHE_SIZE", "100")),
+}
+
+# Hot/cold retention (see api.archive): `manage.py archive_messages` (daily,
+# see MAINTENANCE_SCHEDULE) moves messages older than HOT_DAYS into
+# compressed monthly archive chunks of up to CHUNK_SIZE messages, in
+# transactions of BATCH_SIZE messages, PAUSE seconds apart. The newest MIN_HOT messages always stay hot. Message lists read
+# through to the archive.
+MESSAGE_RETENTION = {
+    "HOT_DAYS": float(os.environ.get("MESSAGE_RETENTION_HOT_DAYS", "90")),
+    "MIN_HOT": int(os.environ.get("MESSAGE_RETENTION_MIN_HOT", "1000")),
+    "BATCH_SIZE": int(os.environ.get("MESSAGE_RETENTION_BATCH_SIZE", "2000")),
+    "CHUNK_SIZE": int(os.environ.get("MESSAGE_RETENTION_CHUNK_SIZE", "500")),
+    "PAUSE": float(os.environ.get("MESSAGE_RETENTION_PAUSE", "0.05")),
+}
+
+# Message change feed (see api.changes). Each client's acknowledged position
+# is saved at most every CURSOR_SAVE_INTERVAL seconds; `manage.py
+# compact_changes` (hourly, see MAINTENANCE_SCHEDULE) deletes changes every
+# client seen within CURSOR_TTL_DAYS has passed, COMPACT_BATCH_SIZE per
+# transaction. Feed requests return up to
+# MAX_BATCH changes (BATCH by default) and long-poll for up to
+# MESSAGES_LONGPOLL_MAX_WAIT seconds.
+MESSAGE_CHANGES = {
+    "BATCH": int(os.environ.get("MESSAGE_CHANGES_BATCH", "100")),
+    "MAX_BATCH": int(os.environ.get("MESSAGE_CHANGES_MAX_BATCH", "1000")),
+    "CURSOR_SAVE_INTERVAL": float(os.environ.get("MESSAGE_CHANGES_CURSOR_SAVE_INTERVAL", "30")),
+    "CURSOR_TTL_DAYS": float(os.environ.get("MESSAGE_CHANGES_CURSOR_TTL_DAYS", "7")),
+    "COMPACT_BATCH_SIZE": int(os.environ.get("MESSAGE_CHANGES_COMPACT_BATCH_SIZE", "5000")),
+}
+
+# Message export (see api.export): `manage.py export_messages` and
+# /api/internal/export/ read BATCH_SIZE messages per query.
+MESSAGE_EXPORT = {
+    "BATCH_SIZE": int(os.environ.get("MESSAGE_EXPORT_BATCH_SIZE", "2000")),
+}
+
+# Message rendering (see api.rendering): after a new renderer version,
+# `manage.py render_messages` renders the stored messages again in batches
+# of BATCH_SIZE on WORKERS processes.
+MESSAGE_RENDERING = {
+    "WORKERS": int(os.environ.get("MESSAGE_RENDERING_WORKERS", str(os.cpu_count() or 2))),
+    "BATCH_SIZE": int(os.environ.get("MESSAGE_RENDERING_BATCH_SIZE", "1000")),
+}
+
+# Message attachments (see api.attachments) live under ROOT, which nginx
+# serves only as an internal location: uploads stream there in chunks of up
+# to MAX_SIZE bytes in all, read BLOCK_SIZE bytes at a time, and each file
+# is stored once per SHA-256. Downloads are checked by Django and handed to
+# nginx by an X-Accel-Redirect to ACCEL_REDIRECT (the URL prefix of ROOT);
+# an empty ACCEL_REDIRECT makes Django send the file itself, for runserver.
+# Thumbnails of images are made on a pool of THUMBNAIL_WORKERS threads with
+# up to THUMBNAIL_MAX_QUEUE waiting, when Pillow is installed. `manage.py
+# clean_attachments` (hourly, see MAINTENANCE_SCHEDULE) removes uploads idle
+# for UPLOAD_TTL_HOURS and files no attachment uses.
+ATTACHMENTS = {
+    "ROOT": os.environ.get("ATTACHMENTS_ROOT", str(MEDIA_ROOT / "private")),
+    "ACCEL_REDIRECT": os.environ.get("ATTACHMENTS_ACCEL_REDIRECT", "/media/private/"),
+    "MAX_SIZE": int(os.environ.get("ATTACHMENTS_MAX_SIZE", str(100 * 1024 * 1024))),
+    "BLOCK_SIZE": int(os.environ.get("ATTACHMENTS_BLOCK_SIZE", str(256 * 1024))),
+    "MAX_PER_MESSAGE": int(os.environ.get("ATTACHMENTS_MAX_PER_MESSAGE", "10")),
+    "UPLOAD_TTL_HOURS": float(os.environ.get("ATTACHMENTS_UPLOAD_TTL_HOURS", "24")),
+    "THUMBNAIL_SIZE": int(os.environ.get("ATTACHMENTS_THUMBNAIL_SIZE", "320")),
+    "THUMBNAIL_WORKERS": int(os.environ.get("ATTACHMENTS_THUMBNAIL_WORKERS", "1")),
+    "THUMBNAIL_MAX_QUEUE": int(os.environ.get("ATTACHMENTS_THUMBNAIL_MAX_QUEUE", "64")),
+}
+
+# Login and registration hash passwords on a bounded pool per process (see
+# api.hashing): WORKERS hash at once, up to MAX_QUEUE more wait, and beyond
+# that the views answer 503. PBKDF2_ITERATIONS is the work factor for new
+# hashes (Django 5.2's default); existing hashes are upgraded on login.
+PASSWORD_HASHING = {
+    "WORKERS": int(os.environ.get("PASSWORD_HASHING_WORKERS", str(os.cpu_count() or 2))),
+    "MAX_QUEUE": int(os.environ.get("PASSWORD_HASHING_MAX_QUEUE", "64")),
+    "TIMEOUT": float(os.environ.get("PASSWORD_HASHING_TIMEOUT", "10")),
+    "PBKDF2_ITERATIONS": int(os.environ.get("PASSWORD_HASHING_PBKDF2_ITERATIONS", "1000000")),
+}
+
+# Per-request metrics (see api.metrics): Server-Timing headers on every
+# response, and per-route histograms that each process writes to its own
+# file in DIRECTORY at most every FLUSH_INTERVAL seconds, folding the files
+# of exited processes into retired.json at most every REAP_INTERVAL seconds.
+# /api/metrics/ serves them merged, in the Prometheus text format, to staff
+# sessions or to requests bearing "Authorization: Bearer <TOKEN>" when TOKEN
+# is set. Test runs (TEST_RUNNER) write to a temporary directory instead.
+REQUEST_METRICS = {
+    "ENABLED": os.environ.get("REQUEST_METRICS", "1") == "1",
+    "SERVER_TIMING": os.environ.get("REQUEST_METRICS_SERVER_TIMING", "1") == "1",
+    "DIRECTORY": os.environ.get(
+        "REQUEST_METRICS_DIR", str(BASE_DIR / "persistent" / "metrics")
+    ),
+    "FLUSH_INTERVAL": float(os.environ.get("REQUEST_METRICS_FLUSH_INTERVAL", "1")),
+    "REAP_INTERVAL": float(os.environ.get("REQUEST_METRICS_REAP_INTERVAL", "300")),
+    "TOKEN": os.environ.get("REQUEST_METRICS_TOKEN", ""),
+}
+
+# Opt-in capture of slow queries with their callers and SQLite query plans,
+# served at /api/internal/slow-queries/ and by `manage.py slowqueries`.
+SLOW_QUERIES = {
+    "ENABLED": os.environ.get("SLOW_QUERIES", "0") == "1",
+    "THRESHOLD_MS": float(os.environ.get("SLOW_QUERIES_THRESHOLD_MS", "100")),
+    "SAMPLE_RATE": float(os.environ.get("SLOW_QUERIES_SAMPLE_RATE", "1")),
+    "BUFFER_SIZE": int(os.environ.get("SLOW_QUERIES_BUFFER_SIZE", "200")),
+    "PLAN_TTL": float(os.environ.get("SLOW_QUERIES_PLAN_TTL", "60")),
+    "DIRECTORY": os.environ.get(
+        "SLOW_QUERIES_DIR", str(BASE_DIR / "persistent" / "slow-queries")
+    ),
+}
+
+# Chat event broker used to fan new messages out to long-poll waiters and
+# WebSocket clients in every server process. The in-memory backend only
+# reaches the current process; api.broker.RelayBroker connects to the relay
+# started with `manage.py runbroker`.
+CHAT_BROKER = {
+    "BACKEND": os.environ.get("CHAT_BROKER_BACKEND", "api.broker.InMemoryBroker"),
+}
+if os.environ.get("CHAT_BROKER_LOCATION"):
+    CHAT_BROKER["LOCATION"] = os.environ["CHAT_BROKER_LOCATION"]
+
+# Maintenance commands and how often to run them, in seconds; 0 disables
+# one. supervisord's maintenance program runs `manage.py run_maintenance`,
+# which runs each command when due and sleeps in between.
+MAINTENANCE_SCHEDULE = {
+    "cull_cache": int(os.environ.get("MAINTENANCE_CULL_CACHE_INTERVAL", "3600")),
+    "compact_changes": int(os.environ.get("MAINTENANCE_COMPACT_CHANGES_INTERVAL", "3600")),
+    "archive_messages": int(os.environ.get("MAINTENANCE_ARCHIVE_MESSAGES_INTERVAL", "86400")),
+    "clean_attachments": int(os.environ.get("MAINTENANCE_CLEAN_ATTACHMENTS_INTERVAL", "3600")),
 }
 
 # drf-spectacular configuration
@@ -92,6 +282,7 @@ SPECTACULAR_SETTINGS = {
 }
 
 MIDDLEWARE = [
+    "api.metrics.RequestMetricsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
     "django.middleware.common.CommonMiddleware",
@@ -101,7 +292,9 @@ MIDDLEWARE = [
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
 ]
 
-ROOT_URLCONF = "config.urls"
+# config/asgi.py selects config.urls_async, which serves the hot endpoints
+# with the async views in api.async_views.
+ROOT_URLCONF = os.environ.get("DJANGO_ROOT_URLCONF", "config.urls")
 
 TEMPLATES = [
     {
@@ -119,19 +312,95 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = "config.wsgi.application"
+ASGI_APPLICATION = "config.asgi.application"
+
+TEST_RUNNER = "config.test_runner.TestRunner"
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
+# SQLite production profile, applied to every new connection. WAL lets
+# readers proceed while a writer commits, synchronous=NORMAL is durable
+# across application crashes in WAL mode, and IMMEDIATE transactions take
+# the write lock up front so concurrent writers wait on busy_timeout
+# instead of failing with "database is locked".
+#
+# Sizing: with CONN_MAX_AGE every server thread keeps its own connection,
+# so a gunicorn process holds up to GUNICORN_THREADS of them (64 by default,
+# see gunicorn.conf.py), each with a private page cache of up to
+# cache_size. Reads are mostly served from the mmap, which is the OS page
+# cache shared by every connection and process, so cache_size is kept at
+# SQLite's own default of 2 MB: at most 64 x 2 MB = 128 MB per process.
+# Budget threads x cache_size before raising either.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.environ.get("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.environ.get("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.environ.get("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    "cache_size": int(os.environ.get("SQLITE_CACHE_SIZE", "-2000")),  # KiB
+    "mmap_size": int(os.environ.get("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": os.environ.get("SQLITE_TEMP_STORE", "MEMORY"),
+}
+
+# Seconds between `PRAGMA optimize` runs per process (0 disables).
+SQLITE_OPTIMIZE_INTERVAL = int(os.environ.get("SQLITE_OPTIMIZE_INTERVAL", "3600"))
+
 DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
-        "NAME": BASE_DIR / "persistent" / "db" / "db.sqlite3",
+        "NAME": os.environ.get(
+            "DJANGO_SQLITE_PATH", BASE_DIR / "persistent" / "db" / "db.sqlite3"
+        ),
+        "CONN_MAX_AGE": int(os.environ.get("DJANGO_CONN_MAX_AGE", "600")),
+        "CONN_HEALTH_CHECKS": True,
+        "OPTIONS": {
+            "timeout": SQLITE_PRAGMAS["busy_timeout"] / 1000,
+            "transaction_mode": os.environ.get("SQLITE_TRANSACTION_MODE", "IMMEDIATE"),
+            "init_command": "".join(
+                f"PRAGMA {name}={value};" for name, value in SQLITE_PRAGMAS.items()
+            ),
+        },
     }
 }
 
 
+# Caches
+# https://docs.djangoproject.com/en/5.2/topics/cache/
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+    },
+    "sessions": {
+        "BACKEND": os.environ.get(
+            "SESSION_CACHE_BACKEND",
+            "api.filecache.FileCache",
+        ),
+        "LOCATION": os.environ.get(
+            "SESSION_CACHE_LOCATION",
+            str(BASE_DIR / "persistent" / "cache" / "sessions"),
+        ),
+        "TIMEOUT": SESSION_COOKIE_AGE,
+        "OPTIONS": {
+            "MAX_ENTRIES": int(os.environ.get("SESSION_CACHE_MAX_ENTRIES", "100000")),
+        },
+    },
+    # Shared by all workers by default; set LATEST_MESSAGES_CACHE_BACKEND to
+    # django.core.cache.backends.locmem.LocMemCache for a per-process copy.
+    "latest-messages": {
+        "BACKEND": os.environ.get(
+            "LATEST_MESSAGES_CACHE_BACKEND",
+            "django.core.cache.backends.filebased.FileBasedCache",
+        ),
+        "LOCATION": os.environ.get(
+            "LATEST_MESSAGES_CACHE_LOCATION",
+            str(BASE_DIR / "persistent" / "cache" / "latest-messages"),
+        ),
+        "TIMEOUT": None,
+    },
+}
+
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -151,6 +420,18 @@ AUTH_PASSWORD_VALIDATORS = [
 ]
 
 
+# The first hasher makes new hashes; the others still verify old ones. Each
+# algorithm must appear once, so api.hashing's PBKDF2 hasher replaces
+# Django's rather than preceding it.
+PASSWORD_HASHERS = [
+    "api.hashing.PBKDF2PasswordHasher",
+    "django.contrib.auth.hashers.PBKDF2SHA1PasswordHasher",
+    "django.contrib.auth.hashers.Argon2PasswordHasher",
+    "django.contrib.auth.hashers.BCryptSHA256PasswordHasher",
+    "django.contrib.auth.hashers.ScryptPasswordHasher",
+]
+
+
 # Internationalization
 # https://docs.djangoproject.com/en/5.2/topics/i18n/
 
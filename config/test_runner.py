@@ -0,0 +1,40 @@
+"""
+Test runner that keeps test runs out of the deployment's files.
+
+Requests made by the test client are recorded by the metrics middleware
+(see api.metrics), whose registry flushes to ``REQUEST_METRICS['DIRECTORY']``.
+The runner points the registry, and the setting, at a temporary directory
+that is removed when the run ends.
+"""
+import tempfile
+
+from django.conf import settings
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        from api import metrics
+
+        self._metrics_directory = tempfile.TemporaryDirectory(prefix='metrics-')
+        self._metrics_settings = override_settings(
+            REQUEST_METRICS={**settings.REQUEST_METRICS, 'DIRECTORY': self._metrics_directory.name}
+        )
+        self._metrics_settings.enable()
+        self._registry = metrics.registry
+        metrics.registry = metrics.MetricsRegistry(
+            self._metrics_directory.name,
+            flush_interval=self._registry.flush_interval,
+            reap_interval=self._registry.reap_interval,
+        )
+
+    def teardown_test_environment(self, **kwargs):
+        from api import metrics
+
+        metrics.registry = self._registry
+        self._metrics_settings.disable()
+        self._metrics_directory.cleanup()
+        super().teardown_test_environment(**kwargs)
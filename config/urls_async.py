@@ -0,0 +1,15 @@
+"""
+URL configuration for the ASGI deployment (selected in config/asgi.py).
+
+The hot API endpoints are served by the async views in api.async_views;
+every other URL resolves exactly as in config.urls.
+"""
+
+from django.urls import include, path
+
+from . import urls
+
+urlpatterns = [
+    path("api/", include("api.async_urls")),
+    *urls.urlpatterns,
+]
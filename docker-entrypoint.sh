@@ -6,15 +6,22 @@ echo "==> Django Pre-Start Script"
 # Remove existing database for fresh start on each deploy
 echo "==> Removing existing database..."
 if [ -f "/app/persistent/db/db.sqlite3" ]; then
-    rm -f /app/persistent/db/db.sqlite3
+    # WAL mode keeps -wal/-shm side files; a stale WAL must not be replayed
+    # into the fresh database.
+    rm -f /app/persistent/db/db.sqlite3 /app/persistent/db/db.sqlite3-wal /app/persistent/db/db.sqlite3-shm
     echo "==> Database removed successfully"
 else
     echo "==> No existing database found, creating new one"
 fi
 
+# Request metrics restart from zero with the processes that record them.
+rm -rf /app/persistent/metrics
+
 # Create persistent dirs
 /bin/mkdir -p /app/persistent/db
 /bin/mkdir -p /app/persistent/media
+/bin/mkdir -p /app/persistent/metrics
+/bin/mkdir -p /app/persistent/slow-queries
 
 # Run migrations
 echo "==> Running database migrations..."
@@ -33,6 +40,16 @@ fi
 
 /bin/chown -R appuser:appuser /app/persistent
 
+# API_SERVER=asgi serves /api/ from the ASGI server (async views) instead
+# of gunicorn; the admin stays on gunicorn either way.
+API_PORT=8001
+if [ "${API_SERVER:-wsgi}" = "asgi" ]; then
+    API_PORT=8002
+fi
+echo "==> Serving /api/ from 127.0.0.1:${API_PORT} (API_SERVER=${API_SERVER:-wsgi})"
+sed -i "s/127.0.0.1:[0-9]* fail_timeout=0;  # api-server/127.0.0.1:${API_PORT} fail_timeout=0;  # api-server/" \
+    /etc/nginx/sites-available/default
+
 echo "==> Pre-start script completed successfully!"
 
 exec /usr/bin/supervisord -c /etc/supervisor/conf.d/supervisord.conf
\ No newline at end of file
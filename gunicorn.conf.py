@@ -1,11 +1,26 @@
 """Gunicorn configuration for Docker deployment"""
 
+import os
+
 # Server socket - bind to different port for nginx upstream
 bind = "127.0.0.1:8001"
 
 # Worker processes
-workers = 2
-worker_class = "sync"
+# "gthread" parks long-poll requests (GET /api/messages/?after_id=N&wait=S) on
+# cheap threads instead of tying up a whole process each. Long-poll waiters
+# are woken through the chat broker; with the default in-memory broker only
+# the posting process is notified, so gthread runs a single process unless
+# GUNICORN_WORKERS is set (supervisord uses the relay broker and 2 workers).
+# Set GUNICORN_WORKER_CLASS=sync (and MESSAGES_LONGPOLL_MAX_WAIT=0) for the
+# classic one-request-per-process model.
+# Every thread keeps a persistent SQLite connection with its own page cache
+# (see SQLITE_PRAGMAS in config/settings.py), so threads are not free: 64
+# per process bound that memory while leaving room for long-poll waiters.
+# Deployments holding thousands of waiting clients should serve them from
+# the ASGI server, where a waiter costs no thread or connection.
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("GUNICORN_WORKERS", "1" if worker_class == "gthread" else "2"))
+threads = int(os.environ.get("GUNICORN_THREADS", "64"))
 worker_connections = 1000
 max_requests = 10000
 max_requests_jitter = 1000
@@ -16,6 +16,40 @@ export const getMessages = async (page = 1, pageSize = 20) => {
   return response.data;
 };
 
+/**
+ * Wait for messages newer than the given id (long poll)
+ * @param {number} afterId - Id of the newest message the client already has
+ * @param {number} [wait=25] - Seconds the server may hold the request open
+ * @returns {Promise} API response with new messages, newest first
+ */
+export const waitForMessages = async (afterId, wait = 25) => {
+  const response = await instance.get('/api/messages/', {
+    params: {
+      after_id: afterId,
+      wait
+    }
+  });
+  return response.data;
+};
+
+/**
+ * Get message creates, edits and deletes after a sequence number (long poll)
+ * @param {number} [since] - Seq of the last change applied; omit to get the current seq
+ * @param {number} [wait=0] - Seconds the server may hold the request open
+ * @param {string} [client=''] - Identifies this tab among the member's clients
+ * @returns {Promise} API response with the changes, oldest first
+ */
+export const getChanges = async (since, wait = 0, client = '') => {
+  const response = await instance.get('/api/messages/changes/', {
+    params: {
+      since,
+      wait,
+      client
+    }
+  });
+  return response.data;
+};
+
 /**
  * Send a new message
  * @param {string} text - Message text content
@@ -1,6 +1,6 @@
 import React, { useState, useEffect, useRef } from 'react';
 import { useNavigate } from 'react-router-dom';
-import { getMessages, sendMessage } from '../../api/messages';
+import { getChanges, getMessages, sendMessage } from '../../api/messages';
 import { getCurrentUser } from '../../api/auth';
 import './styles.css';
 
@@ -12,10 +12,12 @@ const Chat = () => {
   const [hasMore, setHasMore] = useState(true);
   const [isLoading, setIsLoading] = useState(false);
   const [isSending, setIsSending] = useState(false);
+  const [isReady, setIsReady] = useState(false);
   const messagesEndRef = useRef(null);
   const messagesContainerRef = useRef(null);
   const navigate = useNavigate();
-  const intervalRef = useRef(null);
+  const seqRef = useRef(0);
+  const clientRef = useRef(Math.random().toString(36).slice(2));
   const prevScrollHeightRef = useRef(0);
 
   // Load current user
@@ -39,20 +41,42 @@ const Chat = () => {
     }
   }, [currentUser]);
 
-  // Auto-refresh messages every 3 seconds
+  // Follow the change feed: the server holds the request until a message is
+  // created, edited or deleted, so there is no fixed refresh interval
   useEffect(() => {
-    if (currentUser) {
-      intervalRef.current = setInterval(() => {
-        loadMessages(1, true, true);
-      }, 3000);
+    if (!currentUser || !isReady) return undefined;
 
-      return () => {
-        if (intervalRef.current) {
-          clearInterval(intervalRef.current);
+    let cancelled = false;
+    const poll = async () => {
+      while (!cancelled) {
+        try {
+          const data = await getChanges(seqRef.current, 25, clientRef.current);
+          if (cancelled) break;
+          applyChanges(data.events, data.authors);
+          seqRef.current = data.seq;
+        } catch (error) {
+          if (cancelled) break;
+          console.error('Failed to load messages:', error);
+          if (error.response?.status === 401) {
+            navigate('/login');
+            break;
+          }
+          if (error.response?.status === 410) {
+            // Missed changes were compacted away: start over from the top
+            setPage(1);
+            await loadMessages(1, true);
+            continue;
+          }
+          await new Promise((resolve) => setTimeout(resolve, 3000));
         }
-      };
-    }
-  }, [currentUser, page]);
+      }
+    };
+    poll();
+
+    return () => {
+      cancelled = true;
+    };
+  }, [currentUser, isReady, navigate]);
 
   // Scroll to bottom on new messages
   const scrollToBottom = () => {
@@ -61,29 +85,53 @@ const Chat = () => {
     }
   };
 
-  const loadMessages = async (pageNum, isInitial = false, isAutoRefresh = false) => {
+  const applyChanges = (events, authors) => {
+    if (events.length === 0) return;
+    setMessages(prev => {
+      let next = prev;
+      let appended = false;
+      events.forEach((event) => {
+        if (event.op === 'deleted') {
+          next = next.filter(msg => msg.id !== event.id);
+          return;
+        }
+        const message = {
+          id: event.id,
+          text: event.text,
+          created_at: event.created_at,
+          author: authors[event.author_id]
+        };
+        if (next.some(msg => msg.id === event.id)) {
+          next = next.map(msg => (msg.id === event.id ? { ...msg, text: event.text } : msg));
+        } else if (event.op === 'created') {
+          next = [...next, message];
+          appended = true;
+        }
+      });
+      if (appended) {
+        setTimeout(scrollToBottom, 100);
+      }
+      return next;
+    });
+  };
+
+  const loadMessages = async (pageNum, isInitial = false) => {
     if (isLoading) return;
     
     setIsLoading(true);
     try {
+      if (isInitial) {
+        // Take the seq before the page, so no change falls in between
+        const { seq } = await getChanges();
+        seqRef.current = seq;
+      }
       const data = await getMessages(pageNum, 20);
       
       if (isInitial) {
         setMessages(data.results.reverse());
         setHasMore(!!data.next);
+        setIsReady(true);
         setTimeout(scrollToBottom, 100);
-      } else if (isAutoRefresh) {
-        // Only add new messages on auto-refresh
-        const newMessages = data.results.reverse();
-        setMessages(prev => {
-          const lastId = prev.length > 0 ? prev[prev.length - 1].id : 0;
-          const filtered = newMessages.filter(msg => msg.id > lastId);
-          if (filtered.length > 0) {
-            setTimeout(scrollToBottom, 100);
-            return [...prev, ...filtered];
-          }
-          return prev;
-        });
       } else {
         // Load older messages (pagination)
         const olderMessages = data.results.reverse();
@@ -108,7 +156,7 @@ const Chat = () => {
         prevScrollHeightRef.current = messagesContainerRef.current.scrollHeight;
         const nextPage = page + 1;
         setPage(nextPage);
-        loadMessages(nextPage, false, false);
+        loadMessages(nextPage, false);
       }
     }
   };